@@ -0,0 +1,189 @@
+from __future__ import print_function
+import os, time, shutil, zipfile, tempfile, argparse
+from collections import deque
+
+# Compare the wall-clock time to send a directory (from the first byte read
+# to the last file written) with the zipfile mode and the streaming tarball
+# mode at various compression levels, over an emulated link of --rate MB/s
+# (0 means as fast as the receiver can take it). Run this as e.g.:
+#
+#   python misc/bench-directory-send.py --size 64 --rate 10 --rate 100 \
+#       --rate 0 --level 0 --level 1 --level 6
+#
+# The tree holds --size MB of files, half of them compressible (text-like)
+# and half random. No sockets or encryption are involved: records go
+# straight from the sender to the unpacker, each one delayed by its share
+# of the link, with at most WINDOW bytes in flight. Levels above 0 adapt
+# (see dirstream._Adapter) unless --fixed is given. The streaming sender
+# compresses on the reactor's thread pool, so it only gains on a machine
+# with more than one core.
+
+from twisted.internet import reactor, defer
+from twisted.internet.defer import inlineCallbacks
+from wormhole.transit import _RecordPipe
+from wormhole.cli import dirstream
+
+WINDOW = 1024*1024
+FILE_SIZE = 1024*1024
+
+def make_tree(top, size):
+    os.makedirs(top)
+    words = [b"wormhole", b"magic", b"transit", b"record", b"ponies", b"\n"]
+    text = b" ".join(words[i*7 % len(words)] for i in range(FILE_SIZE))
+    for i in range(max(1, size // FILE_SIZE)):
+        with open(os.path.join(top, "%04d" % i), "wb") as f:
+            if i % 2:
+                f.write(os.urandom(FILE_SIZE))
+            else:
+                f.write(text[i:i+FILE_SIZE])
+
+class Link(_RecordPipe):
+    # both ends of an emulated network link
+    def __init__(self, rate):
+        self._init_pipe()
+        self._rate = rate
+        self._busy_until = 0
+        self._in_flight = 0
+        self._wire = deque()
+        self._producer = None
+        self._producer_paused = False
+
+    def registerProducer(self, producer, streaming):
+        self._producer = producer
+    def unregisterProducer(self):
+        self._producer = None
+
+    def send_record(self, record):
+        now = time.time()
+        if self._rate:
+            self._busy_until = max(now, self._busy_until) + len(record)/self._rate
+        else:
+            self._busy_until = now
+        self._in_flight += len(record)
+        self._wire.append(record)
+        # (timers due at the same moment may fire in any order, so each one
+        # delivers the oldest record)
+        reactor.callLater(self._busy_until - now, self._arrived)
+        if self._in_flight > WINDOW and self._producer:
+            self._producer_paused = True
+            self._producer.pauseProducing()
+
+    def _arrived(self):
+        record = self._wire.popleft()
+        self._in_flight -= len(record)
+        self.recordReceived(record)
+        if (self._producer_paused and self._in_flight <= WINDOW//2
+            and self._producer):
+            self._producer_paused = False
+            self._producer.resumeProducing()
+
+    # the unpacker can't slow the link down (it stays well ahead)
+    def pauseProducing(self):
+        pass
+    def resumeProducing(self):
+        pass
+    def stopProducing(self):
+        pass
+
+class FileSender:
+    # just enough of a push producer to send the zipfile
+    def __init__(self, f, link):
+        self._f = f
+        self._link = link
+        self._paused = False
+        self.deferred = defer.Deferred()
+        link.registerProducer(self, True)
+        reactor.callLater(0, self.resumeProducing)
+    def pauseProducing(self):
+        self._paused = True
+    def resumeProducing(self):
+        self._paused = False
+        while not self._paused and self.deferred:
+            data = self._f.read(256*1024)
+            if not data:
+                self._link.unregisterProducer()
+                d, self.deferred = self.deferred, None
+                d.callback(None)
+                return
+            self._link.send_record(data)
+    def stopProducing(self):
+        pass
+
+@inlineCallbacks
+def send_zipfile(top, dest, rate):
+    link = Link(rate)
+    f = tempfile.SpooledTemporaryFile()
+    with zipfile.ZipFile(f, "w", zipfile.ZIP_DEFLATED) as zf:
+        for fn in sorted(os.listdir(top)):
+            zf.write(os.path.join(top, fn), fn)
+    size = f.tell()
+    f.seek(0)
+    received = tempfile.SpooledTemporaryFile()
+    class Consumer:
+        def registerProducer(self, producer, streaming):
+            pass
+        def unregisterProducer(self):
+            pass
+        def write(self, data):
+            received.write(data)
+    d = link.connectConsumer(Consumer(), size)
+    yield FileSender(f, link).deferred
+    yield d
+    received.seek(0)
+    with zipfile.ZipFile(received, "r") as zf:
+        zf.extractall(dest)
+    defer.returnValue(size)
+
+@inlineCallbacks
+def send_stream(top, dest, rate, level, fixed):
+    link = Link(rate)
+    entries, _, _ = dirstream.walk(top)
+    ds = dirstream.DirectorySender(entries, level=level)
+    if level and fixed:
+        ds._adapter.level = lambda: level
+    du = dirstream.DirectoryUnpacker(dest, mode=ds.mode())
+    unpacked = du.unpack(link)
+    size = yield ds.beginTransfer(link)
+    yield unpacked
+    defer.returnValue(size)
+
+@inlineCallbacks
+def main(args):
+    workdir = tempfile.mkdtemp()
+    try:
+        top = os.path.join(workdir, "src")
+        make_tree(top, args.size*1000*1000)
+        for rate in (args.rate or [0]):
+            runs = [("zipfile", lambda dest: send_zipfile(top, dest,
+                                                          rate*1e6))]
+            for level in (args.level or [0, 1, 6]):
+                runs.append(("stream level=%d" % level,
+                             lambda dest, level=level:
+                             send_stream(top, dest, rate*1e6, level,
+                                         args.fixed)))
+            for name, run in runs:
+                dest = os.path.join(workdir, "dest")
+                start = time.time()
+                size = yield run(dest)
+                elapsed = time.time() - start
+                shutil.rmtree(dest)
+                print("rate=%-5s %-16s: %6.1f MB sent in %6.2fs"
+                      % (rate or "inf", name, size/1e6, elapsed))
+    finally:
+        shutil.rmtree(workdir)
+
+if __name__ == "__main__":
+    p = argparse.ArgumentParser()
+    p.add_argument("--size", type=int, default=64,
+                   help="megabytes in the directory")
+    p.add_argument("--rate", type=float, action="append",
+                   help="link speed in MB/s, 0 for unlimited (repeatable)")
+    p.add_argument("--level", type=int, action="append",
+                   help="compression level to try (repeatable)")
+    p.add_argument("--fixed", action="store_true",
+                   help="don't let the level adapt to the link")
+    args = p.parse_args()
+    d = main(args)
+    d.addErrback(lambda f: f.printTraceback())
+    d.addBoth(lambda _: reactor.stop())
+    reactor.run()
@@ -0,0 +1,96 @@
+from __future__ import print_function
+import os, sys, time
+from binascii import hexlify
+
+# Measure how many relay handshakes per second the transit server can accept
+# on one core. Run this as:
+#
+#   python misc/bench-transit-handshakes.py [NUM_PAIRS] [CONCURRENCY]
+#
+# It runs a Transit relay and a storm of clients in a single process (so the
+# client work is included in the figure), connects NUM_PAIRS pairs of
+# connections over loopback, and waits for every one of them to see "ok\n".
+# It also reports the cost of the handshake parser alone, driven without
+# sockets.
+
+from twisted.internet import reactor, protocol, endpoints, defer
+from twisted.test import proto_helpers
+from wormhole.server.database import get_db
+from wormhole.server.transit_server import Transit
+
+num_pairs = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+concurrency = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+
+def handshake(i):
+    token = os.urandom(28) + (b"%04d" % (i % 10000))
+    return b"please relay " + hexlify(token) + b"\n"
+
+def bench_parser():
+    t = Transit(get_db(":memory:"), None)
+    protocols = []
+    for i in range(num_pairs):
+        p = t.buildProtocol(None)
+        p.makeConnection(proto_helpers.StringTransport())
+        protocols.append((p, handshake(i)))
+    start = time.time()
+    for p, hs in protocols:
+        p.dataReceived(hs)
+    elapsed = time.time() - start
+    t.stopService()
+    print("parser only: %d handshakes in %.3fs: %d/s"
+          % (num_pairs, elapsed, num_pairs / elapsed))
+
+class Client(protocol.Protocol):
+    def __init__(self, hs, done):
+        self._hs = hs
+        self._done = done
+        self._buf = b""
+    def connectionMade(self):
+        self.transport.write(self._hs)
+    def dataReceived(self, data):
+        self._buf += data
+        if self._buf.startswith(b"ok\n"):
+            self.transport.loseConnection()
+    def connectionLost(self, why):
+        self._done.callback(self._buf.startswith(b"ok\n"))
+
+@defer.inlineCallbacks
+def bench_tcp():
+    t = Transit(get_db(":memory:"), None)
+    t.startService()
+    ep = endpoints.serverFromString(reactor, "tcp:0:interface=127.0.0.1")
+    port = yield ep.listen(t)
+    client_ep = endpoints.TCP4ClientEndpoint(reactor, "127.0.0.1",
+                                             port.getHost().port)
+    pairs = iter(range(num_pairs))
+    results = []
+
+    @defer.inlineCallbacks
+    def worker():
+        for i in pairs:
+            hs = handshake(i)
+            ds = [defer.Deferred(), defer.Deferred()]
+            for d in ds:
+                yield endpoints.connectProtocol(client_ep, Client(hs, d))
+            ok = yield defer.gatherResults(ds)
+            results.extend(ok)
+
+    start = time.time()
+    yield defer.gatherResults([worker()
+                               for _ in range(min(concurrency, num_pairs))])
+    elapsed = time.time() - start
+    yield port.stopListening()
+    t.stopService()
+    print("tcp storm: %d handshakes (%d ok) in %.3fs: %d/s"
+          % (len(results), results.count(True), elapsed,
+             len(results) / elapsed))
+
+def main():
+    bench_parser()
+    d = bench_tcp()
+    d.addErrback(lambda f: f.printTraceback())
+    d.addBoth(lambda _: reactor.stop())
+    reactor.run()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+from __future__ import print_function
+import sys, time
+
+# Measure the cost of Transit record framing and encryption on one core,
+# without sockets, for a range of record sizes. Run this as:
+#
+#   python misc/bench-transit-records.py [TOTAL_MB]
+#
+# For each record size it sends TOTAL_MB (default 64) worth of records
+# through Connection.send_record (encrypt and frame), then feeds the framed
+# stream back into Connection.dataReceived in 64KiB reads (as TCP would
+# deliver it) to deframe and decrypt it, and reports records/s and MB/s for
+# each direction.
+
+from twisted.test import proto_helpers
+from nacl.secret import SecretBox
+from wormhole import transit
+
+total = int(sys.argv[1]) * 1000 * 1000 if len(sys.argv) > 1 else 64*1000*1000
+READ_SIZE = 64*1024
+KEY = b"k"*SecretBox.KEY_SIZE
+
+class Counter(transit.Connection):
+    def __init__(self):
+        transit.Connection.__init__(self, None, None, 0, "bench")
+        self.state = "records"
+        self.send_box = self.receive_box = SecretBox(KEY)
+        self.send_nonce = self.next_receive_nonce = 0
+        self.received = 0
+    def recordReceived(self, record):
+        self.received += 1
+
+def bench(size):
+    count = max(1, total // size)
+    record = b"\x00" * size
+
+    sender = Counter()
+    t = proto_helpers.StringTransport()
+    sender.transport = t
+    start = time.time()
+    for i in range(count):
+        sender.send_record(record)
+    send_elapsed = time.time() - start
+    stream = t.value()
+
+    receiver = Counter()
+    start = time.time()
+    for offset in range(0, len(stream), READ_SIZE):
+        receiver.dataReceived(stream[offset:offset+READ_SIZE])
+    receive_elapsed = time.time() - start
+    assert receiver.received == count, (receiver.received, count)
+
+    for name, elapsed in [("send", send_elapsed),
+                          ("receive", receive_elapsed)]:
+        print("%7d-byte records, %-7s: %8d records/s %8.1f MB/s"
+              % (size, name, count / elapsed, count*size / 1e6 / elapsed))
+
+def main():
+    for size in [1024, 4096, 16384, 65536, 262144, 1024*1024]:
+        bench(size)
+
+if __name__ == "__main__":
+    main()
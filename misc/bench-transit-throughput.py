@@ -0,0 +1,163 @@
+from __future__ import print_function
+import io, time, argparse, hashlib
+
+# Measure Transit throughput over loopback, optionally through a delay line
+# that emulates a long-haul link, for a range of transit socket buffer sizes
+# and numbers of parallel streams. Run this as e.g.:
+#
+#   python misc/bench-transit-throughput.py --delay 20 --size 64 \
+#       --buffer 0 --buffer 1048576 --buffer 4194304 --streams 1 --streams 4
+#
+# (a --buffer of 0 means "leave SO_SNDBUF/SO_RCVBUF to the kernel"). With
+# --threads, the file is sent with ThreadedFileSender and received with
+# writeToFile(threads=True), both hashing with SHA-256 as 'wormhole send'
+# does, instead of with FileProducer and FileConsumer on the reactor. On an
+# unloaded LAN (--delay 0) this is the number to compare.
+#
+# If you can use 'tc qdisc add dev lo root netem delay 20ms', do that and run
+# with --delay 0 for the most realistic numbers. Otherwise the userspace
+# delay line holds every chunk for --delay milliseconds in each direction,
+# and caps the bytes in flight at the SO_RCVBUF of its (tuned) accepting
+# socket, which stands in for the TCP window. It cannot see the kernel's
+# auto-tuning, so it understates the untuned case on modern kernels.
+
+from twisted.internet import reactor, protocol, endpoints, defer
+from twisted.internet.defer import inlineCallbacks
+import socket
+from wormhole.transit import (TransitSender, TransitReceiver, FileProducer,
+                              ThreadedFileSender)
+from wormhole.sockopts import socket_options, tune_transport
+
+class NullFile:
+    def write(self, data):
+        pass
+
+class DelayPipe(protocol.Protocol):
+    def __init__(self, delay, options):
+        self._delay = delay
+        self._options = options
+        self._peer = None
+        self._queued = []
+        self._in_flight = 0
+        self._paused = False
+
+    def connectionMade(self):
+        tune_transport(self.transport, self._options)
+        sock = self.transport.getHandle()
+        self._window = sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)
+
+    def set_peer(self, peer):
+        self._peer = peer
+        for data in self._queued:
+            peer.transport.write(data)
+        self._queued = []
+
+    def dataReceived(self, data):
+        self._in_flight += len(data)
+        reactor.callLater(self._delay, self._deliver, data)
+        if self._in_flight >= self._window and not self._paused:
+            self._paused = True
+            self.transport.pauseProducing()
+
+    def _deliver(self, data):
+        self._in_flight -= len(data)
+        if self._peer:
+            self._peer.transport.write(data)
+        else:
+            self._queued.append(data)
+        if self._paused and self._in_flight < self._window:
+            self._paused = False
+            self.transport.resumeProducing()
+
+    def connectionLost(self, why):
+        if self._peer:
+            reactor.callLater(self._delay, self._peer.transport.loseConnection)
+
+class DelayLine(protocol.Factory):
+    def __init__(self, delay, options, target_port):
+        self._delay = delay
+        self._options = options
+        self._target = endpoints.TCP4ClientEndpoint(reactor, "127.0.0.1",
+                                                    target_port)
+
+    def buildProtocol(self, addr):
+        upstream = DelayPipe(self._delay, self._options)
+        downstream = DelayPipe(self._delay, self._options)
+        d = endpoints.connectProtocol(self._target, downstream)
+        def _connected(_):
+            upstream.set_peer(downstream)
+            downstream.set_peer(upstream)
+        d.addCallback(_connected)
+        return upstream
+
+@inlineCallbacks
+def run_one(size, delay, buffer_size, streams, threads):
+    options = socket_options(buffer_size or None)
+    s = TransitSender(u"", socket_options=options, streams=streams)
+    r = TransitReceiver(u"", no_listen=True, socket_options=options,
+                        streams=streams)
+    s.add_connection_abilities(r.get_connection_abilities())
+    r.add_connection_abilities(s.get_connection_abilities())
+    key = b"k"*32
+    s.set_transit_key(key)
+    r.set_transit_key(key)
+    hints = yield s.get_connection_hints()
+    yield r.get_connection_hints() # (no_listen=True, so this is empty)
+    port = hints[0][u"port"]
+    if delay:
+        proxy_ep = endpoints.serverFromString(reactor,
+                                              "tcp:0:interface=127.0.0.1")
+        proxy = yield proxy_ep.listen(DelayLine(delay, options, port))
+        port = proxy.getHost().port
+    r.add_connection_hints([{u"type": u"direct-tcp-v1",
+                             u"hostname": u"127.0.0.1", u"port": port}])
+    s_rp, r_rp = yield defer.gatherResults([s.connect(), r.connect()], True)
+
+    f = io.BytesIO(b"\x00"*size)
+    s_hasher = hashlib.sha256()
+    r_hasher = hashlib.sha256()
+    start = time.time()
+    done_d = r_rp.writeToFile(NullFile(), size, hasher=r_hasher.update,
+                              threads=threads)
+    if threads:
+        yield ThreadedFileSender().beginFileTransfer(f, s_rp,
+                                                     hasher=s_hasher.update)
+    else:
+        def _hash(data):
+            s_hasher.update(data)
+            return data
+        yield FileProducer().beginFileTransfer(f, s_rp, transform=_hash)
+    yield done_d
+    elapsed = time.time() - start
+    s_rp.close()
+    r_rp.close()
+    if delay:
+        yield proxy.stopListening()
+    assert s_hasher.digest() == r_hasher.digest()
+    print("buffer=%-9s delay=%3dms streams=%d threads=%-5s: %d MB in %.2fs:"
+          " %.1f MB/s" % (buffer_size or "auto", delay*1000, streams, threads,
+                          size/1e6, elapsed, size/1e6/elapsed))
+
+@inlineCallbacks
+def main(args):
+    for buffer_size in (args.buffer or [0]):
+        for streams in (args.streams or [1]):
+            yield run_one(args.size*1000*1000, args.delay/1000.0,
+                          buffer_size, streams, args.threads)
+
+if __name__ == "__main__":
+    p = argparse.ArgumentParser()
+    p.add_argument("--delay", type=float, default=20,
+                   help="one-way delay in milliseconds (0 for none)")
+    p.add_argument("--size", type=int, default=64, help="megabytes to send")
+    p.add_argument("--buffer", type=int, action="append",
+                   help="socket buffer size to try (repeatable)")
+    p.add_argument("--streams", type=int, action="append",
+                   help="number of parallel streams to try (repeatable)")
+    p.add_argument("--threads", action="store_true",
+                   help="encrypt, decrypt and hash on the thread pool")
+    args = p.parse_args()
+    d = main(args)
+    d.addErrback(lambda f: f.printTraceback())
+    d.addBoth(lambda _: reactor.stop())
+    reactor.run()
@@ -38,6 +38,7 @@ setup(name="magic-wormhole",
       extras_require={
           ':sys_platform=="win32"': ["pypiwin32"],
           "tor": ["txtorcon", "ipaddress"],
+          "compression": ["zstandard", "lz4"],
           "dev": [
               "mock",
               "tox",
@@ -0,0 +1,115 @@
+from __future__ import print_function, unicode_literals
+import os, mmap, errno
+try:
+    import fcntl
+except ImportError:
+    fcntl = None # Windows, which has no O_DIRECT either
+from twisted.python import log
+
+# Disk space for the receiver. We know how big the file (or zipfile) will
+# be before the first byte arrives, so we check that the destination has
+# room before asking the user, and reserve all of it (posix_fallocate) as
+# soon as the file is open: a full disk is reported before the transfer
+# starts instead of after most of it, and the filesystem can lay the file
+# out in one piece. Everything is written next to its final name, so
+# renaming it into place never copies it across filesystems.
+#
+# DirectWriter is for multi-GB files, which would otherwise push everything
+# else out of the page cache: it gathers writes into large, page-aligned
+# blocks and writes those with O_DIRECT (Linux and most BSDs), straight to
+# the disk.
+
+DIRECT_THRESHOLD = 1024*1024*1024 # files smaller than this use the cache
+
+def free_space(directory):
+    """Return the bytes available to us in 'directory', or None if we can't
+    tell."""
+    if not hasattr(os, "statvfs"): # Windows
+        return None
+    try:
+        st = os.statvfs(directory)
+    except EnvironmentError:
+        return None
+    return st.f_bavail * st.f_frsize
+
+def preallocate(f, size):
+    """Reserve 'size' bytes on disk for the open file 'f', which also makes
+    it at least that long. Raises EnvironmentError (with errno ENOSPC) if
+    there isn't room. Returns False if this platform or filesystem can't do
+    it, which is harmless."""
+    if not size or not hasattr(os, "posix_fallocate"):
+        return False
+    try:
+        os.posix_fallocate(f.fileno(), 0, size)
+    except EnvironmentError as e:
+        if e.errno == errno.ENOSPC:
+            raise
+        # e.g. EOPNOTSUPP
+        log.msg("unable to preallocate %s: %s" % (f.name, e))
+        return False
+    return True
+
+class DirectWriter:
+    """A file opened for writing with O_DIRECT. write() takes any amount of
+    data: it is written in aligned blocks of BLOCK_SIZE, and close() writes
+    the remainder normally."""
+    BLOCK_SIZE = 8*1024*1024
+
+    def __init__(self, path, block_size=None):
+        self.name = path
+        self._block_size = block_size or self.BLOCK_SIZE
+        self._fd = os.open(path,
+                           os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_DIRECT,
+                           0o666)
+        # anonymous maps are page-aligned, as O_DIRECT wants
+        self._buffer = mmap.mmap(-1, self._block_size)
+        self._used = 0
+
+    def fileno(self):
+        return self._fd
+
+    def write(self, data):
+        data = memoryview(data)
+        while len(data):
+            n = min(len(data), self._block_size - self._used)
+            self._buffer[self._used:self._used+n] = data[:n]
+            self._used += n
+            data = data[n:]
+            if self._used == self._block_size:
+                self._write(self._buffer)
+                self._used = 0
+
+    def _write(self, block):
+        view = memoryview(block)
+        while len(view):
+            view = view[os.write(self._fd, view):]
+
+    def close(self):
+        if self._fd is None:
+            return
+        if self._used:
+            # the tail isn't a whole block, so it can't go direct
+            flags = fcntl.fcntl(self._fd, fcntl.F_GETFL)
+            fcntl.fcntl(self._fd, fcntl.F_SETFL, flags & ~os.O_DIRECT)
+            self._write(self._buffer[:self._used])
+        os.close(self._fd)
+        self._fd = None
+        self._buffer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def open_direct(path):
+    """Open 'path' for writing with a DirectWriter, or as a normal file if
+    this platform or filesystem doesn't do O_DIRECT."""
+    if hasattr(os, "O_DIRECT"):
+        try:
+            return DirectWriter(path)
+        except EnvironmentError as e:
+            if e.errno != errno.EINVAL: # e.g. tmpfs
+                raise
+            log.msg("unable to use O_DIRECT for %s: %s" % (path, e))
+    return open(path, "wb")
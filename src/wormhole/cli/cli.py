@@ -146,11 +146,40 @@ CommonArgs = _compose(
     click.option("--tor", is_flag=True, default=False,
                  help="use Tor when connecting",
                  ),
+    click.option("--transit-socket-buffer", default=None, type=int,
+                 metavar="BYTES",
+                 help="(advanced) SO_SNDBUF/SO_RCVBUF for Transit sockets",
+                 ),
+    click.option("--transit-streams", default=1, type=int, metavar="N",
+                 help=("(advanced) stripe the transfer across up to N"
+                       " connections, if the other side allows it too"),
+                 ),
+    click.option("--connection-cache", metavar="FILENAME", default=None,
+                 help=("where to remember which of the other side's"
+                       " addresses answered, to try those first next time"
+                       " (default: ~/.cache/magic-wormhole/connections.json)"),
+                 ),
+)
+
+# options for the commands that send files
+SendArgs = _compose(
+    click.option("--dedup", is_flag=True, default=False,
+                 help=("send a directory in chunks, each of which is sent"
+                       " only once, and not at all if the receiver already"
+                       " has it from an earlier transfer (the receiver needs"
+                       " a version that supports this)"),
+                 ),
+    click.option("--mmap", "use_mmap", is_flag=True, default=False,
+                 help=("(advanced) map files into memory to send them,"
+                       " which is a little faster, but crashes if a file"
+                       " is truncated while it is being sent"),
+                 ),
 )
 
 # wormhole send (or "wormhole tx")
 @wormhole.command()
 @CommonArgs
+@SendArgs
 @click.option(
     "--code", metavar="CODE",
     help="human-generated code phrase",
@@ -159,12 +188,46 @@ CommonArgs = _compose(
     "--text", default=None, metavar="MESSAGE",
     help="text message to send, instead of a file. Use '-' to read from stdin.",
 )
-@click.argument("what", required=False)
+@click.option(
+    "--resumable", is_flag=True, default=False,
+    help=("hash the file in chunks before sending, so an interrupted"
+          " transfer can be resumed by sending it again"),
+)
+@click.option(
+    "--stream", is_flag=True, default=False,
+    help=("send a directory as a tarball that is compressed while it is"
+          " sent, instead of building a zipfile first (the receiver needs"
+          " a version that supports this)"),
+)
+@click.option(
+    "--delta", is_flag=True, default=False,
+    help=("send a directory as changes to the copy the receiver already"
+          " has, like rsync: only changed parts of changed files are sent"
+          " (the receiver needs a version that supports this)"),
+)
+@click.option(
+    "--compress-level", default=6, type=click.IntRange(0, 9), metavar="0-9",
+    help=("how hard to compress directories, from 0 (don't: store) to 9"
+          " (with --stream, compression stops by itself if it is slowing"
+          " the transfer down; zipfiles use 1-9 from python 3.7, and"
+          " always level 6 before that). Above 0, files and directories"
+          " are also compressed on the wire if the receiver supports it."),
+)
+@click.option(
+    "--hash-cache", metavar="FILENAME", default=None,
+    help=("where to remember what was learned by reading files, so files"
+          " that haven't changed needn't be read again to send them"
+          " (default: ~/.cache/magic-wormhole/hashes.sqlite)"),
+)
+@click.argument("what", nargs=-1)
 @click.pass_obj
-def send(cfg, **kwargs):
-    """Send a text message, file, or directory"""
+def send(cfg, what, **kwargs):
+    """Send a text message, file, or directory (or several files)"""
     for name, value in kwargs.items():
         setattr(cfg, name, value)
+    # one thing is sent as before, several files go together
+    cfg.what = what[0] if len(what) == 1 else None
+    cfg.batch = list(what) if len(what) > 1 else []
     with cfg.timing.add("import", which="cmd_send"):
         from . import cmd_send
 
@@ -188,12 +251,35 @@ def go(f, cfg):
     "--accept-file", is_flag=True,
     help="accept file transfer without asking for confirmation",
 )
+@click.option(
+    "--update", is_flag=True, default=False,
+    help=("let a directory sent with --delta update the directory of the"
+          " same name that is already here, replacing the files that differ"
+          " (you are asked first, unless --accept-file)"),
+)
 @click.option(
     "--output-file", "-o",
     metavar="FILENAME|DIRNAME",
     help=("The file or directory to create, overriding the name suggested"
           " by the sender."),
 )
+@click.option(
+    "--direct-io", is_flag=True,
+    help=("write files of 1GB or more with O_DIRECT, bypassing the page"
+          " cache"),
+)
+@click.option(
+    "--chunk-cache", metavar="DIRNAME", default=None,
+    help=("where to keep chunks of directories sent with --dedup, to"
+          " avoid receiving them again (default:"
+          " ~/.cache/magic-wormhole/chunks)"),
+)
+@click.option(
+    "--chunk-cache-size", default=1024, type=click.IntRange(0, None),
+    metavar="MB",
+    help=("the most space the chunk cache may take, dropping the chunks"
+          " used longest ago (default: 1024; 0 keeps no chunks)"),
+)
 @click.argument(
     "code", nargs=-1, default=None,
 #    help=("The magic-wormhole code, from the sender. If omitted, the"
@@ -222,6 +308,39 @@ def receive(cfg, code, **kwargs):
     return go(cmd_receive.receive, cfg)
 
 
+# wormhole session
+@wormhole.command()
+@CommonArgs
+@SendArgs
+@click.option(
+    "--compress-level", default=6, type=click.IntRange(0, 9), metavar="0-9",
+    help=("compress files on the wire if the other side supports it, from"
+          " 0 (don't) to 9"),
+)
+@click.argument("code", nargs=-1, default=None)
+@click.pass_obj
+def session(cfg, code, **kwargs):
+    """
+    Keep a wormhole open, to send files both ways
+
+    Each line of input names a file to send to the other side, and files
+    they send are written to the current directory. The session ends when
+    both sides have reached the end of their input.
+    """
+    for name, value in kwargs.items():
+        setattr(cfg, name, value)
+    if len(code) > 1:
+        print(
+            "Pass either no code or just one code; you passed"
+            " {}: {}".format(len(code), ', '.join(code))
+        )
+        raise SystemExit(1)
+    cfg.code = code[0] if code else None
+    with cfg.timing.add("import", which="cmd_session"):
+        from . import cmd_session
+
+    return go(cmd_session.session, cfg)
+
 @wormhole.group()
 def ssh():
     """
@@ -1,14 +1,23 @@
 from __future__ import print_function
-import os, sys, six, tempfile, zipfile, hashlib
+import os, sys, six, errno, tempfile, zipfile, hashlib
 from tqdm import tqdm
 from humanize import naturalsize
-from twisted.internet import reactor
+from twisted.internet import reactor, threads
 from twisted.internet.defer import inlineCallbacks, returnValue
 from twisted.python import log
 from ..wormhole import wormhole
-from ..transit import TransitReceiver
+from ..transit import TransitReceiver, threads_are_useful
+from ..sockopts import socket_options
+from .. import conncache
 from ..errors import TransferError, WormholeClosedError
 from ..util import dict_to_bytes, bytes_to_dict, bytes_to_hexstr
+from .resume import Journal, parse_manifest
+from .dirstream import STREAM_MODES, DirectoryUnpacker
+from .delta import DELTA_MODE, INDEX, DeltaUnpacker
+from .dedup import DEDUP_MODE, ChunkCache, DedupUnpacker, default_cache_dir
+from . import compression, unzip
+from .allocate import (DIRECT_THRESHOLD, free_space, preallocate,
+                       open_direct)
 
 APPID = u"lothar.com/wormhole/text-or-file-xfer"
 
@@ -38,6 +47,10 @@ class TwistedReceiver:
         self._reactor = reactor
         self._tor_manager = None
         self._transit_receiver = None
+        self._journal = None
+        self._resume_from = 0
+        self._codec = None
+        self._batch_accept = None
 
     def _msg(self, *args, **kwargs):
         print(*args, file=self.args.stdout, **kwargs)
@@ -149,11 +162,17 @@ class TwistedReceiver:
                              no_listen=(not self.args.listen),
                              tor_manager=self._tor_manager,
                              reactor=self._reactor,
-                             timing=self.args.timing)
+                             timing=self.args.timing,
+                             socket_options=socket_options(
+                                 self.args.transit_socket_buffer),
+                             streams=self.args.transit_streams,
+                             connection_cache=conncache.open_cache(
+                                 self.args.connection_cache))
         self._transit_receiver = tr
         transit_key = w.derive_key(APPID+u"/transit-key", tr.TRANSIT_KEY_LENGTH)
         tr.set_transit_key(transit_key)
 
+        tr.add_connection_abilities(sender_transit.get("abilities-v1", []))
         tr.add_connection_hints(sender_transit.get("hints-v1", []))
         receiver_abilities = tr.get_connection_abilities()
         receiver_hints = yield tr.get_connection_hints()
@@ -170,18 +189,45 @@ class TwistedReceiver:
             returnValue(None)
         # transit will be created by this point, but not connected
         if "file" in them_d:
-            f = self._handle_file(them_d)
+            f = yield self._handle_file(them_d)
             self._send_permission(w)
             rp = yield self._establish_transit()
             datahash = yield self._transfer_data(rp, f)
             self._write_file(f)
             yield self._close_transit(rp, datahash)
+        elif ("directory" in them_d and
+              them_d["directory"].get("mode") == DELTA_MODE):
+            self._handle_directory_delta(them_d)
+            self._send_permission(w)
+            rp = yield self._establish_transit()
+            datahash = yield self._receive_delta(rp)
+            yield self._close_transit(rp, datahash)
+        elif ("directory" in them_d and
+              them_d["directory"].get("mode") == DEDUP_MODE):
+            self._handle_directory_stream(them_d)
+            self._send_permission(w)
+            rp = yield self._establish_transit()
+            datahash = yield self._receive_dedup(rp)
+            yield self._close_transit(rp, datahash)
+        elif ("directory" in them_d and
+              them_d["directory"].get("mode") in STREAM_MODES):
+            self._handle_directory_stream(them_d)
+            self._send_permission(w)
+            rp = yield self._establish_transit()
+            datahash = yield self._unpack_directory_stream(rp)
+            yield self._close_transit(rp, datahash)
         elif "directory" in them_d:
             f = self._handle_directory(them_d)
             self._send_permission(w)
             rp = yield self._establish_transit()
             datahash = yield self._transfer_data(rp, f)
-            self._write_directory(f)
+            yield self._write_directory(f)
+            yield self._close_transit(rp, datahash)
+        elif "files" in them_d:
+            files = self._handle_batch(them_d)
+            self._send_permission(w)
+            rp = yield self._establish_transit()
+            datahash = yield self._receive_batch(rp, files)
             yield self._close_transit(rp, datahash)
         else:
             self._msg(u"I don't know what they're offering\n")
@@ -193,16 +239,44 @@ class TwistedReceiver:
         self._msg(them_d["message"])
         self._send_data({"answer": {"message_ack": "ok"}}, w)
 
+    @inlineCallbacks
     def _handle_file(self, them_d):
         file_data = them_d["file"]
         self.abs_destname = self._decide_destname("file",
                                                   file_data["filename"])
         self.xfersize = file_data["filesize"]
+        self._codec = compression.choose(file_data.get("compression-v1"))
 
         self._msg(u"Receiving file (%s) into: %s" %
                   (naturalsize(self.xfersize), os.path.basename(self.abs_destname)))
-        self._ask_permission()
         tmp_destname = self.abs_destname + ".tmp"
+        needed = self.xfersize
+        if os.path.exists(tmp_destname):
+            # we'll overwrite (or resume) that
+            needed -= os.path.getsize(tmp_destname)
+        self._check_space(needed)
+        self._ask_permission()
+        if "chunks-v1" not in file_data:
+            returnValue(self._reserve(self._open_tmp(tmp_destname)))
+        try:
+            chunk_size, hashes = parse_manifest(file_data["chunks-v1"],
+                                                self.xfersize)
+        except ValueError as e:
+            log.msg("ignoring bad chunk manifest: %s" % (e,))
+            returnValue(self._reserve(self._open_tmp(tmp_destname)))
+        # the sender can resume: pick up where an earlier attempt left off
+        self._journal = Journal(tmp_destname, self.xfersize, chunk_size,
+                                hashes)
+        self._resume_from = yield threads.deferToThreadPool(
+            self._reactor, self._reactor.getThreadPool(),
+            self._journal.resume_point)
+        if self._resume_from:
+            self._msg(u"Resuming at %s" % naturalsize(self._resume_from))
+        returnValue(self._reserve(self._journal.open()))
+
+    def _open_tmp(self, tmp_destname):
+        if self.args.direct_io and self.xfersize >= DIRECT_THRESHOLD:
+            return open_direct(tmp_destname)
         return open(tmp_destname, "wb")
 
     def _handle_directory(self, them_d):
@@ -214,15 +288,105 @@ class TwistedReceiver:
         self.abs_destname = self._decide_destname("directory",
                                                   file_data["dirname"])
         self.xfersize = file_data["zipsize"]
+        self._codec = compression.choose(file_data.get("compression-v1"))
 
         self._msg(u"Receiving directory (%s) into: %s/" %
                   (naturalsize(self.xfersize), os.path.basename(self.abs_destname)))
         self._msg(u"%d files, %s (uncompressed)" %
                   (file_data["numfiles"], naturalsize(file_data["numbytes"])))
+        # the zipfile and what we unpack from it
+        self._check_space(self.xfersize + file_data["numbytes"])
+        self._ask_permission()
+        # (next to where it will be unpacked, rather than in /tmp)
+        f = tempfile.TemporaryFile(dir=os.path.dirname(self.abs_destname))
+        return self._reserve(f)
+
+    def _handle_directory_stream(self, them_d):
+        file_data = them_d["directory"]
+        self.abs_destname = self._decide_destname("directory",
+                                                  file_data["dirname"])
+        self.xfersize = file_data["numbytes"]
+        self._dir_mode = file_data["mode"]
+        self._codec = compression.choose(file_data.get("compression-v1"))
+        self._msg(u"Receiving directory (%s) into: %s/" %
+                  (naturalsize(self.xfersize),
+                   os.path.basename(self.abs_destname)))
+        self._msg(u"%d files, %s (uncompressed)" %
+                  (file_data["numfiles"], naturalsize(file_data["numbytes"])))
+        self._check_space(self.xfersize)
         self._ask_permission()
-        return tempfile.SpooledTemporaryFile()
 
-    def _decide_destname(self, mode, destname):
+    def _handle_directory_delta(self, them_d):
+        file_data = them_d["directory"]
+        # this one can update a directory we already have, but only if the
+        # receiver asked for that: the sender picks the name
+        self.abs_destname = self._decide_destname("directory",
+                                                  file_data["dirname"],
+                                                  update=self.args.update)
+        self.xfersize = file_data["numbytes"]
+        self._codec = compression.choose(file_data.get("compression-v1"))
+        verb = u"Receiving"
+        updating = os.path.isdir(self.abs_destname)
+        if updating:
+            verb = u"Updating"
+        self._msg(u"%s directory (%s) into: %s/" %
+                  (verb, naturalsize(self.xfersize),
+                   os.path.basename(self.abs_destname)))
+        self._msg(u"%d files, %s (uncompressed)" %
+                  (file_data["numfiles"], naturalsize(file_data["numbytes"])))
+        if updating:
+            # we only learn which files those are from the listing, and
+            # ask again then
+            self._msg(u"Files that are already there and differ will be"
+                      u" replaced")
+        self._check_space(self.xfersize)
+        self._ask_permission()
+
+    def _handle_batch(self, them_d):
+        # several files: we can take any of them, and they arrive one after
+        # the other
+        batch = them_d["files"]
+        entries = batch["files"]
+        self._codec = compression.choose(batch.get("compression-v1"))
+        dest_dir = self.args.cwd
+        if self.args.output_file:
+            # that names the directory to put them in
+            dest_dir = os.path.join(dest_dir, self.args.output_file)
+        dest_dir = os.path.abspath(dest_dir)
+        self._msg(u"Receiving %d files (%s) into: %s/" %
+                  (len(entries), naturalsize(batch["numbytes"]),
+                   os.path.basename(dest_dir)))
+        files = []
+        self._batch_accept = []
+        with self.args.timing.add("permission", waiting="user"):
+            for i, entry in enumerate(entries):
+                # as with single files, the sender only picks the basename
+                filename = os.path.basename(entry["filename"])
+                filesize = entry["filesize"]
+                if not isinstance(filesize, six.integer_types) or filesize < 0:
+                    raise RespondError("bad file size")
+                path = os.path.join(dest_dir, filename)
+                if (not filename or os.path.exists(path)
+                    or path in [f[0] for f in files]):
+                    self._msg(u"Skipping '%s': it already exists" % filename)
+                    continue
+                if not self.args.accept_file:
+                    ok = six.moves.input("Receive '%s' (%s)? (y/n): "
+                                         % (filename, naturalsize(filesize)))
+                    if not ok.lower().startswith("y"):
+                        continue
+                files.append((path, filesize))
+                self._batch_accept.append(i)
+        if not files:
+            self._msg(u"No files to receive")
+            raise TransferRejectedError()
+        self.xfersize = sum(size for (_, size) in files)
+        if not os.path.isdir(dest_dir):
+            os.makedirs(dest_dir)
+        self._check_space(self.xfersize, dest_dir)
+        return files
+
+    def _decide_destname(self, mode, destname, update=False):
         # the basename() is intended to protect us against
         # "~/.ssh/authorized_keys" and other attacks
         destname = os.path.basename(destname)
@@ -231,12 +395,39 @@ class TwistedReceiver:
         abs_destname = os.path.abspath( os.path.join(self.args.cwd, destname) )
 
         # get confirmation from the user before writing to the local directory
+        if update and os.path.isdir(abs_destname):
+            return abs_destname
         if os.path.exists(abs_destname):
             self._msg(u"Error: refusing to overwrite existing %s %s" %
                       (mode, destname))
             raise TransferRejectedError()
         return abs_destname
 
+    def _check_space(self, needed, directory=None):
+        free = free_space(directory or os.path.dirname(self.abs_destname))
+        if free is not None and free < needed:
+            self._msg(u"Error: not enough disk space (%s free, %s needed)" %
+                      (naturalsize(free), naturalsize(needed)))
+            raise RespondError("not enough disk space")
+
+    def _reserve(self, f, size=None):
+        # claim the space now, so we fail before the transfer, not during it
+        if size is None:
+            size = self.xfersize
+        try:
+            preallocate(f, size)
+        except EnvironmentError as e:
+            if e.errno != errno.ENOSPC:
+                raise
+            f.close()
+            if not self._journal and isinstance(f.name, six.string_types):
+                # (TemporaryFiles remove themselves)
+                os.remove(f.name)
+            self._msg(u"Error: not enough disk space (%s needed)" %
+                      naturalsize(size))
+            raise RespondError("not enough disk space")
+        return f
+
     def _ask_permission(self):
         with self.args.timing.add("permission", waiting="user") as t:
             while True and not self.args.accept_file:
@@ -248,8 +439,26 @@ class TwistedReceiver:
                 raise TransferRejectedError()
             t.detail(answer="yes")
 
+    def _confirm_replace(self, names):
+        self._msg(u"These files will be replaced:")
+        for name in names:
+            self._msg(u"  %s" % name)
+        self._ask_permission()
+
     def _send_permission(self, w):
-        self._send_data({"answer": { "file_ack": "ok" }}, w)
+        answer = { "file_ack": "ok" }
+        if self._journal:
+            answer["resume-from"] = self._resume_from
+        if self._codec:
+            answer["compression-v1"] = self._codec
+        if self._batch_accept is not None:
+            answer["accept"] = self._batch_accept
+        self._send_data({"answer": answer}, w)
+
+    def _unpacker(self):
+        if self._codec:
+            return compression.Unpacker(self._codec)
+        return None
 
     @inlineCallbacks
     def _establish_transit(self):
@@ -262,57 +471,190 @@ class TwistedReceiver:
         # now receive the rest of the owl
         self._msg(u"Receiving (%s).." % record_pipe.describe())
 
+        expected = self.xfersize - self._resume_from
         with self.args.timing.add("rx file"):
             progress = tqdm(file=self.args.stdout,
                             disable=self.args.hide_progress,
-                            unit="B", unit_scale=True, total=self.xfersize)
+                            unit="B", unit_scale=True, total=self.xfersize,
+                            initial=self._resume_from)
             hasher = hashlib.sha256()
+            if self._journal:
+                # this checks each chunk as it arrives, and the whole-file
+                # hash already covers what we had before
+                hasher = self._journal.filehasher
+                update = self._journal.update
+            else:
+                update = hasher.update
             with progress:
-                received = yield record_pipe.writeToFile(f, self.xfersize,
-                                                         progress.update,
-                                                         hasher.update)
+                received = 0
+                if expected:
+                    received = yield record_pipe.writeToFile(
+                        f, expected, progress.update, update,
+                        threads=threads_are_useful(),
+                        transform=self._unpacker())
             datahash = hasher.digest()
 
         # except TransitError
-        if received < self.xfersize:
+        if received < expected:
             self._msg()
             self._msg(u"Connection dropped before full file received")
-            self._msg(u"got %d bytes, wanted %d" % (received, self.xfersize))
+            self._msg(u"got %d bytes, wanted %d" % (received, expected))
             raise TransferError("Connection dropped before full file received")
-        assert received == self.xfersize
+        assert received == expected
         returnValue(datahash)
 
+    @inlineCallbacks
+    def _unpack_directory_stream(self, record_pipe):
+        self._msg(u"Receiving (%s).." % record_pipe.describe())
+        # the files are unpacked as they arrive, so the progress is in
+        # uncompressed bytes
+        with self.args.timing.add("rx directory"):
+            progress = tqdm(file=self.args.stdout,
+                            disable=self.args.hide_progress,
+                            unit="B", unit_scale=True, total=self.xfersize)
+            hasher = hashlib.sha256()
+            with progress:
+                du = DirectoryUnpacker(self.abs_destname, progress.update,
+                                       hasher.update, mode=self._dir_mode,
+                                       reactor=self._reactor)
+                yield du.unpack(record_pipe, self._unpacker())
+        self._msg(u"Received files written to %s/" %
+                  os.path.basename(self.abs_destname))
+        returnValue(hasher.digest())
+
+    @inlineCallbacks
+    def _receive_delta(self, record_pipe):
+        self._msg(u"Comparing (%s).." % record_pipe.describe())
+        hasher = hashlib.sha256()
+        # the progress is in bytes of the files that changed, as we rebuild
+        # them
+        progress = tqdm(file=self.args.stdout,
+                        disable=self.args.hide_progress,
+                        unit="B", unit_scale=True, total=self.xfersize)
+        with self.args.timing.add("send signatures"):
+            listing = bytes_to_dict((yield record_pipe.receive_record()))
+            try:
+                du = DeltaUnpacker(self.abs_destname, listing,
+                                   progress=progress.update,
+                                   hasher=hasher.update,
+                                   reactor=self._reactor)
+            except (ValueError, TypeError, KeyError) as e:
+                raise TransferError("bad listing from sender: %s" % (e,))
+            # our copies of the files that changed are read to sign them
+            same, signatures = yield threads.deferToThreadPool(
+                self._reactor, self._reactor.getThreadPool(), du.signatures)
+            if signatures:
+                # we have a different version of these
+                self._confirm_replace([listing["files"][index][0]
+                                       for (index, _) in signatures])
+            record_pipe.send_record(dict_to_bytes({u"same": same}))
+            for index, sig in signatures:
+                record_pipe.send_record(INDEX.pack(index) + sig)
+            record_pipe.send_record(b"")
+        files = listing["files"]
+        self._msg(u"%d of %d files have changed" %
+                  (len(files) - len(same), len(files)))
+        same = set(same)
+        progress.total = sum(f[1] for (i, f) in enumerate(files)
+                             if i not in same)
+
+        with self.args.timing.add("rx delta"):
+            with progress:
+                yield du.unpack(record_pipe, self._unpacker())
+        self._msg(u"Received files written to %s/" %
+                  os.path.basename(self.abs_destname))
+        returnValue(hasher.digest())
+
+    @inlineCallbacks
+    def _receive_dedup(self, record_pipe):
+        self._msg(u"Receiving (%s).." % record_pipe.describe())
+        hasher = hashlib.sha256()
+        progress = tqdm(file=self.args.stdout,
+                        disable=self.args.hide_progress,
+                        unit="B", unit_scale=True, total=self.xfersize)
+        cache = ChunkCache(self.args.chunk_cache or default_cache_dir(),
+                           max_size=self.args.chunk_cache_size*1024*1024,
+                           reserve=self.xfersize)
+        with self.args.timing.add("send chunk bitmap"):
+            listing = bytes_to_dict((yield record_pipe.receive_record()))
+            try:
+                du = DedupUnpacker(self.abs_destname, listing, cache,
+                                   progress=progress.update,
+                                   hasher=hasher.update,
+                                   reactor=self._reactor)
+            except (ValueError, TypeError, KeyError) as e:
+                raise TransferError("bad listing from sender: %s" % (e,))
+            hashes = []
+            while True:
+                record = yield record_pipe.receive_record()
+                if not record:
+                    break
+                hashes.append(record)
+            try:
+                du.set_hashes(b"".join(hashes))
+            except ValueError as e:
+                raise TransferError("bad chunk hashes from sender: %s" % (e,))
+            bitmap = yield threads.deferToThreadPool(
+                self._reactor, self._reactor.getThreadPool(), du.bitmap)
+            record_pipe.send_record(bitmap)
+
+        with self.args.timing.add("rx chunks"):
+            with progress:
+                try:
+                    yield du.unpack(record_pipe, self._unpacker())
+                finally:
+                    yield threads.deferToThreadPool(
+                        self._reactor, self._reactor.getThreadPool(),
+                        cache.trim)
+        self._msg(u"Received files written to %s/" %
+                  os.path.basename(self.abs_destname))
+        returnValue(hasher.digest())
+
+    @inlineCallbacks
+    def _receive_batch(self, record_pipe, files):
+        self._msg(u"Receiving (%s).." % record_pipe.describe())
+        hasher = hashlib.sha256()
+        progress = tqdm(file=self.args.stdout,
+                        disable=self.args.hide_progress,
+                        unit="B", unit_scale=True, total=self.xfersize)
+        with self.args.timing.add("rx files"):
+            with progress:
+                for (path, filesize) in files:
+                    tmp_name = path + ".tmp"
+                    f = self._reserve(open(tmp_name, "wb"), filesize)
+                    received = 0
+                    if filesize:
+                        # this stops at the end of this file, and leaves
+                        # the next one's records queued
+                        received = yield record_pipe.writeToFile(
+                            f, filesize, progress.update, hasher.update,
+                            threads=threads_are_useful(),
+                            transform=self._unpacker())
+                    f.close()
+                    if received < filesize:
+                        raise TransferError("Connection dropped before"
+                                            " full file received")
+                    os.rename(tmp_name, path)
+        self._msg(u"Received %d files written to %s/" %
+                  (len(files), os.path.basename(os.path.dirname(path))))
+        returnValue(hasher.digest())
+
     def _write_file(self, f):
         tmp_name = f.name
         f.close()
         os.rename(tmp_name, self.abs_destname)
+        if self._journal:
+            self._journal.remove()
         self._msg(u"Received file written to %s" %
                   os.path.basename(self.abs_destname))
 
-    def _extract_file(self, zf, info, extract_dir):
-        """
-        the zipfile module does not restore file permissions
-        so we'll do it manually
-        """
-        out_path = os.path.join( extract_dir, info.filename )
-        out_path = os.path.abspath( out_path )
-        if not out_path.startswith( extract_dir ):
-            raise ValueError( "malicious zipfile, %s outside of extract_dir %s"
-                    % (info.filename, extract_dir) )
-
-        zf.extract( info.filename, path=extract_dir )
-
-        # not sure why zipfiles store the perms 16 bits away but they do
-        perm = info.external_attr >> 16
-        os.chmod( out_path, perm )
-
+    @inlineCallbacks
     def _write_directory(self, f):
 
         self._msg(u"Unpacking zipfile..")
         with self.args.timing.add("unpack zip"):
             with zipfile.ZipFile(f, "r", zipfile.ZIP_DEFLATED) as zf:
-                for info in zf.infolist():
-                    self._extract_file( zf, info, self.abs_destname )
+                yield unzip.extract(zf, self.abs_destname, self._reactor)
 
             self._msg(u"Received files written to %s/" %
                       os.path.basename(self.abs_destname))
@@ -1,17 +1,43 @@
 from __future__ import print_function
-import os, sys, six, tempfile, zipfile, hashlib
+import os, sys, six, struct, tempfile, zipfile, hashlib
 from tqdm import tqdm
 from humanize import naturalsize
 from twisted.python import log
-from twisted.protocols import basic
-from twisted.internet import reactor
+from twisted.internet import reactor, threads
 from twisted.internet.defer import inlineCallbacks, returnValue
 from ..errors import TransferError, WormholeClosedError
 from ..wormhole import wormhole
-from ..transit import TransitSender
+from ..transit import (TransitSender, FileProducer, ThreadedFileSender,
+                       threads_are_useful)
+from ..sockopts import socket_options
+from .. import conncache
 from ..util import dict_to_bytes, bytes_to_dict, bytes_to_hexstr
+from .resume import cached_manifest
+from .dirstream import DirectorySender, RECORD_SIZE, walk
+from .delta import DELTA_MODE, INDEX, DeltaSender, listing
+from .dedup import (DEDUP_MODE, HASH_SIZE, DedupSender, chunk_files,
+                    parse_bitmap)
+from .mapped import open_for_sending
+from .hashcache import file_key, open_cache
+from . import compression
 
 APPID = u"lothar.com/wormhole/text-or-file-xfer"
+# files that deflate saves less than this much of are stored in zipfiles
+# instead, once the hash cache knows it
+MIN_SAVING = 0.05
+COMPRESSED = struct.Struct(">Q")
+# ZipFile takes a compresslevel from python 3.7. Before that, members are
+# always deflated at zlib's default level, which is 6.
+ZIP_HAS_COMPRESSLEVEL = sys.version_info >= (3, 7)
+ZLIB_DEFAULT_LEVEL = 6
+
+def _compress_type(value, size):
+    # from what deflate made of this file last time
+    if value is not None and len(value) == COMPRESSED.size:
+        (compressed,) = COMPRESSED.unpack(value)
+        if compressed > size * (1 - MIN_SAVING):
+            return zipfile.ZIP_STORED
+    return zipfile.ZIP_DEFLATED
 
 def send(args, reactor=reactor):
     """I implement 'wormhole send'. I return a Deferred that fires with None
@@ -24,6 +50,21 @@ def send(args, reactor=reactor):
     """
     return Sender(args, reactor).go()
 
+def check_options(args):
+    """Raise TransferError if 'args' asks for ways of sending that don't go
+    together."""
+    modes = [option for (option, value) in [("--resumable", args.resumable),
+                                            ("--stream", args.stream),
+                                            ("--delta", args.delta),
+                                            ("--dedup", args.dedup)]
+             if value]
+    if len(modes) > 1:
+        raise TransferError("Cannot use %s together" % " and ".join(modes))
+    if args.resumable and (args.what is None or
+                           os.path.isdir(os.path.join(args.cwd, args.what))):
+        raise TransferError("Cannot use --resumable: it only works when"
+                            " sending one file")
+
 class Sender:
     def __init__(self, args, reactor):
         self._args = args
@@ -31,11 +72,24 @@ class Sender:
         self._tor_manager = None
         self._timing = args.timing
         self._fd_to_send = None
+        self._dir_bytes = 0
+        self._dir_sender = None
+        self._batch = [] # [(path, filename, filesize)]
+        self._listing = None # for DELTA_MODE and DEDUP_MODE
+        self._listing_paths = None
+        self._listing_mode = None
         self._transit_sender = None
+        self._manifest = None
+        self._codecs = []
+        self._file_hash = None
+        self._file_path = None
+        self._hash_cache = None
 
     @inlineCallbacks
     def go(self):
         assert isinstance(self._args.relay_url, type(u""))
+        # before we connect to anything
+        check_options(self._args)
         if self._args.tor:
             with self._timing.add("import", which="tor_manager"):
                 from ..tor_manager import TorManager
@@ -53,6 +107,12 @@ class Sender:
         d.addBoth(w.close) # must wait for ack from close()
         yield d
 
+    def _open_hash_cache(self):
+        # what we learn about the files we read, for next time
+        if self._hash_cache is None:
+            self._hash_cache = open_cache(self._args.hash_cache) or False
+        return self._hash_cache or None
+
     def _send_data(self, data, w):
         data_bytes = dict_to_bytes(data)
         w.send(data_bytes)
@@ -63,6 +123,21 @@ class Sender:
         # wormhole exchange happen in parallel
         offer, self._fd_to_send = self._build_offer()
         args = self._args
+        if args.resumable and "file" in offer:
+            print(u"Hashing file, so the transfer can be resumed..",
+                  file=args.stdout)
+            pool = self._reactor.getThreadPool()
+            manifest, self._file_hash = yield threads.deferToThreadPool(
+                self._reactor, pool, cached_manifest, self._file_path,
+                self._fd_to_send, offer["file"]["filesize"],
+                self._open_hash_cache())
+            self._manifest = manifest
+            offer["file"]["chunks-v1"] = manifest
+        if args.compress_level:
+            for kind in ("file", "directory", "files"):
+                if kind in offer:
+                    self._codecs = compression.available()
+                    offer[kind]["compression-v1"] = self._codecs
 
         other_cmd = "wormhole receive"
         if args.verify:
@@ -99,12 +174,18 @@ class Sender:
                     w.send(reject_data)
                     raise TransferError(err)
 
-        if self._fd_to_send:
+        if (self._fd_to_send or self._dir_sender or self._batch or
+            self._listing):
             ts = TransitSender(args.transit_helper,
                                no_listen=(not args.listen),
                                tor_manager=self._tor_manager,
                                reactor=self._reactor,
-                               timing=self._timing)
+                               timing=self._timing,
+                               socket_options=socket_options(
+                                   args.transit_socket_buffer),
+                               streams=args.transit_streams,
+                               connection_cache=conncache.open_cache(
+                                   args.connection_cache))
             self._transit_sender = ts
 
             # for now, send this before the main offer
@@ -154,6 +235,7 @@ class Sender:
 
     def _handle_transit(self, receiver_transit):
         ts = self._transit_sender
+        ts.add_connection_abilities(receiver_transit.get("abilities-v1", []))
         ts.add_connection_hints(receiver_transit.get("hints-v1", []))
 
     def _build_offer(self):
@@ -164,7 +246,7 @@ class Sender:
         if text == "-":
             print(u"Reading text message from stdin..", file=args.stdout)
             text = sys.stdin.read()
-        if not text and not args.what:
+        if not text and not args.what and not args.batch:
             text = six.moves.input("Text to send: ")
 
         if text is not None:
@@ -174,6 +256,9 @@ class Sender:
             fd_to_send = None
             return offer, fd_to_send
 
+        if args.batch:
+            return self._build_batch_offer(), None
+
         what = os.path.join(args.cwd, args.what)
         what = what.rstrip(os.sep)
         if not os.path.exists(what):
@@ -191,9 +276,49 @@ class Sender:
             print(u"Sending %s file named '%s'"
                   % (naturalsize(filesize), basename),
                   file=args.stdout)
-            fd_to_send = open(what, "rb")
+            self._file_path = what
+            fd_to_send = open_for_sending(what, args.use_mmap)
             return offer, fd_to_send
 
+        if os.path.isdir(what) and (args.delta or args.dedup):
+            # we only send what the receiver is missing: the listing goes
+            # over the transit connection, since it can be large
+            entries, num_files, num_bytes = walk(what)
+            self._dir_bytes = num_bytes
+            self._listing, self._listing_paths = listing(entries)
+            self._listing_mode = DELTA_MODE if args.delta else DEDUP_MODE
+            offer["directory"] = {
+                "mode": self._listing_mode,
+                "dirname": basename,
+                "numbytes": num_bytes,
+                "numfiles": num_files,
+                }
+            if args.delta:
+                print(u"Sending changes to directory (%s) named '%s'"
+                      % (naturalsize(num_bytes), basename), file=args.stdout)
+            else:
+                print(u"Sending directory (%s) named '%s', without repeats"
+                      % (naturalsize(num_bytes), basename), file=args.stdout)
+            return offer, None
+
+        if os.path.isdir(what) and args.stream:
+            # we're streaming a directory: just find out what's in it for
+            # now, the tarball is built while it is sent
+            entries, num_files, num_bytes = walk(what)
+            self._dir_bytes = num_bytes
+            self._dir_sender = DirectorySender(entries,
+                                               level=args.compress_level,
+                                               reactor=self._reactor)
+            offer["directory"] = {
+                "mode": self._dir_sender.mode(),
+                "dirname": basename,
+                "numbytes": num_bytes,
+                "numfiles": num_files,
+                }
+            print(u"Sending directory (%s uncompressed) named '%s'"
+                  % (naturalsize(num_bytes), basename), file=args.stdout)
+            return offer, None
+
         if os.path.isdir(what):
             print(u"Building zipfile..", file=args.stdout)
             # We're sending a directory. Create a zipfile in a tempdir and
@@ -202,7 +327,19 @@ class Sender:
             num_files = 0
             num_bytes = 0
             tostrip = len(what.split(os.sep))
-            with zipfile.ZipFile(fd_to_send, "w", zipfile.ZIP_DEFLATED) as zf:
+            compression = zipfile.ZIP_DEFLATED
+            if args.compress_level == 0:
+                compression = zipfile.ZIP_STORED
+            cache = None
+            if compression == zipfile.ZIP_DEFLATED:
+                cache = self._open_hash_cache()
+            level = ZLIB_DEFAULT_LEVEL
+            zip_kwargs = {}
+            if ZIP_HAS_COMPRESSLEVEL:
+                level = zip_kwargs["compresslevel"] = args.compress_level
+            kind = "deflate-%d" % level
+            with zipfile.ZipFile(fd_to_send, "w", compression,
+                                 **zip_kwargs) as zf:
                 for path,dirs,files in os.walk(what):
                     # path always starts with args.what, then sometimes might
                     # have "/subdir" appended. We want the zipfile to contain
@@ -211,8 +348,19 @@ class Sender:
                     for fn in files:
                         archivename = os.path.join(*tuple(localpath+[fn]))
                         localfilename = os.path.join(path, fn)
-                        zf.write(localfilename, archivename)
-                        num_bytes += os.stat(localfilename).st_size
+                        if cache:
+                            key = file_key(localfilename)
+                            compress_type = _compress_type(
+                                cache.get(key, kind), key[1])
+                            zf.write(localfilename, archivename,
+                                     compress_type)
+                        else:
+                            zf.write(localfilename, archivename)
+                        info = zf.infolist()[-1]
+                        if cache and info.compress_type != zipfile.ZIP_STORED:
+                            cache.put(key, kind,
+                                      COMPRESSED.pack(info.compress_size))
+                        num_bytes += info.file_size
                         num_files += 1
             fd_to_send.seek(0,2)
             filesize = fd_to_send.tell()
@@ -230,9 +378,33 @@ class Sender:
 
         raise TypeError("'%s' is neither file nor directory" % args.what)
 
+    def _build_batch_offer(self):
+        # several files, sent one after another over a single connection
+        args = self._args
+        files = []
+        names = set()
+        for what in args.batch:
+            path = os.path.join(args.cwd, what).rstrip(os.sep)
+            if not os.path.isfile(path):
+                raise TransferError("Cannot send: no file named '%s' (only"
+                                    " files can be sent together)" % what)
+            basename = os.path.basename(path)
+            if basename in names:
+                raise TransferError("Cannot send two files named '%s'"
+                                    % basename)
+            names.add(basename)
+            filesize = os.stat(path).st_size
+            self._batch.append((path, basename, filesize))
+            files.append({"filename": basename, "filesize": filesize})
+        numbytes = sum(f["filesize"] for f in files)
+        print(u"Sending %d files (%s)" % (len(files), naturalsize(numbytes)),
+              file=args.stdout)
+        return {"files": {"files": files, "numbytes": numbytes}}
+
     @inlineCallbacks
     def _handle_answer(self, them_answer):
-        if self._fd_to_send is None:
+        if (self._fd_to_send is None and self._dir_sender is None
+            and not self._batch and self._listing is None):
             if them_answer["message_ack"] == "ok":
                 print(u"text message sent", file=self._args.stdout)
                 returnValue(None) # terminates this function
@@ -242,16 +414,40 @@ class Sender:
             raise TransferError("ambiguous response from remote, "
                                 "transfer abandoned: %s" % (them_answer,))
 
-        yield self._send_file()
+        packer = None
+        codec = them_answer.get("compression-v1")
+        if codec is not None:
+            if codec not in self._codecs:
+                raise TransferError("unknown compression %r" % (codec,))
+            packer = compression.Packer(codec)
+
+        if self._dir_sender:
+            yield self._send_directory(packer)
+        elif self._listing_mode == DELTA_MODE:
+            yield self._send_delta(packer)
+        elif self._listing_mode == DEDUP_MODE:
+            yield self._send_dedup(packer)
+        elif self._batch:
+            yield self._send_batch(them_answer.get("accept"), packer)
+        else:
+            yield self._send_file(them_answer.get("resume-from", 0), packer)
 
 
     @inlineCallbacks
-    def _send_file(self):
+    def _send_file(self, resume_from=0, packer=None):
         ts = self._transit_sender
 
         self._fd_to_send.seek(0,2)
         filesize = self._fd_to_send.tell()
-        self._fd_to_send.seek(0,0)
+        if resume_from:
+            # the receiver has the chunks before this one already
+            if not (self._manifest and isinstance(resume_from, int) and
+                    0 < resume_from <= filesize and
+                    resume_from % self._manifest["size"] == 0):
+                raise TransferError("bad resume offset %r" % (resume_from,))
+            print(u"Resuming at %s" % naturalsize(resume_from),
+                  file=self._args.stdout)
+        self._fd_to_send.seek(resume_from,0)
 
         record_pipe = yield ts.connect()
         self._timing.add("transit connected")
@@ -262,21 +458,181 @@ class Sender:
         hasher = hashlib.sha256()
         progress = tqdm(file=stdout, disable=self._args.hide_progress,
                         unit="B", unit_scale=True,
-                        total=filesize)
-        def _count_and_hash(data):
-            hasher.update(data)
-            progress.update(len(data))
-            return data
-        fs = basic.FileSender()
-
+                        total=filesize, initial=resume_from)
         with self._timing.add("tx file"):
             with progress:
-                yield fs.beginFileTransfer(self._fd_to_send, record_pipe,
-                                           transform=_count_and_hash)
+                yield send_fd(self._fd_to_send, record_pipe, hasher,
+                              progress, packer)
 
         expected_hash = hasher.digest()
-        expected_hex = bytes_to_hexstr(expected_hash)
+        if resume_from:
+            # we only hashed the end of the file this time
+            expected_hash = self._file_hash
+        print(u"File sent.. waiting for confirmation", file=stdout)
+        yield self._wait_for_ack(record_pipe, expected_hash)
+
+    @inlineCallbacks
+    def _send_batch(self, accept, packer=None):
+        if (not isinstance(accept, list) or
+            sorted(set(accept)) != accept or
+            not all(isinstance(i, int) and 0 <= i < len(self._batch)
+                    for i in accept)):
+            raise TransferError("bad list of accepted files %r" % (accept,))
+        files = [self._batch[i] for i in accept]
+        stdout = self._args.stdout
+        if len(files) < len(self._batch):
+            print(u"The receiver skipped %d of %d files"
+                  % (len(self._batch) - len(files), len(self._batch)),
+                  file=stdout)
+
+        ts = self._transit_sender
+        record_pipe = yield ts.connect()
+        self._timing.add("transit connected")
+        print(u"Sending (%s).." % record_pipe.describe(), file=stdout)
+
+        # the receiver expects each file to be exactly the size we offered,
+        # so that it can tell where the next one starts
+        hasher = hashlib.sha256()
+        progress = tqdm(file=stdout, disable=self._args.hide_progress,
+                        unit="B", unit_scale=True,
+                        total=sum(size for (_, _, size) in files))
+        with self._timing.add("tx files"):
+            with progress:
+                for (path, filename, filesize) in files:
+                    if not filesize:
+                        continue
+                    with open_for_sending(path, self._args.use_mmap) as f:
+                        fd = Limited(f, filesize)
+                        yield send_fd(fd, record_pipe, hasher,
+                                      progress, packer)
+                    if fd.remaining:
+                        raise TransferError("'%s' shrank while it was being"
+                                            " sent" % filename)
+        print(u"Files sent.. waiting for confirmation", file=stdout)
+        yield self._wait_for_ack(record_pipe, hasher.digest())
+
+    @inlineCallbacks
+    def _send_directory(self, packer=None):
+        ts = self._transit_sender
+        record_pipe = yield ts.connect()
+        self._timing.add("transit connected")
+        stdout = self._args.stdout
+        print(u"Sending (%s).." % record_pipe.describe(), file=stdout)
+
+        hasher = hashlib.sha256()
+        # the progress is in uncompressed bytes, as we read them
+        progress = tqdm(file=stdout, disable=self._args.hide_progress,
+                        unit="B", unit_scale=True, total=self._dir_bytes)
+        with self._timing.add("tx directory"):
+            with progress:
+                yield self._dir_sender.beginTransfer(
+                    record_pipe, hasher=hasher.update,
+                    progress=progress.update, transform=packer)
         print(u"File sent.. waiting for confirmation", file=stdout)
+        yield self._wait_for_ack(record_pipe, hasher.digest())
+
+    @inlineCallbacks
+    def _send_delta(self, packer=None):
+        ts = self._transit_sender
+        record_pipe = yield ts.connect()
+        self._timing.add("transit connected")
+        stdout = self._args.stdout
+        print(u"Comparing (%s).." % record_pipe.describe(), file=stdout)
+
+        with self._timing.add("get signatures"):
+            record_pipe.send_record(dict_to_bytes(self._listing))
+            reply = bytes_to_dict((yield record_pipe.receive_record()))
+            same = set(reply.get(u"same", []))
+            signatures = {}
+            while True:
+                record = yield record_pipe.receive_record()
+                if not record:
+                    break
+                (index,) = INDEX.unpack_from(record)
+                signatures[index] = record[INDEX.size:]
+        files = [(index, path) for (index, path)
+                 in enumerate(self._listing_paths) if index not in same]
+        sizes = [f[1] for f in self._listing["files"]]
+        print(u"%d of %d files have changed"
+              % (len(files), len(self._listing_paths)), file=stdout)
+
+        # the progress is in bytes of the files we compare, as we read them
+        hasher = hashlib.sha256()
+        progress = tqdm(file=stdout, disable=self._args.hide_progress,
+                        unit="B", unit_scale=True,
+                        total=sum(sizes[index] for (index, _) in files))
+        with self._timing.add("tx delta"):
+            with progress:
+                ds = DeltaSender(files, signatures, reactor=self._reactor)
+                sent = yield ds.beginTransfer(record_pipe,
+                                              hasher=hasher.update,
+                                              progress=progress.update,
+                                              transform=packer)
+        print(u"Sent %s of changes.. waiting for confirmation"
+              % naturalsize(sent), file=stdout)
+        yield self._wait_for_ack(record_pipe, hasher.digest())
+
+    @inlineCallbacks
+    def _send_dedup(self, packer=None):
+        ts = self._transit_sender
+        record_pipe = yield ts.connect()
+        self._timing.add("transit connected")
+        stdout = self._args.stdout
+        print(u"Looking for repeats (%s).." % record_pipe.describe(),
+              file=stdout)
+
+        # everything is read once to find the chunks, then the new ones
+        # are read again to send them
+        progress = tqdm(file=stdout, disable=self._args.hide_progress,
+                        unit="B", unit_scale=True, total=self._dir_bytes)
+        def report(length):
+            self._reactor.callFromThread(progress.update, length)
+        with self._timing.add("chunk files"):
+            with progress:
+                hashes, recipes = yield threads.deferToThreadPool(
+                    self._reactor, self._reactor.getThreadPool(),
+                    chunk_files, self._listing_paths, report,
+                    self._open_hash_cache())
+        with self._timing.add("get chunk bitmap"):
+            record_pipe.send_record(dict_to_bytes(self._listing))
+            for i in range(0, len(hashes), RECORD_SIZE // HASH_SIZE):
+                record_pipe.send_record(
+                    b"".join(hashes[i:i+RECORD_SIZE // HASH_SIZE]))
+            record_pipe.send_record(b"")
+            bitmap = yield record_pipe.receive_record()
+            try:
+                has = parse_bitmap(bitmap, len(hashes))
+            except ValueError as e:
+                raise TransferError("bad answer from receiver: %s" % (e,))
+        sizes = {}
+        for recipe in recipes:
+            for (number, offset, length) in recipe:
+                sizes[number] = length
+        new_bytes = sum(length for (number, length) in sizes.items()
+                        if number not in has)
+        print(u"%s of %s is new to the receiver"
+              % (naturalsize(new_bytes), naturalsize(self._dir_bytes)),
+              file=stdout)
+
+        hasher = hashlib.sha256()
+        progress = tqdm(file=stdout, disable=self._args.hide_progress,
+                        unit="B", unit_scale=True, total=self._dir_bytes)
+        with self._timing.add("tx chunks"):
+            with progress:
+                ds = DedupSender(self._listing_paths, hashes, recipes, has,
+                                 reactor=self._reactor)
+                sent = yield ds.beginTransfer(record_pipe,
+                                              hasher=hasher.update,
+                                              progress=progress.update,
+                                              transform=packer)
+        print(u"Sent %s.. waiting for confirmation" % naturalsize(sent),
+              file=stdout)
+        yield self._wait_for_ack(record_pipe, hasher.digest())
+
+    @inlineCallbacks
+    def _wait_for_ack(self, record_pipe, expected_hash):
+        stdout = self._args.stdout
+        expected_hex = bytes_to_hexstr(expected_hash)
         with self._timing.add("get ack") as t:
             ack_bytes = yield record_pipe.receive_record()
             record_pipe.close()
@@ -291,3 +647,35 @@ class Sender:
                     raise TransferError("Transfer failed (bad remote hash)")
             print(u"Confirmation received. Transfer complete.", file=stdout)
             t.detail(ack="ok")
+
+def send_fd(fd, record_pipe, hasher, progress, packer=None):
+    """Send the rest of the file 'fd' as records, feeding what is read to
+    'hasher' (a hashlib object) and 'progress' (a tqdm), and compressing
+    with 'packer' if given. Returns a Deferred that fires when it has all
+    been sent."""
+    if threads_are_useful():
+        fs = ThreadedFileSender()
+        return fs.beginFileTransfer(fd, record_pipe, hasher=hasher.update,
+                                    progress=progress.update,
+                                    transform=packer)
+    def _count_and_hash(data):
+        hasher.update(data)
+        progress.update(len(data))
+        if packer:
+            return packer(data)
+        return data
+    fs = FileProducer()
+    return fs.beginFileTransfer(fd, record_pipe, transform=_count_and_hash)
+
+class Limited:
+    # the first 'size' bytes of a file, for the batch mode and sessions
+    def __init__(self, f, size):
+        self._f = f
+        self.remaining = size
+
+    def read(self, size=-1):
+        if size is None or size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self._f.read(size)
+        self.remaining -= len(data)
+        return data
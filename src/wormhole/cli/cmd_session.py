@@ -0,0 +1,430 @@
+from __future__ import print_function
+import os, hashlib
+from collections import deque
+from tqdm import tqdm
+from humanize import naturalsize
+from twisted.internet import reactor, defer, error, stdio
+from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.protocols.basic import LineReceiver
+from twisted.python import log
+from ..wormhole import wormhole, HKDF
+from ..transit import TransitSender, TransitReceiver, threads_are_useful
+from ..sockopts import socket_options
+from .. import conncache
+from ..errors import TransferError, WormholeClosedError
+from ..util import dict_to_bytes, bytes_to_dict, bytes_to_hexstr
+from .mapped import open_for_sending
+from .allocate import free_space, preallocate
+from .cmd_send import Limited, send_fd
+from . import compression
+
+# 'wormhole session': one wormhole code, then any number of files in either
+# direction. 'wormhole send' and 'wormhole receive' pay for the rendezvous,
+# the PAKE exchange, and the transit connection (hints, handshakes, maybe a
+# relay) every time, which takes much longer than sending a small file.
+# Here both sides keep the wormhole and a single transit connection open
+# until both of them have said "bye", and each file costs one round trip
+# over the transit connection before its data starts to flow.
+#
+# Everything after the setup travels as transit records: a JSON control
+# record ({"offer"}, {"answer"}, {"ack"} or {"bye"}), or the data of the
+# file being sent, which follows an accepting answer and is exactly as long
+# as the offer said (after any compression is undone). One file is in
+# flight at a time. If both sides make an offer at once, the leader's
+# (chosen at random during setup) goes first: the leader ignores the
+# follower's, and the follower makes it again later.
+#
+# Each accepted file gets its own record keys. Both sides start a chain key
+# from the wormhole, and for every transfer derive the next record key and
+# the next chain key from it, and forget the old one: a key that leaks
+# later doesn't expose the files that went before it. The receiver switches
+# right after sending its answer, and the sender right after reading it.
+# Neither side sends anything else until the data has gone one way and the
+# ack the other, so no record is in flight when the key changes (records
+# may be decrypted on threads, with whichever key was current when they
+# arrived). Empty files have no data to protect, and their ack follows the
+# answer straight away, so they keep the keys they have.
+
+APPID = u"lothar.com/wormhole/session"
+SIDE_LENGTH = 16
+
+def session(args, reactor=reactor):
+    """I implement 'wormhole session'. Each line on stdin names a file to
+    send; the session ends after EOF, once the other side has finished too.
+    I return a Deferred that fires with None when it ends, or signals an
+    error if the connection was lost."""
+    s = Session(args, reactor)
+    d = s.go()
+    stdio.StandardIO(_PathReader(s, args))
+    return d
+
+class _PathReader(LineReceiver):
+    delimiter = b"\n"
+
+    def __init__(self, session, args):
+        self._session = session
+        self._args = args
+
+    def lineReceived(self, line):
+        path = line.decode("utf-8").strip()
+        if not path:
+            return
+        d = self._session.send_file(os.path.join(self._args.cwd, path))
+        d.addErrback(lambda f: print(u"Sending %s failed: %s"
+                                     % (path, f.getErrorMessage()),
+                                     file=self._args.stderr))
+
+    def connectionLost(self, reason):
+        self._session.finish()
+
+class Session:
+    def __init__(self, args, reactor=reactor):
+        assert isinstance(args.relay_url, type(u""))
+        self._args = args
+        self._reactor = reactor
+        self._tor_manager = None
+        self._timing = args.timing
+        self._transit = None
+        self._pipe = None
+        self._leader = None
+        self._chain = None
+        self._outbound = deque() # (path, Deferred), waiting to be offered
+        self._offered = None # the _Outbound we are sending
+        self._receiving = False
+        self._finishing = False
+        self._said_bye = False
+        self._heard_bye = False
+
+    def _msg(self, *args, **kwargs):
+        print(*args, file=self._args.stdout, **kwargs)
+
+    # API methods
+
+    def send_file(self, path):
+        """Offer the file at 'path' to the other side, after any that were
+        queued before it. Returns a Deferred that fires when the other side
+        has acknowledged it, or errbacks (with TransferError) if it was
+        refused or the session ended first."""
+        if self._finishing:
+            raise TransferError("this session is finishing")
+        d = defer.Deferred()
+        self._outbound.append((path, d))
+        self._maybe_offer()
+        return d
+
+    def finish(self):
+        """Say 'bye' once everything queued has been sent. The session ends
+        when the other side has said it too."""
+        self._finishing = True
+        self._maybe_offer()
+
+    @inlineCallbacks
+    def go(self):
+        if self._args.tor:
+            with self._timing.add("import", which="tor_manager"):
+                from ..tor_manager import TorManager
+            self._tor_manager = TorManager(self._reactor, timing=self._timing)
+            yield self._tor_manager.start()
+
+        w = wormhole(APPID, self._args.relay_url, self._reactor,
+                     self._tor_manager, timing=self._timing)
+        d = self._go(w)
+        d.addErrback(self._abandon)
+        d.addBoth(w.close)
+        yield d
+
+    @inlineCallbacks
+    def _go(self, w):
+        args = self._args
+        if args.zeromode:
+            assert not args.code
+            args.code = u"0-"
+        if args.code:
+            w.set_code(args.code)
+        else:
+            code = yield w.get_code(args.code_length)
+            self._msg(u"On the other computer, please run: wormhole session")
+            self._msg(u"Wormhole code is: %s" % code)
+            self._msg(u"")
+        verifier = yield w.verify() # this may raise WrongPasswordError
+        if args.verify:
+            self._msg(u"Verifier %s." % bytes_to_hexstr(verifier))
+
+        yield self._setup_transit(w)
+        self._pipe = yield self._transit.connect()
+        self._timing.add("transit connected")
+        self._msg(u"Session open (%s)" % self._pipe.describe())
+        self._chain = w.derive_key(APPID+u"/ratchet", 32)
+        try:
+            yield self._serve()
+        finally:
+            self._pipe.close()
+        self._msg(u"Session closed")
+
+    @inlineCallbacks
+    def _get(self, w):
+        try:
+            them_bytes = yield w.get()
+        except WormholeClosedError:
+            raise TransferError("unexpected close")
+        them_d = bytes_to_dict(them_bytes)
+        if u"error" in them_d:
+            raise TransferError("remote error: %s" % them_d[u"error"])
+        returnValue(them_d)
+
+    @inlineCallbacks
+    def _setup_transit(self, w):
+        # the side with the larger random number leads, and makes the
+        # transit connection as the sender
+        side = bytes_to_hexstr(os.urandom(SIDE_LENGTH))
+        w.send(dict_to_bytes({u"session-v1": {u"side": side}}))
+        them_d = yield self._get(w)
+        their_side = them_d.get(u"session-v1", {}).get(u"side")
+        if not isinstance(their_side, type(u"")) or their_side == side:
+            raise TransferError("the other side is not running"
+                                " 'wormhole session'")
+        self._leader = side > their_side
+        args = self._args
+        cls = TransitSender if self._leader else TransitReceiver
+        t = cls(args.transit_helper,
+                no_listen=(not args.listen),
+                tor_manager=self._tor_manager,
+                reactor=self._reactor,
+                timing=self._timing,
+                socket_options=socket_options(args.transit_socket_buffer),
+                streams=args.transit_streams,
+                connection_cache=conncache.open_cache(args.connection_cache))
+        self._transit = t
+        t.set_transit_key(w.derive_key(APPID+u"/transit-key",
+                                       t.TRANSIT_KEY_LENGTH))
+        hints = yield t.get_connection_hints()
+        w.send(dict_to_bytes({u"transit": {
+            u"abilities-v1": t.get_connection_abilities(),
+            u"hints-v1": hints,
+            }}))
+        them_d = yield self._get(w)
+        their_transit = them_d.get(u"transit", {})
+        t.add_connection_abilities(their_transit.get(u"abilities-v1", []))
+        t.add_connection_hints(their_transit.get(u"hints-v1", []))
+
+    def _send(self, msg):
+        self._pipe.send_record(dict_to_bytes(msg))
+
+    def _ratchet(self):
+        key = HKDF(self._chain, 32, CTXinfo=b"wormhole session record key")
+        self._chain = HKDF(self._chain, 32,
+                           CTXinfo=b"wormhole session chain key")
+        self._pipe.rekey(key)
+
+    @inlineCallbacks
+    def _serve(self):
+        self._maybe_offer()
+        while not (self._said_bye and self._heard_bye):
+            try:
+                record = yield self._pipe.receive_record()
+            except error.ConnectionClosed:
+                if self._said_bye and self._heard_bye:
+                    break # we closed it, after saying the last word
+                raise TransferError("connection lost")
+            msg = bytes_to_dict(record)
+            if u"offer" in msg:
+                yield self._handle_offer(msg[u"offer"])
+            elif u"answer" in msg:
+                yield self._handle_answer(msg[u"answer"])
+            elif u"ack" in msg:
+                self._handle_ack(msg)
+            elif u"bye" in msg:
+                self._heard_bye = True
+            else:
+                log.msg("unrecognized message %r" % (msg,))
+            self._maybe_offer()
+
+    def _maybe_offer(self):
+        if (self._pipe is None or self._offered or self._receiving
+            or self._said_bye):
+            return
+        if self._outbound:
+            path, d = self._outbound.popleft()
+            try:
+                self._offered = _Outbound(path, d, self._args.compress_level,
+                                         self._args.use_mmap)
+            except EnvironmentError as e:
+                d.errback(TransferError("Cannot send '%s': %s" % (path, e)))
+                return self._maybe_offer()
+            self._msg(u"Offering %s file named '%s'"
+                      % (naturalsize(self._offered.filesize),
+                         self._offered.filename))
+            self._send({u"offer": self._offered.offer})
+        elif self._finishing:
+            self._said_bye = True
+            self._send({u"bye": True})
+            if self._heard_bye:
+                self._pipe.close()
+
+    def _abandon(self, f):
+        # nothing else will be sent
+        if self._offered:
+            self._outbound.appendleft((self._offered.path, self._offered.d))
+            self._offered.close()
+            self._offered = None
+        while self._outbound:
+            path, d = self._outbound.popleft()
+            d.errback(TransferError("session ended before '%s' was sent"
+                                    % os.path.basename(path)))
+        return f
+
+    # receiving
+
+    @inlineCallbacks
+    def _handle_offer(self, offer):
+        if self._offered:
+            if self._leader:
+                # we offered at the same time: they will ask again later
+                returnValue(None)
+            # the leader's offer goes first, and we make ours again later
+            self._outbound.appendleft((self._offered.path, self._offered.d))
+            self._offered.close()
+            self._offered = None
+        self._receiving = True
+        try:
+            yield self._receive(offer)
+        finally:
+            self._receiving = False
+
+    @inlineCallbacks
+    def _receive(self, offer):
+        filename = offer.get(u"filename")
+        filesize = offer.get(u"filesize")
+        refusal = self._check_offer(filename, filesize)
+        if refusal:
+            self._msg(u"Refused '%s': %s" % (filename, refusal))
+            self._send({u"answer": {u"error": refusal}})
+            returnValue(None)
+        answer = {u"file_ack": u"ok"}
+        codec = compression.choose(offer.get(u"compression-v1"))
+        unpacker = None
+        if codec:
+            answer[u"compression-v1"] = codec
+            unpacker = compression.Unpacker(codec)
+        self._msg(u"Receiving file (%s) into: %s"
+                  % (naturalsize(filesize), filename))
+        destname = os.path.join(self._args.cwd, filename)
+        tmp_name = destname + ".tmp"
+        f = open(tmp_name, "wb")
+        try:
+            preallocate(f, filesize)
+        except EnvironmentError:
+            f.close()
+            os.unlink(tmp_name)
+            self._send({u"answer": {u"error": u"not enough disk space"}})
+            returnValue(None)
+        self._send({u"answer": answer})
+        if filesize:
+            self._ratchet()
+
+        hasher = hashlib.sha256()
+        progress = tqdm(file=self._args.stdout,
+                        disable=self._args.hide_progress,
+                        unit="B", unit_scale=True, total=filesize)
+        with self._timing.add("rx file"):
+            with progress:
+                received = 0
+                if filesize:
+                    received = yield self._pipe.writeToFile(
+                        f, filesize, progress.update, hasher.update,
+                        threads=threads_are_useful(), transform=unpacker)
+        f.close()
+        if received < filesize:
+            raise TransferError("Connection dropped before full file"
+                                " received")
+        os.rename(tmp_name, destname)
+        self._send({u"ack": u"ok",
+                    u"sha256": bytes_to_hexstr(hasher.digest())})
+        self._msg(u"Received file written to %s" % filename)
+
+    def _check_offer(self, filename, filesize):
+        if (not isinstance(filename, type(u"")) or
+            filename in (u"", u".", u"..") or
+            os.path.basename(filename) != filename or
+            (os.altsep and os.altsep in filename)):
+            return u"bad filename"
+        if not isinstance(filesize, int) or filesize < 0:
+            return u"bad filesize"
+        if os.path.exists(os.path.join(self._args.cwd, filename)):
+            return u"file already exists"
+        free = free_space(self._args.cwd)
+        if free is not None and filesize > free:
+            return u"not enough disk space"
+        return None
+
+    # sending
+
+    @inlineCallbacks
+    def _handle_answer(self, answer):
+        o = self._offered
+        if o is None or o.sending:
+            raise TransferError("unexpected answer")
+        if u"error" in answer:
+            self._offered = None
+            o.close()
+            self._msg(u"'%s' was refused: %s" % (o.filename, answer[u"error"]))
+            o.d.errback(TransferError("remote refused '%s': %s"
+                                      % (o.filename, answer[u"error"])))
+            returnValue(None)
+        if answer.get(u"file_ack") != u"ok":
+            raise TransferError("ambiguous response from remote: %r"
+                                % (answer,))
+        packer = None
+        codec = answer.get(u"compression-v1")
+        if codec is not None:
+            if codec not in o.codecs:
+                raise TransferError("unknown compression %r" % (codec,))
+            packer = compression.Packer(codec)
+        if o.filesize:
+            self._ratchet()
+        o.sending = True
+
+        hasher = hashlib.sha256()
+        progress = tqdm(file=self._args.stdout,
+                        disable=self._args.hide_progress,
+                        unit="B", unit_scale=True, total=o.filesize)
+        with self._timing.add("tx file"):
+            with progress:
+                if o.filesize:
+                    yield send_fd(o.fd, self._pipe, hasher, progress, packer)
+        if o.fd.remaining:
+            raise TransferError("'%s' shrank while it was being sent"
+                                % o.filename)
+        o.close()
+        o.hash = bytes_to_hexstr(hasher.digest())
+
+    def _handle_ack(self, ack):
+        o = self._offered
+        if o is None or not o.sending:
+            raise TransferError("unexpected ack")
+        self._offered = None
+        if ack.get(u"ack") != u"ok" or ack.get(u"sha256") != o.hash:
+            raise TransferError("Transfer of '%s' failed (remote says: %r)"
+                                % (o.filename, ack))
+        self._msg(u"Sent %s" % o.filename)
+        o.d.callback(None)
+
+class _Outbound:
+    # a file we have offered, until it has been acknowledged
+    def __init__(self, path, d, compress_level, use_mmap=False):
+        self.path = path
+        self.d = d
+        self.filename = os.path.basename(path)
+        self.filesize = os.stat(path).st_size
+        self._f = open_for_sending(path, use_mmap)
+        self.fd = Limited(self._f, self.filesize)
+        self.codecs = []
+        self.offer = {u"filename": self.filename, u"filesize": self.filesize}
+        if compress_level:
+            self.codecs = compression.available()
+            self.offer[u"compression-v1"] = self.codecs
+        self.sending = False
+        self.hash = None
+
+    def close(self):
+        self._f.close()
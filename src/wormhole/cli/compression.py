@@ -0,0 +1,121 @@
+from __future__ import print_function, unicode_literals
+import zlib
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+# Compression on the wire. The sender lists the codecs it can use, best
+# first, as offer["file"]["compression-v1"] (or offer["directory"][..]),
+# and a receiver that knows one of them names it in its answer as
+# "compression-v1". Receivers that don't know about this ignore the list,
+# and then everything is sent as before. Each transit record is compressed
+# on its own, before it is encrypted, and starts with a byte that says
+# whether it was: the sender first compresses a small sample from the
+# middle of the record, and sends records that wouldn't shrink (media,
+# archives, encrypted data) as they are, so those cost little more than
+# the sample. Both sides hash the data before compression, so the final
+# ack doesn't change.
+#
+# zstd and lz4 are fast enough to keep up with a LAN, but they are
+# optional (pip install magic-wormhole[compression]). zlib at level 1 is
+# always there to fall back on.
+
+RAW = b"\x00"
+PACKED = b"\x01"
+SAMPLE_SIZE = 4096
+MAX_RECORD = 16*1024*1024 # records never decompress to more than this
+
+class _Zstd:
+    name = "zstd"
+    def pack(self, data):
+        # (compressor objects can't be shared between threads)
+        return zstandard.ZstdCompressor(level=3).compress(data)
+    def unpack(self, data, limit):
+        size = zstandard.frame_content_size(data)
+        if not 0 <= size <= limit:
+            raise ValueError("compressed record too large")
+        return zstandard.ZstdDecompressor().decompress(data)
+
+class _LZ4:
+    name = "lz4"
+    def pack(self, data):
+        return lz4.frame.compress(data)
+    def unpack(self, data, limit):
+        d = lz4.frame.LZ4FrameDecompressor()
+        out = d.decompress(data, max_length=limit)
+        if not d.eof:
+            raise ValueError("compressed record too large")
+        return out
+
+class _Zlib:
+    name = "zlib"
+    def pack(self, data):
+        return zlib.compress(data, 1)
+    def unpack(self, data, limit):
+        d = zlib.decompressobj()
+        out = d.decompress(data, limit)
+        if d.unconsumed_tail or not d.eof:
+            raise ValueError("compressed record too large")
+        return out
+
+def _codecs():
+    codecs = []
+    if zstandard:
+        codecs.append(_Zstd())
+    if lz4:
+        codecs.append(_LZ4())
+    codecs.append(_Zlib())
+    return codecs
+
+CODECS = dict((c.name, c) for c in _codecs())
+
+def available():
+    """Return the names of the codecs we can use, best first."""
+    return [c.name for c in _codecs()]
+
+def choose(offered):
+    """Return the first codec in the sender's list that we can use, or None
+    if there isn't one (or the list is malformed)."""
+    if not isinstance(offered, list):
+        return None
+    for name in offered:
+        if name in CODECS:
+            return name
+    return None
+
+class Packer:
+    """I am a transform for the sending side of a record pipe. I may be
+    called from several threads at once."""
+    def __init__(self, name):
+        self._codec = CODECS[name]
+
+    def worth_it(self, record):
+        middle = max(0, (len(record) - SAMPLE_SIZE) // 2)
+        sample = record[middle:middle+SAMPLE_SIZE]
+        return len(self._codec.pack(sample)) < len(sample) * 0.9
+
+    def __call__(self, record):
+        if self.worth_it(record):
+            packed = self._codec.pack(record)
+            if len(packed) < len(record):
+                return PACKED + packed
+        return RAW + record
+
+class Unpacker:
+    """I undo what the Packer did, one record at a time."""
+    def __init__(self, name, limit=MAX_RECORD):
+        self._codec = CODECS[name]
+        self._limit = limit
+
+    def __call__(self, record):
+        flag = record[:1]
+        if flag == RAW:
+            return record[1:]
+        if flag == PACKED:
+            return self._codec.unpack(record[1:], self._limit)
+        raise ValueError("unknown record framing %r" % (flag,))
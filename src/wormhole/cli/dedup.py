@@ -0,0 +1,425 @@
+from __future__ import print_function, unicode_literals
+import os, re, struct, hashlib, tempfile
+from binascii import hexlify, unhexlify
+from twisted.internet import reactor
+from twisted.python import log
+from ..util import bytes_to_hexstr, cache_dir
+from .allocate import free_space
+from .dirstream import RECORD_SIZE
+from .hashcache import file_key
+from .delta import (FILE, DATA, END, INDEX, DeltaSender, DeltaUnpacker,
+                    _Rebuild)
+
+# Sending a directory as content-addressed chunks. Trees often hold the
+# same bytes many times over (vendored libraries, copies of an asset,
+# files that share a long header), and the zipfile and tarball modes send
+# each copy again. Here the sender cuts every file into chunks of about
+# 10kB, at places that depend only on the bytes around them, so the same
+# run of bytes is cut the same way wherever it appears, even after an
+# insertion earlier in the file. Each chunk is named by its SHA-256.
+#
+# Over the transit connection, the sender sends the listing (as for
+# --delta), then the hash of every distinct chunk, in the order they first
+# appear. The receiver answers with a bitmap of the ones it already has in
+# its chunk cache (a directory of chunks from earlier transfers). Then
+# comes one stream of records (see DirectorySender), like the delta one:
+#  F + index: the next file in the listing
+#  R + chunk numbers: chunks the receiver has, or was sent earlier
+#  D + chunk number + data: a chunk that is new to the receiver
+#  E: the end of that file
+# so each distinct chunk crosses the wire at most once. The receiver checks
+# every chunk against its hash as it writes it (whether it came from the
+# wire or from the cache), keeps the new ones in the cache, and both sides
+# hash the chunk hashes of each file in order, so the usual SHA-256 ack
+# covers the contents.
+#
+# The cut points come from a hash of the 16 bytes before each position. A
+# loop in python would manage a few MB/s, so we hash all positions of a
+# buffer at once, with bytes.translate() and XORs of (big) ints, and find
+# the cut points with a regular expression: about 25MB/s.
+
+DEDUP_MODE = "chunks/v1"
+CHUNK_MIN = 2*1024
+CHUNK_MAX = 64*1024
+READ_SIZE = 1024*1024
+HASH_SIZE = 32
+WINDOW = 16
+REF = b"R"
+CACHED_CHUNK = struct.Struct(">%dsI" % HASH_SIZE) # hash, length
+
+def _table(name, i):
+    digest = hashlib.sha256(("%s:%d" % (name, i)).encode("ascii")).digest()
+    return bytearray(digest)[0]
+
+# a random byte for each byte value, and each byte rotated left by k bits
+_GEAR = bytes(bytearray(_table("gear", b) for b in range(256)))
+_ROTATE = [bytes(bytearray(((b << k) | (b >> (8 - k))) & 0xff
+                           for b in range(256)))
+           for k in range(8)]
+# a cut follows positions where this hash is 0, and the next one is below
+# 8: one in 8192
+_CUT = re.compile(b"\x00[\x00-\x07]")
+
+if hasattr(int, "from_bytes"):
+    def _to_int(data):
+        return int.from_bytes(data, "big")
+    def _from_int(value, length):
+        return value.to_bytes(length, "big")
+else:
+    # python2 has no int.from_bytes(), and this is about 8x slower
+    def _to_int(data):
+        return int(hexlify(data), 16) if data else 0
+    def _from_int(value, length):
+        return unhexlify("%0*x" % (2*length, value))
+
+def _window_hashes(buf):
+    # h[i] is a hash of buf[i:i+WINDOW]: the XOR of the gear value of each
+    # byte, rotated by its position. We double the window four times.
+    h = bytes(buf).translate(_GEAR)
+    span = 1
+    for step in range(1, 5):
+        n = len(h) - span
+        if n <= 0:
+            return b""
+        mixed = _to_int(h[:n]) ^ _to_int(h[span:].translate(_ROTATE[step]))
+        h = _from_int(mixed, n)
+        span *= 2
+    return h
+
+def _cuts(buf, final):
+    # the lengths of the chunks at the start of 'buf'. Unless 'final',
+    # leave the last CHUNK_MAX bytes or less: the next read might move
+    # their cut.
+    hashes = _window_hashes(buf)
+    lengths = []
+    pos = 0
+    while len(buf) - pos >= CHUNK_MAX or (final and pos < len(buf)):
+        m = _CUT.search(hashes, pos + CHUNK_MIN - WINDOW - 1,
+                        pos + CHUNK_MAX - WINDOW + 1)
+        end = m.start() + WINDOW + 1 if m else pos + CHUNK_MAX
+        end = min(end, len(buf))
+        lengths.append(end - pos)
+        pos = end
+    return lengths
+
+def split(f):
+    """Read the open file 'f' to the end, and yield its chunks."""
+    buf = b""
+    while True:
+        data = f.read(READ_SIZE)
+        final = not data
+        buf += data
+        pos = 0
+        for length in _cuts(buf, final):
+            yield buf[pos:pos+length]
+            pos += length
+        buf = buf[pos:]
+        if final:
+            return
+
+def chunk_files(paths, report=None, cache=None):
+    """Cut the files at 'paths' into chunks. Returns (hashes, recipes):
+    'hashes' lists the SHA-256 of each distinct chunk, in the order they
+    first appear, and recipes[i] lists (chunk number, offset, length) for
+    each chunk of paths[i]. 'report' is called with the size of each chunk
+    read. Files that haven't changed since they were last cut come from
+    'cache' (a hashcache.HashCache), if given, without being read. This
+    blocks: run it in a thread."""
+    hashes = []
+    numbers = {}
+    recipes = []
+    for path in paths:
+        chunks = None
+        if cache:
+            key = file_key(path)
+            chunks = _cached_chunks(cache.get(key, "dedup-v1"), key[1])
+        if chunks is None:
+            chunks = []
+            with open(path, "rb") as f:
+                for chunk in split(f):
+                    chunks.append((hashlib.sha256(chunk).digest(),
+                                   len(chunk)))
+            if cache:
+                cache.put(key, "dedup-v1",
+                          b"".join(CACHED_CHUNK.pack(*c) for c in chunks))
+        recipe = []
+        offset = 0
+        for h, length in chunks:
+            if h not in numbers:
+                numbers[h] = len(hashes)
+                hashes.append(h)
+            recipe.append((numbers[h], offset, length))
+            offset += length
+            if report:
+                report(length)
+        recipes.append(recipe)
+    return hashes, recipes
+
+def _cached_chunks(value, size):
+    if value is None or len(value) % CACHED_CHUNK.size:
+        return None
+    chunks = [CACHED_CHUNK.unpack_from(value, i)
+              for i in range(0, len(value), CACHED_CHUNK.size)]
+    if sum(length for (h, length) in chunks) != size:
+        return None
+    return chunks
+
+def parse_bitmap(bitmap, count):
+    """Return the set of chunk numbers marked in 'bitmap', which covers
+    'count' chunks. Raises ValueError if it is the wrong size."""
+    if len(bitmap) != (count + 7) // 8:
+        raise ValueError("bad chunk bitmap length")
+    bits = bytearray(bitmap)
+    return set(n for n in range(count) if bits[n // 8] & (0x80 >> (n % 8)))
+
+def default_cache_dir():
+    return cache_dir("chunks")
+
+# The chunk cache has a size limit, and is trimmed back to it after each
+# transfer, dropping the chunks used longest ago: has() and get() touch the
+# chunks they find, so each file's mtime says when it was last used. During
+# a transfer we add no more than the limit, and no more than was free on
+# the disk when it started, less what the received files need ('reserve').
+# Chunks we have no room for aren't kept after the transfer, but the
+# sender may still refer to them again, so DedupUnpacker keeps those in a
+# temporary file until it is done.
+
+MAX_CACHE_SIZE = 1024*1024*1024
+
+class ChunkCache:
+    """A directory of chunks, each in a file named by its SHA-256. Nothing
+    else refers to them: the whole directory can be deleted at any time."""
+    def __init__(self, path, max_size=MAX_CACHE_SIZE, reserve=0):
+        self._path = os.path.abspath(path)
+        self._max_size = max_size
+        self._room = max_size
+        # (the directory may not have been made yet)
+        parent = self._path
+        while not os.path.isdir(parent) and os.path.dirname(parent) != parent:
+            parent = os.path.dirname(parent)
+        free = free_space(parent)
+        if free is not None:
+            self._room = max(0, min(max_size, free - reserve))
+
+    def _name(self, h):
+        hexhash = bytes_to_hexstr(h)
+        return os.path.join(self._path, hexhash[:2], hexhash)
+
+    def _touch(self, name):
+        try:
+            os.utime(name, None)
+        except EnvironmentError:
+            pass
+
+    def has(self, h):
+        name = self._name(h)
+        if not os.path.isfile(name):
+            return False
+        self._touch(name)
+        return True
+
+    def get(self, h):
+        name = self._name(h)
+        with open(name, "rb") as f:
+            data = f.read()
+        if hashlib.sha256(data).digest() != h:
+            os.remove(name)
+            raise ValueError("chunk %s in the cache is corrupt"
+                             % bytes_to_hexstr(h))
+        self._touch(name)
+        return data
+
+    def put(self, h, data):
+        """Store a chunk, if there is room for it. Returns whether the
+        cache has it now."""
+        name = self._name(h)
+        if os.path.exists(name):
+            return True
+        if len(data) > self._room:
+            return False
+        self._room -= len(data)
+        parent = os.path.dirname(name)
+        if not os.path.isdir(parent):
+            os.makedirs(parent)
+        fd, tmp_name = tempfile.mkstemp(dir=parent, suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.rename(tmp_name, name)
+        return True
+
+    def trim(self):
+        """Remove the chunks used longest ago, until the cache is no bigger
+        than its limit."""
+        chunks = []
+        total = 0
+        for (dirpath, dirnames, filenames) in os.walk(self._path):
+            for fn in filenames:
+                name = os.path.join(dirpath, fn)
+                try:
+                    st = os.stat(name)
+                except EnvironmentError:
+                    continue
+                chunks.append((st.st_mtime, name, st.st_size))
+                total += st.st_size
+        chunks.sort()
+        for (mtime, name, size) in chunks:
+            if total <= self._max_size:
+                break
+            try:
+                os.remove(name)
+            except EnvironmentError as e:
+                log.msg("unable to remove %s from the chunk cache: %s"
+                        % (name, e))
+                continue
+            total -= size
+
+# DedupSender sends the records for 'paths' (all of them, in the order of
+# the listing), from the output of chunk_files(), given the set of chunk
+# numbers the receiver 'has'. Only new chunks are read again. 'hasher' (on
+# the thread) sees the hash of each chunk, and 'progress' (on the reactor)
+# the length of each one, whether it was sent or not.
+
+class DedupSender(DeltaSender):
+    def __init__(self, paths, hashes, recipes, has, reactor=reactor):
+        DeltaSender.__init__(self, list(enumerate(paths)), {},
+                             reactor=reactor)
+        self._hashes = hashes
+        self._recipes = recipes
+        self._has = has
+
+    def _write_stream(self):
+        # in a thread
+        known = set(self._has)
+        refs = []
+        for index, path in self._files:
+            self._from_thread(FILE + INDEX.pack(index))
+            with open(path, "rb") as f:
+                for (number, offset, length) in self._recipes[index]:
+                    h = self._hashes[number]
+                    if self._file_hasher:
+                        self._file_hasher(h)
+                    if number in known:
+                        refs.append(INDEX.pack(number))
+                        if len(refs) * INDEX.size >= RECORD_SIZE:
+                            refs = self._flush_refs(refs)
+                    else:
+                        f.seek(offset)
+                        data = f.read(length)
+                        if hashlib.sha256(data).digest() != h:
+                            raise ValueError("%s changed while it was being"
+                                             " sent" % path)
+                        known.add(number)
+                        refs = self._flush_refs(refs)
+                        self._from_thread(DATA + INDEX.pack(number) + data)
+                    self._report(length)
+            refs = self._flush_refs(refs)
+            self._from_thread(END)
+
+    def _flush_refs(self, refs):
+        if refs:
+            self._from_thread(REF + b"".join(refs))
+        return []
+
+# DedupUnpacker writes the directory from the listing into 'extract_dir'
+# (which is made), using chunks from 'cache' (a ChunkCache) and from the
+# stream. Call set_hashes() with the sender's chunk hashes, then bitmap()
+# (in a thread) for the answer, then unpack(). 'hasher' (on the thread)
+# sees the hash of each chunk written, and 'progress' (on the reactor) its
+# length.
+
+class DedupUnpacker(DeltaUnpacker):
+    def __init__(self, extract_dir, listing, cache, progress=None,
+                 hasher=None, budget=None, reactor=reactor):
+        DeltaUnpacker.__init__(self, extract_dir, listing, progress=progress,
+                               hasher=hasher, budget=budget, reactor=reactor)
+        self._cache = cache
+        self._hashes = []
+        self._known = set() # chunk numbers we have, or have been sent
+        self._wanted = set(range(len(self._files)))
+        # chunks we were sent that the cache had no room for
+        self._spill = None
+        self._spilled = {} # chunk number -> (offset, length) in _spill
+
+    def set_hashes(self, data):
+        if len(data) % HASH_SIZE:
+            raise ValueError("bad chunk hashes length")
+        self._hashes = [data[i:i+HASH_SIZE]
+                        for i in range(0, len(data), HASH_SIZE)]
+
+    def bitmap(self):
+        """Return the bitmap of the chunks we already have."""
+        bits = bytearray((len(self._hashes) + 7) // 8)
+        for number, h in enumerate(self._hashes):
+            if self._cache.has(h):
+                self._known.add(number)
+                bits[number // 8] |= 0x80 >> (number % 8)
+        return bytes(bits)
+
+    def _apply(self):
+        try:
+            self._apply_records()
+        finally:
+            if self._spill:
+                self._spill.close()
+
+    def _apply_records(self):
+        while True:
+            record = self._next_record()
+            if record is None:
+                break
+            tag, body = record[:1], record[1:]
+            if tag == FILE and not self._out:
+                (index,) = INDEX.unpack(body)
+                if index not in self._wanted:
+                    raise ValueError("unexpected file %d in stream" % index)
+                self._wanted.remove(index)
+                self._out = _Rebuild(self, index)
+            elif tag == REF and self._out and body:
+                for i in range(0, len(body), INDEX.size):
+                    (number,) = INDEX.unpack(body[i:i+INDEX.size])
+                    if number not in self._known:
+                        raise ValueError("unknown chunk %d" % number)
+                    self._write(number, self._chunk(number))
+            elif tag == DATA and self._out and len(body) >= INDEX.size:
+                (number,) = INDEX.unpack_from(body)
+                if number >= len(self._hashes) or number in self._known:
+                    raise ValueError("unexpected chunk %d" % number)
+                data = body[INDEX.size:]
+                if hashlib.sha256(data).digest() != self._hashes[number]:
+                    raise ValueError("chunk %d doesn't match its hash"
+                                     % number)
+                if not self._cache.put(self._hashes[number], data):
+                    self._keep(number, data)
+                self._known.add(number)
+                self._write(number, data)
+            elif tag == END and self._out:
+                self._out.finish()
+                self._out = None
+            else:
+                raise ValueError("unexpected record %r" % (tag,))
+        if self._out or self._wanted:
+            raise ValueError("stream ended before every file was written")
+
+    def _keep(self, number, data):
+        if self._spill is None:
+            # (in extract_dir, which _unpack() has made)
+            self._spill = tempfile.TemporaryFile(dir=self._extract_dir)
+        self._spill.seek(0, 2)
+        self._spilled[number] = (self._spill.tell(), len(data))
+        self._spill.write(data)
+
+    def _chunk(self, number):
+        if number in self._spilled:
+            offset, length = self._spilled[number]
+            self._spill.seek(offset)
+            return self._spill.read(length)
+        return self._cache.get(self._hashes[number])
+
+    def _write(self, number, data):
+        if self._file_hasher:
+            self._file_hasher(self._hashes[number])
+        self._out.write(data)
+
+    def _wrote(self, data):
+        if self._progress:
+            self._reactor.callFromThread(self._progress, len(data))
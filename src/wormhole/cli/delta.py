@@ -0,0 +1,416 @@
+from __future__ import print_function, unicode_literals
+import os, six, math, struct, hashlib, tempfile, zlib
+from twisted.internet import reactor
+from twisted.python import failure
+from .dirstream import DirectorySender, DirectoryUnpacker, RECORD_SIZE
+from .allocate import preallocate
+
+# Sending a directory as changes, like rsync. Before any data moves, the
+# sender lists the tree (name, size, mtime and mode of every file), and the
+# receiver answers for each file it already has: files with the same size
+# and mtime are left alone, and for the others it sends a signature, a weak
+# (rolling) and a strong checksum of each block of its copy. The sender
+# then reads each file that isn't the same and looks for those blocks at
+# every offset, and sends a stream of records that rebuild the new file
+# from blocks of the old one ("copy") and new bytes ("data"). Bandwidth
+# goes on what changed, plus about 20 bytes per block of signature.
+#
+# The weak checksum is Adler-32, which zlib computes for a whole block and
+# which can be rolled along a byte at a time. We check whole blocks first,
+# which finds unchanged stretches at C speed, and only roll (in python)
+# through the parts that don't match, to find where the next block starts
+# again after an insertion or deletion. The strong checksum is a truncated
+# SHA-256. A false match would corrupt the file, but the SHA-256 of
+# everything we read, which the receiver checks against what it wrote,
+# catches that.
+#
+# Everything after the listing and the signatures is one stream of records
+# (see DirectorySender), each starting with a tag:
+#  F + index: the next file in the listing that isn't the same
+#  C + first block + count: copy blocks of the old file
+#  D + data: new bytes
+#  E: the end of that file, which is then renamed into place
+
+DELTA_MODE = "delta/v1"
+BLOCK_MIN = 2*1024
+BLOCK_MAX = 128*1024
+STRONG_LENGTH = 16
+MOD_ADLER = 65521
+
+FILE, COPY, DATA, END = b"F", b"C", b"D", b"E"
+INDEX = struct.Struct(">I")
+SPAN = struct.Struct(">QI")
+HEADER = struct.Struct(">IQ") # block size, file size
+BLOCK = struct.Struct(">I%ds" % STRONG_LENGTH)
+
+def block_size_for(size):
+    # about sqrt(size) (as rsync does), so the signature grows slowly
+    size = int(math.sqrt(size)) // 1024 * 1024
+    return max(BLOCK_MIN, min(BLOCK_MAX, size))
+
+def strong(block):
+    return hashlib.sha256(block).digest()[:STRONG_LENGTH]
+
+def weak(block):
+    return zlib.adler32(block) & 0xffffffff
+
+def signature(f, size):
+    """Return the signature of the open file 'f', which is 'size' bytes
+    long."""
+    block_size = block_size_for(size)
+    pieces = [HEADER.pack(block_size, size)]
+    while True:
+        block = f.read(block_size)
+        if not block:
+            break
+        pieces.append(BLOCK.pack(weak(block), strong(block)))
+    return b"".join(pieces)
+
+def parse_signature(sig):
+    """Return (block_size, size, table), where 'table' maps each weak
+    checksum to a list of (strong checksum, block number). Raises
+    ValueError if it doesn't add up."""
+    if len(sig) < HEADER.size or (len(sig) - HEADER.size) % BLOCK.size:
+        raise ValueError("bad signature length")
+    block_size, size = HEADER.unpack_from(sig)
+    num_blocks = (len(sig) - HEADER.size) // BLOCK.size
+    if (not BLOCK_MIN <= block_size <= BLOCK_MAX or
+        num_blocks != (size + block_size - 1) // block_size):
+        raise ValueError("bad signature header")
+    table = {}
+    for i in range(num_blocks):
+        w, s = BLOCK.unpack_from(sig, HEADER.size + i*BLOCK.size)
+        table.setdefault(w, []).append((s, i))
+    return block_size, size, table
+
+class _Delta:
+    # the records that turn the old file into the new one, in a thread
+    READ_SIZE = 1024*1024
+
+    def __init__(self, sig, emit):
+        self._block_size, self._old_size, self._table = sig
+        self._tail_size = self._old_size % self._block_size
+        self._emit = emit
+        self._copy = None # [first, count]
+
+    def _match(self, checksum, window):
+        candidates = self._table.get(checksum)
+        if not candidates:
+            return None
+        s = strong(window)
+        for (candidate, i) in candidates:
+            if candidate == s:
+                return i
+        return None
+
+    def _copy_block(self, i):
+        if self._copy and self._copy[0] + self._copy[1] == i:
+            self._copy[1] += 1
+            return
+        self._flush_copy()
+        self._copy = [i, 1]
+
+    def _flush_copy(self):
+        if self._copy:
+            self._emit(COPY + SPAN.pack(*self._copy))
+            self._copy = None
+
+    def _data(self, data):
+        if data:
+            self._flush_copy()
+            for i in range(0, len(data), RECORD_SIZE):
+                self._emit(DATA + bytes(data[i:i+RECORD_SIZE]))
+
+    def _scan(self, buf, pos, checksum, limit):
+        # move the window (and its Adler-32) along a byte at a time, until
+        # the checksum is one of theirs, we run out of buffer, or we reach
+        # 'limit'. Returns the checksum and where the window is.
+        bs = self._block_size
+        table = self._table
+        a = checksum & 0xffff
+        b = checksum >> 16
+        end = min(len(buf) - bs, limit)
+        while pos < end:
+            out_byte = buf[pos]
+            a = (a - out_byte + buf[pos+bs]) % MOD_ADLER
+            b = (b - bs * out_byte + a - 1) % MOD_ADLER
+            pos += 1
+            if (b << 16) | a in table:
+                break
+        return (b << 16) | a, pos
+
+    def run(self, f, read):
+        bs = self._block_size
+        buf = bytearray()
+        pos = 0 # the start of the window
+        literal = 0 # the start of the new bytes before it
+        checksum = None # of the window, while we roll along
+        eof = False
+        while True:
+            if len(buf) - pos < bs and not eof:
+                data = read(f, self.READ_SIZE)
+                eof = not data
+                # keep the new bytes we haven't sent yet
+                buf = buf[literal:] + data
+                pos -= literal
+                literal = 0
+                continue
+            if len(buf) - pos < bs:
+                break
+            if checksum is None:
+                checksum = weak(buf[pos:pos+bs])
+            i = self._match(checksum, buf[pos:pos+bs])
+            if i is not None:
+                self._data(buf[literal:pos])
+                self._copy_block(i)
+                pos += bs
+                literal = pos
+                checksum = None
+                continue
+            if len(buf) - pos > bs:
+                checksum, pos = self._scan(buf, pos, checksum,
+                                           literal + RECORD_SIZE)
+            else:
+                checksum = None
+                pos += 1
+            if pos - literal >= RECORD_SIZE:
+                self._data(buf[literal:pos])
+                literal = pos
+        # the new file ends with less than a block: it might be the end of
+        # the old one
+        tail = buf[pos:]
+        if (tail and len(tail) == self._tail_size and
+            self._match(weak(tail), tail) == self._old_size // bs):
+            self._data(buf[literal:pos])
+            self._copy_block(self._old_size // bs)
+        else:
+            self._data(buf[literal:])
+        self._flush_copy()
+
+def delta(f, sig, emit, read=None):
+    """Call emit() with COPY and DATA records that rebuild the contents of
+    the open file 'f' from the file that has signature 'sig' (as returned
+    by parse_signature(), or None if there is no such file). 'read(f,
+    size)' reads from 'f', which is how the caller gets to see the data."""
+    read = read or (lambda f, size: f.read(size))
+    if sig is None:
+        sig = (BLOCK_MIN, 0, {})
+    _Delta(sig, emit).run(f, read)
+
+def listing(entries):
+    """Build the listing for 'entries' (from dirstream.walk()): a dict with
+    "dirs", a list of directory names, and "files", a list of [name, size,
+    mtime, mode]. Returns (listing, paths), where paths[i] is where the
+    i'th file is."""
+    dirs = []
+    files = []
+    paths = []
+    for path, archivename in entries:
+        if os.path.isdir(path):
+            dirs.append(archivename)
+            continue
+        st = os.stat(path)
+        files.append([archivename, st.st_size, int(st.st_mtime),
+                      st.st_mode & 0o777])
+        paths.append(path)
+    return {"dirs": dirs, "files": files}, paths
+
+# DeltaSender sends the records for the files that differ, as a stream,
+# reading the files in a thread. 'files' is a list of (index, path) for
+# those, and 'signatures' maps the index of each one the receiver has to
+# its signature. 'hasher' (on the thread) and 'progress' (on the
+# reactor) see the contents of each file, and 'transform' applies to the
+# records, as with DirectorySender.
+
+class DeltaSender(DirectorySender):
+    def __init__(self, files, signatures, reactor=reactor):
+        DirectorySender.__init__(self, [], level=0, reactor=reactor)
+        self._files = files
+        self._signatures = signatures
+        self._file_hasher = None
+
+    def beginTransfer(self, pipe, hasher=None, progress=None, transform=None):
+        self._file_hasher = hasher
+        return DirectorySender.beginTransfer(self, pipe, progress=progress,
+                                             transform=transform)
+
+    def _write_stream(self):
+        # in a thread
+        for index, path in self._files:
+            self._from_thread(FILE + INDEX.pack(index))
+            sig = self._signatures.get(index)
+            if sig is not None:
+                sig = parse_signature(sig)
+            with open(path, "rb") as f:
+                delta(f, sig, self._from_thread, self._read)
+            self._from_thread(END)
+
+    def _read(self, f, size):
+        data = f.read(size)
+        if self._file_hasher:
+            self._file_hasher(data)
+        self._report(len(data))
+        return data
+
+# DeltaUnpacker updates 'extract_dir' to match the sender's listing. Call
+# signatures() (in a thread) to find out what to tell the sender, then
+# unpack() the stream it sends back. 'hasher' (on the thread) and
+# 'progress' (on the reactor) see the contents of each file it rebuilds.
+# Each one is written next to the old copy and renamed over it at the end,
+# with the sender's mode and mtime, so the next delta can skip it.
+
+class DeltaUnpacker(DirectoryUnpacker):
+    def __init__(self, extract_dir, listing, progress=None, hasher=None,
+                 budget=None, reactor=reactor):
+        DirectoryUnpacker.__init__(self, extract_dir, progress, budget=budget,
+                                   reactor=reactor)
+        self._file_hasher = hasher
+        self._dirs = [self._path(name) for name in listing["dirs"]]
+        self._files = []
+        for (name, size, mtime, mode) in listing["files"]:
+            if not (isinstance(size, six.integer_types) and size >= 0 and
+                    isinstance(mtime, six.integer_types) and
+                    isinstance(mode, six.integer_types)):
+                raise ValueError("bad listing entry for %s" % (name,))
+            self._files.append((self._path(name), size, mtime, mode))
+        self._sizes = {} # index -> (block size, size) of our copy
+        self._wanted = set()
+        self._out = None # the _Rebuild in progress
+
+    def _path(self, name):
+        path = os.path.abspath(os.path.join(self._extract_dir, name))
+        if not path.startswith(self._extract_dir + os.sep):
+            raise ValueError("malicious listing, %s outside of extract_dir"
+                             " %s" % (name, self._extract_dir))
+        return path
+
+    def signatures(self):
+        """Return (same, signatures): the indexes of the files we already
+        have, and a list of (index, signature) for the ones we have a
+        different version of."""
+        same = []
+        sigs = []
+        for index, (path, size, mtime, mode) in enumerate(self._files):
+            if not os.path.isfile(path):
+                self._wanted.add(index)
+                continue
+            st = os.stat(path)
+            if st.st_size == size and int(st.st_mtime) == mtime:
+                same.append(index)
+                continue
+            self._wanted.add(index)
+            with open(path, "rb") as f:
+                sig = signature(f, st.st_size)
+            self._sizes[index] = HEADER.unpack_from(sig)
+            sigs.append((index, sig))
+        return same, sigs
+
+    def _unpack(self):
+        # in a thread
+        for path in [self._extract_dir] + self._dirs:
+            if not os.path.isdir(path):
+                os.makedirs(path)
+        try:
+            self._apply()
+        finally:
+            if self._out:
+                # don't leave half a file behind
+                self._out.abort()
+
+    def _apply(self):
+        while True:
+            record = self._next_record()
+            if record is None:
+                break
+            tag, body = record[:1], record[1:]
+            if tag == FILE and not self._out:
+                (index,) = INDEX.unpack(body)
+                if index not in self._wanted:
+                    raise ValueError("unexpected file %d in delta" % index)
+                self._wanted.remove(index)
+                self._out = _Rebuild(self, index)
+            elif tag == COPY and self._out:
+                self._out.copy(*SPAN.unpack(body))
+            elif tag == DATA and self._out:
+                self._out.write(body)
+            elif tag == END and self._out:
+                self._out.finish()
+                self._out = None
+            else:
+                raise ValueError("unexpected delta record %r" % (tag,))
+        if self._out or self._wanted:
+            raise ValueError("delta ended before every file was updated")
+
+    def _next_record(self):
+        # in a thread
+        record = self._queue.get()
+        if record is None:
+            return None
+        if isinstance(record, failure.Failure):
+            record.raiseException() # the stream broke
+        self._reactor.callFromThread(self._consumed, len(record))
+        return record
+
+    def _wrote(self, data):
+        if self._file_hasher:
+            self._file_hasher(data)
+        if self._progress:
+            self._reactor.callFromThread(self._progress, len(data))
+
+class _Rebuild:
+    # one file, rebuilt from the old copy and new data, in a thread
+    def __init__(self, unpacker, index):
+        self._unpacker = unpacker
+        self._path, self._size, self._mtime, self._mode = \
+            unpacker._files[index]
+        self._old = None
+        self._block_size, self._old_size = unpacker._sizes.get(index,
+                                                               (None, 0))
+        if self._block_size:
+            self._old = open(self._path, "rb")
+        parent = os.path.dirname(self._path)
+        if not os.path.isdir(parent):
+            os.makedirs(parent)
+        fd, self._tmp_name = tempfile.mkstemp(dir=parent, prefix=".wormhole-",
+                                              suffix=".tmp")
+        self._f = os.fdopen(fd, "wb")
+        preallocate(self._f, self._size)
+        self._written = 0
+
+    def copy(self, first, count):
+        start = first * (self._block_size or 0)
+        end = min(self._old_size, (first + count) * (self._block_size or 0))
+        if not self._old or count < 1 or start >= end:
+            raise ValueError("bad copy in delta")
+        self._old.seek(start)
+        while start < end:
+            data = self._old.read(min(RECORD_SIZE, end - start))
+            if not data:
+                raise ValueError("our copy of %s changed" % self._path)
+            start += len(data)
+            self.write(data)
+
+    def write(self, data):
+        self._written += len(data)
+        if self._written > self._size:
+            raise ValueError("delta for %s is too long" % self._path)
+        self._f.write(data)
+        self._unpacker._wrote(data)
+
+    def finish(self):
+        if self._old:
+            self._old.close()
+        self._f.close()
+        if self._written != self._size:
+            raise ValueError("delta for %s is too short" % self._path)
+        os.chmod(self._tmp_name, self._mode & 0o777)
+        os.utime(self._tmp_name, (self._mtime, self._mtime))
+        if os.name == "nt" and os.path.exists(self._path):
+            os.remove(self._path) # rename doesn't replace files there
+        os.rename(self._tmp_name, self._path)
+
+    def abort(self):
+        if self._old:
+            self._old.close()
+        self._f.close()
+        os.remove(self._tmp_name)
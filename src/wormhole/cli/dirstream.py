@@ -0,0 +1,487 @@
+from __future__ import print_function, unicode_literals
+import os, time, struct, tarfile, threading, zlib
+from collections import deque
+from six.moves import queue
+from zope.interface import implementer
+from twisted.internet import reactor, defer, interfaces, threads
+from twisted.python import log, failure
+from .allocate import preallocate
+
+# Streaming directory transfers. The "zipfile/deflated" mode builds the
+# whole zipfile before the offer goes out, and the receiver spools all of
+# it before unpacking, so the first byte waits for the last file to be
+# compressed, and both sides need room for the whole archive. In the
+# "tarball/gzip" mode, a thread walks the directory and writes a tar stream
+# straight into transit records, and on the other side a thread unpacks
+# each file as its records arrive. The stream ends with an empty record,
+# because nobody knows its size in advance. The offer carries the
+# uncompressed size and the number of files instead.
+#
+# The sender compresses the tar stream in chunks on the reactor's thread
+# pool (zlib releases the GIL), like pigz: each chunk is deflated on its
+# own and flushed to a byte boundary, so the pieces concatenate into one
+# deflate stream, and any plain gzip reader can unpack it. A chunk can
+# also be "compressed" at level 0, which just frames it as stored blocks,
+# so the sender can stop compressing (see _Adapter) without telling the
+# receiver. "tarball/store" sends the tar stream as it is.
+
+STREAM_MODE = "tarball/gzip"
+STORE_MODE = "tarball/store"
+# tarfile modes to unpack each of them
+STREAM_MODES = {STREAM_MODE: "r|gz", STORE_MODE: "r|"}
+DEFAULT_LEVEL = 6
+CHUNK_SIZE = 1024*1024
+RECORD_SIZE = 256*1024
+
+def _in_thread(reactor, f, *args):
+    return threads.deferToThreadPool(reactor, reactor.getThreadPool(),
+                                     f, *args)
+
+def walk(top):
+    """Return (entries, num_files, num_bytes) for the directory 'top', where
+    'entries' is a list of (path, archivename) for every file and
+    subdirectory, in the order they will be sent."""
+    entries = []
+    num_files = 0
+    num_bytes = 0
+    tostrip = len(top.split(os.sep))
+    for path, dirs, files in os.walk(top):
+        dirs.sort()
+        # path always starts with 'top', then sometimes might have
+        # "/subdir" appended. We want the tarball to contain "" or "subdir"
+        localpath = list(path.split(os.sep)[tostrip:])
+        if localpath:
+            entries.append((path, "/".join(localpath)))
+        for fn in sorted(files):
+            localfilename = os.path.join(path, fn)
+            entries.append((localfilename, "/".join(localpath+[fn])))
+            num_bytes += os.stat(localfilename).st_size
+            num_files += 1
+    return entries, num_files, num_bytes
+
+def gzip_header():
+    # no name, no extra fields, unknown OS
+    return struct.pack("<BBBBLBB", 0x1f, 0x8b, 8, 0, int(time.time()), 0, 255)
+
+def gzip_trailer(crc, size):
+    # an empty final block ends the deflate stream
+    return b"\x03\x00" + struct.pack("<LL", crc & 0xffffffff,
+                                      size & 0xffffffff)
+
+def deflate(chunk, level):
+    """Return 'chunk' as raw deflate blocks that end on a byte boundary but
+    don't end the stream, so they can be followed by more."""
+    c = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return c.compress(chunk) + c.flush(zlib.Z_SYNC_FLUSH)
+
+class _Stopped(Exception):
+    pass
+
+class _ToReactor:
+    # the file that tarfile writes to, in the walking thread
+    def __init__(self, sender):
+        self._sender = sender
+        self._pieces = []
+        self._size = 0
+
+    def write(self, data):
+        self._pieces.append(data)
+        self._size += len(data)
+        if self._size >= self._sender._chunk_size:
+            self.flush()
+
+    def flush(self):
+        if self._pieces:
+            chunk = b"".join(self._pieces)
+            self._pieces = []
+            self._size = 0
+            self._sender._from_thread(chunk)
+
+class _Counting:
+    # a file being added to the tarball, which reports how much of it has
+    # been read
+    def __init__(self, f, report):
+        self._f = f
+        self._report = report
+
+    def read(self, size=-1):
+        data = self._f.read(size)
+        self._report(len(data))
+        return data
+
+# Compressing only pays off while the network is slower than the
+# compressor. _Adapter decides, chunk by chunk, whether to compress. While
+# the connection keeps us paused for most of the time, the network is the
+# bottleneck, so we compress. Otherwise we measure both ways: like
+# FileProducer, we time each chunk from the previous send to its own, and
+# compare the uncompressed bytes per second we got with and without
+# compression, starting with compression. We stick with the winner for a
+# while, then measure again, in case the connection has changed.
+# Compression wins ties: the bytes it saves may be a relay's.
+
+class _Adapter:
+    PROBE_CHUNKS = 8 # chunks sent before each decision
+    REPROBE = 8 # decisions before measuring the other way again
+    GAIN = 1.1
+
+    def __init__(self, level):
+        self._level = level
+        self.compress = True
+        self._rates = {} # compress -> uncompressed bytes per second
+        self._bytes = 0
+        self._seconds = 0
+        self._chunks = 0
+        self._waited = 0
+        self._decisions = 0
+
+    def level(self):
+        return self._level if self.compress else 0
+
+    def waited(self, seconds):
+        # for the connection to drain
+        self._waited += seconds
+
+    def measure(self, level, length, elapsed):
+        if (level != 0) != self.compress:
+            return # dispatched before the last decision
+        self._bytes += length
+        self._seconds += elapsed
+        self._chunks += 1
+        if self._chunks < self.PROBE_CHUNKS:
+            return
+        self._rates[self.compress] = self._bytes / max(self._seconds, 1e-6)
+        waited, self._waited = self._waited, 0
+        seconds, self._seconds = self._seconds, 0
+        self._bytes = self._chunks = 0
+        if waited > seconds / 2:
+            self.compress = True
+            return
+        if len(self._rates) < 2:
+            self.compress = not self.compress
+            return
+        self.compress = self._rates[True]*self.GAIN >= self._rates[False]
+        self._decisions += 1
+        if self._decisions >= self.REPROBE:
+            self._decisions = 0
+            self.compress = not self.compress
+            del self._rates[self.compress]
+
+# DirectorySender writes a tarball of 'entries' (from walk()) to a record
+# pipe. The walking and reading happen in one thread, which hands each
+# chunk of the tar stream to the reactor and waits while 'depth' of them
+# are in the pipeline. The reactor has each chunk compressed on the thread
+# pool (at 'level', or not at all when that is 0, or when _Adapter says
+# so), and sends the results in order, as fast as the connection drains,
+# hashing each one first. A 'transform' given to beginTransfer() is
+# applied to each record after it is hashed, also on the thread pool.
+# beginTransfer() returns a Deferred that fires with the number of
+# (compressed) bytes sent. 'progress' is called on the reactor, with the
+# number of (uncompressed) bytes read from each file.
+
+@implementer(interfaces.IPushProducer)
+class DirectorySender:
+    DEPTH = 8
+
+    def __init__(self, entries, level=DEFAULT_LEVEL, chunk_size=None,
+                 depth=None, reactor=reactor):
+        self._entries = entries
+        self._level = level
+        self._chunk_size = chunk_size or CHUNK_SIZE
+        self._depth = depth or self.DEPTH
+        self._reactor = reactor
+        self._adapter = _Adapter(level) if level else None
+        self._slots = threading.Semaphore(self._depth)
+        self._queue = deque() # [done, data, wire, length, level]
+        self._crc = zlib.crc32(b"")
+        self._size = 0
+        self._ended = False
+        self._paused = False
+        self._stopped = False
+        self._sent = 0
+        self.deferred = None
+
+    def mode(self):
+        return STREAM_MODE if self._level else STORE_MODE
+
+    def beginTransfer(self, pipe, hasher=None, progress=None, transform=None):
+        self._pipe = pipe
+        self._hasher = hasher
+        self._progress = progress
+        self._transform = transform
+        self._last_send = self._reactor.seconds()
+        self.deferred = d = defer.Deferred()
+        pipe.registerProducer(self, True)
+        if self._level:
+            header = gzip_header()
+            self._queue.append([True, header, self._framed(header), 0, None])
+        t = _in_thread(self._reactor, self._write_stream)
+        # this runs after every chunk the thread handed over
+        t.addCallbacks(self._ended_stream, self._failed)
+        return d
+
+    def _write_stream(self):
+        # in a thread
+        out = _ToReactor(self)
+        tf = tarfile.open(fileobj=out, mode="w|")
+        for path, archivename in self._entries:
+            if os.path.isdir(path):
+                tf.add(path, archivename, recursive=False)
+                continue
+            with open(path, "rb") as f:
+                # this follows symlinks, like the zipfile mode does
+                info = tf.gettarinfo(arcname=archivename, fileobj=f)
+                tf.addfile(info, _Counting(f, self._report))
+        tf.close()
+        out.flush()
+
+    def _report(self, length):
+        # in a thread
+        if length and self._progress:
+            self._reactor.callFromThread(self._progress, length)
+
+    def _from_thread(self, chunk):
+        # in a thread: wait for room
+        self._slots.acquire()
+        if self._stopped:
+            raise _Stopped()
+        if self._level:
+            self._crc = zlib.crc32(chunk, self._crc)
+            self._size += len(chunk)
+        self._reactor.callFromThread(self._queued, chunk)
+
+    def _queued(self, chunk):
+        if not self.deferred:
+            return
+        level = self._adapter.level() if self._adapter else 0
+        slot = [False, None, None, len(chunk), level]
+        self._queue.append(slot)
+        if level == 0 and not self._transform:
+            # framing it is cheap enough to do here
+            self._compressed(self._compress(chunk, 0), slot)
+            return
+        d = _in_thread(self._reactor, self._compress, chunk, level)
+        d.addCallbacks(self._compressed, self._failed, callbackArgs=(slot,))
+
+    def _compress(self, chunk, level):
+        # returns the data to hash, and the record to send
+        data = deflate(chunk, level) if self._level else chunk
+        return data, self._framed(data)
+
+    def _framed(self, data):
+        return self._transform(data) if self._transform else data
+
+    def _compressed(self, value, slot):
+        slot[0] = True
+        (slot[1], slot[2]) = value
+        self._send()
+
+    def _ended_stream(self, _):
+        if self._level:
+            trailer = gzip_trailer(self._crc, self._size)
+            self._queue.append([True, trailer, self._framed(trailer),
+                                0, None])
+        self._ended = True
+        self._send()
+
+    def _send(self):
+        while (self.deferred and not self._paused and self._queue
+               and self._queue[0][0]):
+            (_, data, wire, length, level) = self._queue.popleft()
+            if self._hasher:
+                self._hasher(data)
+            self._pipe.send_record(wire)
+            self._sent += len(wire)
+            if length:
+                now = self._reactor.seconds()
+                if self._adapter:
+                    self._adapter.measure(level, length,
+                                          now - self._last_send)
+                self._last_send = now
+                self._slots.release()
+        if self.deferred and self._ended and not self._queue:
+            # the receiver knows the stream is over when it sees an empty
+            # record
+            self._pipe.send_record(b"")
+            self._pipe.unregisterProducer()
+            d, self.deferred = self.deferred, None
+            d.callback(self._sent)
+
+    def _failed(self, f):
+        if f.check(_Stopped) or not self.deferred:
+            return
+        self._stop()
+        self._pipe.unregisterProducer()
+        d, self.deferred = self.deferred, None
+        d.errback(f)
+
+    def _stop(self):
+        self._stopped = True
+        # wake the thread up, so it notices
+        self._slots.release()
+
+    def pauseProducing(self):
+        if not self._paused:
+            self._paused = True
+            self._paused_at = self._reactor.seconds()
+
+    def resumeProducing(self):
+        if self._paused:
+            self._paused = False
+            if self._adapter:
+                self._adapter.waited(self._reactor.seconds() - self._paused_at)
+        self._send()
+
+    def stopProducing(self):
+        if self.deferred:
+            self._stop()
+            d, self.deferred = self.deferred, None
+            d.errback(Exception("Consumer asked us to stop producing"))
+
+class _FromReactor:
+    # the file that tarfile reads from, in the unpacking thread
+    def __init__(self, unpacker):
+        self._unpacker = unpacker
+        self._data = b""
+        self._offset = 0
+        self._eof = False
+
+    def read(self, size):
+        while len(self._data) - self._offset < size and not self._eof:
+            record = self._unpacker._queue.get()
+            if record is None:
+                self._eof = True
+                break
+            if isinstance(record, failure.Failure):
+                self._eof = True
+                record.raiseException()
+            self._unpacker._reactor.callFromThread(self._unpacker._consumed,
+                                                   len(record))
+            self._data = self._data[self._offset:] + record
+            self._offset = 0
+        data = self._data[self._offset:self._offset+size]
+        self._offset += len(data)
+        return data
+
+# DirectoryUnpacker is the consumer on the other end: each record is hashed
+# on the reactor and queued for a thread, which unpacks the tarball (sent in
+# 'mode') into 'extract_dir' as it arrives. We pause the pipe while more
+# than 'budget' bytes are queued. Only files and directories are unpacked,
+# and only inside 'extract_dir'. 'progress' is called on the reactor, with
+# the number of (uncompressed) bytes written to each file. unpack() returns
+# a Deferred that fires with the number of (compressed) bytes received,
+# once the whole tarball has been unpacked. If the sender used a transform
+# (see compression.Packer), pass the matching one to unpack(): the hasher
+# sees the records after it.
+
+@implementer(interfaces.IConsumer)
+class DirectoryUnpacker:
+    BUDGET = 8*1024*1024
+
+    def __init__(self, extract_dir, progress=None, hasher=None,
+                 mode=STREAM_MODE, budget=None, reactor=reactor):
+        self._extract_dir = os.path.abspath(extract_dir)
+        self._mode = STREAM_MODES[mode]
+        self._progress = progress
+        self._hasher = hasher
+        self._budget = budget or self.BUDGET
+        self._reactor = reactor
+        self._queue = queue.Queue()
+        self._queued_bytes = 0
+        self._producer = None
+        self._paused = False
+        self._received = None
+
+    def unpack(self, pipe, transform=None):
+        self._pipe = pipe
+        d = pipe.connectStreamConsumer(self, transform)
+        d.addBoth(self._stream_ended)
+        e = _in_thread(self._reactor, self._unpack)
+        e.addBoth(self._unpacked)
+        return e
+
+    def _stream_ended(self, res):
+        self._received = res
+        # wake up the thread even if the stream broke
+        self._queue.put(res if isinstance(res, failure.Failure) else None)
+
+    def _unpacked(self, res):
+        if isinstance(res, failure.Failure):
+            if self._producer:
+                # stop listening to the stream, and stop the sender
+                self._pipe.disconnectConsumer()
+                self._pipe.stopProducing()
+            return res
+        # the thread read to the end of the stream, so it has ended
+        return self._received
+
+    def _unpack(self):
+        # in a thread
+        if not os.path.isdir(self._extract_dir):
+            os.makedirs(self._extract_dir)
+        reader = _FromReactor(self)
+        tf = tarfile.open(fileobj=reader, mode=self._mode)
+        for info in tf:
+            self._unpack_one(tf, info)
+        tf.close()
+        # the stream may have a little more padding after the tarball
+        while reader.read(RECORD_SIZE):
+            pass
+
+    def _unpack_one(self, tf, info):
+        out_path = os.path.abspath(os.path.join(self._extract_dir,
+                                                info.name))
+        if not out_path.startswith(self._extract_dir + os.sep):
+            raise ValueError("malicious tarball, %s outside of extract_dir %s"
+                             % (info.name, self._extract_dir))
+        if info.isdir():
+            if not os.path.isdir(out_path):
+                os.makedirs(out_path)
+            return
+        if not info.isfile():
+            log.msg("skipping %s: not a file or directory" % (info.name,))
+            return
+        parent = os.path.dirname(out_path)
+        if not os.path.isdir(parent):
+            os.makedirs(parent)
+        src = tf.extractfile(info)
+        with open(out_path, "wb") as f:
+            preallocate(f, info.size)
+            while True:
+                data = src.read(RECORD_SIZE)
+                if not data:
+                    break
+                f.write(data)
+                if self._progress:
+                    self._reactor.callFromThread(self._progress, len(data))
+        os.chmod(out_path, info.mode & 0o777)
+
+    def _consumed(self, length):
+        self._queued_bytes -= length
+        if self._paused and self._queued_bytes <= self._budget // 2:
+            self._paused = False
+            if self._producer:
+                self._producer.resumeProducing()
+
+    # IConsumer
+
+    def registerProducer(self, producer, streaming):
+        assert not self._producer
+        self._producer = producer
+        assert streaming
+
+    def write(self, record):
+        if self._hasher:
+            self._hasher(record)
+        self._queue.put(record)
+        self._queued_bytes += len(record)
+        if (self._queued_bytes >= self._budget and self._producer
+            and not self._paused):
+            self._paused = True
+            self._producer.pauseProducing()
+
+    def unregisterProducer(self):
+        assert self._producer
+        if self._paused:
+            self._paused = False
+            self._producer.resumeProducing()
+        self._producer = None
@@ -0,0 +1,101 @@
+from __future__ import print_function, unicode_literals
+import os, sqlite3, threading
+from twisted.python import log
+from ..util import cache_dir
+
+# What the sender learns by reading a file: its resume manifest, its
+# --dedup chunks, whether it compresses. Reading is the slow part of
+# sending a big tree again, so we remember these in a small sqlite
+# database, under the file's path and what kind of thing it is. An entry
+# is only used while the file still has the size, mtime (to the
+# nanosecond, where the OS has it) and inode it had when it was read, the
+# same test rsync and most build tools rely on. The stat is taken before
+# the file is read, so a file that changes while we read it doesn't match
+# next time. Each entry is committed as soon as it is stored, so another
+# sender using the same file waits for one row, not for our whole tree, and
+# it waits at most TIMEOUT seconds. It is only a cache: when it can't be
+# opened, read or written, we log that and read the files as before.
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS `files`
+(
+ `path` VARCHAR NOT NULL,
+ `kind` VARCHAR NOT NULL,
+ `size` INTEGER NOT NULL,
+ `mtime_ns` INTEGER NOT NULL,
+ `inode` INTEGER NOT NULL,
+ `value` BLOB NOT NULL,
+ PRIMARY KEY (`path`, `kind`)
+);
+"""
+TIMEOUT = 0.5
+
+def default_cache_file():
+    return cache_dir("hashes.sqlite")
+
+def file_key(path):
+    """Return the key that identifies this version of the file at 'path'."""
+    st = os.stat(path)
+    mtime_ns = getattr(st, "st_mtime_ns", None)
+    if mtime_ns is None:
+        mtime_ns = int(st.st_mtime * 1e9)
+    return (os.path.abspath(path), st.st_size, mtime_ns, st.st_ino)
+
+class HashCache:
+    def __init__(self, dbfile):
+        # used from the reactor and from threads, one at a time
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(dbfile, timeout=TIMEOUT,
+                                   check_same_thread=False)
+        self._db.execute("PRAGMA synchronous = OFF")
+        self._db.executescript(SCHEMA)
+
+    def get(self, key, kind):
+        """Return what was stored for 'kind' with this 'key' (from
+        file_key()), or None."""
+        path, size, mtime_ns, inode = key
+        try:
+            with self._lock:
+                row = self._db.execute("SELECT `size`, `mtime_ns`, `inode`,"
+                                       " `value` FROM `files`"
+                                       " WHERE `path`=? AND `kind`=?",
+                                       (path, kind)).fetchone()
+        except sqlite3.Error as e:
+            log.msg("unable to read the hash cache: %s" % (e,))
+            return None
+        if row is None or tuple(row[:3]) != (size, mtime_ns, inode):
+            return None
+        return bytes(row[3])
+
+    def put(self, key, kind, value):
+        path, size, mtime_ns, inode = key
+        try:
+            with self._lock:
+                try:
+                    self._db.execute("INSERT OR REPLACE INTO `files`"
+                                     " VALUES (?,?,?,?,?,?)",
+                                     (path, kind, size, mtime_ns, inode,
+                                      sqlite3.Binary(value)))
+                    self._db.commit()
+                except sqlite3.Error:
+                    # don't keep others waiting on a half-done transaction
+                    self._db.rollback()
+                    raise
+        except sqlite3.Error as e:
+            log.msg("unable to update the hash cache: %s" % (e,))
+
+    def close(self):
+        self._db.close()
+
+def open_cache(dbfile=None):
+    """Return a HashCache for 'dbfile' (by default, the one in the user's
+    cache directory), or None if it can't be opened."""
+    dbfile = dbfile or default_cache_file()
+    try:
+        parent = os.path.dirname(os.path.abspath(dbfile))
+        if not os.path.isdir(parent):
+            os.makedirs(parent)
+        return HashCache(dbfile)
+    except (EnvironmentError, sqlite3.Error) as e:
+        log.msg("not using the hash cache %s: %s" % (dbfile, e))
+        return None
@@ -0,0 +1,125 @@
+from __future__ import print_function, unicode_literals
+import os, mmap
+from twisted.python import log
+
+# The file a sender reads from. We tell the kernel that we read it once,
+# front to back: it can read ahead further, and we drop the pages we have
+# sent, so sending a file bigger than RAM doesn't push everything else out
+# of the page cache.
+#
+# With --mmap, we map the file too. That lets us hand the hasher
+# memoryviews straight out of the page cache (see resume.build_manifest),
+# and skips a read() call and its buffer for every record. Records still
+# need one copy, because the encryptor only takes bytes. But a file that
+# shrinks while it is mapped kills the process (SIGBUS) when we touch the
+# missing pages, where read() just comes up short and the transfer fails
+# cleanly, so mapping is only for files that nobody else is writing.
+
+DROP_BEHIND = 8*1024*1024
+
+def _fadvise(fd, offset, length, advice):
+    # (not on Windows, macOS, or python2)
+    if hasattr(os, "posix_fadvise") and hasattr(os, advice):
+        try:
+            os.posix_fadvise(fd, offset, length, getattr(os, advice))
+        except OSError as e:
+            log.msg("posix_fadvise(%s) failed: %s" % (advice, e))
+
+class SequentialFile:
+    """A read-only, seekable file object over 'f', which we will read
+    front to back."""
+    def __init__(self, f):
+        self._f = f
+        self.name = f.name
+        _fadvise(f.fileno(), 0, 0, "POSIX_FADV_SEQUENTIAL")
+        self._dropped = 0
+
+    def read(self, size=-1):
+        data = self._f.read(size)
+        self._drop_behind(self.tell())
+        return data
+
+    def _drop_behind(self, offset):
+        if offset - self._dropped >= 2*DROP_BEHIND:
+            # keep the last stretch, in case we are asked to go back a bit
+            end = offset - DROP_BEHIND
+            _fadvise(self._f.fileno(), self._dropped, end - self._dropped,
+                     "POSIX_FADV_DONTNEED")
+            self._dropped = end
+
+    def seek(self, offset, whence=0):
+        self._f.seek(offset, whence)
+        offset = self._f.tell()
+        self._dropped = min(self._dropped, offset)
+        return offset
+
+    def tell(self):
+        return self._f.tell()
+
+    def close(self):
+        self._f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+class MappedFile(SequentialFile):
+    """A SequentialFile that reads from a mapping of the file."""
+    def __init__(self, f):
+        self._size = os.fstat(f.fileno()).st_size
+        self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if hasattr(self._map, "madvise"): # python3.8 and up
+            self._map.madvise(mmap.MADV_SEQUENTIAL)
+        SequentialFile.__init__(self, f)
+        self._offset = 0
+
+    def view(self, size=-1):
+        """Like read(), but return a memoryview of the mapping instead of
+        copying. Release it before closing the file."""
+        start, end = self._advance(size)
+        return memoryview(self._map)[start:end]
+
+    def read(self, size=-1):
+        start, end = self._advance(size)
+        data = self._map[start:end]
+        self._drop_behind(self._offset)
+        return data
+
+    def _advance(self, size):
+        start = self._offset
+        if size is None or size < 0:
+            size = self._size
+        self._offset = min(self._size, start + size)
+        return start, self._offset
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self._offset
+        elif whence == 2:
+            offset += self._size
+        if offset < 0:
+            raise ValueError("negative seek position %d" % offset)
+        self._offset = offset
+        self._dropped = min(self._dropped, offset)
+        return offset
+
+    def tell(self):
+        return self._offset
+
+    def close(self):
+        self._map.close()
+        self._f.close()
+
+def open_for_sending(path, use_mmap=False):
+    """Open 'path' for reading, mapped if 'use_mmap' and we can."""
+    f = open(path, "rb")
+    if use_mmap:
+        try:
+            return MappedFile(f)
+        except (EnvironmentError, ValueError, OverflowError) as e:
+            # empty files can't be mapped, nor can e.g. pipes, and a 32-bit
+            # process runs out of address space
+            log.msg("not mapping %s: %s" % (path, e))
+    return SequentialFile(f)
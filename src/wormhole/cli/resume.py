@@ -0,0 +1,188 @@
+from __future__ import print_function, unicode_literals
+import os, json, hashlib
+from ..util import (bytes_to_hexstr, hexstr_to_bytes, dict_to_bytes,
+                    bytes_to_dict)
+from .hashcache import file_key
+
+# Resumable file transfers. The sender hashes the file in chunks before
+# making the offer, and includes the chunk size and the SHA-256 of each
+# chunk as offer["file"]["chunks-v1"]. The receiver writes into
+# DESTNAME.tmp as usual, and appends the index of each chunk it has written
+# and checked to DESTNAME.tmp.journal. If the transfer is interrupted, both
+# files are left behind. When the same file is offered again (with a new
+# code, or over a new transit connection), the receiver re-reads the
+# chunks the journal lists, stops at the first one that is missing or
+# doesn't match the new manifest, and answers with "resume-from" set to
+# where that chunk starts. The sender seeks there and sends the rest. The
+# final ack still carries the SHA-256 of the whole file, so both sides know
+# the reassembled file is right.
+
+CHUNK_SIZE = 4*1024*1024
+MAX_CHUNKS = 1024 # bigger files get bigger chunks, to keep the offer small
+
+def chunk_size_for(filesize):
+    size = CHUNK_SIZE
+    while size * MAX_CHUNKS < filesize:
+        size *= 2
+    return size
+
+def build_manifest(f, filesize):
+    """Read all of 'f' (from the start) and return (manifest, filehash),
+    where 'manifest' is the dict to put in the offer and 'filehash' is the
+    SHA-256 of the whole file. This blocks: run it in a thread."""
+    size = chunk_size_for(filesize)
+    hashes = []
+    filehasher = hashlib.sha256()
+    # a mapped.MappedFile can hash straight out of the page cache
+    read = getattr(f, "view", f.read)
+    f.seek(0, 0)
+    while True:
+        chunk = read(size)
+        if not chunk:
+            break
+        filehasher.update(chunk)
+        hashes.append(bytes_to_hexstr(hashlib.sha256(chunk).digest()))
+    f.seek(0, 0)
+    return {"size": size, "sha256": hashes}, filehasher.digest()
+
+def cached_manifest(path, f, filesize, cache=None):
+    """Like build_manifest(), for the file at 'path', but remember the
+    result in 'cache' (a hashcache.HashCache), and use what is there if the
+    file hasn't changed since."""
+    if cache is None:
+        return build_manifest(f, filesize)
+    key = file_key(path)
+    value = cache.get(key, "resume-v1")
+    if value is not None and key[1] == filesize:
+        d = bytes_to_dict(value)
+        return d["manifest"], hexstr_to_bytes(d["sha256"])
+    manifest, filehash = build_manifest(f, filesize)
+    cache.put(key, "resume-v1",
+              dict_to_bytes({"manifest": manifest,
+                             "sha256": bytes_to_hexstr(filehash)}))
+    return manifest, filehash
+
+def parse_manifest(manifest, filesize):
+    """Return (chunk_size, hashes) from an offer's "chunks-v1" entry, or
+    raise ValueError if it doesn't describe a file of 'filesize' bytes."""
+    size = manifest.get("size")
+    hashes = manifest.get("sha256")
+    if not isinstance(size, int) or size <= 0:
+        raise ValueError("bad chunk size")
+    if not isinstance(hashes, list):
+        raise ValueError("bad chunk hashes")
+    if len(hashes) != (filesize + size - 1) // size:
+        raise ValueError("wrong number of chunks")
+    for h in hashes:
+        if not isinstance(h, type("")) or len(h) != 64:
+            raise ValueError("bad chunk hash")
+    return size, hashes
+
+class Journal:
+    """I track the progress of a resumable download into 'tmp_name', in
+    'tmp_name'.journal. Call resume_point() (in a thread) to find where the
+    transfer can pick up, then update() with each piece of data as it is
+    written, in order. update() raises ValueError if a chunk doesn't match
+    the manifest."""
+
+    def __init__(self, tmp_name, filesize, chunk_size, hashes):
+        self._tmp_name = tmp_name
+        self._path = tmp_name + ".journal"
+        self._filesize = filesize
+        self._chunk_size = chunk_size
+        self._hashes = hashes
+        # the journal only applies to the file this manifest describes
+        self._header = hashlib.sha256(json.dumps(
+            [filesize, chunk_size, hashes]).encode("ascii")).hexdigest()
+        self._journal = None
+        self.filehasher = hashlib.sha256()
+
+    def _journaled_chunks(self):
+        try:
+            with open(self._path, "r") as f:
+                lines = f.read().split("\n")
+        except EnvironmentError:
+            return 0
+        if lines[0] != self._header:
+            return 0
+        done = 0
+        for line in lines[1:]:
+            if line != "%d" % done:
+                break # a torn last line, or the end
+            done += 1
+        return done
+
+    def resume_point(self):
+        """Return the offset to resume from: the start of the first chunk
+        that the journal doesn't list, or that doesn't match on disk. This
+        re-reads (and hashes) everything before that offset, so it
+        blocks."""
+        done = self._journaled_chunks()
+        verified = 0
+        if done and os.path.exists(self._tmp_name):
+            with open(self._tmp_name, "rb") as f:
+                for i in range(done):
+                    chunk = f.read(self._chunk_size)
+                    if not self._matches(i, chunk):
+                        break
+                    self.filehasher.update(chunk)
+                    verified += 1
+        self._verified = verified
+        return min(verified * self._chunk_size, self._filesize)
+
+    def _matches(self, index, chunk):
+        expected_size = min(self._chunk_size,
+                            self._filesize - index * self._chunk_size)
+        return (len(chunk) == expected_size and
+                bytes_to_hexstr(hashlib.sha256(chunk).digest())
+                == self._hashes[index])
+
+    def open(self):
+        """Open the temp file for writing from the resume point, and start
+        (or continue) the journal."""
+        offset = min(self._verified * self._chunk_size, self._filesize)
+        if offset:
+            f = open(self._tmp_name, "r+b")
+            f.seek(offset)
+            f.truncate()
+            self._journal = open(self._path, "w")
+            self._journal.write(self._header + "\n")
+            for i in range(self._verified):
+                self._journal.write("%d\n" % i)
+        else:
+            f = open(self._tmp_name, "wb")
+            self._journal = open(self._path, "w")
+            self._journal.write(self._header + "\n")
+        self._journal.flush()
+        self._next = self._verified
+        self._chunk = hashlib.sha256()
+        self._chunk_bytes = 0
+        return f
+
+    def update(self, data):
+        self.filehasher.update(data)
+        while data:
+            want = min(self._chunk_size,
+                       self._filesize - self._next * self._chunk_size)
+            take = data[:want - self._chunk_bytes]
+            data = data[len(take):]
+            self._chunk.update(take)
+            self._chunk_bytes += len(take)
+            if self._chunk_bytes == want:
+                digest = bytes_to_hexstr(self._chunk.digest())
+                if digest != self._hashes[self._next]:
+                    raise ValueError("chunk %d does not match" % self._next)
+                self._journal.write("%d\n" % self._next)
+                self._journal.flush()
+                self._next += 1
+                self._chunk = hashlib.sha256()
+                self._chunk_bytes = 0
+
+    def close(self):
+        if self._journal:
+            self._journal.close()
+            self._journal = None
+
+    def remove(self):
+        self.close()
+        os.unlink(self._path)
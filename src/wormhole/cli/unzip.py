@@ -0,0 +1,115 @@
+from __future__ import print_function, unicode_literals
+import os, sys, shutil, threading, multiprocessing
+from collections import deque
+from twisted.internet import defer, threads
+
+# Unpacking a received zipfile. This used to happen on the reactor, one
+# member at a time, with zipfile making (or checking for) the directories
+# of each one, so the reactor stalled until the last file was written. Now
+# we check every name first (nothing may land outside extract_dir), make
+# all the directories at once, and have a few threads take members from a
+# shared queue and copy each one out in pieces. zlib releases the GIL while
+# it inflates, so members really are decompressed in parallel, and memory
+# stays at one buffer per thread however big the members are. From python
+# 3.5, ZipFile lets several threads read members of one archive at once,
+# since each of them keeps its own position and seeks under a lock; before
+# that (and in python 2) they share the file's position, so there we use
+# one thread.
+
+MAX_WORKERS = 4
+BUFFER_SIZE = 1024*1024
+PARALLEL_READS = sys.version_info >= (3, 5)
+
+def workers():
+    if not PARALLEL_READS:
+        return 1
+    try:
+        return max(1, min(MAX_WORKERS, multiprocessing.cpu_count()))
+    except NotImplementedError:
+        return 1
+
+def out_path(name, extract_dir):
+    """Return where the member 'name' goes, or raise ValueError if that is
+    outside of 'extract_dir'."""
+    path = os.path.abspath(os.path.join(extract_dir, name))
+    # (not just a prefix: "../dest-evil" starts with "dest" too)
+    if path != extract_dir and not path.startswith(extract_dir + os.sep):
+        raise ValueError("malicious zipfile, %s outside of extract_dir %s"
+                         % (name, extract_dir))
+    return path
+
+def plan(infolist, extract_dir):
+    """Return (dirs, members): the directories to make, and a list of
+    (info, path) for each file to write."""
+    dirs = set([extract_dir])
+    paths = []
+    infos = {}
+    for info in infolist:
+        path = out_path(info.filename, extract_dir)
+        if info.filename.endswith("/"):
+            dirs.add(path)
+            continue
+        dirs.add(os.path.dirname(path))
+        if path not in infos:
+            paths.append(path)
+        # a name can appear twice: the last one wins, as it did when we
+        # extracted them in order
+        infos[path] = info
+    return sorted(dirs), [(infos[path], path) for path in paths]
+
+def extract_member(zf, info, path):
+    with zf.open(info) as src:
+        with open(path, "wb") as dst:
+            shutil.copyfileobj(src, dst, BUFFER_SIZE)
+            # the zipfile module does not restore file permissions, so we do
+            # it. Not sure why zipfiles store them 16 bits away, but they do.
+            perm = info.external_attr >> 16
+            if perm:
+                os.chmod(path, perm)
+
+class _Extractor:
+    def __init__(self, zf, members):
+        self._zf = zf
+        self._queue = deque(members)
+        self._failed = threading.Event()
+
+    def run(self):
+        # in a thread
+        try:
+            while not self._failed.is_set():
+                try:
+                    info, path = self._queue.popleft()
+                except IndexError:
+                    return
+                extract_member(self._zf, info, path)
+        except Exception:
+            # the other threads stop after their current member
+            self._failed.set()
+            raise
+
+def _prepare(zf, extract_dir):
+    # in a thread
+    dirs, members = plan(zf.infolist(), extract_dir)
+    for path in dirs:
+        if not os.path.isdir(path):
+            os.makedirs(path)
+    return members
+
+@defer.inlineCallbacks
+def extract(zf, extract_dir, reactor, num_workers=None):
+    """Unpack the open ZipFile 'zf' into 'extract_dir', on the reactor's
+    thread pool. Returns a Deferred that fires when every member has been
+    written."""
+    pool = reactor.getThreadPool()
+    extract_dir = os.path.abspath(extract_dir)
+    members = yield threads.deferToThreadPool(reactor, pool, _prepare, zf,
+                                              extract_dir)
+    extractor = _Extractor(zf, members)
+    num_workers = min(num_workers or workers(), max(1, len(members)))
+    # wait for all of them, so nothing is still writing when we return
+    results = yield defer.DeferredList(
+        [threads.deferToThreadPool(reactor, pool, extractor.run)
+         for i in range(num_workers)], consumeErrors=True)
+    for success, result in results:
+        if not success:
+            result.raiseException()
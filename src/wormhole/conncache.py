@@ -0,0 +1,110 @@
+from __future__ import print_function, unicode_literals
+import os, json, time, tempfile
+from twisted.python import log
+from .util import cache_dir
+
+# What Transit learned about connecting from each network we've been on:
+# which of the peer's addresses answered and which refused, whether the
+# direct connection or the relay won, and how long direct connections took
+# to establish. The same two machines usually end up on the same path, so
+# next time we try the addresses that worked first and the dead ones last,
+# start the relay straight away where direct connections never get
+# through, and start from the right attempt delay instead of the default.
+# A network is recognized by our own addresses. Addresses are remembered
+# without their port, since the listening port is new for every transfer.
+# The file is small JSON, rewritten whole (and atomically) after each
+# connection. It is only a cache: if it can't be read we start empty, and
+# if it can't be written we log that and carry on.
+
+MAX_NETWORKS = 20
+MAX_ADDRESSES = 50
+
+def default_cache_file():
+    return cache_dir("connections.json")
+
+class ConnectionCache:
+    def __init__(self, filename):
+        self._filename = filename
+        self._networks = {}
+        try:
+            with open(filename, "r") as f:
+                data = json.load(f)
+            if data.get("version") == 1:
+                self._networks = data["networks"]
+        except EnvironmentError:
+            pass # no cache yet
+        except (ValueError, KeyError, AttributeError) as e:
+            log.msg("ignoring damaged connection cache %s: %s"
+                    % (filename, e))
+
+    def _network(self, network):
+        n = self._networks.setdefault(network, {"addresses": {}})
+        n["used"] = time.time()
+        return n
+
+    def connect_time(self, network):
+        """Return how long direct connections took from 'network', or
+        None."""
+        return self._networks.get(network, {}).get("connect_time")
+
+    def set_connect_time(self, network, t):
+        self._network(network)["connect_time"] = t
+
+    def winner(self, network):
+        """Return "direct" or "relay", whichever won last time on
+        'network', or None."""
+        return self._networks.get(network, {}).get("winner")
+
+    def set_winner(self, network, kind):
+        self._network(network)["winner"] = kind
+
+    def rank(self, network, hostname):
+        """Return 1 if 'hostname' answered last time we tried it from
+        'network', -1 if it failed, 0 if we haven't tried it."""
+        addresses = self._networks.get(network, {}).get("addresses", {})
+        a = addresses.get(hostname)
+        if a is None:
+            return 0
+        return 1 if a["ok"] else -1
+
+    def record(self, network, hostname, ok):
+        """Remember whether a connection to 'hostname' worked."""
+        self._network(network)["addresses"][hostname] = {"ok": ok,
+                                                         "used": time.time()}
+
+    def _prune(self):
+        def newest(d, n):
+            return sorted(d, key=lambda k: d[k]["used"], reverse=True)[:n]
+        self._networks = dict((k, self._networks[k])
+                              for k in newest(self._networks, MAX_NETWORKS))
+        for n in self._networks.values():
+            addresses = n["addresses"]
+            n["addresses"] = dict((k, addresses[k])
+                                  for k in newest(addresses, MAX_ADDRESSES))
+
+    def save(self):
+        self._prune()
+        data = {"version": 1, "networks": self._networks}
+        try:
+            parent = os.path.dirname(os.path.abspath(self._filename))
+            fd, tmp_name = tempfile.mkstemp(dir=parent, suffix=".tmp")
+            with os.fdopen(fd, "w") as f:
+                json.dump(data, f)
+            if os.name == "nt" and os.path.exists(self._filename):
+                os.unlink(self._filename) # python2 can't rename over it
+            os.rename(tmp_name, self._filename)
+        except EnvironmentError as e:
+            log.msg("unable to update the connection cache: %s" % (e,))
+
+def open_cache(filename=None):
+    """Return a ConnectionCache for 'filename' (by default, the one in the
+    user's cache directory), or None if it can't be used."""
+    filename = filename or default_cache_file()
+    try:
+        parent = os.path.dirname(os.path.abspath(filename))
+        if not os.path.isdir(parent):
+            os.makedirs(parent)
+    except EnvironmentError as e:
+        log.msg("not using the connection cache %s: %s" % (filename, e))
+        return None
+    return ConnectionCache(filename)
@@ -48,9 +48,30 @@ def server(ctx):
     "--signal-error", is_flag=True,
     help="force all clients to fail with a message",
 )
+@click.option(
+    "--transit-max-bytes", default=None, type=int, metavar="BYTES",
+    help="drop relayed transit pairs after this many bytes",
+)
+@click.option(
+    "--transit-max-time", default=None, type=float, metavar="SECONDS",
+    help="drop relayed transit pairs after this many seconds",
+)
+@click.option(
+    "--transit-pair-rate", default=None, type=int, metavar="BYTES/SEC",
+    help="limit each direction of a relayed transit pair to this rate",
+)
+@click.option(
+    "--transit-bandwidth", default=None, type=int, metavar="BYTES/SEC",
+    help="total transit relay bandwidth, shared fairly by all pairs",
+)
+@click.option(
+    "--transit-socket-buffer", default=None, type=int, metavar="BYTES",
+    help="(advanced) SO_SNDBUF/SO_RCVBUF for transit sockets",
+)
 @click.pass_obj
 def start(cfg, signal_error, no_daemon, blur_usage, advertise_version,
-          transit, rendezvous):
+          transit, rendezvous, transit_max_bytes, transit_max_time,
+          transit_pair_rate, transit_bandwidth, transit_socket_buffer):
     """
     Start a relay server
     """
@@ -61,6 +82,11 @@ def start(cfg, signal_error, no_daemon, blur_usage, advertise_version,
     cfg.transit = str(transit)
     cfg.rendezvous = str(rendezvous)
     cfg.signal_error = signal_error
+    cfg.transit_max_bytes = transit_max_bytes
+    cfg.transit_max_time = transit_max_time
+    cfg.transit_pair_rate = transit_pair_rate
+    cfg.transit_bandwidth = transit_bandwidth
+    cfg.transit_socket_buffer = transit_socket_buffer
 
     start_server(cfg)
 
@@ -93,9 +119,30 @@ def start(cfg, signal_error, no_daemon, blur_usage, advertise_version,
     "--signal-error", is_flag=True,
     help="force all clients to fail with a message",
 )
+@click.option(
+    "--transit-max-bytes", default=None, type=int, metavar="BYTES",
+    help="drop relayed transit pairs after this many bytes",
+)
+@click.option(
+    "--transit-max-time", default=None, type=float, metavar="SECONDS",
+    help="drop relayed transit pairs after this many seconds",
+)
+@click.option(
+    "--transit-pair-rate", default=None, type=int, metavar="BYTES/SEC",
+    help="limit each direction of a relayed transit pair to this rate",
+)
+@click.option(
+    "--transit-bandwidth", default=None, type=int, metavar="BYTES/SEC",
+    help="total transit relay bandwidth, shared fairly by all pairs",
+)
+@click.option(
+    "--transit-socket-buffer", default=None, type=int, metavar="BYTES",
+    help="(advanced) SO_SNDBUF/SO_RCVBUF for transit sockets",
+)
 @click.pass_obj
 def restart(cfg, signal_error, no_daemon, blur_usage, advertise_version,
-            transit, rendezvous):
+            transit, rendezvous, transit_max_bytes, transit_max_time,
+            transit_pair_rate, transit_bandwidth, transit_socket_buffer):
     """
     Re-start a relay server
     """
@@ -106,6 +153,11 @@ def restart(cfg, signal_error, no_daemon, blur_usage, advertise_version,
     cfg.transit = str(transit)
     cfg.rendezvous = str(rendezvous)
     cfg.signal_error = signal_error
+    cfg.transit_max_bytes = transit_max_bytes
+    cfg.transit_max_time = transit_max_time
+    cfg.transit_pair_rate = transit_pair_rate
+    cfg.transit_bandwidth = transit_bandwidth
+    cfg.transit_socket_buffer = transit_socket_buffer
 
     restart_server(cfg)
 
@@ -11,11 +11,19 @@ class MyPlugin:
         # delay this import as late as possible, to allow twistd's code to
         # accept --reactor= selection
         from .server import RelayServer
+        from ..sockopts import socket_options
         return RelayServer(self.args.rendezvous, self.args.transit,
                            self.args.advertise_version,
                            "relay.sqlite", self.args.blur_usage,
                            signal_error=self.args.signal_error,
                            stats_file="stats.json",
+                           transit_limits=dict(
+                               max_length=self.args.transit_max_bytes,
+                               max_time=self.args.transit_max_time,
+                               pair_rate=self.args.transit_pair_rate,
+                               bandwidth=self.args.transit_bandwidth),
+                           transit_socket_options=socket_options(
+                               self.args.transit_socket_buffer),
                            )
 
 class MyTwistdConfig(twistd.ServerOptions):
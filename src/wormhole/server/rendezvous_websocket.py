@@ -53,6 +53,7 @@ from ..util import dict_to_bytes, bytes_to_dict
 #        current_cli_version: out-of-date clients display a warning
 #        motd: all clients display message, then continue normally
 #        error: all clients display mesage, then terminate with error
+#        transit_limits: {max_bytes:, max_time:, pair_rate:, bandwidth:}
 # -> {type: "bind", appid:, side:}
 #
 # -> {type: "list"} -> nameplates
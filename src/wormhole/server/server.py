@@ -34,7 +34,8 @@ class PrivacyEnhancedSite(server.Site):
 class RelayServer(service.MultiService):
     def __init__(self, rendezvous_web_port, transit_port,
                  advertise_version, db_url=":memory:", blur_usage=None,
-                 signal_error=None, stats_file=None):
+                 signal_error=None, stats_file=None, transit_limits=None,
+                 transit_socket_options=None):
         service.MultiService.__init__(self)
         self._blur_usage = blur_usage
 
@@ -58,6 +59,16 @@ class RelayServer(service.MultiService):
         if signal_error:
             welcome["error"] = signal_error
 
+        if transit_port:
+            # transit_limits is a dict of max_length=, max_time=, pair_rate=,
+            # and bandwidth= arguments for the Transit constructor
+            transit = Transit(db, blur_usage,
+                              socket_options=transit_socket_options,
+                              **(transit_limits or {}))
+            limits = transit.get_limits()
+            if limits:
+                welcome["transit_limits"] = limits
+
         self._rendezvous = Rendezvous(db, welcome, blur_usage)
         self._rendezvous.setServiceParent(self) # for the pruning timer
 
@@ -74,7 +85,6 @@ class RelayServer(service.MultiService):
         rendezvous_web_service.setServiceParent(self)
 
         if transit_port:
-            transit = Transit(db, blur_usage)
             transit.setServiceParent(self) # for the timer
             t = endpoints.serverFromString(reactor, transit_port)
             transit_service = internet.StreamServerEndpointService(t, transit)
@@ -1,8 +1,11 @@
-from __future__ import print_function, unicode_literals
-import re, time, collections
+from __future__ import print_function, unicode_literals, division
+import time, collections, string, math
+from collections import deque
+from zope.interface import implementer
 from twisted.python import log
-from twisted.internet import protocol
-from twisted.application import service
+from twisted.internet import protocol, interfaces, reactor
+from twisted.application import service, internet
+from ..sockopts import tune_transport
 
 SECONDS = 1.0
 MINUTE = 60*SECONDS
@@ -10,6 +13,78 @@ HOUR = 60*MINUTE
 DAY = 24*HOUR
 MB = 1000*1000
 
+RELAY_PREFIX = b"please relay "
+TOKEN_LENGTH = 32*2
+HANDSHAKE_LENGTH = len(RELAY_PREFIX) + TOKEN_LENGTH + len(b"\n")
+# the token may use the characters of a regexp "\w", i.e. [a-zA-Z0-9_]
+TOKEN_CHARS = (string.ascii_letters + string.digits + "_").encode("ascii")
+
+def parse_handshake(buf):
+    """Return the token from a complete HANDSHAKE_LENGTH-byte relay
+    handshake (bytes or bytearray), or None if it is malformed."""
+    token = bytes(buf[len(RELAY_PREFIX):-1])
+    if (not buf.startswith(RELAY_PREFIX)
+        or not buf.endswith(b"\n")
+        or token.translate(None, TOKEN_CHARS)):
+        return None
+    return token
+
+class Histogram(object):
+    # A log-linear histogram: each power of two is split into SUB_BUCKETS
+    # equal-width buckets, so any value is recorded within 1/SUB_BUCKETS
+    # (about 6%) of its true size, whether it is a few milliseconds or many
+    # gigabytes, in a handful of sparse dictionary entries.
+    SUB_BUCKETS = 16
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0
+        self.max = 0
+        self._zeros = 0
+        self._buckets = collections.defaultdict(int)
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+        if value <= 0:
+            self._zeros += 1
+            return
+        mantissa, exponent = math.frexp(value) # 0.5 <= mantissa < 1
+        sub = int((2*mantissa - 1) * self.SUB_BUCKETS)
+        self._buckets[exponent*self.SUB_BUCKETS + sub] += 1
+
+    def _lower_bound(self, index):
+        exponent, sub = divmod(index, self.SUB_BUCKETS)
+        return math.ldexp(1 + float(sub) / self.SUB_BUCKETS, exponent-1)
+
+    def buckets(self):
+        """Return a list of (lower_bound, count) pairs, in order."""
+        b = [(0, self._zeros)] if self._zeros else []
+        b.extend((self._lower_bound(index), self._buckets[index])
+                 for index in sorted(self._buckets))
+        return b
+
+    def percentile(self, fraction):
+        """Return the lower bound of the bucket holding the given fraction
+        (0..1) of the recorded values, or 0 if nothing has been recorded."""
+        remaining = fraction * self.count
+        for lower_bound, count in self.buckets():
+            remaining -= count
+            if remaining <= 0:
+                return lower_bound
+        return 0
+
+    def get_stats(self):
+        return {"count": self.count,
+                "total": self.total,
+                "max": self.max,
+                "p50": self.percentile(0.50),
+                "p90": self.percentile(0.90),
+                "p99": self.percentile(0.99),
+                "buckets": self.buckets(),
+                }
+
 def round_to(size, coarseness):
     return int(coarseness*(1+int((size-1)/coarseness)))
 
@@ -22,14 +97,72 @@ def blur_size(size):
         return round_to(size, 1e6)
     return round_to(size, 100e6)
 
+class TokenBucket:
+    """I meter a byte stream to 'rate' bytes per second, allowing bursts of
+    up to one second's worth of data. Time is supplied by the caller, so I
+    can be driven by a task.Clock in tests."""
+    def __init__(self, rate, now):
+        self.rate = rate
+        self._tokens = rate
+        self._last = now
+
+    def set_rate(self, rate, now):
+        self._refill(now)
+        self.rate = rate
+        self._tokens = min(self._tokens, rate)
+
+    def _refill(self, now):
+        elapsed = max(0, now - self._last)
+        self._last = now
+        self._tokens = min(self.rate, self._tokens + elapsed*self.rate)
+
+    def consume(self, amount, now):
+        """Remove 'amount' tokens. Returns the number of seconds the caller
+        should wait before sending more data (0 if it may continue)."""
+        self._refill(now)
+        self._tokens -= amount
+        if self._tokens >= 0:
+            return 0
+        return -self._tokens / self.rate
+
+def max_min_shares(capacity, demands):
+    """Split 'capacity' between flows that want 'demands' (None for a flow
+    that would take as much as it can get), max-min fairly: nobody gets more
+    than they want, and whatever the modest flows leave over is shared
+    equally by the rest. Returns a list of shares, in the same order."""
+    shares = [None] * len(demands)
+    order = sorted(range(len(demands)),
+                   key=lambda i: (demands[i] is None, demands[i]))
+    remaining = capacity
+    for n, i in enumerate(order):
+        fair = remaining / (len(order) - n)
+        want = demands[i]
+        shares[i] = fair if want is None else min(want, fair)
+        remaining -= shares[i]
+    return shares
+
+@implementer(interfaces.IPushProducer)
 class TransitConnection(protocol.Protocol):
     def __init__(self):
         self._got_token = False
-        self._token_buffer = b""
+        # the handshake has a fixed length, so if it arrives in pieces, we
+        # collect them in a bytearray of exactly that size
+        self._token_buffer = None
+        self._token_length = 0
         self._sent_ok = False
         self._buddy = None
         self._had_buddy = False
         self._total_sent = 0
+        self._finished = False
+        self._bucket = None
+        self._paused_by = set() # "consumer", "throttle"
+        self._unthrottle_call = None
+        self._max_time_call = None
+        # what we relayed since the Transit last asked, for its fair shares
+        self._recent_bytes = 0
+        self._recent_since = None
+        self._was_throttled = False
+        self.demand = None
 
     def describeToken(self):
         if self._got_token:
@@ -38,6 +171,8 @@ class TransitConnection(protocol.Protocol):
 
     def connectionMade(self):
         self._started = time.time()
+        tune_transport(self.transport, self.factory.socket_options)
+        self.factory.connection_started(self)
 
     def dataReceived(self, data):
         if self._sent_ok:
@@ -47,8 +182,15 @@ class TransitConnection(protocol.Protocol):
             # practice, this buffers about 10MB per connection, after which
             # point the sender will only transmit data as fast as the
             # receiver can handle it.
+            if self._too_long(len(data)):
+                log.msg("transit length limit exceeded %s"
+                        % self.describeToken())
+                self._drop_pair()
+                return
             self._total_sent += len(data)
+            self._recent_bytes += len(data)
             self._buddy.transport.write(data)
+            self._throttle(len(data))
             return
 
         if self._got_token: # but not yet sent_ok
@@ -57,27 +199,35 @@ class TransitConnection(protocol.Protocol):
             return self.disconnect() # impatience yields failure
 
         # else this should be (part of) the token
-        self._token_buffer += data
-        buf = self._token_buffer
-        wanted = len("please relay \n")+32*2
-        if len(buf) < wanted-1 and b"\n" in buf:
-            self.transport.write(b"bad handshake\n")
-            log.msg("transit handshake early failure")
-            return self.disconnect()
-        if len(buf) < wanted:
-            return
-        if len(buf) > wanted:
+        have = self._token_length + len(data)
+        if have > HANDSHAKE_LENGTH:
             self.transport.write(b"impatient\n")
             log.msg("transit impatience failure")
             return self.disconnect() # impatience yields failure
-        mo = re.search(br"^please relay (\w{64})\n", buf, re.M)
-        if not mo:
+        # any earlier newline would have been caught by a previous call
+        if have < HANDSHAKE_LENGTH-1 and b"\n" in data:
+            self.transport.write(b"bad handshake\n")
+            log.msg("transit handshake early failure")
+            return self.disconnect()
+        if have == len(data) == HANDSHAKE_LENGTH:
+            # the usual case: the whole handshake arrived at once
+            buf = data
+        else:
+            if self._token_buffer is None:
+                self._token_buffer = bytearray(HANDSHAKE_LENGTH)
+            memoryview(self._token_buffer)[self._token_length:have] = data
+            self._token_length = have
+            if have < HANDSHAKE_LENGTH:
+                return
+            buf = self._token_buffer
+        token = parse_handshake(buf)
+        if token is None:
             self.transport.write(b"bad handshake\n")
             log.msg("transit handshake failure")
             return self.disconnect() # incorrectness yields failure
-        token = mo.group(1)
 
         self._got_token = token
+        self._token_buffer = None
         self.factory.connection_got_token(token, self)
 
     def buddy_connected(self, them):
@@ -88,16 +238,102 @@ class TransitConnection(protocol.Protocol):
         # Connect the two as a producer/consumer pair. We use streaming=True,
         # so this expects the IPushProducer interface, and uses
         # pauseProducing() to throttle, and resumeProducing() to unthrottle.
-        self._buddy.transport.registerProducer(self.transport, True)
+        # We register ourselves rather than our transport, so that the
+        # buddy's backpressure and our own rate limiter can both pause the
+        # transport without one of them resuming it behind the other's back.
+        self._buddy.transport.registerProducer(self, True)
         # The Transit object calls buddy_connected() on both protocols, so
         # there will be two producer/consumer pairs.
+        max_time = self.factory.max_time
+        if max_time is not None:
+            self._max_time_call = self.factory._reactor.callLater(
+                max_time, self._time_limit_exceeded)
 
     def buddy_disconnected(self):
         log.msg("buddy_disconnected %s" % self.describeToken())
         self._buddy = None
         self.transport.loseConnection()
 
+    # IPushProducer, driven by our buddy's transport
+    def pauseProducing(self):
+        self._pause("consumer")
+    def resumeProducing(self):
+        self._resume("consumer")
+    def stopProducing(self):
+        self.transport.stopProducing()
+
+    def _pause(self, why):
+        if not self._paused_by:
+            self.transport.pauseProducing()
+        self._paused_by.add(why)
+
+    def _resume(self, why):
+        self._paused_by.discard(why)
+        if not self._paused_by:
+            self.transport.resumeProducing()
+
+    def set_rate(self, rate):
+        # called by the Transit whenever the fair share changes
+        now = self.factory._reactor.seconds()
+        if rate is None:
+            self._bucket = None
+        elif self._bucket is None:
+            self._bucket = TokenBucket(rate, now)
+        else:
+            self._bucket.set_rate(rate, now)
+
+    def measure_demand(self, now):
+        """Return the rate (bytes per second) we relayed since the last
+        call, or None if the rate limit held us back (so we'd take more)."""
+        since, self._recent_since = self._recent_since, now
+        used, self._recent_bytes = self._recent_bytes, 0
+        throttled = self._was_throttled or "throttle" in self._paused_by
+        self._was_throttled = False
+        if throttled or since is None or now <= since:
+            return None
+        return used / (now - since)
+
+    def _too_long(self, length):
+        # checked before forwarding, so a pair never goes over the limit
+        max_length = self.factory.max_length
+        if max_length is None or not self._buddy:
+            return False
+        total = self._total_sent + self._buddy._total_sent + length
+        return total > max_length
+
+    def _throttle(self, length):
+        if self._bucket:
+            delay = self._bucket.consume(length,
+                                         self.factory._reactor.seconds())
+            if delay and not self._unthrottle_call:
+                self._was_throttled = True
+                self._pause("throttle")
+                self._unthrottle_call = self.factory._reactor.callLater(
+                    delay, self._unthrottle)
+
+    def _unthrottle(self):
+        self._unthrottle_call = None
+        self._resume("throttle")
+
+    def _time_limit_exceeded(self):
+        self._max_time_call = None
+        log.msg("transit time limit exceeded %s" % self.describeToken())
+        self._drop_pair()
+
+    def _drop_pair(self):
+        # dropping our side makes connectionLost() drop the buddy too
+        self.transport.loseConnection()
+
+    def _cancel_timers(self):
+        for name in ["_unthrottle_call", "_max_time_call"]:
+            call = getattr(self, name)
+            if call and call.active():
+                call.cancel()
+            setattr(self, name, None)
+
     def connectionLost(self, reason):
+        self._finished = True
+        self._cancel_timers()
         if self._buddy:
             self._buddy.buddy_disconnected()
         self.factory.transitFinished(self, self._got_token,
@@ -143,10 +379,28 @@ class Transit(protocol.ServerFactory, service.MultiService):
     # You will not receive "ok\n" until the other side has also connected and
     # submitted a matching token. The token is the same for each side.
 
-    # In addition, the connections will be dropped after MAXLENGTH bytes have
-    # been sent by either side, or MAXTIME seconds have elapsed after the
-    # matching connections were established. A future API will reveal these
-    # limits to clients instead of causing mysterious spontaneous failures.
+    # In addition, the operator may configure a limit on the number of bytes
+    # relayed for each pair (max_length, counting both directions) and on the
+    # time a pair may stay connected after the match (max_time). Both are
+    # disabled by default, and MAXLENGTH/MAXTIME are merely suggested values.
+    # Any configured limits are revealed to clients in the rendezvous
+    # "welcome" message (see get_limits()), instead of causing mysterious
+    # spontaneous failures.
+
+    # Bandwidth can be limited too. 'pair_rate' caps each direction of a
+    # relayed pair (bytes per second), and 'bandwidth' is a budget for the
+    # whole relay, which is split max-min fairly between all active
+    # connections (so one huge transfer cannot starve every other pair, but
+    # the share of a pair that is idle or slow goes to the ones that can
+    # use it). Every REBALANCE_INTERVAL we look at what each connection
+    # relayed: one that kept to its rate gets what it used (times
+    # DEMAND_GROWTH, so it can speed up, and at least IDLE_RATE), and the
+    # rest is divided between the ones that hit their limit. Each
+    # connection meters its data with a TokenBucket, and pauses reading
+    # from its socket when it runs dry.
+    REBALANCE_INTERVAL = 1*SECONDS
+    DEMAND_GROWTH = 2.0
+    IDLE_RATE = 1000
 
     # These relay connections are not half-closeable (unlike full TCP
     # connections, applications will not receive any data after half-closing
@@ -155,32 +409,156 @@ class Transit(protocol.ServerFactory, service.MultiService):
     # transferring in both directions. Applications which only need to send
     # data in one direction can use close() as usual.
 
+    # Usage is counted in memory (for get_stats) and written to the
+    # database in batches, so the relay never waits on a commit between
+    # connections. Rows reach the database within FLUSH_INTERVAL, or sooner
+    # when FLUSH_ROWS of them are queued, and when the service stops.
+    FLUSH_INTERVAL = 1*MINUTE
+    FLUSH_ROWS = 1000
+
     MAX_WAIT_TIME = 30*SECONDS
     MAXLENGTH = 10*MB
     MAXTIME = 60*SECONDS
     protocol = TransitConnection
 
-    def __init__(self, db, blur_usage):
+    def __init__(self, db, blur_usage, max_length=None, max_time=None,
+                 pair_rate=None, bandwidth=None, socket_options=None):
         service.MultiService.__init__(self)
         self._db = db
         self._blur_usage = blur_usage
+        self.max_length = max_length
+        self.max_time = max_time
+        self._pair_rate = pair_rate
+        self._bandwidth = bandwidth
+        self.socket_options = socket_options
+        self._reactor = reactor # tests replace this with a task.Clock
         self._pending_requests = {} # token -> TransitConnection
+        self._pending_tokens = {} # TransitConnection -> token
+        # Every connection must be matched within MAX_WAIT_TIME of arriving.
+        # Since that delay is constant, appending (deadline, connection) as
+        # they arrive keeps this queue in deadline order, and one timer
+        # (for the head of the queue) is enough to expire them all.
+        self._expirations = deque()
+        self._expiration_call = None
         self._active_connections = set() # TransitConnection
+        self._rebalance_call = None
         self._counts = collections.defaultdict(int)
         self._count_bytes = 0
+        self._pair_bytes = Histogram()
+        self._pair_time = Histogram()
+        self._usage_rows = []
+        # all-time totals are read once, then kept up to date in memory
+        self._all_time_counts = collections.defaultdict(int)
+        self._all_time_bytes = 0
+        for row in db.execute("SELECT `result`, COUNT() AS `count`,"
+                              " SUM(`total_bytes`) AS `bytes`"
+                              " FROM `transit_usage`"
+                              " GROUP BY `result`").fetchall():
+            self._all_time_counts[row["result"]] = row["count"]
+            self._all_time_bytes += row["bytes"] or 0
+        t = internet.TimerService(self.FLUSH_INTERVAL, self._flush_usage)
+        t.setServiceParent(self)
+
+    def get_limits(self):
+        # this is published in the rendezvous server's welcome message
+        limits = {}
+        if self.max_length is not None:
+            limits["max_bytes"] = self.max_length
+        if self.max_time is not None:
+            limits["max_time"] = self.max_time
+        if self._pair_rate is not None:
+            limits["pair_rate"] = self._pair_rate
+        if self._bandwidth is not None:
+            limits["bandwidth"] = self._bandwidth
+        return limits
+
+    def _fair_shares(self):
+        # returns a list of (connection, rate), where rate None is unlimited
+        conns = list(self._active_connections)
+        if self._bandwidth is None:
+            return [(p, self._pair_rate) for p in conns]
+        demands = []
+        for p in conns:
+            want = p.demand
+            if want is not None:
+                want = max(want * self.DEMAND_GROWTH, self.IDLE_RATE)
+            if self._pair_rate is not None:
+                want = min(want if want is not None else self._pair_rate,
+                           self._pair_rate)
+            demands.append(want)
+        return list(zip(conns, max_min_shares(self._bandwidth, demands)))
+
+    def _rebalance(self):
+        for p, rate in self._fair_shares():
+            p.set_rate(rate)
+        if self._bandwidth is None or not self._active_connections:
+            self._stop_rebalancing()
+        elif not self._rebalance_call:
+            self._rebalance_call = self._reactor.callLater(
+                self.REBALANCE_INTERVAL, self._measure)
+
+    def _measure(self):
+        self._rebalance_call = None
+        now = self._reactor.seconds()
+        for p in self._active_connections:
+            p.demand = p.measure_demand(now)
+        self._rebalance()
+
+    def _stop_rebalancing(self):
+        if self._rebalance_call and self._rebalance_call.active():
+            self._rebalance_call.cancel()
+        self._rebalance_call = None
+
+    def connection_started(self, p):
+        deadline = self._reactor.seconds() + self.MAX_WAIT_TIME
+        self._expirations.append((deadline, p))
+        if not self._expiration_call:
+            self._expiration_call = self._reactor.callLater(
+                self.MAX_WAIT_TIME, self._expire)
+
+    def _expire(self):
+        self._expiration_call = None
+        now = self._reactor.seconds()
+        while self._expirations and self._expirations[0][0] <= now:
+            deadline, p = self._expirations.popleft()
+            # connections which were matched, or have already gone away,
+            # are left in the queue until their deadline passes
+            if not p._had_buddy and not p._finished:
+                log.msg("transit expired: %s" % p.describeToken())
+                self._remove_pending(p)
+                p.transport.loseConnection()
+        if self._expirations:
+            delay = max(0, self._expirations[0][0] - now)
+            self._expiration_call = self._reactor.callLater(delay,
+                                                            self._expire)
+
+    def stopService(self):
+        if self._expiration_call and self._expiration_call.active():
+            self._expiration_call.cancel()
+        self._expiration_call = None
+        self._stop_rebalancing()
+        self._flush_usage()
+        return service.MultiService.stopService(self)
+
+    def _remove_pending(self, p):
+        token = self._pending_tokens.pop(p, None)
+        if token is not None:
+            del self._pending_requests[token]
 
     def connection_got_token(self, token, p):
         if token in self._pending_requests:
             log.msg("transit relay 2: %s" % p.describeToken())
             buddy = self._pending_requests.pop(token)
+            del self._pending_tokens[buddy]
             self._active_connections.add(p)
             self._active_connections.add(buddy)
+            self._rebalance()
             p.buddy_connected(buddy)
             buddy.buddy_connected(p)
         else:
             self._pending_requests[token] = p
+            self._pending_tokens[p] = token
             log.msg("transit relay 1: %s" % p.describeToken())
-            # TODO: timer
 
     def recordUsage(self, started, result, total_bytes,
                     total_time, waiting_time):
@@ -188,23 +566,35 @@ class Transit(protocol.ServerFactory, service.MultiService):
         if self._blur_usage:
             started = self._blur_usage * (started // self._blur_usage)
             total_bytes = blur_size(total_bytes)
-        self._db.execute("INSERT INTO `transit_usage`"
-                         " (`started`, `total_time`, `waiting_time`,"
-                         "  `total_bytes`, `result`)"
-                         " VALUES (?,?,?, ?,?)",
-                         (started, total_time, waiting_time,
-                          total_bytes, result))
-        self._db.commit()
+        self._usage_rows.append((started, total_time, waiting_time,
+                                 total_bytes, result))
         self._counts[result] += 1
         self._count_bytes += total_bytes
+        self._all_time_counts[result] += 1
+        self._all_time_bytes += total_bytes
+        if result == "happy":
+            self._pair_bytes.add(total_bytes)
+            self._pair_time.add(total_time)
+        if len(self._usage_rows) >= self.FLUSH_ROWS:
+            self._flush_usage()
+
+    def _flush_usage(self):
+        if not self._usage_rows:
+            return
+        rows, self._usage_rows = self._usage_rows, []
+        self._db.executemany("INSERT INTO `transit_usage`"
+                             " (`started`, `total_time`, `waiting_time`,"
+                             "  `total_bytes`, `result`)"
+                             " VALUES (?,?,?, ?,?)",
+                             rows)
+        self._db.commit()
 
     def transitFinished(self, p, token, description):
-        for token,tc in self._pending_requests.items():
-            if tc is p:
-                del self._pending_requests[token]
-                break
+        self._remove_pending(p)
         log.msg("transitFinished %s" % (description,))
-        self._active_connections.discard(p)
+        if p in self._active_connections:
+            self._active_connections.discard(p)
+            self._rebalance()
 
     def transitFailed(self, p):
         log.msg("transitFailed %r" % p)
@@ -212,13 +602,9 @@ class Transit(protocol.ServerFactory, service.MultiService):
 
     def get_stats(self):
         stats = {}
-        def q(query, values=()):
-            row = self._db.execute(query, values).fetchone()
-            return list(row.values())[0]
-
         # current status: expected to be zero most of the time
         c = stats["active"] = {}
-        c["connected"] = len(self._active_connections) / 2
+        c["connected"] = len(self._active_connections) // 2
         c["waiting"] = len(self._pending_requests)
 
         # usage since last reboot
@@ -228,17 +614,16 @@ class Transit(protocol.ServerFactory, service.MultiService):
         rbm = rb["moods"] = {}
         for result, count in self._counts.items():
             rbm[result] = count
+        # and the shape of it, for happy pairs
+        rb["pair_bytes"] = self._pair_bytes.get_stats()
+        rb["pair_time"] = self._pair_time.get_stats()
 
         # historical usage (all-time)
         u = stats["all_time"] = {}
-        u["total"] = q("SELECT COUNT() FROM `transit_usage`")
-        u["bytes"] = q("SELECT SUM(`total_bytes`) FROM `transit_usage`") or 0
+        u["total"] = sum(self._all_time_counts.values(), 0)
+        u["bytes"] = self._all_time_bytes
         um = u["moods"] = {}
-        um["happy"] = q("SELECT COUNT() FROM `transit_usage`"
-                        " WHERE `result`='happy'")
-        um["lonely"] = q("SELECT COUNT() FROM `transit_usage`"
-                         " WHERE `result`='lonely'")
-        um["errory"] = q("SELECT COUNT() FROM `transit_usage`"
-                         " WHERE `result`='errory'")
+        for result in ["happy", "lonely", "errory"]:
+            um[result] = self._all_time_counts[result]
 
         return stats
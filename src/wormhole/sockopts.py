@@ -0,0 +1,66 @@
+# no unicode_literals
+# Socket tuning for Transit data connections (both the client side in
+# transit.py and the relay in server/transit_server.py).
+
+import sys, socket
+from collections import namedtuple
+from twisted.python import log
+
+# sndbuf/rcvbuf: SO_SNDBUF/SO_RCVBUF in bytes, or None to leave the kernel's
+#  buffer auto-tuning alone. Setting them disables auto-tuning on Linux, so
+#  only do it when the defaults are known to be too small for the
+#  bandwidth-delay product of the path (e.g. fast long-haul links).
+# nodelay: TCP_NODELAY. We write whole records, so Nagle only adds latency.
+# notsent_lowat: TCP_NOTSENT_LOWAT in bytes, or None. This keeps the amount
+#  of unsent data in the kernel small, so backpressure reaches our producers
+#  (and the relay's token buckets) quickly, without limiting the window.
+# keepalive: SO_KEEPALIVE, so half-dead NAT mappings get noticed.
+SocketOptions = namedtuple("SocketOptions",
+                           ["sndbuf", "rcvbuf", "nodelay", "notsent_lowat",
+                            "keepalive"])
+
+DEFAULT_SOCKET_OPTIONS = SocketOptions(sndbuf=None, rcvbuf=None,
+                                       nodelay=True,
+                                       notsent_lowat=128*1024,
+                                       keepalive=True)
+
+TCP_NOTSENT_LOWAT = getattr(socket, "TCP_NOTSENT_LOWAT",
+                            25 if sys.platform.startswith("linux") else None)
+
+def socket_options(buffer_size=None):
+    """Return the default SocketOptions, with SO_SNDBUF and SO_RCVBUF set to
+    'buffer_size' if it is not None."""
+    if buffer_size is None:
+        return DEFAULT_SOCKET_OPTIONS
+    return DEFAULT_SOCKET_OPTIONS._replace(sndbuf=buffer_size,
+                                           rcvbuf=buffer_size)
+
+def _settings(options):
+    if options.sndbuf is not None:
+        yield socket.SOL_SOCKET, socket.SO_SNDBUF, options.sndbuf
+    if options.rcvbuf is not None:
+        yield socket.SOL_SOCKET, socket.SO_RCVBUF, options.rcvbuf
+    if options.nodelay:
+        yield socket.IPPROTO_TCP, socket.TCP_NODELAY, 1
+    if options.notsent_lowat is not None and TCP_NOTSENT_LOWAT is not None:
+        yield socket.IPPROTO_TCP, TCP_NOTSENT_LOWAT, options.notsent_lowat
+    if options.keepalive:
+        yield socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1
+
+def tune_transport(transport, options):
+    """Apply SocketOptions to the TCP socket underneath a Twisted transport.
+    Transports without a real TCP socket (e.g. in tests, or when tunnelled)
+    are left alone, as are individual options the platform rejects."""
+    if options is None:
+        return
+    try:
+        sock = transport.getHandle()
+    except AttributeError:
+        return
+    if not isinstance(sock, socket.socket):
+        return
+    for level, name, value in _settings(options):
+        try:
+            sock.setsockopt(level, name, value)
+        except (EnvironmentError, socket.error) as e:
+            log.msg("unable to set socket option %r=%r: %s" % (name, value, e))
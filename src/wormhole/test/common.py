@@ -1,4 +1,5 @@
 # no unicode_literals untill twisted update
+import os
 from twisted.application import service
 from twisted.internet import defer, task
 from twisted.python import log
@@ -11,6 +12,10 @@ from .. import __version__
 
 class ServerBase:
     def setUp(self):
+        # the clients keep their caches here, rather than in the user's
+        # ~/.cache
+        cache_home = os.path.abspath(self.mktemp())
+        self.patch(os, "environ", dict(os.environ, XDG_CACHE_HOME=cache_home))
         self._setup_relay(None)
 
     def _setup_relay(self, error):
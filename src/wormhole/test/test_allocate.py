@@ -0,0 +1,69 @@
+from __future__ import print_function, unicode_literals
+import os, mmap, errno
+from twisted.trial import unittest
+from ..cli import allocate
+
+class Preallocate(unittest.TestCase):
+    def test_free_space(self):
+        free = allocate.free_space(".")
+        if free is None:
+            raise unittest.SkipTest("no statvfs here")
+        self.assertTrue(free > 0)
+        self.assertEqual(allocate.free_space(self.mktemp()), None)
+
+    def test_preallocate(self):
+        fn = self.mktemp()
+        with open(fn, "wb") as f:
+            if not allocate.preallocate(f, 10000):
+                raise unittest.SkipTest("no posix_fallocate here")
+            f.write(b"a"*100)
+        self.assertEqual(os.path.getsize(fn), 10000)
+        with open(fn, "wb") as f:
+            self.assertEqual(allocate.preallocate(f, 0), False)
+
+    def test_full(self):
+        if not hasattr(os, "posix_fallocate"):
+            raise unittest.SkipTest("no posix_fallocate here")
+        def full(fd, offset, length):
+            raise OSError(errno.ENOSPC, "No space left on device")
+        self.patch(os, "posix_fallocate", full)
+        with open(self.mktemp(), "wb") as f:
+            e = self.assertRaises(EnvironmentError,
+                                  allocate.preallocate, f, 10)
+        self.assertEqual(e.errno, errno.ENOSPC)
+
+    def test_unsupported(self):
+        if not hasattr(os, "posix_fallocate"):
+            raise unittest.SkipTest("no posix_fallocate here")
+        def unsupported(fd, offset, length):
+            raise OSError(errno.EOPNOTSUPP, "Operation not supported")
+        self.patch(os, "posix_fallocate", unsupported)
+        with open(self.mktemp(), "wb") as f:
+            self.assertEqual(allocate.preallocate(f, 10), False)
+
+PAGE = mmap.PAGESIZE
+
+class Direct(unittest.TestCase):
+    def test_write(self):
+        if not hasattr(os, "O_DIRECT"):
+            raise unittest.SkipTest("no O_DIRECT here")
+        fn = self.mktemp()
+        try:
+            f = allocate.DirectWriter(fn, block_size=PAGE*2)
+        except EnvironmentError as e:
+            raise unittest.SkipTest("O_DIRECT unsupported here: %s" % e)
+        data = os.urandom(PAGE*5 + 10)
+        with f:
+            f.write(data[:100])
+            f.write(data[100:PAGE*3])
+            f.write(data[PAGE*3:])
+        with open(fn, "rb") as f:
+            self.assertEqual(f.read(), data)
+
+    def test_open_direct(self):
+        fn = self.mktemp()
+        f = allocate.open_direct(fn)
+        f.write(b"data")
+        f.close()
+        with open(fn, "rb") as f:
+            self.assertEqual(f.read(), b"data")
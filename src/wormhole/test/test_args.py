@@ -32,6 +32,13 @@ class Send(unittest.TestCase):
         self.assertEqual(cfg.what, None)
         self.assertEqual(cfg.text, u"hi")
 
+    def test_batch(self):
+        cfg = config("send", "fn")
+        self.assertEqual(cfg.batch, [])
+        cfg = config("send", "fn1", "fn2")
+        self.assertEqual(cfg.what, None)
+        self.assertEqual(cfg.batch, [u"fn1", u"fn2"])
+
     def test_nolisten(self):
         cfg = config("send", "--no-listen", "fn")
         self.assertEqual(cfg.listen, False)
@@ -56,6 +63,66 @@ class Send(unittest.TestCase):
         cfg = config("send", "--tor", "fn")
         self.assertEqual(cfg.tor, True)
 
+    def test_transit_socket_buffer(self):
+        cfg = config("send", "fn")
+        self.assertEqual(cfg.transit_socket_buffer, None)
+        cfg = config("send", "--transit-socket-buffer", "4194304", "fn")
+        self.assertEqual(cfg.transit_socket_buffer, 4194304)
+
+    def test_transit_streams(self):
+        cfg = config("send", "fn")
+        self.assertEqual(cfg.transit_streams, 1)
+        cfg = config("send", "--transit-streams", "4", "fn")
+        self.assertEqual(cfg.transit_streams, 4)
+
+    def test_connection_cache(self):
+        cfg = config("send", "fn")
+        self.assertEqual(cfg.connection_cache, None)
+        cfg = config("send", "--connection-cache", "conns", "fn")
+        self.assertEqual(cfg.connection_cache, u"conns")
+
+    def test_resumable(self):
+        cfg = config("send", "fn")
+        self.assertEqual(cfg.resumable, False)
+        cfg = config("send", "--resumable", "fn")
+        self.assertEqual(cfg.resumable, True)
+
+    def test_stream(self):
+        cfg = config("send", "fn")
+        self.assertEqual(cfg.stream, False)
+        cfg = config("send", "--stream", "fn")
+        self.assertEqual(cfg.stream, True)
+
+    def test_delta(self):
+        cfg = config("send", "fn")
+        self.assertEqual(cfg.delta, False)
+        cfg = config("send", "--delta", "fn")
+        self.assertEqual(cfg.delta, True)
+
+    def test_dedup(self):
+        cfg = config("send", "fn")
+        self.assertEqual(cfg.dedup, False)
+        cfg = config("send", "--dedup", "fn")
+        self.assertEqual(cfg.dedup, True)
+
+    def test_hash_cache(self):
+        cfg = config("send", "fn")
+        self.assertEqual(cfg.hash_cache, None)
+        cfg = config("send", "--hash-cache", "hashes", "fn")
+        self.assertEqual(cfg.hash_cache, u"hashes")
+
+    def test_compress_level(self):
+        cfg = config("send", "fn")
+        self.assertEqual(cfg.compress_level, 6)
+        cfg = config("send", "--compress-level", "0", "fn")
+        self.assertEqual(cfg.compress_level, 0)
+
+    def test_mmap(self):
+        cfg = config("send", "fn")
+        self.assertEqual(cfg.use_mmap, False)
+        cfg = config("send", "--mmap", "fn")
+        self.assertEqual(cfg.use_mmap, True)
+
     def test_verify(self):
         cfg = config("send", "--verify", "fn")
         self.assertEqual(cfg.verify, True)
@@ -106,6 +173,18 @@ class Receive(unittest.TestCase):
         cfg = config("receive", "--tor")
         self.assertEqual(cfg.tor, True)
 
+    def test_transit_socket_buffer(self):
+        cfg = config("receive", "--transit-socket-buffer", "4194304")
+        self.assertEqual(cfg.transit_socket_buffer, 4194304)
+
+    def test_transit_streams(self):
+        cfg = config("receive", "--transit-streams", "4")
+        self.assertEqual(cfg.transit_streams, 4)
+
+    def test_connection_cache(self):
+        cfg = config("receive", "--connection-cache", "conns")
+        self.assertEqual(cfg.connection_cache, u"conns")
+
     def test_verify(self):
         cfg = config("receive", "--verify")
         self.assertEqual(cfg.verify, True)
@@ -122,10 +201,64 @@ class Receive(unittest.TestCase):
         cfg = config("receive", "--accept-file")
         self.assertEqual(cfg.accept_file, True)
 
+    def test_update(self):
+        cfg = config("receive")
+        self.assertEqual(cfg.update, False)
+        cfg = config("receive", "--update")
+        self.assertEqual(cfg.update, True)
+        # accepting files doesn't let the sender replace them
+        cfg = config("receive", "--accept-file")
+        self.assertEqual(cfg.update, False)
+
     def test_output_file(self):
         cfg = config("receive", "--output-file", "fn")
         self.assertEqual(cfg.output_file, u"fn")
 
+    def test_direct_io(self):
+        cfg = config("receive")
+        self.assertEqual(cfg.direct_io, False)
+        cfg = config("receive", "--direct-io")
+        self.assertEqual(cfg.direct_io, True)
+
+    def test_chunk_cache(self):
+        cfg = config("receive")
+        self.assertEqual(cfg.chunk_cache, None)
+        cfg = config("receive", "--chunk-cache", "chunks")
+        self.assertEqual(cfg.chunk_cache, u"chunks")
+
+    def test_chunk_cache_size(self):
+        cfg = config("receive")
+        self.assertEqual(cfg.chunk_cache_size, 1024)
+        cfg = config("receive", "--chunk-cache-size", "0")
+        self.assertEqual(cfg.chunk_cache_size, 0)
+
+class Session(unittest.TestCase):
+    def test_baseline(self):
+        cfg = config("session")
+        self.assertEqual(cfg.code, None)
+        self.assertEqual(cfg.code_length, 2)
+        self.assertEqual(cfg.compress_level, 6)
+        self.assertEqual(cfg.listen, True)
+        self.assertEqual(cfg.transit_streams, 1)
+
+    def test_code(self):
+        cfg = config("session", "1-abc")
+        self.assertEqual(cfg.code, u"1-abc")
+
+    def test_compress_level(self):
+        cfg = config("session", "--compress-level", "0")
+        self.assertEqual(cfg.compress_level, 0)
+
+    def test_dedup(self):
+        cfg = config("session", "--dedup")
+        self.assertEqual(cfg.dedup, True)
+
+    def test_mmap(self):
+        cfg = config("session")
+        self.assertEqual(cfg.use_mmap, False)
+        cfg = config("session", "--mmap")
+        self.assertEqual(cfg.use_mmap, True)
+
 class Config(unittest.TestCase):
     def test_send(self):
         cfg = config("send")
@@ -0,0 +1,55 @@
+from __future__ import print_function, unicode_literals
+import os
+from twisted.trial import unittest
+from ..cli import compression
+
+class Negotiate(unittest.TestCase):
+    def test_available(self):
+        names = compression.available()
+        self.assertEqual(names[-1], "zlib")
+        for name in names:
+            self.assertIn(name, compression.CODECS)
+
+    def test_choose(self):
+        self.assertEqual(compression.choose(["brotli", "zlib"]), "zlib")
+        self.assertEqual(compression.choose(["brotli"]), None)
+        self.assertEqual(compression.choose([]), None)
+        self.assertEqual(compression.choose(None), None)
+        self.assertEqual(compression.choose("zlib"), None)
+
+class Framing(unittest.TestCase):
+    def roundtrip(self, name):
+        p = compression.Packer(name)
+        u = compression.Unpacker(name)
+        text = b"ponies " * 10000
+        noise = os.urandom(100000)
+        for data in [text, noise, text[:10], b""]:
+            record = p(data)
+            self.assertEqual(u(record), data)
+        # compressible records shrink, the rest are sent as they are
+        self.assertEqual(p(text)[:1], compression.PACKED)
+        self.assertTrue(len(p(text)) < len(text) / 10)
+        self.assertEqual(p(noise), compression.RAW + noise)
+        # the sample comes from the middle of the record
+        self.assertEqual(p(noise + text + noise)[:1], compression.PACKED)
+        # records that decompress to too much are refused
+        small = compression.Unpacker(name, limit=1000)
+        self.assertRaises(ValueError, small, p(text))
+
+    def test_zlib(self):
+        self.roundtrip("zlib")
+
+    def test_zstd(self):
+        if "zstd" not in compression.CODECS:
+            raise unittest.SkipTest("zstandard is not installed")
+        self.roundtrip("zstd")
+
+    def test_lz4(self):
+        if "lz4" not in compression.CODECS:
+            raise unittest.SkipTest("lz4 is not installed")
+        self.roundtrip("lz4")
+
+    def test_bad_framing(self):
+        u = compression.Unpacker("zlib")
+        self.assertRaises(ValueError, u, b"\x02data")
+        self.assertRaises(Exception, u, compression.PACKED + b"not zlib")
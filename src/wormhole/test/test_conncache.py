@@ -0,0 +1,73 @@
+from __future__ import print_function, unicode_literals
+import os
+from twisted.trial import unittest
+from .. import conncache
+
+class Cache(unittest.TestCase):
+    def test_cache(self):
+        fn = self.mktemp()
+        c = conncache.open_cache(fn)
+        self.assertEqual(c.connect_time("net"), None)
+        self.assertEqual(c.winner("net"), None)
+        self.assertEqual(c.rank("net", "10.0.0.2"), 0)
+        c.set_connect_time("net", 0.25)
+        c.set_winner("net", "direct")
+        c.record("net", "10.0.0.2", True)
+        c.record("net", "10.0.0.3", False)
+        self.assertFalse(os.path.exists(fn))
+        c.save()
+
+        c = conncache.open_cache(fn)
+        self.assertEqual(c.connect_time("net"), 0.25)
+        self.assertEqual(c.winner("net"), "direct")
+        self.assertEqual(c.rank("net", "10.0.0.2"), 1)
+        self.assertEqual(c.rank("net", "10.0.0.3"), -1)
+        # other networks are separate
+        self.assertEqual(c.rank("other", "10.0.0.2"), 0)
+        # only the latest outcome counts
+        c.record("net", "10.0.0.2", False)
+        self.assertEqual(c.rank("net", "10.0.0.2"), -1)
+
+    def test_prune(self):
+        self.patch(conncache, "MAX_NETWORKS", 2)
+        self.patch(conncache, "MAX_ADDRESSES", 2)
+        clock = iter(range(100))
+        self.patch(conncache.time, "time", lambda: next(clock))
+        fn = self.mktemp()
+        c = conncache.open_cache(fn)
+        for i in range(3):
+            c.set_winner("net%d" % i, "relay")
+            c.record("net2", "10.0.0.%d" % i, True)
+        c.save()
+        c = conncache.open_cache(fn)
+        self.assertEqual(c.winner("net0"), None)
+        self.assertEqual(c.winner("net1"), "relay")
+        self.assertEqual(c.rank("net2", "10.0.0.0"), 0)
+        self.assertEqual(c.rank("net2", "10.0.0.2"), 1)
+
+    def test_damaged(self):
+        fn = self.mktemp()
+        with open(fn, "w") as f:
+            f.write("not json")
+        c = conncache.open_cache(fn)
+        self.assertEqual(c.winner("net"), None)
+        c.set_winner("net", "relay")
+        c.save()
+        self.assertEqual(conncache.open_cache(fn).winner("net"), "relay")
+
+    def test_unusable(self):
+        parent = self.mktemp()
+        with open(parent, "w") as f:
+            f.write("not a directory")
+        fn = os.path.join(parent, "connections.json")
+        self.assertEqual(conncache.open_cache(fn), None)
+        # and if it stops being writable, we carry on without it
+        c = conncache.ConnectionCache(fn)
+        c.set_winner("net", "direct")
+        c.save()
+
+    def test_default(self):
+        self.patch(os, "environ", {"XDG_CACHE_HOME": "/cache"})
+        self.assertEqual(conncache.default_cache_file(),
+                         os.path.join("/cache", "magic-wormhole",
+                                      "connections.json"))
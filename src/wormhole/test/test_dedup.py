@@ -0,0 +1,239 @@
+from __future__ import print_function, unicode_literals
+import os, io, hashlib
+from twisted.trial import unittest
+from twisted.internet.defer import inlineCallbacks, returnValue
+from ..cli import dedup, delta, dirstream, hashcache
+from ..util import bytes_to_hexstr
+from .test_dirstream import SendPipe, ReceivePipe, make_tree
+
+class Chunks(unittest.TestCase):
+    def split(self, data):
+        return list(dedup.split(io.BytesIO(data)))
+
+    def test_split(self):
+        data = os.urandom(1000000)
+        chunks = self.split(data)
+        self.assertEqual(b"".join(chunks), data)
+        for chunk in chunks[:-1]:
+            self.assertTrue(dedup.CHUNK_MIN <= len(chunk) <= dedup.CHUNK_MAX)
+        self.assertEqual(self.split(data), chunks)
+        self.assertEqual(self.split(b""), [])
+        self.assertEqual(self.split(b"short"), [b"short"])
+
+    def test_insert(self):
+        # the cuts only depend on the bytes near them, so everything after
+        # an insertion is cut the same way as before
+        data = os.urandom(3000000)
+        before = self.split(data)
+        after = self.split(data[:1000000] + b"inserted" + data[1000000:])
+        self.assertTrue(len(set(before) - set(after)) <= 2)
+
+    def test_repeats(self):
+        self.assertEqual(len(set(self.split(b"\x00"*1000000))), 2)
+        text = "".join("line %d\n" % i for i in range(100000))
+        text = text.encode("ascii")
+        chunks = self.split(text)
+        self.assertEqual(b"".join(chunks), text)
+        self.assertTrue(len(chunks) > len(text) // dedup.CHUNK_MAX)
+
+    def test_chunk_files(self):
+        top = self.mktemp()
+        os.mkdir(top)
+        data = os.urandom(200000)
+        paths = [os.path.join(top, name) for name in ["a", "b", "c"]]
+        for path, contents in zip(paths, [data, b"", data]):
+            with open(path, "wb") as f:
+                f.write(contents)
+        hashes, recipes = dedup.chunk_files(paths)
+        self.assertEqual(recipes[1], [])
+        self.assertEqual(recipes[0], recipes[2])
+        self.assertEqual(len(hashes), len(recipes[0]))
+        self.assertEqual(sum(length for (_, _, length) in recipes[0]),
+                         len(data))
+
+    def test_chunk_files_cached(self):
+        top = self.mktemp()
+        os.mkdir(top)
+        paths = [os.path.join(top, name) for name in ["a", "b"]]
+        for path in paths:
+            with open(path, "wb") as f:
+                f.write(os.urandom(100000))
+        cache = hashcache.open_cache(self.mktemp())
+        expected = dedup.chunk_files(paths, cache=cache)
+        self.assertEqual(dedup.chunk_files(paths), expected)
+
+        # files that haven't changed aren't read again
+        split = []
+        real_split = dedup.split
+        def counting_split(f):
+            split.append(f.name)
+            return real_split(f)
+        self.patch(dedup, "split", counting_split)
+        reported = []
+        self.assertEqual(dedup.chunk_files(paths, reported.append, cache),
+                         expected)
+        self.assertEqual(split, [])
+        self.assertEqual(sum(reported), 200000)
+        with open(paths[1], "ab") as f:
+            f.write(b"more")
+        hashes, recipes = dedup.chunk_files(paths, cache=cache)
+        self.assertEqual(split, [paths[1]])
+        self.assertEqual(recipes[0], expected[1][0])
+
+    def test_bitmap(self):
+        bits = b"\x81\x80"
+        self.assertEqual(dedup.parse_bitmap(bits, 9), set([0, 7, 8]))
+        self.assertRaises(ValueError, dedup.parse_bitmap, bits, 8)
+        self.assertEqual(dedup.parse_bitmap(b"", 0), set())
+
+class Cache(unittest.TestCase):
+    def test_cache(self):
+        cache = dedup.ChunkCache(self.mktemp())
+        h = hashlib.sha256(b"chunk").digest()
+        self.assertFalse(cache.has(h))
+        cache.put(h, b"chunk")
+        cache.put(h, b"chunk")
+        self.assertTrue(cache.has(h))
+        self.assertEqual(cache.get(h), b"chunk")
+
+        # a damaged chunk is thrown away
+        with open(cache._name(h), "wb") as f:
+            f.write(b"junk")
+        e = self.assertRaises(ValueError, cache.get, h)
+        self.assertIn(bytes_to_hexstr(h), str(e))
+        self.assertFalse(cache.has(h))
+
+    def test_trim(self):
+        path = self.mktemp()
+        cache = dedup.ChunkCache(path)
+        chunks = [("%d" % i).encode("ascii") * 10 for i in range(4)]
+        hashes = [hashlib.sha256(c).digest() for c in chunks]
+        for i, (h, chunk) in enumerate(zip(hashes, chunks)):
+            cache.put(h, chunk)
+            os.utime(cache._name(h), (i, i))
+        cache = dedup.ChunkCache(path, max_size=25)
+        # using a chunk makes it the newest
+        self.assertTrue(cache.has(hashes[0]))
+        cache.trim()
+        self.assertEqual([cache.has(h) for h in hashes],
+                         [True, False, False, True])
+
+    def test_room(self):
+        h = hashlib.sha256(b"chunk").digest()
+        cache = dedup.ChunkCache(self.mktemp(), max_size=4)
+        cache.put(h, b"chunk")
+        self.assertFalse(cache.has(h))
+        # nor more than the disk has room for, after the transfer
+        self.patch(dedup, "free_space", lambda directory: 1000)
+        cache = dedup.ChunkCache(self.mktemp(), reserve=996)
+        cache.put(h, b"chunk")
+        self.assertFalse(cache.has(h))
+        cache = dedup.ChunkCache(self.mktemp(), reserve=994)
+        cache.put(h, b"chunk")
+        self.assertTrue(cache.has(h))
+        # and the room is used up
+        h2 = hashlib.sha256(b"other").digest()
+        cache.put(h2, b"other")
+        self.assertFalse(cache.has(h2))
+
+    def test_default(self):
+        self.patch(os, "environ", {"XDG_CACHE_HOME": "/cache"})
+        self.assertEqual(dedup.default_cache_dir(),
+                         os.path.join("/cache", "magic-wormhole", "chunks"))
+
+class Tree(unittest.TestCase):
+    @inlineCallbacks
+    def transfer(self, top, dest, cache, tamper=None):
+        entries, num_files, num_bytes = dirstream.walk(top)
+        listing, paths = delta.listing(entries)
+        hashes, recipes = dedup.chunk_files(paths)
+
+        r_hasher = hashlib.sha256()
+        du = dedup.DedupUnpacker(dest, listing, cache,
+                                 hasher=r_hasher.update)
+        du.set_hashes(b"".join(hashes))
+        has = dedup.parse_bitmap(du.bitmap(), len(hashes))
+
+        s_hasher = hashlib.sha256()
+        sp = SendPipe()
+        ds = dedup.DedupSender(paths, hashes, recipes, has)
+        sent = yield ds.beginTransfer(sp, s_hasher.update)
+        rp = ReceivePipe()
+        for r in sp.records:
+            rp.recordReceived(tamper(r) if tamper else r)
+        yield du.unpack(rp)
+        self.assertEqual(r_hasher.digest(), s_hasher.digest())
+        returnValue(sent)
+
+    def check(self, top, dest):
+        for path, dirs, files in os.walk(top):
+            rel = os.path.relpath(path, top)
+            for fn in files:
+                with open(os.path.join(path, fn), "rb") as f:
+                    data = f.read()
+                with open(os.path.join(dest, rel, fn), "rb") as f:
+                    self.assertEqual(f.read(), data)
+            for d in dirs:
+                self.assertTrue(os.path.isdir(os.path.join(dest, rel, d)))
+
+    @inlineCallbacks
+    def test_transfer(self):
+        top = self.mktemp()
+        make_tree(top)
+        lib = os.urandom(300000)
+        for name in ["one", "two", "three"]:
+            with open(os.path.join(top, name), "wb") as f:
+                f.write(lib)
+        with open(os.path.join(top, "four"), "wb") as f:
+            f.write(b"header" + lib)
+        cache = dedup.ChunkCache(self.mktemp())
+
+        dest = os.path.join(self.mktemp(), "dest")
+        sent = yield self.transfer(top, dest, cache)
+        self.check(top, dest)
+        # 'lib' is only sent once
+        self.assertTrue(len(lib) < sent < len(lib) + 200000, sent)
+
+        # the receiver has all of them now
+        dest = os.path.join(self.mktemp(), "dest")
+        sent = yield self.transfer(top, dest, cache)
+        self.check(top, dest)
+        self.assertTrue(sent < 10000, sent)
+        self.assertEqual(sorted(os.listdir(dest)),
+                         ["a", "b", "four", "one", "sub", "three", "two"])
+
+    @inlineCallbacks
+    def test_no_room(self):
+        # chunks the cache has no room for can still be used again
+        top = self.mktemp()
+        make_tree(top)
+        lib = os.urandom(300000)
+        for name in ["one", "two"]:
+            with open(os.path.join(top, name), "wb") as f:
+                f.write(lib)
+        cache = dedup.ChunkCache(self.mktemp(), max_size=0)
+        dest = os.path.join(self.mktemp(), "dest")
+        sent = yield self.transfer(top, dest, cache)
+        self.check(top, dest)
+        self.assertTrue(len(lib) < sent < len(lib) + 200000, sent)
+        self.assertFalse(os.path.exists(cache._path))
+        # and the spill file is gone
+        self.assertEqual(sorted(os.listdir(dest)),
+                         ["a", "b", "one", "sub", "two"])
+
+    @inlineCallbacks
+    def test_tampered(self):
+        top = self.mktemp()
+        make_tree(top)
+        def tamper(record):
+            if record[:1] == dedup.DATA:
+                return record[:-1] + b"!"
+            return record
+        dest = os.path.join(self.mktemp(), "dest")
+        cache = dedup.ChunkCache(self.mktemp())
+        e = yield self.assertFailure(self.transfer(top, dest, cache, tamper),
+                                     ValueError)
+        self.assertIn("doesn't match its hash", str(e))
+        # nothing was written, or cached
+        self.assertEqual(os.listdir(dest), ["sub"])
+        self.assertFalse(os.path.exists(cache._path))
@@ -0,0 +1,164 @@
+from __future__ import print_function, unicode_literals
+import os, io, stat, hashlib
+from twisted.trial import unittest
+from twisted.internet.defer import inlineCallbacks, returnValue
+from ..cli import delta, dirstream, compression
+from .test_dirstream import SendPipe, ReceivePipe, make_tree
+
+def rebuild(old, records, block_size):
+    out = []
+    for r in records:
+        if r[:1] == delta.DATA:
+            out.append(r[1:])
+        else:
+            first, count = delta.SPAN.unpack(r[1:])
+            out.append(old[first*block_size:(first+count)*block_size])
+    return b"".join(out)
+
+class Delta(unittest.TestCase):
+    def roundtrip(self, old, new):
+        sig = None
+        if old is not None:
+            sig = delta.parse_signature(delta.signature(io.BytesIO(old),
+                                                        len(old)))
+        records = []
+        read = []
+        delta.delta(io.BytesIO(new), sig, records.append,
+                    lambda f, size: read.append(f.read(size)) or read[-1])
+        self.assertEqual(b"".join(read), new)
+        self.assertEqual(rebuild(old, records, sig and sig[0]), new)
+        return sum(len(r) for r in records)
+
+    def test_same(self):
+        old = os.urandom(100000)
+        self.assertEqual(self.roundtrip(old, old), 1+delta.SPAN.size)
+
+    def test_changes(self):
+        old = os.urandom(300000)
+        new = (old[:100000] + b"inserted" + old[100000:200000] +
+               old[200100:] + b"tail")
+        # about a block for each change
+        sent = self.roundtrip(old, new)
+        self.assertTrue(sent < 4*delta.block_size_for(len(old)), sent)
+
+    def test_new(self):
+        data = os.urandom(1000)
+        self.assertEqual(self.roundtrip(None, data), 1+len(data))
+        self.assertEqual(self.roundtrip(b"", data), 1+len(data))
+        self.assertEqual(self.roundtrip(data, b""), 0)
+
+    def test_short_tail(self):
+        old = os.urandom(5000)
+        self.assertEqual(self.roundtrip(old, old), 1+delta.SPAN.size)
+        self.roundtrip(old, old[:4000])
+        self.roundtrip(old, old[1:])
+
+    def test_different(self):
+        self.patch(dirstream, "RECORD_SIZE", 1000)
+        self.patch(delta, "RECORD_SIZE", 1000)
+        old, new = os.urandom(10000), os.urandom(10000)
+        self.roundtrip(old, new)
+
+    def test_bad_signature(self):
+        sig = delta.signature(io.BytesIO(b"x"*10000), 10000)
+        self.assertRaises(ValueError, delta.parse_signature, sig[:-1])
+        self.assertRaises(ValueError, delta.parse_signature,
+                          sig[:-delta.BLOCK.size])
+
+class Tree(unittest.TestCase):
+    @inlineCallbacks
+    def sync(self, top, dest, codec=None):
+        entries, num_files, num_bytes = dirstream.walk(top)
+        listing, paths = delta.listing(entries)
+
+        r_hasher = hashlib.sha256()
+        du = delta.DeltaUnpacker(dest, listing, hasher=r_hasher.update)
+        same, signatures = du.signatures()
+
+        s_hasher = hashlib.sha256()
+        sp = SendPipe()
+        files = [(i, path) for (i, path) in enumerate(paths)
+                 if i not in same]
+        ds = delta.DeltaSender(files, dict(signatures))
+        packer = compression.Packer(codec) if codec else None
+        sent = yield ds.beginTransfer(sp, s_hasher.update, transform=packer)
+        self.assertEqual(sp.records[-1], b"")
+
+        rp = ReceivePipe()
+        for r in sp.records:
+            rp.recordReceived(r)
+        unpacker = compression.Unpacker(codec) if codec else None
+        yield du.unpack(rp, unpacker)
+        self.assertEqual(r_hasher.digest(), s_hasher.digest())
+        returnValue((same, sent))
+
+    def check(self, top, dest):
+        for path, dirs, files in os.walk(top):
+            rel = os.path.relpath(path, top)
+            for fn in files:
+                with open(os.path.join(path, fn), "rb") as f:
+                    data = f.read()
+                with open(os.path.join(dest, rel, fn), "rb") as f:
+                    self.assertEqual(f.read(), data)
+            for d in dirs:
+                self.assertTrue(os.path.isdir(os.path.join(dest, rel, d)))
+
+    @inlineCallbacks
+    def test_sync(self):
+        top = self.mktemp()
+        make_tree(top)
+        big = os.urandom(500000)
+        with open(os.path.join(top, "big"), "wb") as f:
+            f.write(big)
+        dest = os.path.join(self.mktemp(), "dest")
+        same, sent = yield self.sync(top, dest)
+        self.assertEqual(same, [])
+        self.check(top, dest)
+        self.assertEqual(stat.S_IMODE(os.stat(os.path.join(dest, "a"))
+                                      .st_mode), 0o755)
+
+        # nothing changed
+        same, sent = yield self.sync(top, dest)
+        self.assertEqual(len(same), 4)
+        self.assertEqual(sent, 0)
+
+        # a few bytes of the big file, and a new file
+        with open(os.path.join(top, "big"), "wb") as f:
+            f.write(big[:1000] + b"changed" + big[1000:])
+        os.utime(os.path.join(top, "big"), (1, 1))
+        with open(os.path.join(top, "sub", "new"), "wb") as f:
+            f.write(b"new")
+        same, sent = yield self.sync(top, dest, "zlib")
+        self.assertEqual(len(same), 3)
+        self.assertTrue(sent < 20000, sent)
+        self.check(top, dest)
+        # no temporary files are left behind
+        self.assertEqual(sorted(os.listdir(dest)),
+                         ["a", "b", "big", "sub"])
+
+    def test_outside(self):
+        dest = self.mktemp()
+        listing = {"dirs": [], "files": [["../evil", 1, 0, 0o644]]}
+        self.assertRaises(ValueError, delta.DeltaUnpacker, dest, listing)
+        listing = {"dirs": ["../evil"], "files": []}
+        self.assertRaises(ValueError, delta.DeltaUnpacker, dest, listing)
+        listing = {"dirs": [], "files": [["ok", -1, 0, 0o644]]}
+        self.assertRaises(ValueError, delta.DeltaUnpacker, dest, listing)
+
+    @inlineCallbacks
+    def test_truncated(self):
+        top = self.mktemp()
+        make_tree(top)
+        entries, num_files, num_bytes = dirstream.walk(top)
+        listing, paths = delta.listing(entries)
+        dest = os.path.join(self.mktemp(), "dest")
+        du = delta.DeltaUnpacker(dest, listing)
+        du.signatures()
+        sp = SendPipe()
+        yield delta.DeltaSender(list(enumerate(paths)), {}).beginTransfer(sp)
+        rp = ReceivePipe()
+        # half of the first file, then the end of the stream
+        for r in sp.records[:2] + [b""]:
+            rp.recordReceived(r)
+        yield self.assertFailure(du.unpack(rp), ValueError)
+        self.assertEqual(os.listdir(dest), ["sub"])
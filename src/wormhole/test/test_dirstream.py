@@ -0,0 +1,277 @@
+from __future__ import print_function, unicode_literals
+import os, io, stat, gzip, zlib, tarfile, hashlib
+from twisted.trial import unittest
+from twisted.internet import error
+from twisted.internet.defer import inlineCallbacks, returnValue
+from ..cli import dirstream, compression
+from ..transit import _RecordPipe
+
+class SendPipe:
+    # the sending half of a record pipe
+    def __init__(self):
+        self.records = []
+        self.producer = None
+    def registerProducer(self, producer, streaming):
+        assert streaming
+        self.producer = producer
+    def unregisterProducer(self):
+        self.producer = None
+    def send_record(self, record):
+        self.records.append(record)
+
+class ReceivePipe(_RecordPipe):
+    # the receiving half, which we feed records by hand
+    def __init__(self):
+        self._init_pipe()
+        self.state = "producing"
+    def pauseProducing(self):
+        self.state = "paused"
+    def resumeProducing(self):
+        self.state = "producing"
+    def stopProducing(self):
+        self.state = "stopped"
+
+def make_tree(top):
+    os.makedirs(os.path.join(top, "sub", "empty"))
+    contents = {"a": b"a"*100000, "b": b"", os.path.join("sub", "c"): b"c\n"}
+    for name, data in contents.items():
+        with open(os.path.join(top, name), "wb") as f:
+            f.write(data)
+    os.chmod(os.path.join(top, "a"), 0o755)
+    return contents
+
+class Walk(unittest.TestCase):
+    def test_walk(self):
+        top = self.mktemp()
+        make_tree(top)
+        entries, num_files, num_bytes = dirstream.walk(top)
+        self.assertEqual(entries,
+                         [(os.path.join(top, "a"), "a"),
+                          (os.path.join(top, "b"), "b"),
+                          (os.path.join(top, "sub"), "sub"),
+                          (os.path.join(top, "sub", "c"), "sub/c"),
+                          (os.path.join(top, "sub", "empty"), "sub/empty")])
+        self.assertEqual((num_files, num_bytes), (3, 100002))
+
+class Deflate(unittest.TestCase):
+    def test_concatenated(self):
+        # chunks deflated separately, at any level, make one gzip stream
+        chunks = [b"a"*1000, os.urandom(1000), b"", b"b"*1000]
+        crc = zlib.crc32(b"")
+        data = dirstream.gzip_header()
+        for i, chunk in enumerate(chunks):
+            data += dirstream.deflate(chunk, [6, 0, 9, 1][i])
+            crc = zlib.crc32(chunk, crc)
+        data += dirstream.gzip_trailer(crc, 3000)
+        self.assertEqual(gzip.GzipFile(fileobj=io.BytesIO(data)).read(),
+                         b"".join(chunks))
+
+class Adapter(unittest.TestCase):
+    def feed(self, a, rate, chunks=None):
+        for i in range(chunks or a.PROBE_CHUNKS):
+            a.measure(a.level(), 1000, 1000.0/rate)
+
+    def test_fast_network(self):
+        a = dirstream._Adapter(6)
+        self.assertEqual(a.level(), 6)
+        self.feed(a, 10)
+        # then it tries without
+        self.assertEqual(a.level(), 0)
+        self.feed(a, 100)
+        self.assertEqual(a.level(), 0)
+        # chunks compressed before the switch don't count
+        for i in range(100):
+            a.measure(6, 1000, 1000)
+        self.assertEqual(a.level(), 0)
+        for i in range(a.REPROBE - 2):
+            self.feed(a, 100)
+            self.assertEqual(a.level(), 0)
+        # now and then, it tries compressing again
+        self.feed(a, 100)
+        self.assertEqual(a.level(), 6)
+        self.feed(a, 200) # the network got slower
+        self.assertEqual(a.level(), 6)
+
+    def test_network_bound(self):
+        # while we mostly wait for the connection, we keep compressing
+        a = dirstream._Adapter(6)
+        a.waited(5)
+        self.feed(a, 1000) # 8 chunks in 8 seconds
+        self.assertEqual(a.level(), 6)
+        self.feed(a, 1000)
+        self.assertEqual(a.level(), 0) # now it measures the other way
+        a.waited(5)
+        self.feed(a, 1000)
+        self.assertEqual(a.level(), 6)
+
+    def test_slow_network(self):
+        a = dirstream._Adapter(6)
+        self.feed(a, 50)
+        self.feed(a, 10)
+        self.assertEqual(a.level(), 6)
+        # compression wins ties
+        a = dirstream._Adapter(6)
+        self.feed(a, 100)
+        self.feed(a, 105)
+        self.assertEqual(a.level(), 6)
+
+class Stream(unittest.TestCase):
+    @inlineCallbacks
+    def roundtrip(self, level, adapt=None, codec=None):
+        top = self.mktemp()
+        contents = make_tree(top)
+        entries, num_files, num_bytes = dirstream.walk(top)
+
+        s_hasher = hashlib.sha256()
+        s_progress = []
+        sp = SendPipe()
+        ds = dirstream.DirectorySender(entries, level=level, chunk_size=1000,
+                                       depth=2)
+        if level:
+            # don't let timing make up its mind for it
+            ds._adapter.level = adapt or (lambda: level)
+        packer = compression.Packer(codec) if codec else None
+        sent = yield ds.beginTransfer(sp, s_hasher.update, s_progress.append,
+                                      packer)
+        self.assertIs(sp.producer, None)
+        self.assertEqual(sp.records[-1], b"")
+        self.assertEqual(sent, sum(len(r) for r in sp.records))
+        self.assertEqual(sum(s_progress), num_bytes)
+
+        dest = os.path.join(self.mktemp(), "dest")
+        r_hasher = hashlib.sha256()
+        r_progress = []
+        rp = ReceivePipe()
+        for r in sp.records:
+            rp.recordReceived(r)
+        du = dirstream.DirectoryUnpacker(dest, r_progress.append,
+                                         r_hasher.update, mode=ds.mode())
+        unpacker = compression.Unpacker(codec) if codec else None
+        received = yield du.unpack(rp, unpacker)
+        if not codec:
+            # (otherwise it counts what came out of the unpacker)
+            self.assertEqual(received, sent)
+        self.assertEqual(r_hasher.digest(), s_hasher.digest())
+        self.assertEqual(sum(r_progress), num_bytes)
+        for name, data in contents.items():
+            with open(os.path.join(dest, name), "rb") as f:
+                self.assertEqual(f.read(), data)
+        self.assertTrue(os.path.isdir(os.path.join(dest, "sub", "empty")))
+        self.assertEqual(stat.S_IMODE(os.stat(os.path.join(dest, "a"))
+                                      .st_mode), 0o755)
+        returnValue((ds.mode(), sent, num_bytes))
+
+    @inlineCallbacks
+    def test_roundtrip(self):
+        mode, sent, num_bytes = yield self.roundtrip(6)
+        self.assertEqual(mode, "tarball/gzip")
+        # the a's compress well
+        self.assertTrue(sent < num_bytes / 10, sent)
+
+    @inlineCallbacks
+    def test_roundtrip_store(self):
+        mode, sent, num_bytes = yield self.roundtrip(0)
+        self.assertEqual(mode, "tarball/store")
+        self.assertTrue(sent > num_bytes, sent)
+
+    @inlineCallbacks
+    def test_roundtrip_packed(self):
+        # records compressed on the wire, the way cmd_send does it
+        mode, sent, num_bytes = yield self.roundtrip(0, codec="zlib")
+        self.assertEqual(mode, "tarball/store")
+        self.assertTrue(sent < num_bytes / 10, sent)
+        mode, sent, num_bytes = yield self.roundtrip(6, codec="zlib")
+        self.assertEqual(mode, "tarball/gzip")
+
+    @inlineCallbacks
+    def test_roundtrip_adapting(self):
+        levels = [9, 0, 0, 1]
+        def adapt():
+            levels.append(levels.pop(0))
+            return levels[-1]
+        mode, sent, num_bytes = yield self.roundtrip(9, adapt)
+        self.assertEqual(mode, "tarball/gzip")
+
+    @inlineCallbacks
+    def test_sender_stopped(self):
+        top = self.mktemp()
+        make_tree(top)
+        entries, num_files, num_bytes = dirstream.walk(top)
+        sp = SendPipe()
+        # the first records fill the queue, and the thread waits
+        ds = dirstream.DirectorySender(entries, chunk_size=100, depth=1)
+        sp.producer = ds
+        ds.pauseProducing()
+        d = ds.beginTransfer(sp)
+        ds.stopProducing()
+        e = yield self.assertFailure(d, Exception)
+        self.assertEqual(str(e), "Consumer asked us to stop producing")
+        self.assertEqual(sp.records, [])
+
+    def build_tarball(self, names):
+        out = io.BytesIO()
+        with tarfile.open(fileobj=out, mode="w|gz") as tf:
+            for name in names:
+                info = tarfile.TarInfo(name)
+                info.size = 3
+                tf.addfile(info, io.BytesIO(b"bad"))
+        return out.getvalue()
+
+    @inlineCallbacks
+    def test_malicious(self):
+        parent = self.mktemp()
+        dest = os.path.join(parent, "dest")
+        rp = ReceivePipe()
+        rp.recordReceived(self.build_tarball(["ok", "../evil"]))
+        rp.recordReceived(b"")
+        du = dirstream.DirectoryUnpacker(dest)
+        e = yield self.assertFailure(du.unpack(rp), ValueError)
+        self.assertIn("malicious tarball", str(e))
+        self.assertTrue(os.path.exists(os.path.join(dest, "ok")))
+        self.assertFalse(os.path.exists(os.path.join(parent, "evil")))
+
+    @inlineCallbacks
+    def test_malicious_early(self):
+        # when unpacking fails before the stream ends, we stop reading it
+        dest = os.path.join(self.mktemp(), "dest")
+        tarball = self.build_tarball(["../evil"])
+        rp = ReceivePipe()
+        du = dirstream.DirectoryUnpacker(dest)
+        d = du.unpack(rp)
+        rp.recordReceived(tarball)
+        rp.recordReceived(b"\x00" * 10240) # more than tarfile reads ahead
+        yield self.assertFailure(d, ValueError)
+        self.assertEqual(rp.state, "stopped")
+        self.assertIs(rp._consumer, None)
+        # records that were already on their way are dropped
+        rp.recordReceived(b"more")
+
+    @inlineCallbacks
+    def test_lost(self):
+        dest = os.path.join(self.mktemp(), "dest")
+        tarball = self.build_tarball(["a", "b"])
+        rp = ReceivePipe()
+        du = dirstream.DirectoryUnpacker(dest)
+        d = du.unpack(rp)
+        rp.recordReceived(tarball[:20])
+        rp._consumer_deferred.errback(error.ConnectionClosed())
+        yield self.assertFailure(d, error.ConnectionClosed)
+
+    def test_budget(self):
+        du = dirstream.DirectoryUnpacker(self.mktemp(), budget=10)
+        rp = ReceivePipe()
+        # (without the thread that would take records off the queue)
+        rp.connectStreamConsumer(du)
+        rp.recordReceived(b"12345")
+        self.assertEqual(rp.state, "producing")
+        rp.recordReceived(b"67890")
+        self.assertEqual(rp.state, "paused")
+        du._consumed(4)
+        self.assertEqual(rp.state, "paused")
+        du._consumed(1)
+        self.assertEqual(rp.state, "producing")
+        rp.recordReceived(b"abcde")
+        self.assertEqual(rp.state, "paused")
+        # disconnecting leaves the pipe readable
+        rp.disconnectConsumer()
+        self.assertEqual(rp.state, "producing")
@@ -0,0 +1,82 @@
+from __future__ import print_function, unicode_literals
+import os, sqlite3
+from twisted.trial import unittest
+from ..cli import hashcache
+
+class Cache(unittest.TestCase):
+    def write(self, data):
+        fn = self.mktemp()
+        with open(fn, "wb") as f:
+            f.write(data)
+        return fn
+
+    def test_cache(self):
+        dbfile = self.mktemp()
+        cache = hashcache.open_cache(dbfile)
+        fn = self.write(b"data")
+        key = hashcache.file_key(fn)
+        self.assertEqual(key[:2], (os.path.abspath(fn), 4))
+        self.assertEqual(cache.get(key, "kind"), None)
+        cache.put(key, "kind", b"value")
+        cache.put(key, "other", b"other value")
+        self.assertEqual(cache.get(key, "kind"), b"value")
+        cache.close()
+
+        cache = hashcache.open_cache(dbfile)
+        self.assertEqual(cache.get(hashcache.file_key(fn), "kind"), b"value")
+        self.assertEqual(cache.get(hashcache.file_key(fn), "other"),
+                         b"other value")
+        # a different mtime is a different file
+        os.utime(fn, (1, 1))
+        self.assertEqual(cache.get(hashcache.file_key(fn), "kind"), None)
+        cache.put(hashcache.file_key(fn), "kind", b"new value")
+        self.assertEqual(cache.get(hashcache.file_key(fn), "kind"),
+                         b"new value")
+        # and so is a different size, or inode
+        with open(fn, "ab") as f:
+            f.write(b"more")
+        os.utime(fn, (1, 1))
+        self.assertEqual(cache.get(hashcache.file_key(fn), "kind"), None)
+        path, size, mtime_ns, inode = hashcache.file_key(fn)
+        cache.put((path, size, mtime_ns, inode), "kind", b"value")
+        self.assertEqual(cache.get((path, size, mtime_ns, inode+1), "kind"),
+                         None)
+        cache.close()
+
+    def test_shared(self):
+        # each entry is committed, so another sender can store its own
+        self.patch(hashcache, "TIMEOUT", 0.01)
+        dbfile = self.mktemp()
+        one = hashcache.open_cache(dbfile)
+        two = hashcache.open_cache(dbfile)
+        key = hashcache.file_key(self.write(b"data"))
+        one.put(key, "kind", b"one")
+        two.put(key, "other", b"two")
+        self.assertEqual(two.get(key, "kind"), b"one")
+        self.assertEqual(one.get(key, "other"), b"two")
+
+        # and if the database stays locked, we carry on without it
+        db = sqlite3.connect(dbfile)
+        db.execute("BEGIN EXCLUSIVE")
+        one.put(key, "kind", b"new")
+        self.assertEqual(one.get(key, "kind"), None)
+        db.rollback()
+        db.close()
+        self.assertEqual(one.get(key, "kind"), b"one")
+        one.put(key, "kind", b"new")
+        self.assertEqual(two.get(key, "kind"), b"new")
+        one.close()
+        two.close()
+
+    def test_unusable(self):
+        parent = self.write(b"not a directory")
+        self.assertEqual(hashcache.open_cache(os.path.join(parent, "db")),
+                         None)
+        junk = self.write(b"not a database"*100)
+        self.assertEqual(hashcache.open_cache(junk), None)
+
+    def test_default(self):
+        self.patch(os, "environ", {"XDG_CACHE_HOME": "/cache"})
+        self.assertEqual(hashcache.default_cache_file(),
+                         os.path.join("/cache", "magic-wormhole",
+                                      "hashes.sqlite"))
@@ -0,0 +1,101 @@
+from __future__ import print_function, unicode_literals
+import os, io, hashlib
+from twisted.trial import unittest
+from ..cli import mapped, resume
+
+class Mapped(unittest.TestCase):
+    def make_file(self, data):
+        fn = self.mktemp()
+        with open(fn, "wb") as f:
+            f.write(data)
+        return fn
+
+    def test_read(self):
+        data = os.urandom(1000)
+        f = mapped.open_for_sending(self.make_file(data))
+        # we only map files when asked to
+        self.assertNotIsInstance(f, mapped.MappedFile)
+        self.assertFalse(hasattr(f, "view"))
+        self.assertEqual(f.read(10), data[:10])
+        self.assertEqual(f.tell(), 10)
+        self.assertEqual(f.seek(0, 2), 1000)
+        self.assertEqual(f.read(10), b"")
+        f.seek(-5, 1)
+        self.assertEqual(f.read(), data[-5:])
+        f.seek(0)
+        self.assertEqual(f.read(), data)
+        f.close()
+
+    def test_read_mapped(self):
+        data = os.urandom(1000)
+        f = mapped.open_for_sending(self.make_file(data), use_mmap=True)
+        self.assertIsInstance(f, mapped.MappedFile)
+        self.assertEqual(f.read(10), data[:10])
+        self.assertEqual(f.tell(), 10)
+        self.assertEqual(f.read(20), data[10:30])
+        self.assertEqual(f.seek(0, 2), 1000)
+        self.assertEqual(f.read(10), b"")
+        f.seek(-5, 1)
+        self.assertEqual(f.read(), data[-5:])
+        f.seek(100)
+        view = f.view(50)
+        self.assertEqual(bytes(view), data[100:150])
+        self.assertEqual(f.tell(), 150)
+        view.release()
+        f.seek(0)
+        self.assertEqual(f.read(), data)
+        self.assertRaises(ValueError, f.seek, -1)
+        f.close()
+
+    def test_not_mapped(self):
+        # empty files can't be mapped, so we read them as usual
+        f = mapped.open_for_sending(self.make_file(b""), use_mmap=True)
+        self.assertNotIsInstance(f, mapped.MappedFile)
+        self.assertEqual(f.read(), b"")
+        f.close()
+
+    def test_drop_behind(self):
+        self.check_drop_behind(use_mmap=False)
+
+    def test_drop_behind_mapped(self):
+        self.check_drop_behind(use_mmap=True)
+
+    def check_drop_behind(self, use_mmap):
+        self.patch(mapped, "DROP_BEHIND", 100)
+        advice = []
+        self.patch(mapped, "_fadvise",
+                   lambda fd, offset, length, what:
+                   advice.append((offset, length, what)))
+        data = os.urandom(1000)
+        f = mapped.open_for_sending(self.make_file(data), use_mmap)
+        self.assertEqual(advice, [(0, 0, "POSIX_FADV_SEQUENTIAL")])
+        del advice[:]
+        chunks = []
+        for i in range(10):
+            chunks.append(f.read(100))
+        self.assertEqual(b"".join(chunks), data)
+        # we keep the last DROP_BEHIND bytes
+        self.assertEqual(advice,
+                         [(0, 100, "POSIX_FADV_DONTNEED"),
+                          (100, 100, "POSIX_FADV_DONTNEED"),
+                          (200, 100, "POSIX_FADV_DONTNEED"),
+                          (300, 100, "POSIX_FADV_DONTNEED"),
+                          (400, 100, "POSIX_FADV_DONTNEED"),
+                          (500, 100, "POSIX_FADV_DONTNEED"),
+                          (600, 100, "POSIX_FADV_DONTNEED"),
+                          (700, 100, "POSIX_FADV_DONTNEED"),
+                          (800, 100, "POSIX_FADV_DONTNEED")])
+        f.close()
+
+    def test_manifest(self):
+        # hashing the views gives the same manifest
+        self.patch(resume, "CHUNK_SIZE", 10)
+        data = os.urandom(95)
+        f = mapped.open_for_sending(self.make_file(data), use_mmap=True)
+        self.assertEqual(resume.build_manifest(f, len(data)),
+                         resume.build_manifest(io.BytesIO(data), len(data)))
+        self.assertEqual(f.tell(), 0)
+        self.assertEqual(f.read(), data)
+        self.assertEqual(hashlib.sha256(data).digest(),
+                         resume.build_manifest(f, len(data))[1])
+        f.close()
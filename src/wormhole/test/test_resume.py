@@ -0,0 +1,142 @@
+from __future__ import print_function, unicode_literals
+import os, io, hashlib
+from twisted.trial import unittest
+from ..cli import resume, hashcache
+
+DATA = b"".join([("%02d" % i).encode("ascii") for i in range(48)]) # 96 bytes
+
+class Manifest(unittest.TestCase):
+    def test_chunk_size(self):
+        self.assertEqual(resume.chunk_size_for(0), resume.CHUNK_SIZE)
+        limit = resume.CHUNK_SIZE * resume.MAX_CHUNKS
+        self.assertEqual(resume.chunk_size_for(limit), resume.CHUNK_SIZE)
+        self.assertEqual(resume.chunk_size_for(limit+1), 2*resume.CHUNK_SIZE)
+
+    def test_build(self):
+        self.patch(resume, "CHUNK_SIZE", 10)
+        f = io.BytesIO(DATA)
+        f.seek(50)
+        manifest, filehash = resume.build_manifest(f, len(DATA))
+        self.assertEqual(f.tell(), 0)
+        self.assertEqual(filehash, hashlib.sha256(DATA).digest())
+        self.assertEqual(manifest["size"], 10)
+        self.assertEqual(manifest["sha256"],
+                         [hashlib.sha256(DATA[i:i+10]).hexdigest()
+                          for i in range(0, 96, 10)])
+        self.assertEqual(resume.parse_manifest(manifest, len(DATA)),
+                         (10, manifest["sha256"]))
+
+    def test_cached(self):
+        self.patch(resume, "CHUNK_SIZE", 10)
+        fn = self.mktemp()
+        with open(fn, "wb") as f:
+            f.write(DATA)
+        cache = hashcache.open_cache(self.mktemp())
+        with open(fn, "rb") as f:
+            expected = resume.cached_manifest(fn, f, len(DATA), cache)
+        self.assertEqual(expected, resume.build_manifest(io.BytesIO(DATA),
+                                                         len(DATA)))
+        # the file isn't read again
+        f = io.BytesIO(b"")
+        self.assertEqual(resume.cached_manifest(fn, f, len(DATA), cache),
+                         expected)
+        # until it changes
+        os.utime(fn, (1, 1))
+        with open(fn, "rb") as f:
+            self.assertEqual(resume.cached_manifest(fn, f, len(DATA), cache),
+                             expected)
+        self.assertEqual(resume.cached_manifest(fn, io.BytesIO(DATA),
+                                                len(DATA), None),
+                         expected)
+
+    def test_parse_bad(self):
+        good = {"size": 10, "sha256": ["0"*64]*10}
+        self.assertEqual(resume.parse_manifest(good, 96)[0], 10)
+        for bad in [{"size": 0, "sha256": ["0"*64]*10},
+                    {"size": "10", "sha256": ["0"*64]*10},
+                    {"size": 10, "sha256": "0"*640},
+                    {"size": 10, "sha256": ["0"*64]*9},
+                    {"size": 10, "sha256": ["0"*64]*9 + ["0"*63]},
+                    ]:
+            self.assertRaises(ValueError, resume.parse_manifest, bad, 96)
+
+class Journal(unittest.TestCase):
+    def setUp(self):
+        self.tmp_name = self.mktemp()
+        self.hashes = [hashlib.sha256(DATA[i:i+10]).hexdigest()
+                       for i in range(0, 96, 10)]
+
+    def make_journal(self, hashes=None):
+        return resume.Journal(self.tmp_name, len(DATA), 10,
+                              hashes or self.hashes)
+
+    def interrupted(self, length):
+        # write 'length' bytes, in awkward pieces, then stop
+        j = self.make_journal()
+        self.assertEqual(j.resume_point(), 0)
+        with j.open() as f:
+            for i in range(0, length, 7):
+                piece = DATA[i:min(i+7, length)]
+                f.write(piece)
+                j.update(piece)
+        j.close()
+
+    def test_complete(self):
+        j = self.make_journal()
+        self.assertEqual(j.resume_point(), 0)
+        with j.open() as f:
+            f.write(DATA)
+            j.update(DATA)
+        self.assertEqual(j.filehasher.digest(), hashlib.sha256(DATA).digest())
+        j.remove()
+        self.assertFalse(os.path.exists(self.tmp_name + ".journal"))
+
+    def test_resume(self):
+        self.interrupted(35)
+        j = self.make_journal()
+        self.assertEqual(j.resume_point(), 30)
+        with j.open() as f:
+            self.assertEqual(f.tell(), 30)
+            f.write(DATA[30:])
+            j.update(DATA[30:])
+        j.close()
+        with open(self.tmp_name, "rb") as f:
+            self.assertEqual(f.read(), DATA)
+        # the whole-file hash includes the chunks we kept
+        self.assertEqual(j.filehasher.digest(), hashlib.sha256(DATA).digest())
+        # and the journal was rewritten to cover everything
+        self.assertEqual(self.make_journal().resume_point(), 96)
+
+    def test_damaged(self):
+        self.interrupted(50)
+        with open(self.tmp_name, "r+b") as f:
+            f.seek(25)
+            f.write(b"X")
+        self.assertEqual(self.make_journal().resume_point(), 20)
+
+    def test_torn_journal(self):
+        self.interrupted(50)
+        with open(self.tmp_name + ".journal", "r+") as f:
+            f.seek(0, 2)
+            f.seek(f.tell() - 2) # chop the newline off "4\n"
+            f.truncate()
+        self.assertEqual(self.make_journal().resume_point(), 40)
+
+    def test_different_file(self):
+        self.interrupted(50)
+        other = ["0"*64] + self.hashes[1:]
+        self.assertEqual(self.make_journal(other).resume_point(), 0)
+
+    def test_no_journal(self):
+        with open(self.tmp_name, "wb") as f:
+            f.write(DATA[:50])
+        self.assertEqual(self.make_journal().resume_point(), 0)
+
+    def test_bad_chunk(self):
+        j = self.make_journal()
+        j.resume_point()
+        j.open().close()
+        j.update(DATA[:10])
+        self.assertRaises(ValueError, j.update, b"X"*10)
+        j.close()
+        self.assertEqual(self.make_journal().resume_point(), 0) # file empty
@@ -5,10 +5,10 @@ import mock
 from twisted.trial import unittest
 from twisted.python import procutils, log
 from twisted.internet.utils import getProcessOutputAndValue
-from twisted.internet.defer import gatherResults, inlineCallbacks
+from twisted.internet.defer import gatherResults, inlineCallbacks, returnValue
 from .. import __version__
 from .common import ServerBase, config
-from ..cli import cmd_send, cmd_receive
+from ..cli import cmd_send, cmd_receive, resume, compression, unzip
 from ..errors import TransferError, WrongPasswordError, WelcomeError
 
 
@@ -23,6 +23,7 @@ class OfferData(unittest.TestCase):
         self.cfg = cfg = config("send")
         cfg.stdout = io.StringIO()
         cfg.stderr = io.StringIO()
+        cfg.hash_cache = self.mktemp()
 
     def tearDown(self):
         for fn in self._things_to_delete:
@@ -70,6 +71,42 @@ class OfferData(unittest.TestCase):
         self.assertEqual(str(e),
                          "Cannot send: no file/directory named '%s'" % filename)
 
+    @inlineCallbacks
+    def test_conflicting_options(self):
+        send_dir = self.mktemp()
+        os.makedirs(os.path.join(send_dir, "dirname"))
+        self.cfg.cwd = send_dir
+        self.cfg.what = "dirname"
+        self.cfg.stream = True
+        self.cfg.delta = True
+        e = self.assertRaises(TransferError, cmd_send.check_options, self.cfg)
+        self.assertEqual(str(e), "Cannot use --stream and --delta together")
+        self.cfg.delta = False
+        self.cfg.dedup = True
+        self.cfg.resumable = True
+        e = self.assertRaises(TransferError, cmd_send.check_options, self.cfg)
+        self.assertEqual(str(e), "Cannot use --resumable and --stream and"
+                         " --dedup together")
+        # --resumable is only for files
+        self.cfg.stream = self.cfg.dedup = False
+        e = self.assertRaises(TransferError, cmd_send.check_options, self.cfg)
+        self.assertIn("only works when sending one file", str(e))
+        with open(os.path.join(send_dir, "file"), "wb") as f:
+            f.write(b"data")
+        self.cfg.what = "file"
+        cmd_send.check_options(self.cfg)
+        self.cfg.what = None
+        self.cfg.batch = ["file", "file2"]
+        e = self.assertRaises(TransferError, cmd_send.check_options, self.cfg)
+        self.assertIn("only works when sending one file", str(e))
+
+        # send checks them before it connects to anything
+        self.cfg.batch = []
+        self.cfg.what = "dirname"
+        self.cfg.relay_url = u"ws://127.0.0.1:1/v1"
+        e = yield self.assertFailure(cmd_send.send(self.cfg), TransferError)
+        self.assertIn("only works when sending one file", str(e))
+
     def _do_test_directory(self, addslash):
         parent_dir = self.mktemp()
         os.mkdir(parent_dir)
@@ -115,6 +152,121 @@ class OfferData(unittest.TestCase):
     def test_directory_addslash(self):
         return self._do_test_directory(addslash=True)
 
+    def test_directory_stream(self):
+        parent_dir = self.mktemp()
+        os.mkdir(parent_dir)
+        send_dir = os.path.join(parent_dir, "dirname")
+        os.makedirs(os.path.join(send_dir, "sub", "empty"))
+        for name in ["b", "a", os.path.join("sub", "c")]:
+            with open(os.path.join(send_dir, name), "wb") as f:
+                f.write(b"ponies\n")
+        self.cfg.what = "dirname"
+        self.cfg.cwd = parent_dir
+        self.cfg.stream = True
+
+        s = cmd_send.Sender(self.cfg, None)
+        d, fd_to_send = s._build_offer()
+
+        self.assertIsNone(fd_to_send)
+        self.assertEqual(d["directory"], {"mode": "tarball/gzip",
+                                          "dirname": "dirname",
+                                          "numfiles": 3,
+                                          "numbytes": 21,
+                                          })
+        # nothing is read until the transfer starts
+        self.assertEqual(s._dir_sender.mode(), "tarball/gzip")
+        self.assertEqual([name for (path, name) in s._dir_sender._entries],
+                         ["a", "b", "sub", "sub/c", "sub/empty"])
+
+    def test_batch(self):
+        send_dir = self.mktemp()
+        os.makedirs(os.path.join(send_dir, "sub"))
+        for name, data in [("a", b"ponies\n"), (os.path.join("sub", "b"), b"")]:
+            with open(os.path.join(send_dir, name), "wb") as f:
+                f.write(data)
+        self.cfg.batch = ["a", os.path.join("sub", "b") + os.sep]
+        self.cfg.cwd = send_dir
+
+        s = cmd_send.Sender(self.cfg, None)
+        d, fd_to_send = s._build_offer()
+        self.assertIsNone(fd_to_send)
+        self.assertEqual(d["files"], {"files": [{"filename": "a",
+                                                 "filesize": 7},
+                                                {"filename": "b",
+                                                 "filesize": 0}],
+                                      "numbytes": 7})
+
+        # only files, and no two with the same name
+        self.cfg.batch = ["a", "sub"]
+        e = self.assertRaises(TransferError, build_offer, self.cfg)
+        self.assertIn("no file named 'sub'", str(e))
+        self.cfg.batch = ["a", os.path.join("sub", "..", "a")]
+        e = self.assertRaises(TransferError, build_offer, self.cfg)
+        self.assertEqual(str(e), "Cannot send two files named 'a'")
+
+    def test_directory_store(self):
+        parent_dir = self.mktemp()
+        os.makedirs(os.path.join(parent_dir, "dirname"))
+        with open(os.path.join(parent_dir, "dirname", "a"), "wb") as f:
+            f.write(b"a"*1000)
+        self.cfg.what = "dirname"
+        self.cfg.cwd = parent_dir
+        self.cfg.compress_level = 0
+
+        d, fd_to_send = build_offer(self.cfg)
+        self.assertEqual(d["directory"]["mode"], "zipfile/deflated")
+        with zipfile.ZipFile(fd_to_send, "r") as zf:
+            self.assertEqual(zf.getinfo("a").compress_type,
+                             zipfile.ZIP_STORED)
+
+        self.cfg.stream = True
+        d, fd_to_send = build_offer(self.cfg)
+        self.assertEqual(d["directory"]["mode"], "tarball/store")
+
+    def test_directory_compress_level(self):
+        if not cmd_send.ZIP_HAS_COMPRESSLEVEL:
+            raise unittest.SkipTest("zipfile has no compresslevel before"
+                                    " python 3.7")
+        parent_dir = self.mktemp()
+        os.makedirs(os.path.join(parent_dir, "dirname"))
+        with open(os.path.join(parent_dir, "dirname", "a"), "wb") as f:
+            f.write(b"".join([("line %d\n" % i).encode("ascii")
+                              for i in range(20000)]))
+        self.cfg.what = "dirname"
+        self.cfg.cwd = parent_dir
+        sizes = []
+        for level in [1, 9]:
+            self.cfg.compress_level = level
+            d, fd_to_send = build_offer(self.cfg)
+            sizes.append(d["directory"]["zipsize"])
+        self.assertTrue(sizes[0] > sizes[1], sizes)
+
+    def test_directory_cached(self):
+        parent_dir = self.mktemp()
+        os.makedirs(os.path.join(parent_dir, "dirname"))
+        contents = {"random": os.urandom(10000), "text": b"text"*1000}
+        for name, data in contents.items():
+            with open(os.path.join(parent_dir, "dirname", name), "wb") as f:
+                f.write(data)
+        self.cfg.what = "dirname"
+        self.cfg.cwd = parent_dir
+
+        def compress_types():
+            d, fd_to_send = build_offer(self.cfg)
+            self.assertEqual(d["directory"]["numbytes"], 14000)
+            with zipfile.ZipFile(fd_to_send, "r") as zf:
+                for name, data in contents.items():
+                    self.assertEqual(zf.read(name), data)
+                return dict((name, zf.getinfo(name).compress_type)
+                            for name in contents)
+        self.assertEqual(compress_types(),
+                         {"random": zipfile.ZIP_DEFLATED,
+                          "text": zipfile.ZIP_DEFLATED})
+        # now we know that one doesn't compress
+        self.assertEqual(compress_types(),
+                         {"random": zipfile.ZIP_STORED,
+                          "text": zipfile.ZIP_DEFLATED})
+
     def test_unknown(self):
         self.cfg.what = filename = "unknown"
         send_dir = self.mktemp()
@@ -224,10 +376,14 @@ class PregeneratedCode(ServerBase, ScriptsBase, unittest.TestCase):
 
     @inlineCallbacks
     def _do_test(self, as_subprocess=False,
-                 mode="text", addslash=False, override_filename=False):
+                 mode="text", addslash=False, override_filename=False,
+                 stream=False, compress_level=6, direct_io=False):
         assert mode in ("text", "file", "directory")
         send_cfg = config("send")
+        send_cfg.stream = stream
+        send_cfg.compress_level = compress_level
         recv_cfg = config("receive")
+        recv_cfg.direct_io = direct_io
         message = "blah blah blah ponies"
 
         for cfg in [send_cfg, recv_cfg]:
@@ -236,6 +392,7 @@ class PregeneratedCode(ServerBase, ScriptsBase, unittest.TestCase):
             cfg.transit_helper = ""
             cfg.listen = True
             cfg.code = "1-abc"
+            cfg.connection_cache = self.mktemp()
             cfg.stdout = io.StringIO()
             cfg.stderr = io.StringIO()
 
@@ -306,10 +463,13 @@ class PregeneratedCode(ServerBase, ScriptsBase, unittest.TestCase):
                     '--code', send_cfg.code,
                 ] + content_args
 
+            # (with our XDG_CACHE_HOME, so their caches aren't the user's)
+            env = dict(LC_ALL="en_US.UTF-8", LANG="en_US.UTF-8",
+                       XDG_CACHE_HOME=os.environ["XDG_CACHE_HOME"])
             send_d = getProcessOutputAndValue(
                 wormhole_bin, send_args,
                 path=send_dir,
-                env=dict(LC_ALL="en_US.UTF-8", LANG="en_US.UTF-8"),
+                env=env,
             )
             recv_args = [
                 '--relay-url', self.relayurl,
@@ -325,7 +485,7 @@ class PregeneratedCode(ServerBase, ScriptsBase, unittest.TestCase):
             receive_d = getProcessOutputAndValue(
                 wormhole_bin, recv_args,
                 path=receive_dir,
-                env=dict(LC_ALL="en_US.UTF-8", LANG="en_US.UTF-8"),
+                env=env,
             )
 
             (send_res, receive_res) = yield gatherResults([send_d, receive_d],
@@ -339,6 +499,12 @@ class PregeneratedCode(ServerBase, ScriptsBase, unittest.TestCase):
             NL = os.linesep
             self.assertEqual((send_rc, receive_rc), (0, 0),
                              (send_res, receive_res))
+            if mode != "text":
+                # they remembered the connection in our cache, not the
+                # user's
+                self.assertTrue(os.path.exists(os.path.join(
+                    os.environ["XDG_CACHE_HOME"], "magic-wormhole",
+                    "connections.json")))
         else:
             send_cfg.cwd = send_dir
             send_d = cmd_send.send(send_cfg)
@@ -412,6 +578,10 @@ class PregeneratedCode(ServerBase, ScriptsBase, unittest.TestCase):
             self.failUnless(os.path.exists(fn))
             with open(fn, "r") as f:
                 self.failUnlessEqual(f.read(), message)
+            if not as_subprocess:
+                # both sides remember how they connected, for next time
+                for cfg in [send_cfg, recv_cfg]:
+                    self.failUnless(os.path.exists(cfg.connection_cache))
         elif mode == "directory":
             want = (r"Receiving directory \(\d+ \w+\) into: {name}/"
                     .format(name=receive_dirname))
@@ -438,8 +608,17 @@ class PregeneratedCode(ServerBase, ScriptsBase, unittest.TestCase):
 
     def test_file(self):
         return self._do_test(mode="file")
+    def test_file_subprocess(self):
+        return self._do_test(as_subprocess=True, mode="file")
     def test_file_override(self):
         return self._do_test(mode="file", override_filename=True)
+    def test_file_direct_io(self):
+        self.patch(cmd_receive, "DIRECT_THRESHOLD", 0)
+        return self._do_test(mode="file", direct_io=True)
+    def test_file_threads(self):
+        self.patch(cmd_send, "threads_are_useful", lambda: True)
+        self.patch(cmd_receive, "threads_are_useful", lambda: True)
+        return self._do_test(mode="file")
 
     def test_directory(self):
         return self._do_test(mode="directory")
@@ -447,6 +626,353 @@ class PregeneratedCode(ServerBase, ScriptsBase, unittest.TestCase):
         return self._do_test(mode="directory", addslash=True)
     def test_directory_override(self):
         return self._do_test(mode="directory", override_filename=True)
+    def test_directory_stream(self):
+        return self._do_test(mode="directory", stream=True)
+    def test_directory_stream_addslash(self):
+        return self._do_test(mode="directory", addslash=True, stream=True)
+    def test_directory_stream_store(self):
+        return self._do_test(mode="directory", stream=True, compress_level=0)
+    def test_directory_store(self):
+        return self._do_test(mode="directory", compress_level=0)
+
+    @inlineCallbacks
+    def test_file_resume(self):
+        self.patch(resume, "CHUNK_SIZE", 10)
+        send_cfg = config("send", "--resumable")
+        recv_cfg = config("receive")
+
+        for cfg in [send_cfg, recv_cfg]:
+            cfg.hide_progress = True
+            cfg.relay_url = self.relayurl
+            cfg.transit_helper = ""
+            cfg.listen = True
+            cfg.code = "1-abc"
+            cfg.stdout = io.StringIO()
+            cfg.stderr = io.StringIO()
+        recv_cfg.accept_file = True
+
+        send_dir = self.mktemp()
+        os.mkdir(send_dir)
+        receive_dir = self.mktemp()
+        os.mkdir(receive_dir)
+
+        # 96 bytes
+        message = b"".join([("%02d" % i).encode("ascii") for i in range(48)])
+        with open(os.path.join(send_dir, "testfile"), "wb") as f:
+            f.write(message)
+        send_cfg.what = "testfile"
+
+        # an earlier attempt got three chunks, but the third one was damaged
+        # on disk since
+        tmp_name = os.path.join(receive_dir, "testfile.tmp")
+        manifest, _ = resume.build_manifest(io.BytesIO(message), len(message))
+        j = resume.Journal(tmp_name, len(message), 10, manifest["sha256"])
+        self.assertEqual(j.resume_point(), 0)
+        with j.open() as f:
+            j.update(message[:30])
+            f.write(message[:20] + b"X"*10)
+        j.close()
+
+        send_cfg.cwd = send_dir
+        send_d = cmd_send.send(send_cfg)
+        recv_cfg.cwd = receive_dir
+        receive_d = cmd_receive.receive(recv_cfg)
+        yield gatherResults([send_d, receive_d], True)
+
+        self.failUnlessIn("Resuming at 20 Bytes", send_cfg.stdout.getvalue())
+        self.failUnlessIn("Resuming at 20 Bytes", recv_cfg.stdout.getvalue())
+        self.failUnlessIn("Confirmation received. Transfer complete.",
+                          send_cfg.stdout.getvalue())
+        with open(os.path.join(receive_dir, "testfile"), "rb") as f:
+            self.assertEqual(f.read(), message)
+        self.assertFalse(os.path.exists(tmp_name))
+        self.assertFalse(os.path.exists(tmp_name + ".journal"))
+
+    @inlineCallbacks
+    def _do_test_compressed(self, threads):
+        self.patch(cmd_send, "threads_are_useful", lambda: threads)
+        self.patch(cmd_receive, "threads_are_useful", lambda: threads)
+        unpacked = []
+        original = compression.Unpacker
+        class Unpacker(original):
+            def __call__(self, record):
+                unpacked.append((self._codec.name, record[:1], len(record)))
+                return original.__call__(self, record)
+        self.patch(compression, "Unpacker", Unpacker)
+        send_cfg = config("send")
+        recv_cfg = config("receive")
+
+        for cfg in [send_cfg, recv_cfg]:
+            cfg.hide_progress = True
+            cfg.relay_url = self.relayurl
+            cfg.transit_helper = ""
+            cfg.listen = True
+            cfg.code = "1-abc"
+            cfg.stdout = io.StringIO()
+            cfg.stderr = io.StringIO()
+        recv_cfg.accept_file = True
+
+        send_dir = self.mktemp()
+        os.mkdir(send_dir)
+        receive_dir = self.mktemp()
+        os.mkdir(receive_dir)
+
+        message = b"blah blah blah ponies\n" * 50000
+        with open(os.path.join(send_dir, "testfile"), "wb") as f:
+            f.write(message)
+        send_cfg.what = "testfile"
+
+        send_cfg.cwd = send_dir
+        send_d = cmd_send.send(send_cfg)
+        recv_cfg.cwd = receive_dir
+        receive_d = cmd_receive.receive(recv_cfg)
+        yield gatherResults([send_d, receive_d], True)
+
+        self.failUnlessIn("Confirmation received. Transfer complete.",
+                          send_cfg.stdout.getvalue())
+        with open(os.path.join(receive_dir, "testfile"), "rb") as f:
+            self.assertEqual(f.read(), message)
+        codec = compression.available()[0]
+        self.assertEqual(set(u[:2] for u in unpacked),
+                         set([(codec, compression.PACKED)]))
+        self.assertTrue(sum(u[2] for u in unpacked) < len(message) / 10)
+
+    def test_file_compressed(self):
+        return self._do_test_compressed(False)
+    def test_file_compressed_threads(self):
+        return self._do_test_compressed(True)
+
+    @inlineCallbacks
+    def _do_test_batch(self, threads):
+        self.patch(cmd_send, "threads_are_useful", lambda: threads)
+        self.patch(cmd_receive, "threads_are_useful", lambda: threads)
+        send_cfg = config("send", "one", "two", "three", "four")
+        recv_cfg = config("receive")
+
+        for cfg in [send_cfg, recv_cfg]:
+            cfg.hide_progress = True
+            cfg.relay_url = self.relayurl
+            cfg.transit_helper = ""
+            cfg.listen = True
+            cfg.code = "1-abc"
+            cfg.stdout = io.StringIO()
+            cfg.stderr = io.StringIO()
+
+        send_dir = self.mktemp()
+        os.mkdir(send_dir)
+        receive_dir = self.mktemp()
+        os.mkdir(receive_dir)
+        contents = {"one": b"1"*100000, "two": b"", "three": b"3"*10,
+                    "four": os.urandom(300000)}
+        for name, data in contents.items():
+            with open(os.path.join(send_dir, name), "wb") as f:
+                f.write(data)
+        # the receiver already has one, and doesn't want another
+        with open(os.path.join(receive_dir, "three"), "wb") as f:
+            f.write(b"mine")
+        answers = ["y", "n", "yes"]
+        self.patch(six.moves, "input", lambda prompt: answers.pop(0))
+
+        send_cfg.cwd = send_dir
+        send_d = cmd_send.send(send_cfg)
+        recv_cfg.cwd = receive_dir
+        receive_d = cmd_receive.receive(recv_cfg)
+        yield gatherResults([send_d, receive_d], True)
+
+        self.assertEqual(answers, [])
+        send_stdout = send_cfg.stdout.getvalue()
+        self.failUnlessIn("Sending 4 files (400.0 kB)", send_stdout)
+        self.failUnlessIn("The receiver skipped 2 of 4 files", send_stdout)
+        self.failUnlessIn("Confirmation received. Transfer complete.",
+                          send_stdout)
+        receive_stdout = recv_cfg.stdout.getvalue()
+        self.failUnlessIn("Skipping 'three': it already exists",
+                          receive_stdout)
+        self.assertEqual(sorted(os.listdir(receive_dir)),
+                         ["four", "one", "three"])
+        for name in ["one", "four"]:
+            with open(os.path.join(receive_dir, name), "rb") as f:
+                self.assertEqual(f.read(), contents[name])
+        with open(os.path.join(receive_dir, "three"), "rb") as f:
+            self.assertEqual(f.read(), b"mine")
+
+    def test_batch(self):
+        return self._do_test_batch(False)
+    def test_batch_threads(self):
+        return self._do_test_batch(True)
+
+    @inlineCallbacks
+    def test_directory_delta(self):
+        send_cfg = config("send", "--delta", "dirname")
+        recv_cfg = config("receive", "--accept-file")
+        for cfg in [send_cfg, recv_cfg]:
+            cfg.hide_progress = True
+            cfg.relay_url = self.relayurl
+            cfg.transit_helper = ""
+            cfg.listen = True
+            cfg.code = "1-abc"
+
+        send_dir = self.mktemp()
+        os.makedirs(os.path.join(send_dir, "dirname", "sub"))
+        receive_dir = self.mktemp()
+        os.mkdir(receive_dir)
+        big = os.urandom(300000)
+        contents = {"big": big, "small": b"small",
+                    os.path.join("sub", "empty"): b""}
+        for name, data in contents.items():
+            with open(os.path.join(send_dir, "dirname", name), "wb") as f:
+                f.write(data)
+        send_cfg.cwd = send_dir
+        recv_cfg.cwd = receive_dir
+
+        @inlineCallbacks
+        def sync():
+            for cfg in [send_cfg, recv_cfg]:
+                cfg.stdout = io.StringIO()
+                cfg.stderr = io.StringIO()
+            yield gatherResults([cmd_send.send(send_cfg),
+                                 cmd_receive.receive(recv_cfg)], True)
+            for name, data in contents.items():
+                fn = os.path.join(receive_dir, "dirname", name)
+                with open(fn, "rb") as f:
+                    self.assertEqual(f.read(), data)
+
+        yield sync()
+        self.failUnlessIn("Receiving directory", recv_cfg.stdout.getvalue())
+        self.failUnlessIn("3 of 3 files have changed",
+                          send_cfg.stdout.getvalue())
+
+        # a small change to the big file only sends a little
+        contents["big"] = big[:1000] + b"changed" + big[1000:]
+        with open(os.path.join(send_dir, "dirname", "big"), "wb") as f:
+            f.write(contents["big"])
+        os.utime(os.path.join(send_dir, "dirname", "big"), (1, 1))
+
+        # but the receiver must ask for the update: --accept-file isn't
+        # enough
+        for cfg in [send_cfg, recv_cfg]:
+            cfg.listen = False # (a rejected transfer doesn't stop listening)
+            cfg.stdout = io.StringIO()
+            cfg.stderr = io.StringIO()
+        send_d = cmd_send.send(send_cfg)
+        receive_d = cmd_receive.receive(recv_cfg)
+        f = yield self.assertFailure(send_d, TransferError)
+        self.assertEqual(str(f), "remote error, transfer abandoned:"
+                         " transfer rejected")
+        f = yield self.assertFailure(receive_d, TransferError)
+        self.failUnlessIn("refusing to overwrite existing directory dirname",
+                          recv_cfg.stdout.getvalue())
+        with open(os.path.join(receive_dir, "dirname", "big"), "rb") as f:
+            self.assertEqual(f.read(), big)
+
+        for cfg in [send_cfg, recv_cfg]:
+            cfg.listen = True
+        recv_cfg.update = True
+        recv_cfg.accept_file = False
+        answers = ["y", "y"]
+        self.patch(six.moves, "input", lambda prompt: answers.pop(0))
+        yield sync()
+        self.assertEqual(answers, [])
+        receive_stdout = recv_cfg.stdout.getvalue()
+        self.failUnlessIn("Updating directory", receive_stdout)
+        self.failUnlessIn("These files will be replaced:\n  big\n",
+                          receive_stdout)
+        self.failUnlessIn("1 of 3 files have changed", receive_stdout)
+        send_stdout = send_cfg.stdout.getvalue()
+        self.failUnlessIn("Confirmation received. Transfer complete.",
+                          send_stdout)
+        sent = re.search(r"Sent ([\d.]+) kB of changes", send_stdout)
+        self.assertTrue(float(sent.group(1)) < 20, send_stdout)
+
+    @inlineCallbacks
+    def test_directory_dedup(self):
+        send_cfg = config("send", "--dedup", "dirname")
+        recv_cfg = config("receive", "--accept-file")
+        for cfg in [send_cfg, recv_cfg]:
+            cfg.hide_progress = True
+            cfg.relay_url = self.relayurl
+            cfg.transit_helper = ""
+            cfg.listen = True
+            cfg.code = "1-abc"
+        recv_cfg.chunk_cache = self.mktemp()
+        send_cfg.hash_cache = self.mktemp()
+
+        send_dir = self.mktemp()
+        os.makedirs(os.path.join(send_dir, "dirname", "sub"))
+        lib = os.urandom(300000)
+        contents = {"one": lib, os.path.join("sub", "two"): lib,
+                    "three": lib + b"more"}
+        for name, data in contents.items():
+            with open(os.path.join(send_dir, "dirname", name), "wb") as f:
+                f.write(data)
+        send_cfg.cwd = send_dir
+
+        @inlineCallbacks
+        def transfer():
+            for cfg in [send_cfg, recv_cfg]:
+                cfg.stdout = io.StringIO()
+                cfg.stderr = io.StringIO()
+            recv_cfg.cwd = self.mktemp()
+            os.mkdir(recv_cfg.cwd)
+            yield gatherResults([cmd_send.send(send_cfg),
+                                 cmd_receive.receive(recv_cfg)], True)
+            for name, data in contents.items():
+                fn = os.path.join(recv_cfg.cwd, "dirname", name)
+                with open(fn, "rb") as f:
+                    self.assertEqual(f.read(), data)
+            send_stdout = send_cfg.stdout.getvalue()
+            self.failUnlessIn("without repeats", send_stdout)
+            self.failUnlessIn("Confirmation received. Transfer complete.",
+                              send_stdout)
+            returnValue(send_stdout)
+
+        # the three copies cost one
+        send_stdout = yield transfer()
+        new = re.search(r"([\d.]+) kB of 900.0 kB is new", send_stdout)
+        self.assertTrue(300 <= float(new.group(1)) < 350, send_stdout)
+        # and the chunks are cached for next time
+        send_stdout = yield transfer()
+        self.failUnlessIn("0 Bytes of 900.0 kB is new to the receiver",
+                          send_stdout)
+
+    @inlineCallbacks
+    def test_file_no_space(self):
+        self.patch(cmd_receive, "free_space", lambda directory: 10)
+        send_cfg = config("send")
+        recv_cfg = config("receive")
+
+        for cfg in [send_cfg, recv_cfg]:
+            cfg.hide_progress = True
+            cfg.relay_url = self.relayurl
+            cfg.transit_helper = ""
+            cfg.listen = False
+            cfg.code = "1-abc"
+            cfg.stdout = io.StringIO()
+            cfg.stderr = io.StringIO()
+        recv_cfg.accept_file = True
+
+        send_dir = self.mktemp()
+        os.mkdir(send_dir)
+        receive_dir = self.mktemp()
+        os.mkdir(receive_dir)
+        with open(os.path.join(send_dir, "testfile"), "w") as f:
+            f.write("test message")
+        send_cfg.what = "testfile"
+
+        send_cfg.cwd = send_dir
+        send_d = cmd_send.send(send_cfg)
+        recv_cfg.cwd = receive_dir
+        receive_d = cmd_receive.receive(recv_cfg)
+
+        # we refuse before anything is written
+        f = yield self.assertFailure(send_d, TransferError)
+        self.assertEqual(str(f), "remote error, transfer abandoned:"
+                         " not enough disk space")
+        f = yield self.assertFailure(receive_d, TransferError)
+        self.assertEqual(str(f), "not enough disk space")
+        self.failUnlessIn("Error: not enough disk space (10 Bytes free,"
+                          " 12 Bytes needed)", recv_cfg.stdout.getvalue())
+        self.assertEqual(os.listdir(receive_dir), [])
 
     @inlineCallbacks
     def test_file_noclobber(self):
@@ -615,42 +1141,24 @@ class Cleanup(ServerBase, unittest.TestCase):
 
 class ExtractFile(unittest.TestCase):
     def test_filenames(self):
-        args = mock.Mock()
-        args.relay_url = ""
-        ef = cmd_receive.TwistedReceiver(args)._extract_file
         extract_dir = os.path.abspath(self.mktemp())
+        def plan(*names):
+            return unzip.plan([zipfile.ZipInfo(name) for name in names],
+                              extract_dir)
 
-        zf = mock.Mock()
-        zi = mock.Mock()
-        zi.filename = "ok"
-        zi.external_attr = 5 << 16
-        expected = os.path.join(extract_dir, "ok")
-        with mock.patch.object(cmd_receive.os, "chmod") as chmod:
-            ef(zf, zi, extract_dir)
-            self.assertEqual(zf.extract.mock_calls,
-                             [mock.call(zi.filename, path=extract_dir)])
-            self.assertEqual(chmod.mock_calls, [mock.call(expected, 5)])
-
-        zf = mock.Mock()
-        zi = mock.Mock()
-        zi.filename = "../haha"
-        e = self.assertRaises(ValueError, ef, zf, zi, extract_dir)
+        dirs, members = plan("ok")
+        self.assertEqual(dirs, [extract_dir])
+        self.assertEqual([(zi.filename, path) for (zi, path) in members],
+                         [("ok", os.path.join(extract_dir, "ok"))])
+
+        e = self.assertRaises(ValueError, plan, "ok", "../haha")
         self.assertIn("malicious zipfile", str(e))
 
-        zf = mock.Mock()
-        zi = mock.Mock()
-        zi.filename = "haha//root" # abspath squashes this, hopefully zipfile
-                                   # does too
-        zi.external_attr = 5 << 16
-        expected = os.path.join(extract_dir, "haha", "root")
-        with mock.patch.object(cmd_receive.os, "chmod") as chmod:
-            ef(zf, zi, extract_dir)
-            self.assertEqual(zf.extract.mock_calls,
-                             [mock.call(zi.filename, path=extract_dir)])
-            self.assertEqual(chmod.mock_calls, [mock.call(expected, 5)])
-
-        zf = mock.Mock()
-        zi = mock.Mock()
-        zi.filename = "/etc/passwd"
-        e = self.assertRaises(ValueError, ef, zf, zi, extract_dir)
+        # abspath squashes this
+        dirs, members = plan("haha//root")
+        self.assertEqual(dirs, [extract_dir, os.path.join(extract_dir, "haha")])
+        self.assertEqual([path for (zi, path) in members],
+                         [os.path.join(extract_dir, "haha", "root")])
+
+        e = self.assertRaises(ValueError, plan, "/etc/passwd")
         self.assertIn("malicious zipfile", str(e))
@@ -4,10 +4,11 @@ from binascii import hexlify
 import mock
 from twisted.trial import unittest
 from twisted.python import log
-from twisted.internet import protocol, reactor, defer
+from twisted.internet import protocol, reactor, defer, task
 from twisted.internet.defer import inlineCallbacks, returnValue
 from twisted.internet.endpoints import clientFromString, connectProtocol
 from twisted.web import client
+from twisted.test import proto_helpers
 from autobahn.twisted import websocket
 from .. import __version__
 from .common import ServerBase
@@ -1193,3 +1194,293 @@ class Transit(ServerBase, unittest.TestCase):
         self.assertEqual(a1.data, exp)
 
         a1.transport.loseConnection()
+
+class TransitProtocolBase:
+    def make_transit(self, **kwargs):
+        t = transit_server.Transit(get_db(":memory:"), None, **kwargs)
+        self.clock = t._reactor = task.Clock()
+        return t
+
+    def connect(self, t, token):
+        p = t.buildProtocol(None)
+        tr = proto_helpers.StringTransport()
+        p.makeConnection(tr)
+        p.dataReceived(b"please relay " + hexlify(token) + b"\n")
+        return p, tr
+
+class TransitLimits(TransitProtocolBase, unittest.TestCase):
+    def test_token_bucket(self):
+        b = transit_server.TokenBucket(100, now=0)
+        self.assertEqual(b.consume(60, now=0), 0)
+        self.assertEqual(b.consume(60, now=0), 0.2)
+        # refilled at 100 tokens per second
+        self.assertEqual(b.consume(10, now=0.3), 0)
+        # but never beyond one second's worth
+        self.assertEqual(b.consume(150, now=10), 0.5)
+        b.set_rate(10, now=10)
+        self.assertEqual(b.consume(0, now=10), 5.0)
+
+    def test_advertised(self):
+        rs = server.RelayServer(str("tcp:0"), str("tcp:0"), None,
+                                transit_limits=dict(max_length=1000,
+                                                    bandwidth=5000))
+        welcome = rs._rendezvous.get_welcome()
+        self.assertEqual(welcome["transit_limits"],
+                         {"max_bytes": 1000, "bandwidth": 5000})
+        rs = server.RelayServer(str("tcp:0"), str("tcp:0"), None)
+        self.assertNotIn("transit_limits", rs._rendezvous.get_welcome())
+
+    def test_max_length(self):
+        t = self.make_transit(max_length=10)
+        p1, tr1 = self.connect(t, b"\x00"*32)
+        p2, tr2 = self.connect(t, b"\x00"*32)
+        self.assertEqual(tr1.value(), b"ok\n")
+        p1.dataReceived(b"12345")
+        p2.dataReceived(b"12345")
+        self.assertFalse(tr1.disconnecting)
+        self.assertFalse(tr2.disconnecting)
+        p1.dataReceived(b"!")
+        self.assertTrue(tr1.disconnecting)
+        # the byte that would have gone over the limit isn't relayed
+        self.assertEqual(tr2.value(), b"ok\n12345")
+
+    def test_max_time(self):
+        t = self.make_transit(max_time=60)
+        p1, tr1 = self.connect(t, b"\x00"*32)
+        self.clock.advance(20) # waiting for a buddy doesn't count
+        self.assertFalse(tr1.disconnecting)
+        p2, tr2 = self.connect(t, b"\x00"*32)
+        self.clock.advance(59)
+        self.assertFalse(tr1.disconnecting)
+        self.clock.advance(1)
+        self.assertTrue(tr1.disconnecting)
+        self.assertTrue(tr2.disconnecting)
+        p1.connectionLost(None)
+        p2.connectionLost(None)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_throttle(self):
+        t = self.make_transit(pair_rate=100)
+        p1, tr1 = self.connect(t, b"\x00"*32)
+        p2, tr2 = self.connect(t, b"\x00"*32)
+        p1.dataReceived(b"x"*50)
+        self.assertEqual(tr1.producerState, "producing")
+        p1.dataReceived(b"x"*100)
+        self.assertEqual(tr1.producerState, "paused")
+        self.assertEqual(tr2.value(), b"ok\n"+b"x"*150)
+        # backpressure from the buddy must not override the rate limit
+        p1.pauseProducing()
+        p1.resumeProducing()
+        self.assertEqual(tr1.producerState, "paused")
+        self.clock.advance(0.5)
+        self.assertEqual(tr1.producerState, "producing")
+        # and vice versa
+        p1.pauseProducing()
+        p1.dataReceived(b"x"*200)
+        self.clock.advance(5)
+        self.assertEqual(tr1.producerState, "paused")
+        p1.resumeProducing()
+        self.assertEqual(tr1.producerState, "producing")
+
+    def test_fair_share(self):
+        t = self.make_transit(bandwidth=1000, pair_rate=400)
+        p1, tr1 = self.connect(t, b"\x01"*32)
+        p2, tr2 = self.connect(t, b"\x01"*32)
+        self.assertEqual(p1._bucket.rate, 400)
+        p3, tr3 = self.connect(t, b"\x02"*32)
+        p4, tr4 = self.connect(t, b"\x02"*32)
+        for p in [p1, p2, p3, p4]:
+            self.assertEqual(p._bucket.rate, 250)
+        p3.connectionLost(None)
+        p4.connectionLost(None)
+        self.assertEqual(p1._bucket.rate, 400)
+        p1.connectionLost(None)
+        p2.connectionLost(None)
+        self.assertEqual(t._rebalance_call, None)
+
+    def test_max_min_shares(self):
+        shares = transit_server.max_min_shares
+        self.assertEqual(shares(900, [None, None, None]), [300, 300, 300])
+        self.assertEqual(shares(900, [100, None, None]), [100, 400, 400])
+        self.assertEqual(shares(900, [None, 500, 100]), [400, 400, 100])
+        self.assertEqual(shares(900, [100, 200]), [100, 200])
+        self.assertEqual(shares(900, []), [])
+
+    def test_idle_share(self):
+        t = self.make_transit(bandwidth=10000)
+        p1, tr1 = self.connect(t, b"\x01"*32)
+        p2, tr2 = self.connect(t, b"\x01"*32)
+        p3, tr3 = self.connect(t, b"\x02"*32)
+        p4, tr4 = self.connect(t, b"\x02"*32)
+        for p in [p1, p2, p3, p4]:
+            self.assertEqual(p._bucket.rate, 2500)
+        # p1 sends as fast as it is allowed to, the others hardly at all
+        for i in range(5):
+            p1.dataReceived(b"x"*20000)
+            p3.dataReceived(b"x"*1500)
+            self.clock.advance(t.REBALANCE_INTERVAL)
+        # so the others keep what they use, with some headroom, and p1
+        # gets the rest
+        self.assertEqual(p2._bucket.rate, t.IDLE_RATE)
+        self.assertEqual(p4._bucket.rate, t.IDLE_RATE)
+        self.assertEqual(p3._bucket.rate, 3000)
+        self.assertEqual(p1._bucket.rate, 10000 - 2*t.IDLE_RATE - 3000)
+        # once it has calmed down (and worked off what it sent over its
+        # rate), it gives its share back
+        self.clock.pump([t.REBALANCE_INTERVAL]*30)
+        self.assertEqual(p1._bucket.rate, t.IDLE_RATE)
+        for p in [p1, p2, p3, p4]:
+            p.connectionLost(None)
+        self.assertEqual(t._rebalance_call, None)
+
+class TransitExpiry(TransitProtocolBase, unittest.TestCase):
+    def test_lonely(self):
+        t = self.make_transit()
+        p1, tr1 = self.connect(t, b"\x00"*32)
+        self.clock.advance(10)
+        p2, tr2 = self.connect(t, b"\x01"*32)
+        self.clock.advance(19)
+        self.assertFalse(tr1.disconnecting)
+        self.clock.advance(1)
+        self.assertTrue(tr1.disconnecting)
+        self.assertFalse(tr2.disconnecting)
+        self.assertEqual(list(t._pending_requests.values()), [p2])
+        self.assertEqual(list(t._pending_tokens.keys()), [p2])
+        p1.connectionLost(None)
+        self.clock.advance(10)
+        self.assertTrue(tr2.disconnecting)
+        self.assertEqual(t._pending_requests, {})
+        self.assertEqual(t._pending_tokens, {})
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_no_token(self):
+        t = self.make_transit()
+        p1 = t.buildProtocol(None)
+        tr1 = proto_helpers.StringTransport()
+        p1.makeConnection(tr1)
+        self.clock.advance(30)
+        self.assertTrue(tr1.disconnecting)
+
+    def test_matched(self):
+        t = self.make_transit()
+        p1, tr1 = self.connect(t, b"\x00"*32)
+        p2, tr2 = self.connect(t, b"\x00"*32)
+        self.assertEqual(t._pending_tokens, {})
+        self.clock.advance(30)
+        self.assertFalse(tr1.disconnecting)
+        self.assertFalse(tr2.disconnecting)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_finished(self):
+        t = self.make_transit()
+        p1, tr1 = self.connect(t, b"\x00"*32)
+        p1.connectionLost(None)
+        self.assertEqual(t._pending_requests, {})
+        self.assertEqual(t._pending_tokens, {})
+        t.startService()
+        t.stopService()
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+class TransitHandshake(TransitProtocolBase, unittest.TestCase):
+    def test_bytewise(self):
+        t = self.make_transit()
+        p1 = t.buildProtocol(None)
+        tr1 = proto_helpers.StringTransport()
+        p1.makeConnection(tr1)
+        handshake = b"please relay " + hexlify(b"\x00"*32) + b"\n"
+        for i in range(len(handshake)):
+            p1.dataReceived(handshake[i:i+1])
+        self.assertEqual(p1._got_token, hexlify(b"\x00"*32))
+        self.assertEqual(t._pending_requests, {hexlify(b"\x00"*32): p1})
+        self.assertEqual(tr1.value(), b"")
+
+    def test_bad_token(self):
+        t = self.make_transit()
+        p1 = t.buildProtocol(None)
+        tr1 = proto_helpers.StringTransport()
+        p1.makeConnection(tr1)
+        p1.dataReceived(b"please relay " + b"-"*64 + b"\n")
+        self.assertEqual(tr1.value(), b"bad handshake\n")
+        self.assertTrue(tr1.disconnecting)
+
+    def test_missing_newline(self):
+        t = self.make_transit()
+        p1 = t.buildProtocol(None)
+        tr1 = proto_helpers.StringTransport()
+        p1.makeConnection(tr1)
+        p1.dataReceived(b"please relay " + b"a"*65)
+        self.assertEqual(tr1.value(), b"bad handshake\n")
+
+class TransitUsage(TransitProtocolBase, unittest.TestCase):
+    def test_histogram(self):
+        h = transit_server.Histogram()
+        self.assertEqual(h.percentile(0.5), 0)
+        for value in [0, 1, 1, 1000, 1000, 1000, 1000, 1000, 1000, 10**9]:
+            h.add(value)
+        self.assertEqual(h.count, 10)
+        self.assertEqual(h.max, 10**9)
+        self.assertEqual(h.percentile(0.1), 0)
+        self.assertEqual(h.percentile(0.2), 1)
+        # buckets are within 1/16th of the true value
+        p50 = h.percentile(0.5)
+        self.assertTrue(1000*15/16 <= p50 <= 1000, p50)
+        p99 = h.percentile(0.99)
+        self.assertTrue(10**9*15/16 <= p99 <= 10**9, p99)
+        self.assertEqual(sum(count for (_, count) in h.buckets()), 10)
+        stats = h.get_stats()
+        self.assertEqual(stats["p50"], p50)
+        h.add(0.25)
+        self.assertIn((0.25, 1), h.buckets())
+
+    def test_batched(self):
+        t = self.make_transit()
+        db = t._db
+        def rows():
+            return db.execute("SELECT COUNT() AS `c` FROM `transit_usage`"
+                              ).fetchone()["c"]
+        p1, tr1 = self.connect(t, b"\x00"*32)
+        p2, tr2 = self.connect(t, b"\x00"*32)
+        p1.dataReceived(b"x"*100)
+        p1.connectionLost(None)
+        p2.connectionLost(None)
+        p3, tr3 = self.connect(t, b"\x01"*32)
+        p3.connectionLost(None)
+
+        # counted immediately, but not yet written
+        self.assertEqual(rows(), 0)
+        stats = t.get_stats()
+        self.assertEqual(stats["since_reboot"]["total"], 2)
+        self.assertEqual(stats["since_reboot"]["bytes"], 100)
+        self.assertEqual(stats["since_reboot"]["pair_bytes"]["count"], 1)
+        self.assertEqual(stats["since_reboot"]["pair_bytes"]["max"], 100)
+        self.assertEqual(stats["since_reboot"]["pair_time"]["count"], 1)
+        self.assertEqual(stats["all_time"]["total"], 2)
+        self.assertEqual(stats["all_time"]["moods"],
+                         {"happy": 1, "lonely": 1, "errory": 0})
+
+        t._flush_usage()
+        self.assertEqual(rows(), 2)
+        t._flush_usage()
+        self.assertEqual(rows(), 2)
+
+        # a new relay picks up the all-time totals from the database
+        t2 = transit_server.Transit(db, None)
+        stats = t2.get_stats()
+        self.assertEqual(stats["since_reboot"]["total"], 0)
+        self.assertEqual(stats["all_time"]["total"], 2)
+        self.assertEqual(stats["all_time"]["bytes"], 100)
+        self.assertEqual(stats["all_time"]["moods"]["happy"], 1)
+
+    def test_flush_when_full(self):
+        db = get_db(":memory:")
+        t = transit_server.Transit(db, None)
+        t.FLUSH_ROWS = 3
+        for i in range(4):
+            t.recordUsage(0, "lonely", 0, 1.0, None)
+        self.assertEqual(len(t._usage_rows), 1)
+        t.startService()
+        t.stopService()
+        self.assertEqual(len(t._usage_rows), 0)
+        count = db.execute("SELECT COUNT() AS `c` FROM `transit_usage`"
+                           ).fetchone()["c"]
+        self.assertEqual(count, 4)
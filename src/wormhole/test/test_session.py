@@ -0,0 +1,107 @@
+from __future__ import print_function, unicode_literals
+import os, io
+from twisted.trial import unittest
+from twisted.internet.defer import gatherResults, inlineCallbacks
+from .common import ServerBase, config
+from ..cli import cmd_session
+from ..errors import TransferError
+
+class Session(ServerBase, unittest.TestCase):
+    def make_session(self, *argv):
+        cfg = config("session", *argv)
+        cfg.hide_progress = True
+        cfg.relay_url = self.relayurl
+        cfg.transit_helper = ""
+        cfg.listen = True
+        cfg.code = "1-abc"
+        cfg.stdout = io.StringIO()
+        cfg.stderr = io.StringIO()
+        cfg.cwd = self.mktemp()
+        os.mkdir(cfg.cwd)
+        return cmd_session.Session(cfg), cfg
+
+    def write(self, cfg, name, data):
+        with open(os.path.join(cfg.cwd, name), "wb") as f:
+            f.write(data)
+        return os.path.join(cfg.cwd, name)
+
+    def read(self, cfg, name):
+        with open(os.path.join(cfg.cwd, name), "rb") as f:
+            return f.read()
+
+    @inlineCallbacks
+    def _do_test_both_ways(self, *argv):
+        a, a_cfg = self.make_session(*argv)
+        b, b_cfg = self.make_session(*argv)
+        a_files = {"one": b"1"*100000, "empty": b"", "two": os.urandom(1000)}
+        b_files = {"three": b"3"*10, "four": os.urandom(200000)}
+        sent = []
+        for s, cfg, files in [(a, a_cfg, a_files), (b, b_cfg, b_files)]:
+            for name in sorted(files):
+                path = self.write(cfg, name, files[name])
+                sent.append(s.send_file(path))
+        # the other side has one of these already, and refuses it
+        self.write(b_cfg, "two", b"mine")
+        refused = sent.pop(2)
+        for s in [a, b]:
+            s.finish()
+
+        yield gatherResults([a.go(), b.go()], True)
+        yield gatherResults(sent, True)
+        f = yield self.assertFailure(refused, TransferError)
+        self.assertIn("file already exists", str(f))
+
+        self.assertEqual(self.read(b_cfg, "one"), a_files["one"])
+        self.assertEqual(self.read(b_cfg, "empty"), b"")
+        self.assertEqual(self.read(b_cfg, "two"), b"mine")
+        for name in b_files:
+            self.assertEqual(self.read(a_cfg, name), b_files[name])
+        self.assertEqual(sorted(os.listdir(a_cfg.cwd)),
+                         ["empty", "four", "one", "three", "two"])
+        for cfg in [a_cfg, b_cfg]:
+            stdout = cfg.stdout.getvalue()
+            self.assertIn("Session open", stdout)
+            self.assertIn("Session closed", stdout)
+        self.assertIn("Refused 'two': file already exists",
+                      b_cfg.stdout.getvalue())
+        # one side leads, and each file got its own keys
+        self.assertNotEqual(a._leader, b._leader)
+        self.assertEqual(a._chain, b._chain)
+
+    def test_both_ways(self):
+        return self._do_test_both_ways()
+
+    def test_both_ways_uncompressed(self):
+        return self._do_test_both_ways("--compress-level", "0")
+
+    def test_threads(self):
+        self.patch(cmd_session, "threads_are_useful", lambda: True)
+        return self._do_test_both_ways()
+
+    @inlineCallbacks
+    def test_later(self):
+        # files can be offered while the session is open
+        a, a_cfg = self.make_session()
+        b, b_cfg = self.make_session()
+        done = gatherResults([a.go(), b.go()], True)
+        path = self.write(a_cfg, "first", b"first")
+        yield a.send_file(path)
+        path = self.write(b_cfg, "second", b"second")
+        yield b.send_file(path)
+        a.finish()
+        b.finish()
+        yield done
+        self.assertEqual(self.read(b_cfg, "first"), b"first")
+        self.assertEqual(self.read(a_cfg, "second"), b"second")
+        self.assertRaises(TransferError, a.send_file, path)
+
+    @inlineCallbacks
+    def test_missing_file(self):
+        a, a_cfg = self.make_session()
+        b, b_cfg = self.make_session()
+        d = a.send_file(os.path.join(a_cfg.cwd, "missing"))
+        a.finish()
+        b.finish()
+        yield gatherResults([a.go(), b.go()], True)
+        yield self.assertFailure(d, TransferError)
+        self.assertEqual(os.listdir(b_cfg.cwd), [])
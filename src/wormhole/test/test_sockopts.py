@@ -0,0 +1,47 @@
+import socket
+from twisted.trial import unittest
+from twisted.test import proto_helpers
+from .. import sockopts
+
+class FakeTCPTransport:
+    def __init__(self, sock):
+        self._sock = sock
+    def getHandle(self):
+        return self._sock
+
+class Options(unittest.TestCase):
+    def test_socket_options(self):
+        self.assertIs(sockopts.socket_options(), sockopts.DEFAULT_SOCKET_OPTIONS)
+        o = sockopts.socket_options(1000000)
+        self.assertEqual(o.sndbuf, 1000000)
+        self.assertEqual(o.rcvbuf, 1000000)
+        self.assertEqual(o.nodelay, True)
+
+    def test_tune(self):
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.addCleanup(s.close)
+        sndbuf = s.getsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF)
+        sockopts.tune_transport(FakeTCPTransport(s),
+                                sockopts.DEFAULT_SOCKET_OPTIONS)
+        self.assertEqual(s.getsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY),
+                         1)
+        self.assertEqual(s.getsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE),
+                         1)
+        # buffers are left to the kernel's auto-tuning by default
+        self.assertEqual(s.getsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF),
+                         sndbuf)
+
+        sockopts.tune_transport(FakeTCPTransport(s),
+                                sockopts.socket_options(sndbuf+65536))
+        # (linux doubles the value to allow for bookkeeping overhead)
+        self.assertTrue(s.getsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF)
+                        >= sndbuf+65536)
+
+    def test_not_tcp(self):
+        # transports without a socket are ignored
+        sockopts.tune_transport(proto_helpers.StringTransport(),
+                                sockopts.DEFAULT_SOCKET_OPTIONS)
+        sockopts.tune_transport(FakeTCPTransport(None),
+                                sockopts.DEFAULT_SOCKET_OPTIONS)
+        # and so are no options
+        sockopts.tune_transport(FakeTCPTransport(None), None)
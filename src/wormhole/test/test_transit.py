@@ -1,14 +1,16 @@
 from __future__ import print_function, unicode_literals
 import io
 import gc
+import threading
 from binascii import hexlify, unhexlify
 from twisted.trial import unittest
-from twisted.internet import defer, task, endpoints, protocol, address, error
+from twisted.internet import (defer, task, endpoints, protocol, address,
+                               error, reactor)
 from twisted.internet.defer import gatherResults, inlineCallbacks
 from twisted.python import log, failure
 from twisted.test import proto_helpers
 from ..errors import InternalError
-from .. import transit
+from .. import transit, conncache, ipaddrs
 from nacl.secret import SecretBox
 from nacl.exceptions import CryptoError
 
@@ -220,6 +222,25 @@ class Basic(unittest.TestCase):
         self.assertEqual(hexlify(r._sender_record_key()),
                          hexlify(s._receiver_record_key()))
 
+    def test_record_keys(self):
+        KEY = b"123"
+        s = transit.TransitSender("")
+        s.set_transit_key(KEY)
+        r = transit.TransitReceiver("")
+        r.set_transit_key(KEY)
+        # the transit key gives the usual record keys
+        self.assertEqual(s._record_keys(KEY),
+                         (s._sender_record_key(), s._receiver_record_key()))
+        self.assertEqual(r._record_keys(KEY),
+                         (r._sender_record_key(), r._receiver_record_key()))
+        # and each side sends with the key the other receives with
+        s_send, s_receive = s._record_keys(b"new")
+        r_send, r_receive = r._record_keys(b"new")
+        self.assertEqual(s_send, r_receive)
+        self.assertEqual(r_send, s_receive)
+        self.assertNotEqual(s_send, r_send)
+        self.assertNotEqual(s._record_keys(b"new"), s._record_keys(KEY))
+
     def test_connection_ready(self):
         s = transit.TransitSender("")
         self.assertEqual(s.connection_ready("p1"), "go")
@@ -303,6 +324,8 @@ class FakeTransport:
         self._connected = True
     def write(self, data):
         self._buf += data
+    def writeSequence(self, data):
+        self._buf += b"".join(data)
     def loseConnection(self):
         self._connected = False
         if self.signalConnectionLost:
@@ -494,6 +517,7 @@ class OutboundConnectionFactory(unittest.TestCase):
 
 class MockOwner:
     _connection_ready_called = False
+    _reactor = reactor
     def connection_ready(self, connection):
         self._connection_ready_called = True
         self._connection = connection
@@ -506,6 +530,8 @@ class MockOwner:
         return b"s"*32
     def _receiver_record_key(self):
         return b"r"*32
+    def _record_keys(self, key):
+        return (key[:16]+b"s"*16, key[:16]+b"r"*16)
 
 class MockFactory:
     _connectionWasMade_called = False
@@ -518,26 +544,26 @@ class Connection(unittest.TestCase):
 
     def test_check_and_remove(self):
         c = transit.Connection(None, None, None, "description")
-        c.buf = b""
+        c.buf = bytearray(b"")
         EXP = b"expectation"
         self.assertFalse(c._check_and_remove(EXP))
         self.assertEqual(c.buf, b"")
 
-        c.buf = b"unexpected"
+        c.buf = bytearray(b"unexpected")
         e = self.assertRaises(transit.BadHandshake, c._check_and_remove, EXP)
         self.assertEqual(str(e),
                          "got %r want %r" % (b'unexpected', b'expectation'))
         self.assertEqual(c.buf, b"unexpected")
 
-        c.buf = b"expect"
+        c.buf = bytearray(b"expect")
         self.assertFalse(c._check_and_remove(EXP))
         self.assertEqual(c.buf, b"expect")
 
-        c.buf = b"expectation"
+        c.buf = bytearray(b"expectation")
         self.assertTrue(c._check_and_remove(EXP))
         self.assertEqual(c.buf, b"")
 
-        c.buf = b"expectation exceeded"
+        c.buf = bytearray(b"expectation exceeded")
         self.assertTrue(c._check_and_remove(EXP))
         self.assertEqual(c.buf, b" exceeded")
 
@@ -934,6 +960,55 @@ class Connection(unittest.TestCase):
         c.dataReceived(r5+r6)
         self.assertEqual(inbound_records, [RECORD5, RECORD6])
 
+    def test_rekey(self):
+        t, c, owner = self.make_connection()
+        inbound_records = []
+        c.recordReceived = inbound_records.append
+        c.send_record(b"record0")
+        c.rekey(b"k"*32)
+        c.send_record(b"record1")
+        buf = t.read_buf()
+        first, second = buf[:4+24+7+16], buf[4+24+7+16+4:]
+        self.assertEqual(SecretBox(b"s"*32).decrypt(first[4:]), b"record0")
+        # the nonces carry on counting
+        self.assertEqual(int(hexlify(second[:SecretBox.NONCE_SIZE]), 16), 1)
+        self.assertRaises(CryptoError,
+                          SecretBox(b"s"*32).decrypt, second)
+        self.assertEqual(SecretBox(b"k"*16+b"s"*16).decrypt(second),
+                         b"record1")
+
+        send_box = SecretBox(b"k"*16+b"r"*16)
+        encrypted = send_box.encrypt(b"record2", unhexlify("%048x" % 0))
+        c.dataReceived(unhexlify("%08x" % len(encrypted)) + encrypted)
+        self.assertEqual(inbound_records, [b"record2"])
+
+    def test_encode_nonce(self):
+        for counter in [0, 1, 255, 2**32+7, 2**64-1]:
+            self.assertEqual(transit.encode_nonce(counter),
+                             unhexlify("%048x" % counter))
+
+    def test_records_batched(self):
+        # many records in a single read, followed by a partial one
+        t, c, owner = self.make_connection()
+        inbound_records = []
+        c.recordReceived = inbound_records.append
+        send_box = SecretBox(owner._receiver_record_key())
+        frames = []
+        for i in range(101):
+            nonce_buf = unhexlify("%048x" % i)
+            encrypted = send_box.encrypt(("r%d" % i).encode("ascii"),
+                                         nonce_buf)
+            length = unhexlify("%08x" % len(encrypted))
+            frames.append(length+encrypted)
+        data = b"".join(frames)
+        c.dataReceived(data[:-5])
+        self.assertEqual(inbound_records,
+                         [("r%d" % i).encode("ascii") for i in range(100)])
+        self.assertEqual(bytes(c.buf), frames[-1][:-5])
+        c.dataReceived(data[-5:])
+        self.assertEqual(inbound_records[-1], b"r100")
+        self.assertEqual(len(c.buf), 0)
+
     def corrupt(self, orig):
         last_byte = orig[-1:]
         num = int(hexlify(last_byte).decode("ascii"), 16)
@@ -1027,6 +1102,15 @@ class Connection(unittest.TestCase):
         self.assertIsInstance(f, failure.Failure)
         self.assertIsInstance(f.value, error.ConnectionClosed)
 
+    def test_receive_lost(self):
+        # reads that are waiting when the other side hangs up fail too
+        t, c, owner = self.make_connection()
+        closed = []
+        c.receive_record().addBoth(closed.append)
+        c.connectionLost()
+        self.assertEqual(len(closed), 1)
+        self.assertIsInstance(closed[0].value, error.ConnectionClosed)
+
     def test_producer(self):
         # a Transit object (receiving data from the remote peer) produces
         # data and writes it into a local Consumer
@@ -1102,6 +1186,85 @@ class Connection(unittest.TestCase):
         self.assertIsInstance(f, failure.Failure)
         self.assertIsInstance(f.value, error.ConnectionClosed)
 
+    def test_connectStreamConsumer(self):
+        # connectStreamConsumer() writes records until an empty one arrives
+        c = transit.Connection(None, None, None, "description")
+        c._negotiation_d.addErrback(lambda err: None) # eat it
+        c.transport = proto_helpers.StringTransport()
+        c.recordReceived(b"r1.")
+        c.recordReceived(b"")
+
+        # the end may already be queued
+        consumer = proto_helpers.StringTransport()
+        results = []
+        d = c.connectStreamConsumer(consumer)
+        d.addBoth(results.append)
+        self.assertEqual(consumer.value(), b"r1.")
+        self.assertEqual(results, [3])
+        self.assertIs(c._consumer, None)
+
+        consumer = proto_helpers.StringTransport()
+        results = []
+        d = c.connectStreamConsumer(consumer)
+        d.addBoth(results.append)
+        c.recordReceived(b"r2.")
+        c.recordReceived(b"r3.")
+        self.assertEqual(consumer.value(), b"r2.r3.")
+        self.assertEqual(results, [])
+        c.recordReceived(b"")
+        self.assertEqual(results, [6])
+        c.recordReceived(b"next")
+        self.assertEqual(consumer.value(), b"r2.r3.")
+
+        # it errbacks when the connection is lost
+        results = []
+        d = c.connectStreamConsumer(proto_helpers.StringTransport())
+        d.addBoth(results.append)
+        c.connectionLost()
+        self.assertEqual(len(results), 1)
+        self.assertIsInstance(results[0].value, error.ConnectionClosed)
+
+    def test_transform(self):
+        c = transit.Connection(None, None, None, "description")
+        c._negotiation_d.addErrback(lambda err: None) # eat it
+        c.transport = proto_helpers.StringTransport()
+        c.recordReceived(b"r1.")
+
+        # 'expected' counts the transformed bytes
+        f = io.BytesIO()
+        progress = []
+        results = []
+        d = c.writeToFile(f, 8, progress.append, transform=lambda r: r*2)
+        d.addBoth(results.append)
+        c.recordReceived(b"r2")
+        self.assertEqual(f.getvalue(), b"r1.r1.r2r2")
+        self.assertEqual(progress, [6, 4])
+        self.assertEqual(results, [10])
+
+        # the empty record that ends a stream isn't transformed
+        consumer = proto_helpers.StringTransport()
+        results = []
+        d = c.connectStreamConsumer(consumer, lambda r: r.upper())
+        d.addBoth(results.append)
+        c.recordReceived(b"r3.")
+        c.recordReceived(b"")
+        self.assertEqual(consumer.value(), b"R3.")
+        self.assertEqual(results, [3])
+
+        # a transform that fails closes the connection
+        def bad(record):
+            raise ValueError("bad record")
+        consumer = proto_helpers.StringTransport()
+        results = []
+        d = c.connectStreamConsumer(consumer, bad)
+        d.addBoth(results.append)
+        c.recordReceived(b"r4.")
+        self.assertEqual(consumer.value(), b"")
+        self.assertEqual(len(results), 1)
+        self.assertIsInstance(results[0].value, ValueError)
+        self.assertIs(c._consumer, None)
+        self.assertTrue(c.transport.disconnecting)
+
     def test_writeToFile(self):
         c = transit.Connection(None, None, None, "description")
         c._negotiation_d.addErrback(lambda err: None) # eat it
@@ -1192,6 +1355,169 @@ class FileConsumer(unittest.TestCase):
         self.assertEqual(progress, [99, 1])
         self.assertEqual(f.getvalue(), b"."*99+b"!")
 
+class PullConsumer:
+    def __init__(self):
+        self.producer = None
+        self.records = []
+    def registerProducer(self, producer, streaming):
+        assert not streaming
+        self.producer = producer
+    def unregisterProducer(self):
+        self.producer = None
+    def write(self, data):
+        self.records.append(data)
+
+class FileProducer(unittest.TestCase):
+    def test_adaptive(self):
+        clock = task.Clock()
+        fp = transit.FileProducer(min_record_size=10, max_record_size=40,
+                                  clock=clock)
+        fp.PROBE_RECORDS = 1
+        fp.record_size = 10
+        c = PullConsumer()
+        data = b"".join([("%d" % (i%10)).encode("ascii") for i in range(200)])
+        seen = []
+        def transform(chunk):
+            seen.append(chunk)
+            return chunk
+        d = fp.beginFileTransfer(io.BytesIO(data), c, transform=transform)
+        self.assertEqual(c.records, [])
+        # 10-byte records go at 10B/s, 20-byte ones at 40B/s, and 40-byte
+        # ones are no faster than that
+        fp.resumeProducing()
+        clock.advance(1.0)
+        fp.resumeProducing() # no smaller size, so try a bigger one
+        clock.advance(0.5)
+        fp.resumeProducing() # that was better, keep going
+        clock.advance(1.0)
+        fp.resumeProducing() # that wasn't, go back
+        clock.advance(0.5)
+        fp.resumeProducing() # and stay there
+        self.assertEqual([len(s) for s in seen], [10, 20, 40, 20, 20])
+        while c.producer:
+            fp.resumeProducing()
+        self.assertEqual(b"".join(c.records), data)
+        self.assertEqual(c.records, seen)
+        self.assertEqual(self.successResultOf(d), b"9")
+
+    def test_stop(self):
+        fp = transit.FileProducer()
+        c = PullConsumer()
+        d = fp.beginFileTransfer(io.BytesIO(b"data"), c)
+        fp.stopProducing()
+        self.failureResultOf(d, Exception)
+
+def make_stream(description, owner=None):
+    c = transit.Connection(owner, None, 0, description)
+    c._negotiation_d = None
+    c.transport = proto_helpers.StringTransport()
+    c.state = "records"
+    c.send_box = SecretBox(b"s"*32)
+    c.receive_box = SecretBox(b"r"*32)
+    c.send_nonce = c.next_receive_nonce = 0
+    return c
+
+def frame(nonce, record):
+    encrypted = SecretBox(b"r"*32).encrypt(record, transit.encode_nonce(nonce))
+    return transit.RECORD_LENGTH.pack(len(encrypted)) + encrypted
+
+def unframe(data):
+    records = []
+    box = SecretBox(b"s"*32)
+    while data:
+        (length,) = transit.RECORD_LENGTH.unpack_from(data)
+        encrypted, data = data[4:4+length], data[4+length:]
+        (nonce,) = transit.NONCE_COUNTER.unpack_from(encrypted, 16)
+        records.append((nonce, box.decrypt(encrypted)))
+    return records
+
+class MultiConnection(unittest.TestCase):
+    def make_bundle(self):
+        c1 = make_stream("one")
+        c2 = make_stream("two")
+        m = transit.MultiConnection(c1)
+        m.add_stream(c2)
+        return m, c1, c2
+
+    def test_send(self):
+        m, c1, c2 = self.make_bundle()
+        self.assertEqual(m.describe(), "one, two")
+        for i in range(3):
+            m.send_record(("r%d" % i).encode("ascii"))
+        self.assertEqual(unframe(c1.transport.value()),
+                         [(0, b"r0"), (2, b"r2")])
+        self.assertEqual(unframe(c2.transport.value()), [(1, b"r1")])
+        # full streams are skipped
+        c1.transport.clear()
+        c2.transport.clear()
+        c2.transport.producer.pauseProducing()
+        m.send_record(b"r3")
+        m.send_record(b"r4")
+        self.assertEqual(unframe(c1.transport.value()),
+                         [(3, b"r3"), (4, b"r4")])
+        self.assertEqual(c2.transport.value(), b"")
+
+    def test_pull_producer(self):
+        m, c1, c2 = self.make_bundle()
+        fp = transit.FileProducer(min_record_size=10, max_record_size=10)
+        d = fp.beginFileTransfer(io.BytesIO(b"x"*100), m)
+        # with nothing to push back, the whole file gets written at once
+        self.assertEqual(self.successResultOf(d), b"x")
+        records = (unframe(c1.transport.value()) +
+                   unframe(c2.transport.value()))
+        self.assertEqual(sorted(records), [(i, b"x"*10) for i in range(10)])
+
+    def test_reorder(self):
+        m, c1, c2 = self.make_bundle()
+        inbound = []
+        m.connectConsumer(transit.FileConsumer(io.BytesIO(),
+                                               hasher=inbound.append))
+        c2.dataReceived(frame(1, b"r1"))
+        c2.dataReceived(frame(3, b"r3"))
+        self.assertEqual(inbound, [])
+        c1.dataReceived(frame(0, b"r0"))
+        self.assertEqual(inbound, [b"r0", b"r1"])
+        c1.dataReceived(frame(2, b"r2"))
+        self.assertEqual(inbound, [b"r0", b"r1", b"r2", b"r3"])
+        # replays are rejected
+        self.assertRaises(transit.BadNonce, c1.dataReceived, frame(3, b"r3"))
+        self.assertTrue(c1.transport.disconnecting)
+
+    def test_reorder_limit(self):
+        m, c1, c2 = self.make_bundle()
+        m.MAX_REORDER_BYTES = 5
+        d = m.receive_record()
+        c2.dataReceived(frame(1, b"r1"))
+        self.assertEqual(c2.transport.producerState, "producing")
+        c2.dataReceived(frame(2, b"r2..."))
+        self.assertEqual(c2.transport.producerState, "paused")
+        c1.dataReceived(frame(0, b"r0"))
+        self.assertEqual(self.successResultOf(d), b"r0")
+        self.assertEqual(c2.transport.producerState, "producing")
+
+    def test_lost_record(self):
+        m, c1, c2 = self.make_bundle()
+        d = m.receive_record()
+        c2.dataReceived(frame(0, b"r0"))
+        self.assertEqual(self.successResultOf(d), b"r0")
+        d = m.receive_record()
+        c1.dataReceived(frame(2, b"r2"))
+        # c2 might still deliver record 1..
+        self.assertNoResult(d)
+        # .. until it goes away
+        c2.connectionLost()
+        self.failureResultOf(d, error.ConnectionClosed)
+        self.assertTrue(c1.transport.disconnecting)
+
+    def test_all_lost(self):
+        m, c1, c2 = self.make_bundle()
+        d = m.receive_record()
+        c1.connectionLost()
+        self.assertNoResult(d)
+        c2.connectionLost()
+        self.failureResultOf(d, error.ConnectionClosed)
+        self.assertRaises(transit.TransitClosed, m.send_record, b"r0")
+
 
 DIRECT_HINT = {"type": "direct-tcp-v1",
                "hostname": "direct", "port": 1234}
@@ -1207,6 +1533,220 @@ DIRECT_HINT_INTERNAL = transit.DirectTCPV1Hint("direct", 1234)
 RELAY_HINT_FIRST = transit.DirectTCPV1Hint("relay", 1234)
 RELAY_HINT_INTERNAL = transit.RelayV1Hint([RELAY_HINT_FIRST])
 
+def wait_for(check):
+    # threaded work finishes on the real reactor, eventually
+    d = defer.Deferred()
+    def _poll():
+        if check():
+            d.callback(None)
+        else:
+            reactor.callLater(0.01, _poll)
+    _poll()
+    return d
+
+class Producer:
+    def __init__(self):
+        self.state = "producing"
+    def pauseProducing(self):
+        self.state = "paused"
+    def resumeProducing(self):
+        self.state = "producing"
+    def stopProducing(self):
+        self.state = "stopped"
+
+class BrokenFile:
+    def write(self, data):
+        raise IOError("disk full")
+
+class SlowFile(io.BytesIO):
+    def __init__(self):
+        io.BytesIO.__init__(self)
+        self.ready = threading.Event()
+    def write(self, data):
+        self.ready.wait()
+        return io.BytesIO.write(self, data)
+
+class Threads(unittest.TestCase):
+    def test_decrypt_reactor(self):
+        # the owner's reactor runs the threads, not the global one
+        owner = MockOwner()
+        owner._reactor = task.Clock()
+        used = []
+        def _in_thread(reactor, f, *args):
+            used.append(reactor)
+            return defer.succeed(f(*args))
+        self.patch(transit, "_in_thread", _in_thread)
+        c = make_stream("one", owner)
+        c.decrypt_in_threads()
+        inbound = []
+        c.recordReceived = inbound.append
+        c.dataReceived(frame(0, b"r0"))
+        self.assertEqual(used, [owner._reactor])
+        self.assertEqual(inbound, [b"r0"])
+
+    @inlineCallbacks
+    def test_decrypt(self):
+        self.patch(transit, "DECRYPT_BUDGET", 200)
+        c = make_stream("one")
+        c.decrypt_in_threads()
+        inbound = []
+        c.recordReceived = inbound.append
+        count = 10 # each one is 42 or 43 bytes
+        c.dataReceived(b"".join([frame(i, ("r%d" % i).encode("ascii"))
+                                 for i in range(count)]))
+        # too many bytes are waiting for a thread, so stop reading, and
+        # stay stopped even if the consumer is happy
+        self.assertEqual(inbound, [])
+        self.assertEqual(c.transport.producerState, "paused")
+        c.pauseProducing()
+        c.resumeProducing()
+        self.assertEqual(c.transport.producerState, "paused")
+        yield wait_for(lambda: len(inbound) == count)
+        self.assertEqual(inbound,
+                         [("r%d" % i).encode("ascii") for i in range(count)])
+        self.assertEqual(c.transport.producerState, "producing")
+
+    @inlineCallbacks
+    def test_decrypt_then_lost(self):
+        c = make_stream("one")
+        f = io.BytesIO()
+        d = c.writeToFile(f, 100, threads=True)
+        c.dataReceived(b"".join([frame(i, ("%010d" % i).encode("ascii"))
+                                 for i in range(5)]))
+        c.connectionLost()
+        # the records we already read are written before we give up
+        yield self.assertFailure(d, error.ConnectionClosed)
+        self.assertEqual(f.getvalue(),
+                         b"".join([("%010d" % i).encode("ascii")
+                                   for i in range(5)]))
+
+    @inlineCallbacks
+    def test_decrypt_corrupt(self):
+        c = make_stream("one")
+        c.decrypt_in_threads()
+        inbound = []
+        c.recordReceived = inbound.append
+        bad = frame(1, b"r1")
+        c.dataReceived(frame(0, b"r0") + bad[:-1] + b"!" + frame(2, b"r2"))
+        yield wait_for(lambda: c.transport.disconnecting)
+        self.assertEqual(inbound, [b"r0"])
+        self.assertIsInstance(c._error, CryptoError)
+        self.assertEqual(len(self.flushLoggedErrors(CryptoError)), 1)
+
+    @inlineCallbacks
+    def test_file_consumer(self):
+        f = io.BytesIO()
+        progress = []
+        hashed = []
+        fc = transit.ThreadedFileConsumer(f, progress.append, hashed.append,
+                                          budget=8)
+        p = Producer()
+        fc.registerProducer(p, True)
+        fc.write(b"one.")
+        self.assertEqual(p.state, "producing")
+        fc.write(b"two.")
+        self.assertEqual(p.state, "paused")
+        fc.write(b"three.")
+        yield fc.whenFlushed()
+        self.assertEqual(p.state, "producing")
+        self.assertEqual(f.getvalue(), b"one.two.three.")
+        self.assertEqual(hashed, [b"one.", b"two.", b"three."])
+        self.assertEqual(progress, [4, 4, 6])
+        fc.unregisterProducer()
+
+    @inlineCallbacks
+    def test_slow_disk(self):
+        # a disk that can't keep up stops us reading from the network, and
+        # we start again once it catches up
+        c = make_stream("one")
+        f = SlowFile()
+        self.addCleanup(f.ready.set)
+        d = c.writeToFile(f, 600, threads=True, budget=100)
+        c.dataReceived(b"".join([frame(i, ("%030d" % i).encode("ascii"))
+                                 for i in range(10)]))
+        yield wait_for(lambda: c.transport.producerState == "paused")
+        self.assertEqual(f.getvalue(), b"")
+        f.ready.set()
+        yield wait_for(lambda: c.transport.producerState == "producing")
+        c.dataReceived(b"".join([frame(i, ("%030d" % i).encode("ascii"))
+                                 for i in range(10, 20)]))
+        received = yield d
+        self.assertEqual(received, 600)
+        self.assertEqual(f.getvalue(),
+                         b"".join([("%030d" % i).encode("ascii")
+                                   for i in range(20)]))
+
+    @inlineCallbacks
+    def test_file_consumer_error(self):
+        fc = transit.ThreadedFileConsumer(BrokenFile())
+        p = Producer()
+        fc.registerProducer(p, True)
+        fc.write(b"data")
+        fc.write(b"more")
+        yield self.assertFailure(fc.whenFlushed(), IOError)
+        self.assertEqual(p.state, "stopped")
+
+    @inlineCallbacks
+    def test_sender(self):
+        c = make_stream("one")
+        data = b"".join([("%d" % (i%10)).encode("ascii") for i in range(95)])
+        hashed = []
+        progress = []
+        fs = transit.ThreadedFileSender(record_size=10, depth=3)
+        sent = yield fs.beginFileTransfer(io.BytesIO(data), c,
+                                          hasher=hashed.append,
+                                          progress=progress.append)
+        self.assertEqual(sent, 95)
+        records = [data[i:i+10] for i in range(0, 95, 10)]
+        self.assertEqual(unframe(c.transport.value()),
+                         list(enumerate(records)))
+        self.assertEqual(hashed, records)
+        self.assertEqual(progress, [len(r) for r in records])
+        self.assertIs(c.transport.producer, None)
+
+    @inlineCallbacks
+    def test_sender_paused(self):
+        c = make_stream("one")
+        fs = transit.ThreadedFileSender(record_size=10, depth=2)
+        d = fs.beginFileTransfer(io.BytesIO(b"x"*100), c)
+        c.transport.producer.pauseProducing()
+        yield task.deferLater(reactor, 0.1, lambda: None)
+        # only the records already in the pipeline were sent
+        self.assertEqual(len(unframe(c.transport.value())), 2)
+        c.transport.producer.resumeProducing()
+        sent = yield d
+        self.assertEqual(sent, 100)
+        self.assertEqual(len(unframe(c.transport.value())), 10)
+
+    @inlineCallbacks
+    def test_sender_transform(self):
+        c = make_stream("one")
+        data = b"x"*25
+        hashed = []
+        fs = transit.ThreadedFileSender(record_size=10)
+        sent = yield fs.beginFileTransfer(io.BytesIO(data), c,
+                                          hasher=hashed.append,
+                                          transform=lambda r: b"<"+r+b">")
+        # hashes and the count come before the transform
+        self.assertEqual(sent, 25)
+        self.assertEqual(hashed, [b"x"*10, b"x"*10, b"x"*5])
+        self.assertEqual(unframe(c.transport.value()),
+                         [(0, b"<"+b"x"*10+b">"), (1, b"<"+b"x"*10+b">"),
+                          (2, b"<"+b"x"*5+b">")])
+
+    @inlineCallbacks
+    def test_sender_multi(self):
+        c1 = make_stream("one")
+        c2 = make_stream("two")
+        m = transit.MultiConnection(c1)
+        m.add_stream(c2)
+        fs = transit.ThreadedFileSender(record_size=10)
+        sent = yield fs.beginFileTransfer(io.BytesIO(b"x"*100), m)
+        self.assertEqual(sent, 100)
+        records = (unframe(c1.transport.value()) +
+                   unframe(c2.transport.value()))
+        self.assertEqual(sorted(records), [(i, b"x"*10) for i in range(10)])
+
 class Transit(unittest.TestCase):
     @inlineCallbacks
     def test_success_direct(self):
@@ -1319,6 +1859,173 @@ class Transit(unittest.TestCase):
         relay_connectors[0].callback("winner")
         self.assertEqual(results, ["winner"])
 
+    def _race(self, hints, addresses=["10.0.0.5"], cache=None):
+        clock = task.Clock()
+        s = transit.TransitSender("", reactor=clock, no_listen=True,
+                                  connection_cache=cache)
+        s.set_transit_key(b"key")
+        s._addresses = addresses
+        s.get_connection_hints()
+        s.add_connection_hints(hints)
+        connectors = []
+        def _endpoint_from_hint_obj(hint):
+            if isinstance(hint, transit.RelayV1Hint):
+                return "relay"
+            return hint.hostname
+        s._endpoint_from_hint_obj = _endpoint_from_hint_obj
+        def _start_connector(ep, description, is_relay=False):
+            d = defer.Deferred()
+            connectors.append((ep, d))
+            return d
+        s._start_connector = _start_connector
+        return clock, s, connectors
+
+    def _direct(self, hostname):
+        return {"type": "direct-tcp-v1", "hostname": hostname, "port": 1234}
+
+    def test_stagger(self):
+        clock, s, connectors = self._race([self._direct("192.168.1.2"),
+                                           self._direct("10.0.0.2"),
+                                           RELAY_HINT])
+        d = s.connect()
+        results = []
+        d.addBoth(results.append)
+        # the address on our own subnet goes first, the other one a little
+        # later, and the relay a while after that
+        self.assertEqual([ep for ep, _ in connectors], ["10.0.0.2"])
+        clock.advance(s.ATTEMPT_DELAY)
+        self.assertEqual([ep for ep, _ in connectors],
+                         ["10.0.0.2", "192.168.1.2"])
+        clock.advance(s.RELAY_DELAY)
+        self.assertEqual([ep for ep, _ in connectors],
+                         ["10.0.0.2", "192.168.1.2", "relay"])
+        connectors[1][1].callback("winner")
+        self.assertEqual(results, ["winner"])
+        self.assertEqual(clock.getDelayedCalls(), [])
+
+    def test_fast_failover(self):
+        clock, s, connectors = self._race([self._direct("10.0.0.2"),
+                                           self._direct("10.0.0.3"),
+                                           RELAY_HINT])
+        d = s.connect()
+        results = []
+        d.addBoth(results.append)
+        self.assertEqual([ep for ep, _ in connectors], ["10.0.0.2"])
+        # a refused connection moves straight on to the next hint
+        connectors[0][1].errback(error.ConnectionRefusedError())
+        self.assertEqual([ep for ep, _ in connectors],
+                         ["10.0.0.2", "10.0.0.3"])
+        # and when that fails too, the relay doesn't wait
+        connectors[1][1].errback(error.ConnectionRefusedError())
+        self.assertEqual([ep for ep, _ in connectors],
+                         ["10.0.0.2", "10.0.0.3", "relay"])
+        connectors[2][1].callback("winner")
+        self.assertEqual(results, ["winner"])
+        self.assertEqual(clock.getDelayedCalls(), [])
+
+    def test_cancel(self):
+        clock, s, connectors = self._race([self._direct("10.0.0.2"),
+                                           self._direct("10.0.0.3"),
+                                           RELAY_HINT])
+        d = s.connect()
+        d.addErrback(lambda f: f.trap(defer.CancelledError))
+        d.cancel()
+        # the attempts that hadn't started yet never will
+        self.assertEqual(len(connectors), 1)
+        self.assertEqual(clock.getDelayedCalls(), [])
+
+    def test_learn_connect_time(self):
+        clock, s, connectors = self._race([self._direct("10.0.0.2"),
+                                           self._direct("10.0.0.3"),
+                                           RELAY_HINT])
+        self.assertEqual(s._delays(), (s.ATTEMPT_DELAY, s.RELAY_DELAY))
+        s.connect()
+        clock.advance(0.04)
+        connectors[0][1].callback("winner")
+        self.assertEqual(s._connect_times, {"10.0.0.5": 0.04})
+        # this network is fast, so we don't wait long for the next hint,
+        # or the relay
+        self.assertEqual(s._delays(), (s.MIN_ATTEMPT_DELAY,
+                                       s.MIN_RELAY_DELAY))
+        s._record_connect_time("10.0.0.5", 1.2)
+        self.assertAlmostEqual(s._connect_times["10.0.0.5"], 0.185)
+        self.assertAlmostEqual(s._delays()[0], 0.37)
+        self.assertAlmostEqual(s._delays()[1], 0.74)
+        s._record_connect_time("slow", 30.0)
+        s._addresses = ["slow"]
+        self.assertEqual(s._delays(), (s.MAX_ATTEMPT_DELAY, s.RELAY_DELAY))
+        # each Transit learns for itself
+        clock, s, connectors = self._race([])
+        self.assertEqual(s._connect_times, {})
+        self.assertEqual(s._delays(), (s.ATTEMPT_DELAY, s.RELAY_DELAY))
+
+    def test_no_listen_addresses(self):
+        # without a listener we don't look up our addresses, so we don't
+        # know which network we're on, and use the usual delays
+        def find_addresses():
+            raise AssertionError("looked up our addresses")
+        self.patch(ipaddrs, "find_addresses", find_addresses)
+        clock = task.Clock()
+        s = transit.TransitSender("", reactor=clock, no_listen=True)
+        self.assertEqual(s._network_key(), None)
+        self.assertEqual(s._delays(), (s.ATTEMPT_DELAY, s.RELAY_DELAY))
+        s._attempt_finished(None, None, False, 0.04, True)
+        self.assertEqual(s._connect_times, {})
+
+    def test_connection_cache(self):
+        fn = self.mktemp()
+        hints = [self._direct("10.0.0.2"), self._direct("10.0.0.3"),
+                 self._direct("10.0.0.4"), RELAY_HINT]
+        clock, s, connectors = self._race(hints, addresses=["192.168.1.5"],
+                                          cache=conncache.open_cache(fn))
+        d = s.connect()
+        connectors[0][1].errback(error.ConnectionRefusedError())
+        clock.advance(0.05)
+        connectors[1][1].callback("winner")
+        self.assertEqual(clock.getDelayedCalls(), [])
+
+        # next time, the address that answered goes first, and the one that
+        # refused last
+        cache = conncache.open_cache(fn)
+        self.assertEqual(cache.winner("192.168.1.5"), "direct")
+        self.assertEqual(cache.connect_time("192.168.1.5"), 0.05)
+        clock, s, connectors = self._race(hints, addresses=["192.168.1.5"],
+                                          cache=cache)
+        self.assertEqual(s._delays(), (s.MIN_ATTEMPT_DELAY,
+                                       s.MIN_RELAY_DELAY))
+        d = s.connect()
+        clock.pump([s.MIN_ATTEMPT_DELAY]*2)
+        self.assertEqual([ep for ep, _ in connectors],
+                         ["10.0.0.3", "10.0.0.4", "10.0.0.2"])
+        clock.advance(s.MIN_RELAY_DELAY)
+        self.assertEqual(connectors[-1][0], "relay")
+        d.addErrback(lambda f: f.trap(defer.CancelledError))
+        d.cancel()
+
+    def test_connection_cache_relay(self):
+        fn = self.mktemp()
+        cache = conncache.open_cache(fn)
+        cache.set_winner("10.0.0.5", "relay")
+        cache.record("10.0.0.5", "10.0.0.2", False)
+        clock, s, connectors = self._race([self._direct("10.0.0.2"),
+                                           RELAY_HINT], cache=cache)
+        d = s.connect()
+        # direct connections didn't get through last time, so the relay
+        # doesn't wait for them
+        clock.advance(0)
+        self.assertEqual([ep for ep, _ in connectors], ["10.0.0.2", "relay"])
+        connectors[1][1].callback("winner")
+        self.assertEqual(conncache.open_cache(fn).winner("10.0.0.5"),
+                         "relay")
+        del d
+
+    def test_shared_prefix(self):
+        addresses = ["10.0.0.5", "192.168.1.7"]
+        self.assertEqual(transit.shared_prefix("10.0.0.9", addresses), 28)
+        self.assertEqual(transit.shared_prefix("192.168.1.7", addresses), 32)
+        self.assertEqual(transit.shared_prefix("172.16.0.1", addresses), 1)
+        self.assertEqual(transit.shared_prefix("example.com", addresses), 0)
+
 
 class Full(unittest.TestCase):
     def doBoth(self, d1, d2):
@@ -1351,3 +2058,73 @@ class Full(unittest.TestCase):
 
         yield x.close()
         yield y.close()
+
+    @inlineCallbacks
+    def test_threaded_file(self):
+        KEY = b"k"*32
+        s = transit.TransitSender(None)
+        r = transit.TransitReceiver(None)
+        s.set_transit_key(KEY)
+        r.set_transit_key(KEY)
+        s.add_connection_hints((yield r.get_connection_hints()))
+        r.add_connection_hints((yield s.get_connection_hints()))
+        (x,y) = yield self.doBoth(s.connect(), r.connect())
+
+        data = b"".join([("%010d" % i).encode("ascii") for i in range(10000)])
+        f = io.BytesIO()
+        d = y.writeToFile(f, len(data), threads=True)
+        fs = transit.ThreadedFileSender(record_size=1000)
+        sent = yield fs.beginFileTransfer(io.BytesIO(data), x)
+        self.assertEqual(sent, len(data))
+        received = yield d
+        self.assertEqual(received, len(data))
+        self.assertEqual(f.getvalue(), data)
+
+        yield x.close()
+        yield y.close()
+
+    @inlineCallbacks
+    def test_multi_stream(self):
+        KEY = b"k"*32
+        s = transit.TransitSender(None, streams=2)
+        r = transit.TransitReceiver(None, streams=3)
+        s.add_connection_abilities(r.get_connection_abilities())
+        r.add_connection_abilities(s.get_connection_abilities())
+
+        s.set_transit_key(KEY)
+        r.set_transit_key(KEY)
+
+        shints = yield s.get_connection_hints()
+        rhints = yield r.get_connection_hints()
+
+        s.add_connection_hints(rhints)
+        r.add_connection_hints(shints)
+
+        (x,y) = yield self.doBoth(s.connect(), r.connect())
+        self.assertIsInstance(x, transit.MultiConnection)
+        self.assertIsInstance(y, transit.MultiConnection)
+        # the second stream might still be on its way
+        for i in range(50):
+            if len(x._streams) == 2 and len(y._streams) == 2:
+                break
+            yield task.deferLater(reactor, 0.1, lambda: None)
+        self.assertEqual(len(x._streams), 2)
+        self.assertEqual(len(y._streams), 2)
+
+        f = io.BytesIO()
+        d = y.writeToFile(f, 1000)
+        for i in range(100):
+            x.send_record(("%010d" % i).encode("ascii"))
+        received = yield d
+        self.assertEqual(received, 1000)
+        self.assertEqual(f.getvalue(),
+                         b"".join([("%010d" % i).encode("ascii")
+                                   for i in range(100)]))
+
+        d = x.receive_record()
+        y.send_record(b"ack")
+        ack = yield d
+        self.assertEqual(ack, b"ack")
+
+        yield x.close()
+        yield y.close()
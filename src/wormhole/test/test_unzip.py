@@ -0,0 +1,101 @@
+from __future__ import print_function, unicode_literals
+import os, io, stat, zipfile
+from twisted.trial import unittest
+from twisted.internet import reactor
+from twisted.internet.defer import inlineCallbacks
+from ..cli import unzip
+
+def make_zip(contents, dirs=()):
+    f = io.BytesIO()
+    with zipfile.ZipFile(f, "w", zipfile.ZIP_DEFLATED) as zf:
+        for name in dirs:
+            zf.writestr(zipfile.ZipInfo(name), b"")
+        for name, data in sorted(contents.items()):
+            zi = zipfile.ZipInfo(name)
+            zi.compress_type = zipfile.ZIP_DEFLATED
+            zi.external_attr = 0o640 << 16
+            zf.writestr(zi, data)
+    f.seek(0)
+    return zipfile.ZipFile(f, "r")
+
+class Extract(unittest.TestCase):
+    @inlineCallbacks
+    def _do_test_extract(self, num_workers):
+        contents = dict(("sub%d/file%d" % (i % 7, i), os.urandom(i * 100))
+                        for i in range(50))
+        contents["big"] = b"big" * 1000000
+        extract_dir = self.mktemp()
+        yield unzip.extract(make_zip(contents, dirs=["empty/"]), extract_dir,
+                            reactor, num_workers)
+        for name, data in contents.items():
+            path = os.path.join(extract_dir, name)
+            with open(path, "rb") as f:
+                self.assertEqual(f.read(), data)
+            self.assertEqual(stat.S_IMODE(os.stat(path).st_mode), 0o640)
+        self.assertTrue(os.path.isdir(os.path.join(extract_dir, "empty")))
+
+    def test_extract(self):
+        return self._do_test_extract(None)
+
+    def test_extract_one_worker(self):
+        return self._do_test_extract(1)
+
+    def test_extract_workers(self):
+        return self._do_test_extract(4)
+
+    def test_workers(self):
+        self.patch(unzip, "PARALLEL_READS", False)
+        self.assertEqual(unzip.workers(), 1)
+
+    def test_plan_duplicates(self):
+        infos = [zipfile.ZipInfo(name)
+                 for name in ["a", "sub/", "sub/b", "a", "c"]]
+        top = os.path.abspath(self.mktemp())
+        dirs, members = unzip.plan(infos, top)
+        self.assertEqual(dirs, [top, os.path.join(top, "sub")])
+        self.assertEqual(members,
+                         [(infos[3], os.path.join(top, "a")),
+                          (infos[2], os.path.join(top, "sub", "b")),
+                          (infos[4], os.path.join(top, "c"))])
+
+    @inlineCallbacks
+    def test_malicious(self):
+        # nothing is written if any name is bad
+        extract_dir = self.mktemp()
+        zf = make_zip({"ok": b"ok", "../evil": b"evil"})
+        e = yield self.assertFailure(unzip.extract(zf, extract_dir, reactor),
+                                     ValueError)
+        self.assertIn("malicious zipfile", str(e))
+        self.assertFalse(os.path.exists(extract_dir))
+
+    @inlineCallbacks
+    def test_malicious_sibling(self):
+        # a name that leaves extract_dir for a directory whose name starts
+        # with the same letters
+        parent = self.mktemp()
+        extract_dir = os.path.join(parent, "dest")
+        zf = make_zip({"ok": b"ok", "../dest-evil/x": b"evil"})
+        e = yield self.assertFailure(unzip.extract(zf, extract_dir, reactor),
+                                     ValueError)
+        self.assertIn("malicious zipfile", str(e))
+        self.assertFalse(os.path.exists(parent))
+
+    @inlineCallbacks
+    def test_failure(self):
+        extract_dir = self.mktemp()
+        contents = dict(("file%d" % i, b"data") for i in range(20))
+        zf = make_zip(contents)
+        calls = []
+        real_extract_member = unzip.extract_member
+        def extract_member(zf, info, path):
+            calls.append(info.filename)
+            if info.filename == "file1":
+                raise EnvironmentError("disk on fire")
+            real_extract_member(zf, info, path)
+        self.patch(unzip, "extract_member", extract_member)
+        e = yield self.assertFailure(unzip.extract(zf, extract_dir, reactor,
+                                                   num_workers=2),
+                                     EnvironmentError)
+        self.assertIn("disk on fire", str(e))
+        # the workers stopped soon after
+        self.assertTrue(len(calls) < 5, calls)
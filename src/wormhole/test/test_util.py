@@ -1,5 +1,5 @@
 from __future__ import unicode_literals
-import unicodedata
+import os, unicodedata
 from twisted.trial import unittest
 from .. import util
 
@@ -38,3 +38,12 @@ class Utils(unittest.TestCase):
         d = util.bytes_to_dict(b)
         self.assertIsInstance(d, dict)
         self.assertEqual(d, {"a": "b", "c": 2})
+
+    def test_cache_dir(self):
+        self.patch(os, "environ", {"XDG_CACHE_HOME": "/cache"})
+        self.assertEqual(util.cache_dir("a"),
+                         os.path.join("/cache", "magic-wormhole", "a"))
+        self.patch(os, "environ", {})
+        self.patch(os.path, "expanduser", lambda path: "/home")
+        self.assertEqual(util.cache_dir(),
+                         os.path.join("/home", ".cache", "magic-wormhole"))
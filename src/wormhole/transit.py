@@ -1,20 +1,21 @@
 # no unicode_literals, revisit after twisted patch
 from __future__ import print_function, absolute_import
-import re, sys, time, socket
+import re, sys, time, socket, struct, functools, multiprocessing
 from collections import namedtuple, deque
-from binascii import hexlify, unhexlify
+from binascii import hexlify
 import six
 from zope.interface import implementer
-from twisted.python import log
+from twisted.python import log, failure
 from twisted.python.runtime import platformType
 from twisted.internet import (reactor, interfaces, defer, protocol,
-                              endpoints, task, address, error)
+                              endpoints, address, error, threads)
 from twisted.internet.defer import inlineCallbacks, returnValue
 from twisted.protocols import policies
 from nacl.secret import SecretBox
 from hkdf import Hkdf
 from .errors import InternalError
 from .timing import DebugTiming
+from .sockopts import DEFAULT_SOCKET_OPTIONS, tune_transport
 from . import ipaddrs
 
 def HKDF(skm, outlen, salt=None, CTXinfo=b""):
@@ -131,23 +132,213 @@ def parse_hint_argv(hint):
 
 TIMEOUT=15
 
+# Records are framed as a 4-byte big-endian length, then the SecretBox
+# output (a 24-byte big-endian nonce counter, then the ciphertext). The
+# counter never gets near 2**64, so only its last 8 bytes are ever set.
+RECORD_LENGTH = struct.Struct(">L")
+NONCE_COUNTER = struct.Struct(">Q")
+NONCE_PADDING = b"\x00" * (SecretBox.NONCE_SIZE - NONCE_COUNTER.size)
+
+def encode_nonce(counter):
+    return NONCE_PADDING + NONCE_COUNTER.pack(counter)
+
+# SecretBox, hashlib and file I/O all release the GIL while they work on a
+# big buffer, so records can be encrypted, decrypted, hashed, read and
+# written on the reactor's thread pool while the reactor moves the next ones
+# over the network. DECRYPT_BUDGET bounds how many bytes of inbound
+# records may be waiting for a thread, however big the records are.
+DECRYPT_BUDGET = 4*1024*1024
+
+def _in_thread(reactor, f, *args):
+    return threads.deferToThreadPool(reactor, reactor.getThreadPool(),
+                                     f, *args)
+
+def threads_are_useful():
+    # with only one core, handing records to threads just adds overhead
+    try:
+        return multiprocessing.cpu_count() > 1
+    except NotImplementedError:
+        return False
+
+class _RecordPipe:
+    # Inbound record delivery, shared by Connection and MultiConnection:
+    # records go to an attached consumer, or to receive_record() callers,
+    # or are queued until one of those turns up. Subclasses call
+    # _init_pipe() and recordReceived(), and provide the IProducer methods.
+
+    def _init_pipe(self):
+        self._consumer = None
+        self._consumer_bytes_written = 0
+        self._consumer_bytes_expected = None
+        self._consumer_until_end = False
+        self._consumer_transform = None
+        self._consumer_deferred = None
+        self._inbound_records = deque()
+        self._waiting_reads = deque()
+
+    def recordReceived(self, record):
+        if self._consumer:
+            self._writeToConsumer(record)
+            return
+        self._inbound_records.append(record)
+        self._deliverRecords()
+
+    def receive_record(self):
+        d = defer.Deferred()
+        self._waiting_reads.append(d)
+        self._deliverRecords()
+        return d
+
+    def _deliverRecords(self):
+        while self._inbound_records and self._waiting_reads:
+            r = self._inbound_records.popleft()
+            d = self._waiting_reads.popleft()
+            d.callback(r)
+
+    def connectConsumer(self, consumer, expected=None):
+        """Helper method to glue an instance of e.g. t.p.ftp.FileConsumer to
+        us. Inbound records will be written as bytes to the consumer.
+
+        Set 'expected' to an integer to automatically disconnect when at
+        least that number of bytes have been written. This function will then
+        return a Deferred (that fires with the number of bytes actually
+        received). If the connection is lost while this Deferred is
+        outstanding, it will errback.
+
+        If 'expected' is None, then this function returns None instead of a
+        Deferred, and you must call disconnectConsumer() when you are done."""
+        return self._connect(consumer, expected, False)
+
+    def connectStreamConsumer(self, consumer, transform=None):
+        """Like connectConsumer(), for streams whose length isn't known in
+        advance: the sender ends the stream with an empty record, which is
+        not written to the consumer. Returns a Deferred that fires (with the
+        number of bytes written) when that record arrives, after the
+        consumer has been disconnected. If the connection is lost first, the
+        Deferred errbacks.
+
+        If 'transform' is given, each record is passed through it before
+        being written (and counted). If it raises an exception, the consumer
+        is disconnected, the pipe is closed, and the Deferred errbacks with
+        that exception."""
+        return self._connect(consumer, None, True, transform)
+
+    def _connect(self, consumer, expected, until_end, transform=None):
+        if self._consumer:
+            raise RuntimeError("A consumer is already attached: %r" %
+                               self._consumer)
+
+        # be aware of an ordering hazard: when we call the consumer's
+        # .registerProducer method, they are likely to immediately call
+        # self.resumeProducing, which we'll deliver to self.transport, which
+        # might call our .dataReceived, which may cause more records to be
+        # available. By waiting to set self._consumer until *after* we drain
+        # any pending records, we avoid delivering records out of order,
+        # which would be bad.
+        consumer.registerProducer(self, True)
+        # There might be enough data queued to exceed 'expected' before we
+        # leave this function. We must be sure to register the producer
+        # before it gets unregistered.
+
+        self._consumer = consumer
+        self._consumer_bytes_written = 0
+        self._consumer_bytes_expected = expected
+        self._consumer_until_end = until_end
+        self._consumer_transform = transform
+        d = None
+        if expected is not None or until_end:
+            d = defer.Deferred()
+        self._consumer_deferred = d
+        # drain any pending records
+        while self._consumer and self._inbound_records:
+            r = self._inbound_records.popleft()
+            self._writeToConsumer(r)
+        return d
+
+    def _writeToConsumer(self, record):
+        if self._consumer_until_end and not record:
+            d = self._consumer_deferred
+            self.disconnectConsumer()
+            d.callback(self._consumer_bytes_written)
+            return
+        if self._consumer_transform:
+            try:
+                record = self._consumer_transform(record)
+            except Exception:
+                f = failure.Failure()
+                d = self._consumer_deferred
+                self.disconnectConsumer()
+                self.close()
+                d.errback(f)
+                return
+        self._consumer.write(record)
+        self._consumer_bytes_written += len(record)
+        if self._consumer_bytes_expected is not None:
+            if self._consumer_bytes_written >= self._consumer_bytes_expected:
+                d = self._consumer_deferred
+                self.disconnectConsumer()
+                d.callback(self._consumer_bytes_written)
+
+    def disconnectConsumer(self):
+        self._consumer.unregisterProducer()
+        self._consumer = None
+        self._consumer_bytes_expected = None
+        self._consumer_until_end = False
+        self._consumer_transform = None
+        self._consumer_deferred = None
+
+    # Helper method to write a known number of bytes to a file. 'progress'
+    # is an optional callable which will be called on each write (with the
+    # number of bytes written). Returns a Deferred that fires (with the
+    # number of bytes written) when the count is reached or the RecordPipe
+    # is closed. By default each write happens on the reactor, which waits
+    # for the disk. With threads=True, records are decrypted, written and
+    # hashed on the reactor's thread pool (so 'hasher' is called from a
+    # thread), we stop reading from the network while more than 'budget'
+    # bytes are waiting for the disk, and the Deferred waits until the last
+    # write has finished. 'transform' is applied to each record before it is
+    # written, as with connectStreamConsumer(), and 'expected' counts the
+    # bytes it returns.
+    def writeToFile(self, f, expected, progress=None, hasher=None,
+                    threads=False, budget=None, transform=None):
+        if not threads:
+            fc = FileConsumer(f, progress, hasher)
+            return self._connect(fc, expected, False, transform)
+        self.decrypt_in_threads()
+        fc = ThreadedFileConsumer(f, progress, hasher, budget)
+        d = self._connect(fc, expected, False, transform)
+        # whenFlushed() errbacks if a write failed, which explains more than
+        # any closed connection that followed it
+        d.addBoth(lambda res: fc.whenFlushed().addCallback(lambda _: res))
+        return d
+
+    def _fail_reads(self):
+        while self._waiting_reads:
+            d = self._waiting_reads.popleft()
+            d.errback(error.ConnectionClosed())
+
 @implementer(interfaces.IProducer, interfaces.IConsumer)
-class Connection(protocol.Protocol, policies.TimeoutMixin):
+class Connection(protocol.Protocol, policies.TimeoutMixin, _RecordPipe):
     def __init__(self, owner, relay_handshake, start, description):
         self.state = "too-early"
-        self.buf = b""
+        self.buf = bytearray()
         self.owner = owner
+        # some tests build a Connection without an owner
+        self._reactor = owner._reactor if owner else reactor
         self.relay_handshake = relay_handshake
         self.start = start
         self._description = description
         self._negotiation_d = defer.Deferred(self._cancel)
         self._error = None
-        self._consumer = None
-        self._consumer_bytes_written = 0
-        self._consumer_bytes_expected = None
-        self._consumer_deferred = None
-        self._inbound_records = deque()
-        self._waiting_reads = deque()
+        self._bundle = None # a MultiConnection, if we are one of its streams
+        self._decrypt_in_threads = False
+        self._decrypting = deque() # [done, nonce, record], in arrival order
+        self._decrypting_bytes = 0
+        self._lost_while_decrypting = False
+        self._consumer_paused = False
+        self._backlogged = False
+        self._reading_paused = False
+        self._init_pipe()
 
     def connectionMade(self):
         debug("handle %r" %  (self.transport,))
@@ -186,12 +377,14 @@ class Connection(protocol.Protocol, policies.TimeoutMixin):
                 raise
 
     def _check_and_remove(self, expected):
-        # any divergence is a handshake error
-        if not self.buf.startswith(expected[:len(self.buf)]):
-            raise BadHandshake("got %r want %r" % (self.buf, expected))
-        if len(self.buf) < len(expected):
+        # any divergence is a handshake error. Compare through a memoryview
+        # so we don't copy the buffer for each partial read.
+        have = min(len(self.buf), len(expected))
+        if memoryview(self.buf)[:have] != expected[:have]:
+            raise BadHandshake("got %r want %r" % (bytes(self.buf), expected))
+        if have < len(expected):
             return False # keep waiting
-        self.buf = self.buf[len(expected):]
+        del self.buf[:have] # bytearray removes a prefix in-place
         return True
 
     def _dataReceived(self, data):
@@ -251,66 +444,163 @@ class Connection(protocol.Protocol, policies.TimeoutMixin):
         d.callback(self)
 
     def dataReceivedRECORDS(self):
-        while True:
-            if len(self.buf) < 4:
-                return
-            length = int(hexlify(self.buf[:4]), 16)
-            if len(self.buf) < 4+length:
-                return
-            encrypted, self.buf = self.buf[4:4+length], self.buf[4+length:]
-
-            record = self._decrypt_record(encrypted)
-            self.recordReceived(record)
-
-    def _decrypt_record(self, encrypted):
-        nonce_buf = encrypted[:SecretBox.NONCE_SIZE] # assume it's prepended
-        nonce = int(hexlify(nonce_buf), 16)
-        if nonce != self.next_receive_nonce:
+        # Walk an offset through the buffer instead of trimming it after
+        # every record, so a read that holds many small records doesn't
+        # shift the unconsumed tail once per record. Each ciphertext is
+        # copied out exactly once (SecretBox wants bytes), and the consumed
+        # prefix is dropped in one go at the end, which bytearray does
+        # without moving the remainder.
+        buf = self.buf
+        view = memoryview(buf)
+        offset = 0
+        try:
+            while len(buf) - offset >= 4:
+                (length,) = RECORD_LENGTH.unpack_from(buf, offset)
+                end = offset + 4 + length
+                if len(buf) < end:
+                    return
+                encrypted = view[offset+4:end].tobytes()
+                offset = end
+                if self._bundle:
+                    nonce = self._check_striped_nonce(encrypted)
+                else:
+                    nonce = self._check_nonce(encrypted)
+                if self._decrypt_in_threads:
+                    self._decrypt_later(nonce, encrypted)
+                else:
+                    self._deliver(nonce, self.receive_box.decrypt(encrypted))
+        finally:
+            del view # the buffer cannot be resized while it is exported
+            del buf[:offset]
+
+    def _check_nonce(self, encrypted):
+        # the nonce is prepended: compare it against the one we expect
+        # rather than parsing it
+        expected = encode_nonce(self.next_receive_nonce)
+        if not encrypted.startswith(expected):
+            nonce = int(hexlify(encrypted[:SecretBox.NONCE_SIZE]), 16)
             raise BadNonce("received out-of-order record: got %d, expected %d"
                            % (nonce, self.next_receive_nonce))
         self.next_receive_nonce += 1
-        record = self.receive_box.decrypt(encrypted)
-        return record
+        return self.next_receive_nonce - 1
+
+    def _check_striped_nonce(self, encrypted):
+        # when records are striped across several streams, each stream sees
+        # a strictly increasing subset of the nonces, and the MultiConnection
+        # puts them back in order
+        if not encrypted.startswith(NONCE_PADDING):
+            raise BadNonce("received record with an impossible nonce")
+        (nonce,) = NONCE_COUNTER.unpack_from(encrypted, len(NONCE_PADDING))
+        if nonce < self.next_receive_nonce:
+            raise BadNonce("received out-of-order record: got %d, expected"
+                           " at least %d" % (nonce, self.next_receive_nonce))
+        self.next_receive_nonce = nonce + 1
+        return nonce
+
+    def _decrypt_record(self, encrypted):
+        self._check_nonce(encrypted)
+        return self.receive_box.decrypt(encrypted)
+
+    def _deliver(self, nonce, record):
+        if self._bundle:
+            self._bundle.streamRecordReceived(self, nonce, record)
+        else:
+            self.recordReceived(record)
+
+    def decrypt_in_threads(self):
+        """Decrypt inbound records on the reactor's thread pool from now on,
+        several at a time, instead of in dataReceived. Nonces are still
+        checked as records arrive, and records are still delivered in
+        order. Once DECRYPT_BUDGET bytes are waiting for a thread, we stop
+        reading from the transport until half of them are done."""
+        self._decrypt_in_threads = True
+
+    def _decrypt_later(self, nonce, encrypted):
+        slot = [False, nonce, None]
+        self._decrypting.append(slot)
+        self._decrypting_bytes += len(encrypted)
+        d = _in_thread(self._reactor, self.receive_box.decrypt, encrypted)
+        d.addCallbacks(self._decrypted, self._decrypt_failed,
+                       callbackArgs=(slot, len(encrypted)),
+                       errbackArgs=(len(encrypted),))
+        if (self._decrypting_bytes >= DECRYPT_BUDGET
+            and not self._backlogged):
+            self._backlogged = True
+            self._update_reading()
+
+    def _decrypted(self, record, slot, length):
+        self._decrypting_bytes -= length
+        slot[0] = True
+        slot[2] = record
+        try:
+            while self._decrypting and self._decrypting[0][0]:
+                (_, nonce, record) = self._decrypting.popleft()
+                self._deliver(nonce, record)
+        except Exception:
+            self._decrypting.clear()
+            self._error = sys.exc_info()[1]
+            self.transport.loseConnection()
+            self.state = "hung up"
+            log.err()
+        if self._backlogged and self._decrypting_bytes <= DECRYPT_BUDGET // 2:
+            self._backlogged = False
+            self._update_reading()
+        if self._lost_while_decrypting and not self._decrypting:
+            self._lost_while_decrypting = False
+            self._recordsLost()
+
+    def _decrypt_failed(self, f, length):
+        self._decrypting_bytes -= length
+        if not self._decrypting:
+            return # we already gave up
+        self._decrypting.clear()
+        self._error = f.value
+        self.transport.loseConnection()
+        self.state = "hung up"
+        log.err(f, "transit record did not decrypt")
+        if self._lost_while_decrypting:
+            self._lost_while_decrypting = False
+            self._recordsLost()
 
     def describe(self):
         return self._description
 
+    # Sending a record is split in three, so ThreadedFileSender can take
+    # nonces in order, encrypt on worker threads, and write in order.
     def send_record(self, record):
+        self._write_sealed(self._seal(record, self._allocate_nonce()))
+
+    def rekey(self, key):
+        """Encrypt and decrypt the following records with keys derived from
+        'key' instead of the transit key. Both sides must do this between
+        the same two records in each direction, while none are on their
+        way: records that have already arrived may be decrypted (on a
+        thread) with the old key. The nonces carry on counting."""
+        send_key, receive_key = self.owner._record_keys(key)
+        self.send_box = SecretBox(send_key)
+        self.receive_box = SecretBox(receive_key)
+
+    def _allocate_nonce(self):
+        self.send_nonce += 1
+        return self.send_nonce - 1
+
+    def _seal(self, record, nonce_counter):
+        # this only reads the send key, so it is safe to call from a thread
         if not isinstance(record, type(b"")): raise InternalError
         assert SecretBox.NONCE_SIZE == 24
-        assert self.send_nonce < 2**(8*24)
+        assert nonce_counter < 2**(8*NONCE_COUNTER.size)
         assert len(record) < 2**(8*4)
-        nonce = unhexlify("%048x" % self.send_nonce) # big-endian
-        self.send_nonce += 1
+        nonce = encode_nonce(nonce_counter)
         encrypted = self.send_box.encrypt(record, nonce)
-        length = unhexlify("%08x" % len(encrypted)) # always 4 bytes long
-        self.transport.write(length)
-        self.transport.write(encrypted)
-
-    def recordReceived(self, record):
-        if self._consumer:
-            self._writeToConsumer(record)
-            return
-        self._inbound_records.append(record)
-        self._deliverRecords()
-
-    def receive_record(self):
-        d = defer.Deferred()
-        self._waiting_reads.append(d)
-        self._deliverRecords()
-        return d
+        length = RECORD_LENGTH.pack(len(encrypted))
+        return [length, encrypted]
 
-    def _deliverRecords(self):
-        while self._inbound_records and self._waiting_reads:
-            r = self._inbound_records.popleft()
-            d = self._waiting_reads.popleft()
-            d.callback(r)
+    def _write_sealed(self, sealed):
+        self.transport.writeSequence(sealed)
 
     def close(self):
         self.transport.loseConnection()
-        while self._waiting_reads:
-            d = self._waiting_reads.popleft()
-            d.errback(error.ConnectionClosed())
+        self._fail_reads()
 
     def timeoutConnection(self):
         self._error = BadHandshake("timeout")
@@ -334,8 +624,18 @@ class Connection(protocol.Protocol, policies.TimeoutMixin):
             # timeout: BadHandshake("timeout")
 
             d.errback(self._error or BadHandshake("connection lost"))
+        if self._decrypting:
+            # deliver the records we already read before reporting the loss
+            self._lost_while_decrypting = True
+            return
+        self._recordsLost()
+
+    def _recordsLost(self):
         if self._consumer_deferred:
             self._consumer_deferred.errback(error.ConnectionClosed())
+        self._fail_reads()
+        if self._bundle:
+            self._bundle.streamLost(self)
 
     # IConsumer methods, for outbound flow-control. We pass these through to
     # the transport. The 'producer' is something like a t.p.basic.FileSender
@@ -348,89 +648,259 @@ class Connection(protocol.Protocol, policies.TimeoutMixin):
         self.send_record(data)
 
     # IProducer methods, for inbound flow-control. We pass these through to
-    # the transport.
+    # the transport, which also stays paused while too many records are
+    # waiting to be decrypted.
     def stopProducing(self):
         self.transport.stopProducing()
     def pauseProducing(self):
-        self.transport.pauseProducing()
+        self._consumer_paused = True
+        self._update_reading()
     def resumeProducing(self):
-        self.transport.resumeProducing()
+        self._consumer_paused = False
+        self._update_reading()
+
+    def _update_reading(self):
+        paused = self._consumer_paused or self._backlogged
+        if paused != self._reading_paused:
+            self._reading_paused = paused
+            if paused:
+                self.transport.pauseProducing()
+            else:
+                self.transport.resumeProducing()
 
     # Helper methods
 
-    def connectConsumer(self, consumer, expected=None):
-        """Helper method to glue an instance of e.g. t.p.ftp.FileConsumer to
-        us. Inbound records will be written as bytes to the consumer.
+@implementer(interfaces.IPushProducer)
+class _StreamProducer:
+    # registered with each stream's transport, so the MultiConnection knows
+    # which streams have room for more records
+    def __init__(self, bundle, stream):
+        self._bundle = bundle
+        self._stream = stream
+    def pauseProducing(self):
+        self._bundle._streamFull(self._stream)
+    def resumeProducing(self):
+        self._bundle._streamDrained(self._stream)
+    def stopProducing(self):
+        pass # we'll hear about it in streamLost
 
-        Set 'expected' to an integer to automatically disconnect when at
-        least that number of bytes have been written. This function will then
-        return a Deferred (that fires with the number of bytes actually
-        received). If the connection is lost while this Deferred is
-        outstanding, it will errback.
+@implementer(interfaces.IProducer, interfaces.IConsumer)
+class MultiConnection(_RecordPipe):
+    """I look like a Connection, but stripe records across several of them
+    ('streams'), to aggregate the bandwidth of several TCP flows or paths.
+
+    All streams share the per-direction record keys, so the nonce counter
+    is shared too: each record gets the next nonce, on whichever stream has
+    room for it, and the receiving side puts them back in nonce order. Each
+    stream still rejects nonces that go backwards. Records which arrive
+    early are held, and once MAX_REORDER_BYTES of them are waiting we stop
+    reading from the streams that delivered them: those streams are already
+    past the missing nonce, so it can only arrive on another one.
+    """
+    MAX_REORDER_BYTES = 16*1024*1024
+
+    def __init__(self, first_stream, on_close=None):
+        self._init_pipe()
+        self._on_close = on_close
+        self._first = first_stream
+        self._decrypt_in_threads = False
+        self._streams = []
+        self._writable = [] # streams whose transports have room, in order
+        self._held = set() # streams we stopped reading, while we reorder
+        self._paused = False # our consumer asked us to stop
+        self._send_nonce = 0
+        self._next_nonce = 0
+        self._early = {} # nonce -> record
+        self._early_bytes = 0
+        self._producer = None
+        self._streaming = False
+        self._producer_paused = False
+        self._pumping = False
+        self._closing = False
+        self._lost_streams = 0
+        self.add_stream(first_stream)
+
+    def add_stream(self, p):
+        if self._closing:
+            p.close()
+            return
+        p._bundle = self
+        if self._decrypt_in_threads:
+            p.decrypt_in_threads()
+        self._streams.append(p)
+        self._writable.append(p)
+        p.registerProducer(_StreamProducer(self, p), True)
+        if self._paused:
+            p.pauseProducing()
+        self._pump()
 
-        If 'expected' is None, then this function returns None instead of a
-        Deferred, and you must call disconnectConsumer() when you are done."""
+    def describe(self):
+        return ", ".join([p.describe() for p in self._streams])
 
-        if self._consumer:
-            raise RuntimeError("A consumer is already attached: %r" %
-                               self._consumer)
+    # outbound
 
-        # be aware of an ordering hazard: when we call the consumer's
-        # .registerProducer method, they are likely to immediately call
-        # self.resumeProducing, which we'll deliver to self.transport, which
-        # might call our .dataReceived, which may cause more records to be
-        # available. By waiting to set self._consumer until *after* we drain
-        # any pending records, we avoid delivering records out of order,
-        # which would be bad.
-        consumer.registerProducer(self, True)
-        # There might be enough data queued to exceed 'expected' before we
-        # leave this function. We must be sure to register the producer
-        # before it gets unregistered.
+    def send_record(self, record):
+        self._write_sealed(self._seal(record, self._allocate_nonce()))
+
+    def rekey(self, key):
+        for p in [self._first] + self._streams:
+            p.rekey(key)
+
+    def _allocate_nonce(self):
+        self._send_nonce += 1
+        return self._send_nonce - 1
+
+    def _seal(self, record, nonce_counter):
+        # every stream has the same send key, and the first one's send_box
+        # outlives its transport, so this is safe to call from a thread
+        return self._first._seal(record, nonce_counter)
+
+    def _write_sealed(self, sealed):
+        # records are written in nonce order, so whichever stream this one
+        # goes to will see its nonces increase
+        if not self._streams:
+            raise TransitClosed("all streams have closed")
+        if self._writable:
+            p = self._writable.pop(0)
+            self._writable.append(p) # round-robin between the ones with room
+        else:
+            p = self._streams[self._send_nonce % len(self._streams)]
+        p._write_sealed(sealed)
+
+    def decrypt_in_threads(self):
+        self._decrypt_in_threads = True
+        for p in self._streams:
+            p.decrypt_in_threads()
+
+    def _streamFull(self, p):
+        if p in self._writable:
+            self._writable.remove(p)
+        if (not self._writable and self._streaming and self._producer
+            and not self._producer_paused):
+            self._producer_paused = True
+            self._producer.pauseProducing()
+
+    def _streamDrained(self, p):
+        if p in self._streams and p not in self._writable:
+            self._writable.append(p)
+        self._pump()
+
+    def _pump(self):
+        # give the producer a chance to write whenever any stream has room
+        if self._pumping:
+            return
+        self._pumping = True
+        try:
+            if self._streaming:
+                if self._producer and self._writable and self._producer_paused:
+                    self._producer_paused = False
+                    self._producer.resumeProducing()
+            else:
+                while self._producer and self._writable:
+                    self._producer.resumeProducing()
+        finally:
+            self._pumping = False
 
-        self._consumer = consumer
-        self._consumer_bytes_written = 0
-        self._consumer_bytes_expected = expected
-        d = None
-        if expected is not None:
-            d = defer.Deferred()
-        self._consumer_deferred = d
-        # drain any pending records
-        while self._consumer and self._inbound_records:
-            r = self._inbound_records.popleft()
-            self._writeToConsumer(r)
-        return d
+    # IConsumer methods, for outbound flow-control
+    def registerProducer(self, producer, streaming):
+        self._producer = producer
+        self._streaming = streaming
+        self._producer_paused = False
+        if streaming and not self._writable:
+            self._producer_paused = True
+            producer.pauseProducing()
+        self._pump()
+    def unregisterProducer(self):
+        self._producer = None
+    def write(self, data):
+        self.send_record(data)
 
-    def _writeToConsumer(self, record):
-        self._consumer.write(record)
-        self._consumer_bytes_written += len(record)
-        if self._consumer_bytes_expected is not None:
-            if self._consumer_bytes_written >= self._consumer_bytes_expected:
-                d = self._consumer_deferred
-                self.disconnectConsumer()
-                d.callback(self._consumer_bytes_written)
+    # inbound
+
+    def streamRecordReceived(self, p, nonce, record):
+        if nonce < self._next_nonce or nonce in self._early:
+            raise BadNonce("received duplicate record %d" % nonce)
+        if nonce != self._next_nonce:
+            self._early[nonce] = record
+            self._early_bytes += len(record)
+            if self._early_bytes > self.MAX_REORDER_BYTES:
+                self._held.add(p)
+                p.pauseProducing()
+            self._check_for_gap()
+            return
+        self._next_nonce += 1
+        self.recordReceived(record)
+        while self._next_nonce in self._early:
+            record = self._early.pop(self._next_nonce)
+            self._early_bytes -= len(record)
+            self._next_nonce += 1
+            self.recordReceived(record)
+        if self._held and self._early_bytes <= self.MAX_REORDER_BYTES:
+            held, self._held = self._held, set()
+            if not self._paused:
+                for p in held:
+                    p.resumeProducing()
+
+    def _check_for_gap(self):
+        # After losing a stream, a missing record is gone for good once
+        # every surviving stream has moved past it.
+        if not self._early or not self._lost_streams:
+            return
+        if all(p.next_receive_nonce > self._next_nonce
+               for p in self._streams):
+            self._fail()
+
+    def streamLost(self, p):
+        self._lost_streams += 1
+        if p in self._streams:
+            self._streams.remove(p)
+        if p in self._writable:
+            self._writable.remove(p)
+        self._held.discard(p)
+        if self._closing:
+            return
+        if not self._streams:
+            self._fail()
+        else:
+            self._check_for_gap()
 
-    def disconnectConsumer(self):
-        self._consumer.unregisterProducer()
-        self._consumer = None
-        self._consumer_bytes_expected = None
-        self._consumer_deferred = None
+    def _fail(self):
+        d, self._consumer_deferred = self._consumer_deferred, None
+        self.close()
+        if d:
+            d.errback(error.ConnectionClosed())
 
-    # Helper method to write a known number of bytes to a file. This has no
-    # flow control: the filehandle cannot push back. 'progress' is an
-    # optional callable which will be called on each write (with the number
-    # of bytes written). Returns a Deferred that fires (with the number of
-    # bytes written) when the count is reached or the RecordPipe is closed.
-    def writeToFile(self, f, expected, progress=None, hasher=None):
-        fc = FileConsumer(f, progress, hasher)
-        return self.connectConsumer(fc, expected)
+    def close(self):
+        self._closing = True
+        if self._on_close:
+            self._on_close()
+        for p in list(self._streams):
+            p.close()
+        self._fail_reads()
+
+    # IProducer methods, for inbound flow-control
+    def stopProducing(self):
+        for p in list(self._streams):
+            p.stopProducing()
+    def pauseProducing(self):
+        self._paused = True
+        for p in self._streams:
+            p.pauseProducing()
+    def resumeProducing(self):
+        self._paused = False
+        for p in self._streams:
+            if p not in self._held:
+                p.resumeProducing()
 
 class OutboundConnectionFactory(protocol.ClientFactory):
     protocol = Connection
 
-    def __init__(self, owner, relay_handshake, description):
+    def __init__(self, owner, relay_handshake, description,
+                 socket_options=None):
         self.owner = owner
         self.relay_handshake = relay_handshake
         self._description = description
+        self._socket_options = socket_options
         self.start = time.time()
 
     def buildProtocol(self, addr):
@@ -440,22 +910,30 @@ class OutboundConnectionFactory(protocol.ClientFactory):
         return p
 
     def connectionWasMade(self, p):
+        if self._socket_options:
+            tune_transport(p.transport, self._socket_options)
         # outbound connections are handled via the endpoint
-        pass
 
 
 class InboundConnectionFactory(protocol.ClientFactory):
     protocol = Connection
 
-    def __init__(self, owner):
+    def __init__(self, owner, socket_options=None):
         self.owner = owner
+        self._socket_options = socket_options
         self.start = time.time()
         self._inbound_d = defer.Deferred(self._cancel)
         self._pending_connections = set()
+        self._add_stream = None
 
     def whenDone(self):
         return self._inbound_d
 
+    def acceptMany(self, add_stream):
+        # multi-stream mode: don't hang up on the other negotiations when
+        # the first one succeeds, and hand any later winners to add_stream
+        self._add_stream = add_stream
+
     def _cancel(self, inbound_d):
         self._shutdown()
         # our _inbound_d will be errbacked by Deferred.cancel()
@@ -478,6 +956,8 @@ class InboundConnectionFactory(protocol.ClientFactory):
         return p
 
     def connectionWasMade(self, p):
+        if self._socket_options:
+            tune_transport(p.transport, self._socket_options)
         d = p.startNegotiation()
         self._pending_connections.add(d)
         d.addBoth(self._remove, d)
@@ -488,6 +968,12 @@ class InboundConnectionFactory(protocol.ClientFactory):
         return res
 
     def _proto_succeeded(self, p):
+        if self._add_stream:
+            if self._inbound_d.called:
+                self._add_stream(p)
+            else:
+                self._inbound_d.callback(p)
+            return
         self._shutdown()
         self._inbound_d.callback(p)
 
@@ -569,12 +1055,249 @@ class _ThereCanBeOnlyOne:
 def there_can_be_only_one(contenders):
     return _ThereCanBeOnlyOne(contenders).run()
 
+class _GatherStreams:
+    """Like _ThereCanBeOnlyOne, but for multi-stream mode. Each contender
+    that fires successfully is passed to add_stream(), which returns the
+    MultiConnection it joined. The summary Deferred fires with that when the
+    first contender succeeds, but the rest are allowed to carry on for
+    'window' seconds before being cancelled. If all error, errback the
+    summary.
+    """
+    def __init__(self, contenders, add_stream, window, reactor):
+        self._remaining = set(contenders)
+        self._add_stream = add_stream
+        self._window = window
+        self._reactor = reactor
+        self._summary_d = defer.Deferred(self._cancel)
+        self._first_failure = None
+        self._fired = False
+        self._timer = None
+
+    def _cancel(self, _):
+        self.stop()
+
+    def stop(self):
+        """Cancel any contenders that haven't finished yet."""
+        if self._timer and self._timer.active():
+            self._timer.cancel()
+        self._timer = None
+        for d in list(self._remaining):
+            d.cancel()
+
+    def run(self):
+        for d in list(self._remaining):
+            d.addBoth(self._remove, d)
+            d.addCallbacks(self._succeeded, self._failed)
+            d.addCallback(self._maybe_done)
+        return self._summary_d
+
+    def _remove(self, res, d):
+        self._remaining.remove(d)
+        return res
+
+    def _succeeded(self, p):
+        if self._fired:
+            if self._timer is None:
+                p.close() # too late: we already failed, or gave up waiting
+                return
+            self._add_stream(p)
+            return
+        self._fired = True
+        bundle = self._add_stream(p)
+        self._timer = self._reactor.callLater(self._window, self.stop)
+        self._summary_d.callback(bundle)
+
+    def _failed(self, f):
+        if self._first_failure is None:
+            self._first_failure = f
+
+    def _maybe_done(self, _):
+        if self._remaining:
+            return
+        if self._timer and self._timer.active():
+            self._timer.cancel()
+        if not self._fired:
+            self._fired = True
+            self._summary_d.errback(self._first_failure)
+
+# Outbound connections are started happy-eyeballs style (RFC 8305). We
+# used to start every direct hint at once, and the relay a fixed
+# RELAY_DELAY later, so when the direct hints were all refused or
+# unreachable (a firewall that answers with RST, a peer on another
+# network) we still sat out the whole delay before trying the relay. Now
+# the direct hints are tried one at a time, best first, a short "attempt
+# delay" apart, and the next one starts right away when the current ones
+# fail. Once every direct attempt has failed, the relay starts without
+# waiting. Both delays come from how long direct connections took to
+# establish (TCP plus our handshake) the last few times on this network,
+# so a fast LAN gets a short stagger and a quick fallback, and a network
+# we know nothing about gets RFC 8305's defaults. We recognize a network by
+# the addresses we listen on; with no_listen we don't look them up, and
+# always use the defaults. Given a connection_cache (see conncache.py),
+# Common remembers this between runs, along with which addresses answered
+# and whether the relay won, and uses that to order the hints.
+
+def _ipv4_int(hostname):
+    try:
+        return struct.unpack(">L", socket.inet_aton(hostname))[0]
+    except (socket.error, ValueError, TypeError):
+        return None
+
+def shared_prefix(hostname, addresses):
+    """Return how many leading bits the IPv4 address 'hostname' shares with
+    the closest of 'addresses' (0 if it isn't an IPv4 address). This is the
+    "longest matching prefix" rule of RFC 6724: an address on one of our
+    own subnets is the one most likely to answer."""
+    a = _ipv4_int(hostname)
+    if a is None:
+        return 0
+    best = 0
+    for addr in addresses:
+        b = _ipv4_int(addr)
+        if b is not None:
+            best = max(best, 32 - (a ^ b).bit_length())
+    return best
+
+class _Attempt:
+    def __init__(self, race, hint, start, is_relay):
+        self._race = race
+        self.hint = hint
+        self._start = start
+        self.is_relay = is_relay
+        self.started = None
+        self._inner = None
+        self.d = defer.Deferred(self._cancel)
+
+    def _cancel(self, _):
+        if self._inner:
+            self._inner.cancel()
+        else:
+            # never started: Deferred.cancel() errbacks self.d for us
+            self._race._forget(self)
+
+    def start(self):
+        self.started = self._race.seconds()
+        self._inner = defer.maybeDeferred(self._start)
+        self._inner.addBoth(self._race._finished, self)
+        self._inner.chainDeferred(self.d)
+
+class _ConnectionRace:
+    """Decide when each outbound connection attempt starts. add_direct()
+    takes a list of start functions (one per stream) for each direct hint,
+    in order of preference, and add_relay() one for each relay hint. Each
+    returns Deferreds to hand to there_can_be_only_one() or
+    _GatherStreams: they fire with the result of the start function once
+    it has been called, and cancelling one that hasn't started yet means it
+    never will. report(hint, is_relay, elapsed, ok) is called when an
+    attempt succeeds or fails (but not when it is cancelled), and .winner
+    is the first attempt that succeeded.
+    """
+    def __init__(self, reactor, attempt_delay, relay_delay, report):
+        self._reactor = reactor
+        self._attempt_delay = attempt_delay
+        self._relay_delay = relay_delay
+        self._report = report
+        self.winner = None
+        self._waiting = deque() # lists of _Attempts, one list per hint
+        self._relays = []
+        self._running = 0
+        self._next_timer = None
+        self._relay_timer = None
+
+    def seconds(self):
+        return self._reactor.seconds()
+
+    def add_direct(self, hint, starts):
+        group = [_Attempt(self, hint, start, False) for start in starts]
+        self._waiting.append(group)
+        return [a.d for a in group]
+
+    def add_relay(self, hint, start):
+        a = _Attempt(self, hint, start, True)
+        self._relays.append(a)
+        return a.d
+
+    def run(self):
+        if self._relays:
+            # with no direct hints at all, the relay goes right away
+            delay = self._relay_delay if self._waiting else 0
+            self._relay_timer = self._reactor.callLater(delay,
+                                                        self._start_relays)
+        self._start_next_direct()
+
+    def _cancel_timer(self, t):
+        if t and t.active():
+            t.cancel()
+
+    def _start_next_direct(self):
+        self._cancel_timer(self._next_timer)
+        self._next_timer = None
+        if not self._waiting:
+            return
+        group = self._waiting.popleft()
+        self._running += len(group)
+        for a in group:
+            a.start()
+        # a start function that fails right away may have got here first
+        if self._waiting and self._next_timer is None:
+            self._next_timer = self._reactor.callLater(
+                self._attempt_delay, self._start_next_direct)
+
+    def _start_relays(self):
+        self._cancel_timer(self._relay_timer)
+        self._relay_timer = None
+        relays, self._relays = self._relays, []
+        for a in relays:
+            a.start()
+
+    def _finished(self, res, a):
+        ok = not isinstance(res, failure.Failure)
+        cancelled = not ok and res.check(defer.CancelledError)
+        if ok and self.winner is None:
+            self.winner = a
+        if not cancelled:
+            self._report(a.hint, a.is_relay, self.seconds() - a.started, ok)
+        if a.is_relay:
+            return res
+        self._running -= 1
+        if not ok and not cancelled and not self._running:
+            # everything we've tried so far has failed: don't wait
+            if self._waiting:
+                self._start_next_direct()
+            else:
+                self._start_relays()
+        return res
+
+    def _forget(self, a):
+        if a.is_relay:
+            self._relays.remove(a)
+        else:
+            for group in self._waiting:
+                if a in group:
+                    group.remove(a)
+            self._waiting = deque(g for g in self._waiting if g)
+        if not self._waiting:
+            self._cancel_timer(self._next_timer)
+        if not self._relays:
+            self._cancel_timer(self._relay_timer)
+
 class Common:
     RELAY_DELAY = 2.0
+    # how far apart to start the direct hints when we know nothing about
+    # this network, and the bounds on it when we do (RFC 8305 section 5)
+    ATTEMPT_DELAY = 0.25
+    MIN_ATTEMPT_DELAY = 0.1
+    MAX_ATTEMPT_DELAY = 2.0
+    MIN_RELAY_DELAY = 0.5
     TRANSIT_KEY_LENGTH = SecretBox.KEY_SIZE
+    # In multi-stream mode, the sender accepts extra streams for this long
+    # after the first one wins. The receiver waits a bit longer, since it
+    # only hears about them (with "go") a round trip later.
+    STREAM_WINDOW = 5.0
 
     def __init__(self, transit_relay, no_listen=False, tor_manager=None,
-                 reactor=reactor, timing=None):
+                 reactor=reactor, timing=None, socket_options=None,
+                 streams=1, connection_cache=None):
         if transit_relay:
             if not isinstance(transit_relay, type(u"")):
                 raise InternalError
@@ -587,9 +1310,17 @@ class Common:
         self._tor_manager = tor_manager
         self._transit_key = None
         self._no_listen = no_listen
+        self._socket_options = socket_options or DEFAULT_SOCKET_OPTIONS
         self._waiting_for_transit_key = []
         self._listener = None
         self._winner = None
+        self._streams = streams
+        self._their_streams = 1
+        self._extra_winners = 0
+        self._bundle = None
+        self._addresses = None
+        self._connection_cache = connection_cache
+        self._connect_times = {} # network key -> smoothed time (seconds)
         self._reactor = reactor
         self._timing = timing or DebugTiming()
         self._timing.add("transit")
@@ -598,7 +1329,7 @@ class Common:
         if self._no_listen or self._tor_manager:
             return ([], None)
         portnum = allocate_tcp_port()
-        addresses = ipaddrs.find_addresses()
+        addresses = self._local_addresses()
         non_loopback_addresses = [a for a in addresses if a != "127.0.0.1"]
         if non_loopback_addresses:
             # some test hosts, including the appveyor VMs, *only* have
@@ -609,10 +1340,59 @@ class Common:
         ep = endpoints.serverFromString(reactor, "tcp:%d" % portnum)
         return direct_hints, ep
 
+    def _local_addresses(self):
+        if self._addresses is None:
+            # (looking them up runs a program, so only when we listen)
+            self._addresses = ([] if self._no_listen
+                               else ipaddrs.find_addresses())
+        return self._addresses
+
+    def _network_key(self):
+        # connection times are remembered for each network we're on, which
+        # we recognize by our own addresses. Returns None if we don't know
+        # them.
+        if self._tor_manager:
+            return "tor"
+        return ",".join(sorted(self._local_addresses())) or None
+
+    def _connect_time(self, key):
+        if key is None:
+            return None
+        t = self._connect_times.get(key)
+        if t is None and self._connection_cache:
+            # from an earlier run
+            t = self._connection_cache.connect_time(key)
+        return t
+
+    def _delays(self):
+        # returns (attempt_delay, relay_delay)
+        t = self._connect_time(self._network_key())
+        if t is None:
+            return (self.ATTEMPT_DELAY, self.RELAY_DELAY)
+        attempt_delay = min(max(2*t, self.MIN_ATTEMPT_DELAY),
+                            self.MAX_ATTEMPT_DELAY)
+        relay_delay = min(max(4*t, self.MIN_RELAY_DELAY), self.RELAY_DELAY)
+        return (attempt_delay, relay_delay)
+
     def get_connection_abilities(self):
-        return [{u"type": u"direct-tcp-v1"},
-                {u"type": u"relay-v1"},
-                ]
+        abilities = [{u"type": u"direct-tcp-v1"},
+                     {u"type": u"relay-v1"},
+                     ]
+        if self._streams > 1:
+            abilities.append({u"type": u"multi-stream-v1",
+                              u"streams": self._streams})
+        return abilities
+
+    def add_connection_abilities(self, abilities):
+        for a in abilities:
+            if a.get(u"type", u"") == u"multi-stream-v1":
+                streams = a.get(u"streams")
+                if isinstance(streams, int) and streams > 1:
+                    self._their_streams = streams
+
+    def _max_streams(self):
+        # multi-stream mode is only used if both sides asked for it
+        return min(self._streams, self._their_streams)
 
     @inlineCallbacks
     def get_connection_hints(self):
@@ -651,7 +1431,7 @@ class Common:
 
         # Start the server, so it will be running by the time anyone tries to
         # connect to the direct hints we return.
-        f = InboundConnectionFactory(self)
+        f = InboundConnectionFactory(self, self._socket_options)
         self._listener_f = f # for tests # XX move to __init__ ?
         self._listener_d = f.whenDone()
         d = self._listener.listen(f)
@@ -742,6 +1522,17 @@ class Common:
             return HKDF(self._transit_key, SecretBox.KEY_SIZE,
                         CTXinfo=b"transit_record_sender_key")
 
+    def _record_keys(self, key):
+        # (send_key, receive_key) for the records of a Connection, keyed by
+        # the transit key or by a later Connection.rekey()
+        sender = HKDF(key, SecretBox.KEY_SIZE,
+                      CTXinfo=b"transit_record_sender_key")
+        receiver = HKDF(key, SecretBox.KEY_SIZE,
+                        CTXinfo=b"transit_record_receiver_key")
+        if self.is_sender:
+            return sender, receiver
+        return receiver, sender
+
     def set_transit_key(self, key):
         assert isinstance(key, type(b"")), type(key)
         # We use pubsub to protect against the race where the sender knows
@@ -775,49 +1566,121 @@ class Common:
         returnValue(winner)
 
     def _connect(self):
-        # It might be nice to wire this so that a failure in the direct hints
-        # causes the relay hints to be used right away (fast failover). But
-        # none of our current use cases would take advantage of that: if we
-        # have any viable direct hints, then they're either going to succeed
-        # quickly or hang for a long time.
         contenders = []
         if self._listener_d:
             contenders.append(self._listener_d)
-        relay_delay = 0
-
+        key = self._network_key()
+        cache = self._connection_cache if key else None
+        # in multi-stream mode, make several connections to each direct
+        # hint. The relay pairs up connections by token, so we only ever
+        # make one connection to it.
+        streams = self._max_streams()
+
+        direct = []
         for hint_obj in self._their_direct_hints:
             # Check the hint type to see if we can support it (e.g. skip
-            # onion hints on a non-Tor client). Do not increase relay_delay
-            # unless we have at least one viable hint.
+            # onion hints on a non-Tor client).
             ep = self._endpoint_from_hint_obj(hint_obj)
-            if not ep:
-                continue
+            if ep:
+                direct.append((hint_obj, ep))
+        # addresses that answered last time we were on this network come
+        # first, then untried ones, then ones that failed. Within those,
+        # addresses on our own subnets first (sorted() is stable, so
+        # otherwise in the order the peer gave them).
+        addresses = [] if self._tor_manager else self._local_addresses()
+        ranks = dict((hint_obj, cache.rank(key, hint_obj.hostname)
+                      if cache else 0) for hint_obj, ep in direct)
+        direct.sort(key=lambda h: (-ranks[h[0]],
+                                   -shared_prefix(h[0].hostname, addresses)))
+
+        attempt_delay, relay_delay = self._delays()
+        if (cache and cache.winner(key) == "relay"
+            and 1 not in ranks.values()):
+            # direct connections haven't got through from here lately, so
+            # don't hold the relay back
+            relay_delay = 0
+        race = _ConnectionRace(self._reactor, attempt_delay, relay_delay,
+                               functools.partial(self._attempt_finished,
+                                                 key))
+        for hint_obj, ep in direct:
             description = "->%s" % describe_hint_obj(hint_obj)
-            d = self._start_connector(ep, description)
-            contenders.append(d)
-            relay_delay = self.RELAY_DELAY
-
-        # Start trying the relay a few seconds after we start to try the
-        # direct hints. The idea is to prefer direct connections, but not be
-        # afraid of using the relay when we have direct hints that don't
-        # resolve quickly. Many direct hints will be to unused local-network
-        # IP addresses, which won't answer, and would take the full TCP
-        # timeout (30s or more) to fail.
+            starts = [functools.partial(self._start_connector, ep,
+                                        description)
+                      for i in range(streams)]
+            contenders.extend(race.add_direct(hint_obj, starts))
+
+        # The relay starts relay_delay after the first direct hint, or as
+        # soon as all of the direct hints have failed. The idea is to
+        # prefer direct connections, but not be afraid of using the relay
+        # when we have direct hints that don't resolve quickly. Many direct
+        # hints will be to unused local-network IP addresses, which won't
+        # answer, and would take the full TCP timeout (30s or more) to fail.
         for hint_obj in self._their_relay_hints:
             ep = self._endpoint_from_hint_obj(hint_obj)
             if not ep:
                 continue
             description = "->relay:%s" % describe_hint_obj(hint_obj)
-            d = task.deferLater(self._reactor, relay_delay,
-                                self._start_connector, ep, description,
-                                is_relay=True)
-            contenders.append(d)
+            start = functools.partial(self._start_connector, ep,
+                                      description, is_relay=True)
+            contenders.append(race.add_relay(hint_obj, start))
 
         if not contenders:
             raise TransitError("No contenders for connection")
 
-        winner = there_can_be_only_one(contenders)
-        return self._not_forever(2*TIMEOUT, winner)
+        if streams > 1:
+            if self._listener_d:
+                self._listener_f.acceptMany(self._add_stream)
+            window = self.STREAM_WINDOW
+            if not self.is_sender:
+                window += TIMEOUT
+            gatherer = _GatherStreams(contenders, self._add_stream, window,
+                                      self._reactor)
+            self._stop_gathering = gatherer.stop
+            winner = gatherer.run()
+        else:
+            winner = there_can_be_only_one(contenders)
+        race.run()
+        d = self._not_forever(2*TIMEOUT, winner)
+        if cache:
+            d.addBoth(self._remember_winner, race, key)
+        return d
+
+    def _attempt_finished(self, key, hint, is_relay, elapsed, ok):
+        if is_relay or key is None:
+            return
+        if ok:
+            self._record_connect_time(key, elapsed)
+        if self._connection_cache:
+            self._connection_cache.record(key, hint.hostname, ok)
+            if key in self._connect_times:
+                self._connection_cache.set_connect_time(
+                    key, self._connect_times[key])
+
+    def _record_connect_time(self, key, sample):
+        # the same smoothing TCP uses for its RTT estimate (RFC 6298)
+        old = self._connect_time(key)
+        if old is None:
+            self._connect_times[key] = sample
+        else:
+            self._connect_times[key] = 0.875*old + 0.125*sample
+
+    def _remember_winner(self, res, race, key):
+        if not isinstance(res, failure.Failure):
+            # if nothing of ours won, the peer connected to our listener
+            relay = race.winner is not None and race.winner.is_relay
+            self._connection_cache.set_winner(key,
+                                              "relay" if relay else "direct")
+        self._connection_cache.save()
+        return res
+
+    def _add_stream(self, p):
+        # multi-stream mode: the first winner becomes a MultiConnection, and
+        # later ones join it
+        if self._bundle is None:
+            self._bundle = MultiConnection(p, self._stop_gathering)
+        else:
+            self._bundle.add_stream(p)
+        return self._bundle
 
     def _not_forever(self, timeout, d):
         """If the timer fires first, cancel the deferred. If the deferred fires
@@ -835,7 +1698,8 @@ class Common:
         if is_relay:
             assert self._transit_key
             relay_handshake = build_relay_handshake(self._transit_key)
-        f = OutboundConnectionFactory(self, relay_handshake, description)
+        f = OutboundConnectionFactory(self, relay_handshake, description,
+                                      self._socket_options)
         d = ep.connect(f)
         # fires with protocol, or ConnectError
         d.addCallback(lambda p: p.startNegotiation())
@@ -863,10 +1727,16 @@ class Common:
             return "wait-for-decision"
 
         if self._winner:
-            # we already have a winner, so this one loses
+            # We already have a winner. In multi-stream mode, a few more can
+            # join it for a little while. Otherwise this one loses.
+            if (self._extra_winners < self._max_streams() - 1
+                and self._reactor.seconds() < self._winner_deadline):
+                self._extra_winners += 1
+                return "go"
             return "nevermind"
         # this one wins!
         self._winner = p
+        self._winner_deadline = self._reactor.seconds() + self.STREAM_WINDOW
         return "go"
 
 class TransitSender(Common):
@@ -904,6 +1774,335 @@ class FileConsumer:
         assert self._producer
         self._producer = None
 
+# FileConsumer, but the writes and the hashing happen one at a time, in
+# order, on the reactor's thread pool, so the reactor can keep reading and
+# decrypting while the disk is busy. Memory stays flat however big the file
+# is, and however slow the disk: once 'budget' bytes are queued we pause
+# the producer (the Connection, which stops reading from its socket), and
+# resume it when half of them have been written. whenFlushed() returns a
+# Deferred that fires when every queued write has finished, or errbacks
+# with the first one that failed (after which the rest are skipped).
+# 'progress' is called on the reactor, after each write.
+
+@implementer(interfaces.IConsumer)
+class ThreadedFileConsumer:
+    BUDGET = 8*1024*1024
+
+    def __init__(self, f, progress=None, hasher=None, budget=None,
+                 reactor=reactor):
+        self._f = f
+        self._progress = progress
+        self._hasher = hasher
+        self._budget = budget or self.BUDGET
+        self._reactor = reactor
+        self._producer = None
+        self._paused = False
+        self._lock = defer.DeferredLock()
+        self._queued = 0
+        self._queued_bytes = 0
+        self._failure = None
+        self._flush_waiters = []
+
+    def registerProducer(self, producer, streaming):
+        assert not self._producer
+        self._producer = producer
+        assert streaming
+
+    def write(self, bytes):
+        self._queued += 1
+        self._queued_bytes += len(bytes)
+        d = self._lock.run(_in_thread, self._reactor, self._write, bytes)
+        d.addCallbacks(self._written, self._write_failed,
+                       callbackArgs=(len(bytes),), errbackArgs=(len(bytes),))
+        if (self._queued_bytes >= self._budget and self._producer
+            and not self._paused):
+            self._paused = True
+            self._producer.pauseProducing()
+
+    def _write(self, bytes):
+        # in a thread
+        if self._failure:
+            return
+        self._f.write(bytes)
+        if self._hasher:
+            self._hasher(bytes)
+
+    def _written(self, _, length):
+        self._queued -= 1
+        self._queued_bytes -= length
+        if self._progress and not self._failure:
+            self._progress(length)
+        self._check()
+
+    def _write_failed(self, f, length):
+        self._queued -= 1
+        self._queued_bytes -= length
+        if not self._failure:
+            self._failure = f
+            if self._producer:
+                self._producer.stopProducing()
+        self._check()
+
+    def _check(self):
+        if self._paused and self._queued_bytes <= self._budget // 2:
+            self._paused = False
+            if self._producer:
+                self._producer.resumeProducing()
+        if not self._queued:
+            waiters, self._flush_waiters = self._flush_waiters, []
+            for d in waiters:
+                if self._failure:
+                    d.errback(self._failure)
+                else:
+                    d.callback(None)
+
+    def unregisterProducer(self):
+        assert self._producer
+        if self._paused:
+            # don't leave the connection stuck: it may be asked for more
+            # records later
+            self._paused = False
+            self._producer.resumeProducing()
+        self._producer = None
+
+    def whenFlushed(self):
+        d = defer.Deferred()
+        self._flush_waiters.append(d)
+        self._check()
+        return d
+
+# based on twisted.protocols.basic.FileSender, but with records whose size
+# adapts to the connection. FileSender reads 16KiB at a time, and each read
+# becomes one record: on a fast LAN the per-record cost (a Python round-trip
+# through the transform and send_record, a SecretBox call, and 44 bytes of
+# nonce, MAC and length) caps the throughput below what the network can do.
+# Bigger is not always better, though: past a few hundred KiB each record
+# falls out of the CPU caches while it is hashed, encrypted (which copies
+# it) and written, and on slow links big records just make the progress bar
+# jumpy. So we measure the throughput we actually get at each record size
+# (from one resumeProducing to the next, which covers reading, hashing,
+# encrypting and draining a record), and hill-climb: double the size while
+# that beats the smaller size, halve it when it doesn't, and every so often
+# forget what we learned, in case the connection has changed.
+
+@implementer(interfaces.IPullProducer)
+class FileProducer:
+    MIN_RECORD_SIZE = 16*1024
+    INITIAL_RECORD_SIZE = 64*1024
+    MAX_RECORD_SIZE = 4*1024*1024
+    PROBE_RECORDS = 8 # records sent at each size before deciding
+    REPROBE = 64 # decisions before forgetting old measurements
+    GAIN = 1.1
+
+    lastSent = b""
+    deferred = None
+
+    def __init__(self, min_record_size=None, max_record_size=None,
+                 clock=reactor):
+        self._min = min_record_size or self.MIN_RECORD_SIZE
+        self._max = max(max_record_size or self.MAX_RECORD_SIZE, self._min)
+        self._clock = clock
+        self.record_size = min(max(self.INITIAL_RECORD_SIZE, self._min),
+                               self._max)
+        self._rates = {} # record size -> smoothed bytes per second
+        self._last_resume = None
+        self._last_size = 0
+        self._records = 0
+        self._decisions = 0
+
+    def beginFileTransfer(self, file, consumer, transform=None):
+        """Like FileSender.beginFileTransfer: returns a Deferred that fires
+        (with the last byte sent) when the whole file has been written to
+        the consumer."""
+        self.file = file
+        self.consumer = consumer
+        self.transform = transform
+        self.deferred = deferred = defer.Deferred()
+        self.consumer.registerProducer(self, False)
+        return deferred
+
+    def _measure(self, size, elapsed):
+        rate = size / max(elapsed, 1e-6)
+        old = self._rates.get(size)
+        self._rates[size] = rate if old is None else 0.75*old + 0.25*rate
+        self._records += 1
+        if self._records >= self.PROBE_RECORDS:
+            self._records = 0
+            self._adapt()
+
+    def _adapt(self):
+        size = self.record_size
+        here = self._rates[size]
+        smaller = self._rates.get(size//2) if size//2 >= self._min else None
+        bigger = self._rates.get(size*2) if size*2 <= self._max else None
+        # prefer the smaller size unless the bigger one is clearly better
+        if smaller is not None and smaller*self.GAIN > here:
+            self.record_size = size//2
+        elif size*2 <= self._max and (bigger is None or
+                                      bigger > here*self.GAIN):
+            self.record_size = size*2
+        self._decisions += 1
+        if self._decisions >= self.REPROBE:
+            self._decisions = 0
+            self._rates = {self.record_size: self._rates.get(self.record_size,
+                                                             here)}
+
+    def resumeProducing(self):
+        now = self._clock.seconds()
+        if self._last_size:
+            self._measure(self._last_size, now - self._last_resume)
+        self._last_resume = now
+        chunk = b""
+        if self.file:
+            chunk = self.file.read(self.record_size)
+        if not chunk:
+            self.file = None
+            self.consumer.unregisterProducer()
+            if self.deferred:
+                d, self.deferred = self.deferred, None
+                d.callback(self.lastSent)
+            return
+        # only full records tell us anything about the record size
+        self._last_size = 0
+        if len(chunk) == self.record_size:
+            self._last_size = len(chunk)
+        if self.transform:
+            chunk = self.transform(chunk)
+        self.consumer.write(chunk)
+        self.lastSent = chunk[-1:]
+
+    def pauseProducing(self):
+        pass
+
+    def stopProducing(self):
+        if self.deferred:
+            d, self.deferred = self.deferred, None
+            d.errback(Exception("Consumer asked us to stop producing"))
+
+# FileProducer does everything on the reactor, so a transfer can use one
+# core at most. ThreadedFileSender spreads the work over the reactor's
+# thread pool as a pipeline: reading and hashing happen one record at a
+# time, in order (they have to), then each record takes the next nonce and
+# is encrypted on whichever thread is free, and the reactor writes the
+# sealed records to the connection in nonce order. At most 'depth' records
+# are in the pipeline at once, and we stop feeding it while the transport
+# (or, for a MultiConnection, every stream) is full, so memory use stays at
+# about depth*record_size. 'hasher' is called from a thread, 'progress' on
+# the reactor. If 'transform' is given, each record goes through it just
+# before it is encrypted, in the same thread. beginFileTransfer() returns a
+# Deferred that fires with the number of (untransformed) bytes sent.
+
+@implementer(interfaces.IPushProducer)
+class ThreadedFileSender:
+    RECORD_SIZE = 256*1024
+    DEPTH = 8
+
+    def __init__(self, record_size=None, depth=None, reactor=reactor):
+        self._record_size = record_size or self.RECORD_SIZE
+        self._depth = depth or self.DEPTH
+        self._reactor = reactor
+        self._lock = defer.DeferredLock()
+        self._queue = deque() # [done, (sealed, length) or None]
+        self._paused = False
+        self._eof = False
+        self._sent = 0
+        self.deferred = None
+
+    def beginFileTransfer(self, file, pipe, hasher=None, progress=None,
+                          transform=None):
+        self._file = file
+        self._pipe = pipe
+        self._hasher = hasher
+        self._progress = progress
+        self._transform = transform
+        self.deferred = defer.Deferred()
+        d = self.deferred
+        pipe.registerProducer(self, True)
+        self._fill()
+        return d
+
+    def _fill(self):
+        while (self.deferred and not self._paused and not self._eof
+               and len(self._queue) < self._depth):
+            slot = [False, None]
+            self._queue.append(slot)
+            d = self._lock.run(_in_thread, self._reactor, self._read)
+            d.addCallback(self._seal, slot)
+            d.addCallback(self._sealed, slot)
+            d.addErrback(self._failed)
+
+    def _read(self):
+        # in a thread, one at a time
+        chunk = self._file.read(self._record_size)
+        if chunk and self._hasher:
+            self._hasher(chunk)
+        return chunk
+
+    def _seal(self, chunk, slot):
+        # back on the reactor, in file order, so the nonces are too
+        if self._eof or not self.deferred:
+            return None # a read that was queued behind the last one
+        if len(chunk) < self._record_size:
+            # A short read means the end of the file. Forget the reads
+            # queued behind this one, so we finish as soon as the last
+            # record is written: the receiver may hang up right after that.
+            self._eof = True
+            while self._queue[-1] is not slot:
+                self._queue.pop()
+            if not chunk:
+                return None
+        d = _in_thread(self._reactor, self._pack, chunk,
+                       self._pipe._allocate_nonce())
+        d.addCallback(lambda sealed: (sealed, len(chunk)))
+        return d
+
+    def _pack(self, chunk, nonce):
+        # in a thread, several at once
+        if self._transform:
+            chunk = self._transform(chunk)
+        return self._pipe._seal(chunk, nonce)
+
+    def _sealed(self, value, slot):
+        slot[0] = True
+        slot[1] = value
+        while self.deferred and self._queue and self._queue[0][0]:
+            (_, value) = self._queue.popleft()
+            if value is None:
+                continue
+            (sealed, length) = value
+            self._pipe._write_sealed(sealed)
+            self._sent += length
+            if self._progress:
+                self._progress(length)
+        if not self.deferred:
+            return
+        if self._eof and not self._queue:
+            self._pipe.unregisterProducer()
+            d, self.deferred = self.deferred, None
+            d.callback(self._sent)
+            return
+        self._fill()
+
+    def _failed(self, f):
+        if not self.deferred:
+            return
+        self._eof = True
+        self._pipe.unregisterProducer()
+        d, self.deferred = self.deferred, None
+        d.errback(f)
+
+    def pauseProducing(self):
+        self._paused = True
+
+    def resumeProducing(self):
+        self._paused = False
+        self._fill()
+
+    def stopProducing(self):
+        if self.deferred:
+            d, self.deferred = self.deferred, None
+            d.errback(Exception("Consumer asked us to stop producing"))
+
 # the TransitSender/Receiver.connect() yields a Connection, on which you can
 # do send_record(), but what should the receive API be? set a callback for
 # inbound records? get a Deferred for the next record? The producer/consumer
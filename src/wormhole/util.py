@@ -1,5 +1,5 @@
 # No unicode_literals
-import json, unicodedata
+import os, json, unicodedata
 from binascii import hexlify, unhexlify
 
 def to_bytes(u):
@@ -24,3 +24,7 @@ def bytes_to_dict(b):
     d = json.loads(b.decode("utf-8"))
     assert isinstance(d, dict)
     return d
+def cache_dir(*names):
+    base = (os.environ.get("XDG_CACHE_HOME") or
+            os.path.join(os.path.expanduser("~"), ".cache"))
+    return os.path.join(base, "magic-wormhole", *names)